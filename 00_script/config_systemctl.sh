@@ -8,6 +8,10 @@ systemctl disable evcloud
 systemctl disable evcloud_vnc
 systemctl disable evcloud-vnc  # 后期删除
 systemctl disable evcloud_openvpn.service
+systemctl disable evcloud_openvpn_auth.service
+systemctl disable evcloud_job_worker.service
+systemctl disable evcloud_host_telemetry.service
+systemctl disable evcloud_novnc_token.service
 
 rm /usr/lib/systemd/system/evcloud.service -f
 rm /usr/lib/systemd/system/evcloud-vnc.service -f
@@ -16,6 +20,10 @@ rm /usr/lib/systemd/system/evcloud_vnc.service -f
 ln -s /home/uwsgi/evcloud/00_script/evcloud.service /usr/lib/systemd/system/evcloud.service
 ln -s /home/uwsgi/evcloud/00_script/evcloud_vnc.service /usr/lib/systemd/system/evcloud_vnc.service
 ln -s /home/uwsgi/evcloud/00_script/evcloud_openvpn.service /usr/lib/systemd/system/evcloud_openvpn.service
+ln -s /home/uwsgi/evcloud/00_script/evcloud_openvpn_auth.service /usr/lib/systemd/system/evcloud_openvpn_auth.service
+ln -s /home/uwsgi/evcloud/00_script/evcloud_job_worker.service /usr/lib/systemd/system/evcloud_job_worker.service
+ln -s /home/uwsgi/evcloud/00_script/evcloud_host_telemetry.service /usr/lib/systemd/system/evcloud_host_telemetry.service
+ln -s /home/uwsgi/evcloud/00_script/evcloud_novnc_token.service /usr/lib/systemd/system/evcloud_novnc_token.service
 
 # 如果 软连接不生效 将 软连接命令注释掉 将下面两行内容打开 重新执行该文件
 #cp /home/uwsgi/evcloud/00_script/evcloud.service /usr/lib/systemd/system/ -f
@@ -25,3 +33,7 @@ systemctl daemon-reload
 systemctl enable evcloud
 systemctl enable evcloud_vnc
 systemctl enable evcloud_openvpn.service
+systemctl enable evcloud_openvpn_auth.service
+systemctl enable evcloud_job_worker.service
+systemctl enable evcloud_host_telemetry.service
+systemctl enable evcloud_novnc_token.service
@@ -6,7 +6,6 @@ import sys
 import time
 import logging
 import traceback
-import MySQLdb
 
 logging.basicConfig(level=logging.WARNING, filename='/var/log/nginx/openvpn-auth.log', filemode='a')  # 'a'为追加模式,'w'为覆盖写
 
@@ -19,17 +18,23 @@ def return_auth_passed():
     sys.exit(0)  # 认证通过
 
 
+# 将项目路径添加到系统搜寻路径当中，查找方式为从当前脚本开始，找到要调用的django项目的路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
-    # 将项目路径添加到系统搜寻路径当中，查找方式为从当前脚本开始，找到要调用的django项目的路径
-    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    # 设置项目的配置文件 不做修改的话就是 settings 文件
-    from django_site.security import DATABASES
+    from vpn.auth_client import request_auth    # 不依赖django
 except Exception as e:
     logging.error(traceback.format_exc())
-    return_auth_failed()
+    request_auth = None
 
 
 def get_vpn(username):
+    """
+    认证服务不可用时，直接查询数据库
+    """
+    import MySQLdb
+    # 设置项目的配置文件 不做修改的话就是 settings 文件
+    from django_site.security import DATABASES
+
     d = DATABASES.get('default')
     conn = MySQLdb.connect(host=d['HOST'],
                            user=d['USER'],
@@ -53,6 +58,13 @@ def auth(username, raw_password):
         True -> auth passed
         False -> not passed
     """
+    # 优先由常驻的认证服务验证(manage.py openvpn_auth_server)
+    if request_auth is not None:
+        try:
+            return request_auth(username=username, password=raw_password)
+        except OSError as exc:
+            logging.error(f'openvpn auth server unavailable, {str(exc)}')
+
     # 验证用户
     try:
         vpn = get_vpn(username=username)
@@ -61,6 +61,13 @@ class VmSerializer(serializers.ModelSerializer):
         else:
             ret['mem'] = ret['mem'] * 1024
             ret['mem_unit'] = 'MB'
+
+        # 虚拟机列表时附带运行状态缓存，无有效缓存时为None
+        vms_status = self.context.get('vms_status')
+        if vms_status is not None:
+            st = vms_status.get(instance.hex_uuid)
+            ret['status'] = {'status_code': st[0], 'status_text': st[1]} if st else None
+
         return ret
 
 
@@ -115,6 +122,44 @@ class VmCreateSerializer(serializers.Serializer):
         return ret
 
 
+class VmBatchCreateSerializer(VmCreateSerializer):
+    """
+    批量创建虚拟机序列化器
+    """
+    count = serializers.IntegerField(label='虚拟机数量', min_value=1, required=True, help_text='要创建的虚拟机数量')
+    ipv4 = None
+
+
+class VmBatchJobItemSerializer(serializers.Serializer):
+    index = serializers.IntegerField()
+    vm_uuid = serializers.CharField()
+    host = serializers.SerializerMethodField(method_name='get_host')
+    ipv4 = serializers.SerializerMethodField(method_name='get_ipv4')
+    status = serializers.CharField()
+    error = serializers.CharField()
+    update_time = serializers.DateTimeField()
+
+    @staticmethod
+    def get_host(obj):
+        return obj.host.ipv4 if obj.host else None
+
+    @staticmethod
+    def get_ipv4(obj):
+        return obj.mac_ip.ipv4 if obj.mac_ip else None
+
+
+class VmBatchJobSerializer(serializers.Serializer):
+    id = serializers.CharField()
+    status = serializers.CharField()
+    total = serializers.IntegerField()
+    image_id = serializers.IntegerField()
+    vcpu = serializers.IntegerField()
+    mem = serializers.IntegerField()
+    remarks = serializers.CharField()
+    create_time = serializers.DateTimeField()
+    complete_time = serializers.DateTimeField()
+
+
 class VmPatchSerializer(serializers.Serializer):
     """
     创建虚拟机序列化器
@@ -592,6 +637,96 @@ class VmChangePasswordSerializer(serializers.Serializer):
     password = serializers.CharField(min_length=6, max_length=20, label='新密码', required=True, help_text='新密码')
 
 
+class VmLiveMigrateSerializer(serializers.Serializer):
+    """
+    动态迁移参数
+    """
+    auto_converge = serializers.BooleanField(
+        label='自动收敛', required=False, default=False, help_text='脏页速率高、迁移难以收敛时逐步限制虚拟机cpu')
+    postcopy = serializers.BooleanField(
+        label='post-copy', required=False, default=False,
+        help_text='内存迭代达到postcopy_after次后切换到post-copy，虚拟机立即在目标宿主机运行，切换后不能取消')
+    postcopy_after = serializers.IntegerField(
+        label='post-copy切换迭代次数', required=False, default=2, min_value=1, max_value=100)
+    compression = serializers.ChoiceField(
+        label='压缩方法', choices=['', 'xbzrle', 'mt'], required=False, default='', allow_blank=True,
+        help_text='xbzrle: 压缩重复传输的脏页；mt: 多线程压缩；空不压缩')
+    parallel = serializers.IntegerField(
+        label='并行连接数', required=False, default=0, min_value=0, max_value=16, help_text='大于1时使用多个连接并行传输')
+    bandwidth = serializers.IntegerField(
+        label='带宽上限', required=False, default=0, min_value=0, help_text='MiB/s，0不限制')
+    max_downtime = serializers.IntegerField(
+        label='最大停机时间', required=False, default=0, min_value=0, max_value=60000, help_text='毫秒，0使用默认值')
+    timeout = serializers.IntegerField(
+        label='超时时间', required=False, default=0, min_value=0, help_text='秒，超时未完成时取消迁移，0不限制')
+
+    def validate(self, attrs):
+        if attrs.get('parallel', 0) > 1:
+            if attrs.get('compression'):
+                raise serializers.ValidationError('并行连接迁移不支持压缩')
+            if attrs.get('postcopy'):
+                raise serializers.ValidationError('并行连接迁移不支持post-copy')
+
+        return attrs
+
+
+class HostEvacuateSerializer(serializers.Serializer):
+    """
+    宿主机疏散参数
+    """
+    src_parallel = serializers.IntegerField(
+        label='同时迁移数', required=False, default=None, allow_null=True, min_value=1, max_value=32,
+        help_text='从此宿主机同时迁出的虚拟机数，默认使用系统配置')
+    dst_parallel = serializers.IntegerField(
+        label='目标宿主机同时迁入数', required=False, default=None, allow_null=True, min_value=1, max_value=16,
+        help_text='每个目标宿主机同时迁入的虚拟机数，默认使用系统配置')
+    options = VmLiveMigrateSerializer(label='动态迁移参数', required=False, default=None, allow_null=True)
+
+
+class HostEvacuationSerializer(serializers.Serializer):
+    id = serializers.CharField()
+    host_id = serializers.IntegerField()
+    host_ipv4 = serializers.CharField()
+    status = serializers.CharField()
+    total = serializers.IntegerField()
+    src_parallel = serializers.IntegerField()
+    dst_parallel = serializers.IntegerField()
+    options = serializers.JSONField()
+    create_time = serializers.DateTimeField()
+    complete_time = serializers.DateTimeField()
+
+
+class HostEvacuationItemSerializer(serializers.Serializer):
+    vm_uuid = serializers.CharField()
+    tag = serializers.CharField()
+    dst_host = serializers.SerializerMethodField()
+    migrate_task = serializers.SerializerMethodField()
+    status = serializers.CharField()
+    error = serializers.CharField()
+    update_time = serializers.DateTimeField()
+
+    @staticmethod
+    def get_dst_host(obj):
+        return obj.dst_host.ipv4 if obj.dst_host else None
+
+    @staticmethod
+    def get_migrate_task(obj):
+        task = obj.migrate_task
+        if task is None:
+            return None
+
+        return {'id': task.id, 'status': task.status, 'progress': task.progress}
+
+
+class VmStatusBatchSerializer(serializers.Serializer):
+    """
+    批量查询虚拟机运行状态
+    """
+    vm_uuids = serializers.ListField(
+        child=serializers.CharField(max_length=36), min_length=1, max_length=500,
+        label='虚拟机uuid列表', required=True, help_text='要查询运行状态的虚拟机uuid列表，最多500个')
+
+
 class FlavorSerializer(serializers.Serializer):
     id = serializers.IntegerField(label='配置样式')
     vcpus = serializers.IntegerField(label='虚拟CPU数')
@@ -640,6 +775,10 @@ class MigrateTaskSerializer(serializers.Serializer):
     status = serializers.CharField(help_text=f'{MigrateTask.Status.choices}')
     content = serializers.CharField()
     tag = serializers.CharField(help_text=f'{MigrateTask.Tag.choices}')
+    options = serializers.JSONField(help_text='动态迁移参数')
+    progress = serializers.JSONField(help_text='迁移进度，剩余数据量、脏页速率、迭代次数、预计停机时间等')
+    progress_time = serializers.DateTimeField(help_text='迁移进度更新时间')
+    abort_requested = serializers.BooleanField(help_text='是否已请求取消迁移')
 
 
 class LogRecordSerializer(serializers.ModelSerializer):
@@ -680,7 +819,9 @@ class MirrorImageSerializer(serializers.ModelSerializer):
             'mirror_image_architecture', 'mirror_image_boot_mode', 'mirror_image_base_image',
             'mirror_image_enable', 'mirror_image_xml_tpl', 'mirror_image_default_user', 'mirror_image_default_password',
             'mirror_image_size', 'user', 'desc', 'import_date', 'import_date_complate',
-            'export_date', 'export_date_complate', 'error_msg', 'create_time', 'update_time',)
+            'export_date', 'export_date_complate', 'error_msg', 'create_time', 'update_time',
+            'transfer_size', 'transfer_bytes', 'transfer_speed', 'transfer_eta', 'dedup_bytes',
+            'transfer_seconds')
 
     def get_operate_status(self, obj):
         return obj.get_operate_display()
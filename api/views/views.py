@@ -19,9 +19,12 @@ from logrecord.manager import user_operation_record
 from users.models import UserProfile
 from users.managers import UserManager
 from utils.permissions import APIIPPermission
-from vms.manager import VmManager, VmError, FlavorManager, VmSharedUserManager
+from vms.manager import VmManager, VmError, FlavorManager, VmSharedUserManager, VmDomainStateManager
 from vms.api import VmAPI
 from vms.migrate import VmMigrateManager
+from vms.models import VmBatchJobItem
+from vms.vm_batch import VmBatchBuilder
+from vms.evacuate import HostEvacuator
 from novnc.manager import NovncTokenManager, NovncError
 from compute.models import Center, Group, Host
 from compute.managers import HostManager, CenterManager, GroupManager, ComputeError
@@ -135,7 +138,11 @@ class VmsViewSet(CustomGenericViewSet):
                 "username": "wanghuang"
               },
               "create_time": "2023-07-27T15:54:25.383633+08:00",
-              "mem_unit": "MB"
+              "mem_unit": "MB",
+              "status": {               # 运行状态缓存，无有效缓存时为null，需通过运行状态接口查询
+                "status_code": 1,
+                "status_text": "running"
+              }
             },
           ]
         }
@@ -259,10 +266,12 @@ class VmsViewSet(CustomGenericViewSet):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = self.get_serializer(page, context={'mem_unit': mem_unit}, many=True)
+            vms_status = VmDomainStateManager.get_vms_status(vms=page)
+            serializer = self.get_serializer(page, context={'mem_unit': mem_unit, 'vms_status': vms_status}, many=True)
             return self.get_paginated_response(serializer.data)
 
-        serializer = self.get_serializer(queryset, context={'mem_unit': mem_unit}, many=True)
+        vms_status = VmDomainStateManager.get_vms_status(vms=queryset)
+        serializer = self.get_serializer(queryset, context={'mem_unit': mem_unit, 'vms_status': vms_status}, many=True)
         data = {'results': serializer.data}
         return Response(data)
 
@@ -948,6 +957,200 @@ class VmsViewSet(CustomGenericViewSet):
         return Response(data={'code': 200, 'code_text': '获取虚拟机状态成功',
                               'status': {'status_code': code, 'status_text': msg}})
 
+    @swagger_auto_schema(
+        operation_summary='批量获取虚拟机当前运行状态',
+        responses={
+            200: """
+            {
+              "code": 200,
+              "code_text": "获取虚拟机状态成功",
+              "status": {
+                "c58ad1b0b3e311eaa4a1c800a0c5e5d1": {
+                  "status_code": 5,
+                  "status_text": "shut off"
+                }
+              }
+            }
+            """
+        }
+    )
+    @action(methods=['post'], url_path='status/batch', detail=False, url_name='vm-status-batch')
+    def vm_status_batch(self, request, *args, **kwargs):
+        """
+        批量获取虚拟机当前运行状态，每个宿主机只查询一次，多个宿主机并行查询
+
+            请求体：
+            {
+              "vm_uuids": ["xxx", "xxx"]
+            }
+
+            >> http code 200, 成功：
+            {
+              "code": 200,
+              "code_text": "获取虚拟机状态成功",
+              "status": {
+                "c58ad1b0b3e311eaa4a1c800a0c5e5d1": {
+                  "status_code": 5,
+                  "status_text": "shut off"
+                }
+              }
+            }
+
+            * 宿主机无法连接时，其上的虚拟机status_code为9(VIR_DOMAIN_HOST_DOWN)；
+            * 不存在或搁置的虚拟机不在结果中；
+            * status_code同获取虚拟机当前运行状态接口
+        """
+        serializer = serializers.VmStatusBatchSerializer(data=request.data)
+        if not serializer.is_valid(raise_exception=False):
+            msg = serializer_error_msg(serializer.errors, 'vm_uuids无效')
+            return self.exception_response(exceptions.BadRequestError(msg=msg))
+
+        vm_uuids = serializer.validated_data['vm_uuids']
+        try:
+            vms_status = VmAPI().get_vms_status(vm_uuids=vm_uuids, user=request.user)
+        except VmError as e:
+            e.msg = f'获取虚拟机状态失败，{str(e)}'
+            return self.exception_response(e)
+
+        return Response(data={'code': 200, 'code_text': '获取虚拟机状态成功', 'status': vms_status})
+
+    @swagger_auto_schema(
+        operation_summary='批量创建虚拟机',
+        manual_parameters=[
+            openapi.Parameter(
+                name='ip-type',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                required=False,
+                description='指定分配公网(public)或私网(private)ip，默认不指定'
+            ),
+        ],
+        responses={
+            202: ''
+        }
+    )
+    @action(methods=['post'], url_path='batch', detail=False, url_name='vm-batch-create')
+    def vm_batch_create(self, request, *args, **kwargs):
+        """
+        资源管理员/超级管理员 批量创建虚拟机
+
+            请求一次性申请所有虚拟机的宿主机资源和ip，成功后立即返回任务ID，后台并行创建虚拟机，
+            通过查询批量创建任务接口获取每个虚拟机的创建进度；创建失败的虚拟机单独回滚，不影响其他虚拟机
+
+            请求体同创建虚拟机，增加"count"(虚拟机数量)，不支持指定ipv4
+
+            http code 202:
+            {
+              "code": 202,
+              "code_text": "批量创建任务已提交",
+              "job_id": "c58ad1b0b3e311eaa4a1c800a0c5e5d1"
+            }
+        """
+        ip_type = request.query_params.get('ip-type', None)
+        if ip_type is None:
+            ip_public = None
+        elif ip_type == 'public':
+            ip_public = True
+        elif ip_type == 'private':
+            ip_public = False
+        else:
+            return self.exception_response(exceptions.BadRequestError(msg='参数ip-type的值无效'))
+
+        mem_unit = str.upper(request.data.get('mem_unit', 'UNKNOWN'))
+        if mem_unit not in ['GB', 'MB', 'UNKNOWN']:
+            return self.exception_response(exceptions.BadRequestError(msg='无效的内存单位, 正确格式为GB、MB或为空'))
+
+        serializer = serializers.VmBatchCreateSerializer(data=request.data, context={'mem_unit': mem_unit})
+        if not serializer.is_valid(raise_exception=False):
+            code_text = serializer_error_msg(errors=serializer.errors, default='参数验证有误')
+            return self.exception_response(exceptions.BadRequestError(msg=code_text))
+
+        validated_data = serializer.validated_data
+        owner_name = validated_data.pop('username', None)
+        if owner_name and not UserManager.is_email_address(owner_name):
+            return self.exception_response(exceptions.BadRequestError(msg='用户名必须是一个有效的邮箱地址格式'))
+
+        flavor_id = validated_data.pop('flavor_id', None)
+        if flavor_id:
+            flavor = FlavorManager().get_flavor_by_id(flavor_id)
+            if not flavor:
+                return self.exception_response(exceptions.NotFoundError(msg='配置样式flavor不存在'))
+
+            validated_data['vcpu'] = flavor.vcpus
+            validated_data['mem'] = flavor.ram  # 单位为GB
+
+        if not check_superuser_and_resource_permissions(request):
+            return self.exception_response(exceptions.AccessDeniedError(msg=_('你没有权限创建虚拟机')))
+
+        owner = UserManager.get_or_create_user(username=owner_name) if owner_name else None
+        try:
+            job = VmBatchBuilder().create_vms(user=request.user, **validated_data, ip_public=ip_public, owner=owner)
+        except VmError as e:
+            return self.exception_response(e)
+
+        user_operation_record.add_log(
+            request=request, operation_content=f'批量创建云主机{job.total}台, 任务ID：{job.id}',
+            remark=validated_data['remarks'], owner=owner)
+        return Response(data={'code': 202, 'code_text': '批量创建任务已提交', 'job_id': job.id},
+                        status=status.HTTP_202_ACCEPTED)
+
+    @swagger_auto_schema(
+        operation_summary='查询批量创建虚拟机任务',
+        responses={
+            200: ''
+        }
+    )
+    @action(methods=['get'], url_path=r'batch/(?P<job_id>[0-9a-f]{32})', detail=False, url_name='vm-batch-job')
+    def vm_batch_job(self, request, *args, **kwargs):
+        """
+        查询批量创建虚拟机任务和每个虚拟机的创建进度，只有任务创建者和超级用户可查询
+
+            http code 200:
+            {
+              "code": 200,
+              "code_text": "查询成功",
+              "job": {
+                "id": "c58ad1b0b3e311eaa4a1c800a0c5e5d1",
+                "status": "running",    # running(正在创建), complete(全部成功), partial(部分失败), failed(全部失败)
+                "total": 2,
+                "image_id": 1,
+                "vcpu": 2,
+                "mem": 4,
+                "remarks": "",
+                "create_time": "2026-10-18T14:46:27.149648+08:00",
+                "complete_time": null
+              },
+              "progress": {"pending": 0, "cloning": 0, "defining": 1, "complete": 1, "failed": 0},
+              "items": [
+                {
+                  "index": 0,
+                  "vm_uuid": "1b2c3e6b3e311eaa4a1c800a0c5e5d1",
+                  "host": "10.0.0.1",
+                  "ipv4": "10.107.50.22",
+                  "status": "complete",     # pending, cloning, defining, complete, failed
+                  "error": "",
+                  "update_time": "2026-10-18T14:46:30.149648+08:00"
+                }
+              ]
+            }
+        """
+        try:
+            job = VmBatchBuilder.get_job(job_id=kwargs.get('job_id'), user=request.user)
+        except exceptions.Error as e:
+            return self.exception_response(e)
+
+        items = list(job.items.select_related('host', 'mac_ip').all())
+        progress = {s.value: 0 for s in VmBatchJobItem.Status}
+        for item in items:
+            progress[item.status] = progress.get(item.status, 0) + 1
+
+        return Response(data={
+            'code': 200, 'code_text': '查询成功',
+            'job': serializers.VmBatchJobSerializer(job).data,
+            'progress': progress,
+            'items': serializers.VmBatchJobItemSerializer(items, many=True).data
+        })
+
     @swagger_auto_schema(
         operation_summary='创建虚拟机vnc',
         request_body=no_body,
@@ -1359,7 +1562,6 @@ class VmsViewSet(CustomGenericViewSet):
 
     @swagger_auto_schema(
         operation_summary='动态迁移虚拟机到指定宿主机',
-        request_body=no_body,
         responses={
             202: """
                 {
@@ -1372,6 +1574,19 @@ class VmsViewSet(CustomGenericViewSet):
     def vm_migrate_live(self, request, *args, **kwargs):
         """
         动态迁移虚拟机到指定宿主机
+
+            迁移参数都是可选的，迁移进度通过查询迁移任务状态接口获取
+
+            {
+                "auto_converge": false,     # 自动收敛
+                "postcopy": false,          # 内存迭代postcopy_after次后切换到post-copy
+                "postcopy_after": 2,
+                "compression": "",          # 压缩方法，xbzrle、mt
+                "parallel": 0,              # 并行连接数
+                "bandwidth": 0,             # 带宽上限MiB/s
+                "max_downtime": 0,          # 最大停机时间，毫秒
+                "timeout": 0                # 超时时间(秒)，超时未完成时取消迁移
+            }
         """
         vm_uuid = kwargs.get(self.lookup_field, '')
         host_id = str_to_int_or_default(kwargs.get('host_id', '0'), default=0)
@@ -1379,9 +1594,15 @@ class VmsViewSet(CustomGenericViewSet):
             exc = exceptions.BadRequestError(msg='无效的host id参数')
             return self.exception_response(exc)
 
+        serializer = self.get_serializer(data=request.data)
+        if not serializer.is_valid(raise_exception=False):
+            msg = serializer_error_msg(serializer.errors, '无效的迁移参数')
+            return self.exception_response(exceptions.BadRequestError(msg=msg))
+
         api = VmAPI()
         try:
-            m_task = api.live_migrate_vm(vm_uuid=vm_uuid, dest_host_id=host_id, request=request)
+            m_task = api.live_migrate_vm(vm_uuid=vm_uuid, dest_host_id=host_id, request=request,
+                                         options=serializer.validated_data)
         except VmError as e:
             e.msg = f'迁移虚拟机失败，{str(e)}'
             return self.exception_response(e)
@@ -1521,6 +1742,89 @@ class VmsViewSet(CustomGenericViewSet):
 
         return Response(data=stats)
 
+    @swagger_auto_schema(
+        operation_summary='查询虚拟机cpu、内存、硬盘io、网络io等监控指标的历史数据',
+        request_body=no_body,
+        manual_parameters=[
+            openapi.Parameter(
+                name='start',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                description='开始时间戳（秒），默认结束时间前1小时'
+            ),
+            openapi.Parameter(
+                name='end',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                description='结束时间戳（秒），默认当前时间'
+            ),
+            openapi.Parameter(
+                name='step',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                description='数据点间隔（秒），按存储的采样间隔取整'
+            ),
+        ],
+        responses={
+            200: """"""
+        }
+    )
+    @action(methods=['get'], url_path='stats/history', detail=True, url_name='vm-stats-history')
+    def vm_stats_history(self, request, *args, **kwargs):
+        """
+        查询虚拟机cpu、内存、硬盘io、网络io等监控指标的历史数据，由采样服务vm_metrics_sampler采集
+
+            >> http code 200:
+            {
+              "start": 1625810653,
+              "end": 1625814253,
+              "step": 10,
+              "timestamps": [1625810650, 1625810660, ...],
+              "metrics": {
+                "cpu_percent": [1.5, null, ...],      # cpu使用率%，null表示没有数据
+                "mem_percent": [14.08, null, ...],    # 内存使用率%
+                "disk_rd_iops": [0.0, null, ...],     # 硬盘读次数/秒
+                "disk_wr_iops": [2.3, null, ...],     # 硬盘写次数/秒
+                "disk_rd_bps": [0.0, null, ...],      # 硬盘读字节/秒
+                "disk_wr_bps": [9420.8, null, ...],   # 硬盘写字节/秒
+                "net_rx_bps": [120.5, null, ...],     # 网络接收字节/秒
+                "net_tx_bps": [80.1, null, ...]       # 网络发送字节/秒
+              }
+            }
+            >> http code 400, 403, 404
+            {
+                "code": xxx,
+                "code_text": "xxx",
+                "err_code": "xxx"
+            }
+            * err_code list:
+                400: InvalidParam, 参数无效或数据点过多;
+                403: VmAccessDenied, 无权访问此虚拟主机;
+                404: VmNotExist，无虚拟主机记录;
+        """
+        vm_uuid = kwargs.get(self.lookup_field, '')
+        params = {}
+        for key in ['start', 'end', 'step']:
+            val = request.query_params.get(key, None)
+            if val is None:
+                continue
+
+            val = str_to_int_or_default(val, default=None)
+            if val is None or val < 0:
+                return self.exception_response(exceptions.InvalidParamError(msg=f'参数{key}必须是正整数'))
+
+            params[key] = val
+
+        try:
+            data = VmAPI().get_vm_stats_history(vm_uuid=vm_uuid, user=request.user, **params)
+        except exceptions.Error as e:
+            return Response(data=e.data(), status=e.status_code)
+
+        return Response(data=data)
+
     @swagger_auto_schema(
         operation_summary='虚拟机系统盘扩容',
         request_body=no_body,
@@ -1956,6 +2260,8 @@ class VmsViewSet(CustomGenericViewSet):
             return serializers.VmPatchSerializer
         elif self.action == 'vm_change_password':
             return serializers.VmChangePasswordSerializer
+        elif self.action == 'vm_migrate_live':
+            return serializers.VmLiveMigrateSerializer
         elif self.action == 'vm_shelve_list':
             return serializers.VmShelveListSerializer
         elif self.action == 'vm_attach_ip_list':
@@ -1970,7 +2276,7 @@ class VmsViewSet(CustomGenericViewSet):
         """
         # 跳过ip白名单限制
         if self.action in [
-            'vm_status', 'vm_vnc', 'vm_operations'
+            'vm_status', 'vm_status_batch', 'vm_vnc', 'vm_operations'
         ]:
             return [
                 permission() for permission in self.permission_classes if permission is not APIIPPermission]
@@ -2198,6 +2504,110 @@ class HostViewSet(CustomGenericViewSet):
         serializer = self.get_serializer(queryset, context={'mem_unit': mem_unit}, many=True)
         return Response(serializer.data)
 
+    @swagger_auto_schema(
+        operation_summary='疏散宿主机',
+        responses={
+            202: """
+                {
+                    "code": 202,
+                    "code_text": "疏散任务已提交",
+                    "evacuation_id": "c58ad1b0b3e311eaa4a1c800a0c5e5d1"
+                }
+                """
+        }
+    )
+    @action(methods=['post'], url_path='evacuate', detail=True, url_name='host-evacuate',
+            permission_classes=[IsAuthenticated, IsSuperUser, APIIPPermission])
+    def host_evacuate(self, request, *args, **kwargs):
+        """
+        超级管理员 疏散宿主机，停用宿主机(不再调度新虚拟机到此宿主机)，后台把宿主机上的虚拟机全部迁移到同宿主机组的其他宿主机
+
+            目标宿主机按宿主机组的调度策略选择，运行中的虚拟机动态迁移，关机的虚拟机静态迁移；
+            通过GET请求此接口查询疏散进度
+
+            请求体都是可选的：
+            {
+                "src_parallel": 4,      # 从此宿主机同时迁出的虚拟机数
+                "dst_parallel": 2,      # 每个目标宿主机同时迁入的虚拟机数
+                "options": {}           # 动态迁移参数，同动态迁移虚拟机接口
+            }
+        """
+        host_id = str_to_int_or_default(kwargs.get(self.lookup_field, '0'), default=0)
+        serializer = serializers.HostEvacuateSerializer(data=request.data)
+        if not serializer.is_valid(raise_exception=False):
+            msg = serializer_error_msg(serializer.errors, '无效的疏散参数')
+            return self.exception_response(exceptions.BadRequestError(msg=msg))
+
+        data = serializer.validated_data
+        try:
+            evacuation = HostEvacuator.evacuate(
+                host_id=host_id, user=request.user, src_parallel=data.get('src_parallel'),
+                dst_parallel=data.get('dst_parallel'), options=data.get('options'))
+        except exceptions.Error as e:
+            return self.exception_response(e)
+
+        user_operation_record.add_log(
+            request=request, operation_content=f'疏散宿主机{evacuation.host_ipv4}，虚拟机{evacuation.total}台, '
+                                               f'任务ID：{evacuation.id}', remark='')
+        return Response(data={'code': 202, 'code_text': '疏散任务已提交', 'evacuation_id': evacuation.id},
+                        status=status.HTTP_202_ACCEPTED)
+
+    @swagger_auto_schema(
+        operation_summary='查询宿主机疏散进度',
+        request_body=no_body,
+        responses={
+            200: ''
+        }
+    )
+    @host_evacuate.mapping.get
+    def host_evacuate_status(self, request, *args, **kwargs):
+        """
+        超级管理员 查询宿主机最近一次疏散任务和每个虚拟机的迁移进度
+
+            http code 200:
+            {
+              "code": 200,
+              "code_text": "查询成功",
+              "evacuation": {
+                "id": "c58ad1b0b3e311eaa4a1c800a0c5e5d1",
+                "host_id": 1,
+                "host_ipv4": "10.0.0.1",
+                "status": "running",    # running(正在疏散), complete(全部迁移成功), partial(部分迁移失败), failed(全部迁移失败)
+                "total": 40,
+                "src_parallel": 4,
+                "dst_parallel": 2,
+                "options": {},
+                "create_time": "2026-10-18T14:46:27.149648+08:00",
+                "complete_time": null
+              },
+              "progress": {"pending": 30, "migrating": 4, "complete": 6, "failed": 0},
+              "items": [
+                {
+                  "vm_uuid": "1b2c3e6b3e311eaa4a1c800a0c5e5d1",
+                  "tag": "live",            # live(动态迁移), static(静态迁移)
+                  "dst_host": "10.0.0.2",
+                  "migrate_task": {"id": 2, "status": "in-process", "progress": {}},   # 动态迁移任务和迁移进度
+                  "status": "migrating",    # pending, migrating, complete, failed
+                  "error": "",
+                  "update_time": "2026-10-18T14:46:30.149648+08:00"
+                }
+              ]
+            }
+        """
+        host_id = str_to_int_or_default(kwargs.get(self.lookup_field, '0'), default=0)
+        try:
+            evacuation = HostEvacuator.get_evacuation(host_id=host_id)
+        except exceptions.Error as e:
+            return self.exception_response(e)
+
+        progress, items = HostEvacuator.get_progress(evacuation)
+        return Response(data={
+            'code': 200, 'code_text': '查询成功',
+            'evacuation': serializers.HostEvacuationSerializer(evacuation).data,
+            'progress': progress,
+            'items': serializers.HostEvacuationItemSerializer(items, many=True).data
+        })
+
     def get_serializer_class(self):
         """
         Return the class to use for the serializer.
@@ -4655,6 +5065,48 @@ class MigrateTaskViewSet(CustomGenericViewSet):
         serializer = self.get_serializer(task)
         return Response(data=serializer.data)
 
+    @swagger_auto_schema(
+        operation_summary='取消虚拟机动态迁移',
+        request_body=no_body,
+        responses={
+            202: """
+                {
+                    'code': 202,
+                    'code_text': '已请求取消迁移'
+                }
+                """
+        }
+    )
+    @action(methods=['post'], url_path='abort', detail=True, url_name='abort')
+    def abort(self, request, *args, **kwargs):
+        """
+        取消虚拟机动态迁移，未开始的迁移不再执行，正在迁移的在下一次采样迁移进度时取消；已切换到post-copy的迁移不能取消
+
+            >> http code 202:
+            {
+                "code": 202,
+                "code_text": "已请求取消迁移"
+            }
+            >> http code 400, 403, 404, 500
+            {
+                "code": xxx,
+                "code_text": "xxx",
+                "err_code": "xxx"
+            }
+        """
+        task_id = kwargs.get(self.lookup_field, '')
+
+        try:
+            task = VmMigrateManager.get_migrate_task(_id=task_id, user=request.user)
+            if task is None:
+                return self.exception_response(exc=exceptions.NotFoundError(msg='迁移任务不存在'))
+
+            VmMigrateManager.abort_live_migrate(m_task=task)
+        except VmError as exc:
+            return self.exception_response(exc)
+
+        return Response(data={'code': 202, 'code_text': '已请求取消迁移'}, status=status.HTTP_202_ACCEPTED)
+
     def get_serializer_class(self):
         if self.action == 'retrieve':
             return serializers.MigrateTaskSerializer
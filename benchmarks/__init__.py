@@ -0,0 +1,9 @@
+"""
+离线性能测试，不需要KVM宿主机和ceph集群
+
+宿主机libvirt连接使用test驱动，rbd使用内存实现(fake_rbd)，在临时测试数据库中测量创建、删除、状态、统计信息、
+静态迁移、列表和调度的ops/sec和p50/p99延迟，需要安装libvirt-python和ceph的python绑定(rados、rbd)
+
+    python -m benchmarks --output result.json
+    python -m benchmarks --output new.json --compare result.json
+"""
@@ -0,0 +1,71 @@
+"""
+python -m benchmarks [--scenarios create,delete] [--iterations 200] [--output result.json] [--compare base.json]
+"""
+import argparse
+import os
+import sys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='evcloud离线性能测试')
+    parser.add_argument('--scenarios', default='', help='逗号分隔的场景名，默认全部')
+    parser.add_argument('--iterations', type=int, default=200, help='每个场景计时的操作次数')
+    parser.add_argument('--warmup', type=int, default=5, help='每个场景预热的操作次数')
+    parser.add_argument('--hosts', type=int, default=4, help='宿主机数')
+    parser.add_argument('--output', default='', help='结果json文件路径')
+    parser.add_argument('--compare', default='', help='与之对比的历史结果json文件路径')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup()
+
+    from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+    from . import fake_rbd
+    from .fixtures import create_env
+    from .runner import run_scenario, make_report, save_report, load_report, format_report, compare_reports
+    from .scenarios import SCENARIOS
+
+    names = [s.strip() for s in args.scenarios.split(',') if s.strip()] or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f'未知的场景{unknown}，可选{list(SCENARIOS)}')
+
+    base_report = None
+    if args.compare:
+        from django.db import connection
+
+        base_report = load_report(args.compare)
+        base_db = base_report.get('meta', {}).get('db_vendor')
+        if base_db != connection.vendor:    # sqlite和mysql的结果差别很大，不对比
+            parser.error(f'对比的结果使用的数据库是{base_db}，当前是{connection.vendor}，请设置EVCLOUD_BENCH_DB_ENGINE等环境变量')
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        fake_rbd.reset()
+        env = create_env(hosts=args.hosts)
+        results = {}
+        for name in names:
+            print(f'running {name} ...', file=sys.stderr)
+            try:
+                results[name] = run_scenario(SCENARIOS[name](env), iterations=args.iterations, warmup=args.warmup)
+            except Exception as e:
+                results[name] = {'error': str(e)}
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+    report = make_report(results, params={'iterations': args.iterations, 'warmup': args.warmup, 'hosts': args.hosts})
+    print(format_report(report))
+    if args.output:
+        save_report(report, args.output)
+
+    if args.compare:
+        print()
+        print(compare_reports(base_report, report))
+
+    return 1 if any('error' in r for r in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
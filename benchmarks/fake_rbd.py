@@ -0,0 +1,261 @@
+"""
+内存中的rbd实现，离线性能测试时通过RBD_MANAGER_CLASS替换RbdManager
+
+只保存镜像和快照的元数据，不保存数据；同一进程内按(ceph_id, pool_name)共享，语义与rbd一致：
+* 克隆只能从已protect的快照，克隆的镜像记录父快照，flatten后解除
+* 有快照的镜像不能删除，有克隆子镜像的快照不能unprotect和删除
+* 不允许时缩小镜像返回None，回滚快照恢复快照时的大小
+"""
+import threading
+from collections import OrderedDict
+
+from ceph.managers import RadosError, ImageExistsError, ImageNotExistsError
+
+
+_lock = threading.RLock()
+_pools = {}     # {(ceph_id, pool_name): {image_name: MemoryImage}}
+
+
+def reset():
+    """
+    清空所有内存中的镜像
+    """
+    with _lock:
+        _pools.clear()
+
+
+class MemoryImage:
+    def __init__(self, key: tuple, size: int, parent: tuple = None):
+        self.key = key                      # (pool_key, image_name)
+        self._size = size
+        self.parent = parent                # (pool_key, image_name, snap_name)
+        self.snaps = OrderedDict()          # {snap_name: {'id': int, 'size': int, 'protected': bool}}
+        self.children = {}                  # {snap_name: set((pool_key, image_name))}
+        self._snap_id = 0
+
+    def size(self):
+        return self._size
+
+    def resize(self, size: int, allow_shrink: bool = True):
+        if size < self._size and not allow_shrink:
+            raise RadosError('resize error: shrink not allowed')
+
+        self._size = size
+
+    def list_snaps(self):
+        return [{'id': s['id'], 'size': s['size'], 'name': name} for name, s in self.snaps.items()]
+
+    def flatten(self):
+        with _lock:
+            if self.parent is None:
+                return
+
+            pool_key, image_name, snap_name = self.parent
+            parent = _pools.get(pool_key, {}).get(image_name)
+            if parent is not None:
+                parent.children.get(snap_name, set()).discard(self.key)
+
+            self.parent = None
+
+    def close(self):
+        pass
+
+
+class MemoryRbdManager:
+    """
+    与RbdManager接口一致的内存实现
+    """
+    def __init__(self, pool_name: str, ceph_id=None, **kwargs):
+        self.pool_name = pool_name
+        self._key = (ceph_id, pool_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        return False
+
+    def shutdown(self):
+        pass
+
+    def _images(self):
+        return _pools.setdefault(self._key, {})
+
+    def _get(self, image_name: str):
+        image = self._images().get(image_name)
+        if image is None:
+            raise ImageNotExistsError('ImageNotExists')
+
+        return image
+
+    def create_snap(self, image_name: str, snap_name: str, protected: bool = False):
+        with _lock:
+            try:
+                image = self._get(image_name)
+            except ImageNotExistsError as e:
+                raise RadosError(f'create_snap error:{str(e)}')
+
+            if snap_name in image.snaps:
+                raise RadosError(f'create_snap error:snap "{snap_name}" exists')
+
+            image._snap_id += 1
+            image.snaps[snap_name] = {'id': image._snap_id, 'size': image.size(), 'protected': protected}
+
+        return True
+
+    def rename_image(self, image_name: str, new_name: str):
+        with _lock:
+            images = self._images()
+            if image_name not in images:
+                raise RadosError('rename_image error: image not found')
+            if new_name in images:
+                raise RadosError('rename_image error: A image with the same name already exists')
+
+            image = images.pop(image_name)
+            images[new_name] = image
+            self._relink(image, new=(self._key, new_name))
+
+        return True
+
+    @staticmethod
+    def _relink(image: MemoryImage, new: tuple):
+        """
+        重命名后更新父快照和子镜像中的引用
+        """
+        old, image.key = image.key, new
+        if image.parent is not None:
+            pool_key, parent_name, snap_name = image.parent
+            parent = _pools.get(pool_key, {}).get(parent_name)
+            if parent is not None:
+                children = parent.children.setdefault(snap_name, set())
+                children.discard(old)
+                children.add(new)
+
+        for snap_name, children in image.children.items():
+            for pool_key, child_name in children:
+                child = _pools.get(pool_key, {}).get(child_name)
+                if child is not None:
+                    child.parent = (new[0], new[1], snap_name)
+
+    def remove_image(self, image_name: str):
+        with _lock:
+            images = self._images()
+            image = images.get(image_name)
+            if image is None:
+                return True
+
+            if image.snaps:
+                raise RadosError('remove_image error:image has snapshots')
+
+            if image.parent is not None:
+                pool_key, parent_name, snap_name = image.parent
+                parent = _pools.get(pool_key, {}).get(parent_name)
+                if parent is not None:
+                    parent.children.get(snap_name, set()).discard(image.key)
+
+            images.pop(image_name)
+
+        return True
+
+    def clone_image(self, snap_image_name: str, snap_name: str, new_image_name: str, data_pool=None):
+        if not snap_name:
+            raise RadosError('clone_image error:invalid param "snap_name"')
+
+        with _lock:
+            images = self._images()
+            parent = images.get(snap_image_name)
+            if parent is None or snap_name not in parent.snaps:
+                raise RadosError('clone_image error:parent image or snap not found')
+            if not parent.snaps[snap_name]['protected']:
+                raise RadosError('clone_image error:parent snap is not protected')
+            if new_image_name in images:
+                raise ImageExistsError('clone_image error,image exists')
+
+            image = MemoryImage(key=(self._key, new_image_name), size=parent.snaps[snap_name]['size'],
+                                parent=(self._key, snap_image_name, snap_name))
+            images[new_image_name] = image
+            parent.children.setdefault(snap_name, set()).add(image.key)
+
+        return True
+
+    def list_images(self):
+        with _lock:
+            return list(self._images().keys())
+
+    def create_image(self, name: str, size: int, data_pool=None):
+        with _lock:
+            images = self._images()
+            if name in images:
+                return None
+
+            images[name] = MemoryImage(key=(self._key, name), size=size)
+
+        return True
+
+    def list_image_snaps(self, name: str):
+        with _lock:
+            try:
+                return self._get(name).list_snaps()
+            except ImageNotExistsError as e:
+                raise RadosError(f'list_image_snaps error:{str(e)}')
+
+    def remove_snap(self, image_name: str, snap: str):
+        with _lock:
+            image = self._images().get(image_name)
+            if image is None or snap not in image.snaps:
+                return True
+
+            if image.children.get(snap):
+                raise RadosError('remove_snap error:snap has children')
+
+            image.snaps.pop(snap)
+            image.children.pop(snap, None)
+
+        return True
+
+    def image_rollback_to_snap(self, image_name: str, snap: str):
+        with _lock:
+            try:
+                image = self._get(image_name)
+            except ImageNotExistsError as e:
+                raise RadosError(f'rollback_to_snap error:{str(e)}')
+
+            if snap not in image.snaps:
+                raise RadosError('rollback_to_snap error:snap not found')
+
+            image.resize(image.snaps[snap]['size'])
+
+        return True
+
+    def image_exists(self, image_name: str):
+        with _lock:
+            return image_name in self._images()
+
+    def get_rbd_image(self, image_name: str):
+        with _lock:
+            return self._get(image_name)
+
+    @staticmethod
+    def close_rbd_image(image):
+        pass
+
+    def resize_rbd_image(self, image_name: str, size: int, allow_shrink: bool = False):
+        image = self.get_rbd_image(image_name=image_name)
+        with _lock:
+            si = image.size()
+            if size == si:
+                return True
+
+            if size < si and not allow_shrink:
+                return None
+
+            image.resize(size=size, allow_shrink=allow_shrink)
+
+        return True
+
+    def get_rbd_image_size(self, image_name: str):
+        return self.get_rbd_image(image_name=image_name).size()
+
+    def flatten_image(self, image_name):
+        self.get_rbd_image(image_name=image_name).flatten()
+        return True
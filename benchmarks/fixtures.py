@@ -0,0 +1,102 @@
+"""
+性能测试的基础数据：数据中心、ceph、宿主机组、宿主机、子网和ip、系统镜像(内存rbd中创建基础镜像和快照)
+"""
+from django.contrib.auth import get_user_model
+
+from ceph.models import CephCluster, CephPool
+from compute.models import Center, Group, Host
+from image.models import Image, VmXmlTemplate
+from network.managers import VlanManager
+from network.models import Vlan, MacIP
+
+
+User = get_user_model()
+
+# test驱动只支持type='test'的虚拟机
+BENCH_VM_XML_TPL = """<domain type='test'>
+  <name>{name}</name>
+  <uuid>{uuid}</uuid>
+  <memory unit='GiB'>{mem}</memory>
+  <currentMemory unit='GiB'>{mem}</currentMemory>
+  <vcpu placement='static'>{vcpu}</vcpu>
+  <os>
+    <type arch='x86_64'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <devices>
+    <disk type='network' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <auth username='{ceph_username}'>
+        <secret type='ceph' uuid='{ceph_uuid}'/>
+      </auth>
+      <source protocol='rbd' name='{ceph_pool}/{diskname}'>
+        {ceph_hosts_xml}
+      </source>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <interface type='bridge'>
+      <mac address='{mac}'/>
+      <source bridge='{bridge}'/>
+      <model type='virtio'/>
+    </interface>
+  </devices>
+</domain>"""
+
+
+class BenchEnv:
+    """
+    性能测试环境
+    """
+    def __init__(self, user, center, group, hosts: list, vlan, image):
+        self.user = user
+        self.center = center
+        self.group = group
+        self.hosts = hosts
+        self.vlan = vlan
+        self.image = image
+
+
+def create_env(hosts: int = 4, host_vcpu: int = 1024, host_mem: int = 4096, vm_limit: int = 10000):
+    """
+    创建性能测试的基础数据
+
+    :param hosts: 宿主机数，最多250
+    :param host_vcpu: 每个宿主机vcpu数
+    :param host_mem: 每个宿主机内存大小(GB)
+    :param vm_limit: 每个宿主机虚拟机数量上限
+    :return:
+        BenchEnv()
+    """
+    user = User.objects.create(username='bench', is_active=True)
+    center = Center(name='bench', location='bench', desc='bench')
+    center.save()
+    ceph = CephCluster(name='bench', center=center, has_auth=False, config='[global]', keyring='[client.admin]',
+                       hosts_xml="<host name='127.0.0.1' port='6789'/>", username='admin')
+    ceph.save()
+    ceph_pool = CephPool(pool_name='bench', ceph=ceph)
+    ceph_pool.save(force_insert=True)
+
+    group = Group(center=center, name='bench', enable=True, desc='bench')
+    group.save(force_insert=True)
+    group.users.add(user)
+    host_list = [
+        Host(group=group, ipv4=f'198.18.0.{i + 1}', real_cpu=host_vcpu, real_mem=host_mem, vcpu_total=host_vcpu,
+             mem_total=host_mem, vm_limit=vm_limit)
+        for i in range(hosts)
+    ]
+    for host in host_list:
+        host.save(force_insert=True)
+
+    # /20子网，4000多个ip
+    vlan = Vlan(br='br-bench', name='bench', group=group, subnet_ip='198.19.0.0', net_mask='255.255.240.0',
+                gateway='198.19.0.1', dns_server='', dhcp_config='')
+    vlan.save(force_insert=True)
+    ip_macs = VlanManager.generate_subips(vlan=vlan, from_ip='198.19.0.2', to_ip='198.19.15.254')
+    MacIP.objects.bulk_create([MacIP(vlan=vlan, ipv4=ip, mac=mac) for ip, mac in ip_macs], batch_size=500)
+
+    xml_tpl = VmXmlTemplate(name='bench', xml=BENCH_VM_XML_TPL)
+    xml_tpl.save(force_insert=True)
+    image = Image(name='bench', sys_type=Image.SYS_TYPE_LINUX, version='bench', ceph_pool=ceph_pool,
+                  tag=Image.TAG_BASE, user=user, xml_tpl=xml_tpl, size=10, base_image='bench-base', enable=True)
+    image.save()    # 内存rbd中创建基础镜像和protected快照
+    return BenchEnv(user=user, center=center, group=group, hosts=host_list, vlan=vlan, image=image)
@@ -0,0 +1,185 @@
+"""
+运行性能测试场景，统计ops/sec和延迟分位数，输出可跨提交对比的json结果
+"""
+import datetime
+import json
+import platform
+import subprocess
+import time
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.db import connection
+
+from .scenarios import Scenario
+
+
+# 结果json格式版本，字段变化时加1，不同版本的结果不对比
+RESULT_SCHEMA = 1
+
+
+def percentile(sorted_values: list, p: float):
+    n = len(sorted_values)
+    if n == 0:
+        return 0.0
+
+    return sorted_values[min(int(n * p), n - 1)]
+
+
+def run_scenario(scenario: Scenario, iterations: int, warmup: int = 0):
+    """
+    运行一个场景，setup和teardown不计时，预热的操作不计入统计
+
+    :param scenario: 场景对象
+    :param iterations: 计时的操作次数
+    :param warmup: 预热的操作次数
+    :return:
+        dict
+    """
+    latencies = []
+    errors = 0
+    last_error = ''
+    scenario.setup(iterations + warmup)
+    try:
+        for i in range(warmup):
+            scenario.run_once(i)
+
+        begin = time.perf_counter()
+        for i in range(warmup, warmup + iterations):
+            t = time.perf_counter()
+            try:
+                scenario.run_once(i)
+            except Exception as e:
+                errors += 1
+                last_error = str(e)
+                continue
+
+            latencies.append(time.perf_counter() - t)
+
+        elapsed = time.perf_counter() - begin
+    finally:
+        scenario.teardown()
+
+    latencies.sort()
+    ok = len(latencies)
+    return {
+        'iterations': iterations,
+        'ok': ok,
+        'errors': errors,
+        'last_error': last_error,
+        'elapsed_s': round(elapsed, 6),
+        'ops_per_sec': round(ok / elapsed, 3) if elapsed > 0 else 0.0,
+        'mean_ms': round(sum(latencies) / ok * 1000, 3) if ok else 0.0,
+        'min_ms': round(latencies[0] * 1000, 3) if ok else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3) if ok else 0.0,
+    }
+
+
+def _git(*args):
+    try:
+        r = subprocess.run(['git', *args], cwd=Path(__file__).resolve().parent, capture_output=True, text=True,
+                           timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+    return r.stdout.strip() if r.returncode == 0 else ''
+
+
+def get_meta():
+    """
+    运行环境信息，对比结果时确认是否同一环境
+    """
+    try:
+        import libvirt
+        libvirt_version = libvirt.getVersion()
+    except Exception:
+        libvirt_version = None
+
+    return {
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'time': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'libvirt': libvirt_version,
+        'db_vendor': connection.vendor,
+        'libvirt_uri': getattr(settings, 'LIBVIRT_CONNECT_URI', ''),
+        'rbd_manager': getattr(settings, 'RBD_MANAGER_CLASS', ''),
+    }
+
+
+def make_report(results: dict, params: dict):
+    return {
+        'schema': RESULT_SCHEMA,
+        'meta': get_meta(),
+        'params': params,
+        'results': results,
+    }
+
+
+def load_report(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_report(report: dict, path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def _change(old, new):
+    if not old:
+        return '-'
+
+    return f'{(new - old) / old * 100:+.1f}%'
+
+
+def format_report(report: dict):
+    lines = [f"{'scenario':<10} {'ops/sec':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>7}"]
+    for name, r in report['results'].items():
+        if 'error' in r:
+            lines.append(f"{name:<10} failed: {r['error']}")
+            continue
+
+        lines.append(f"{name:<10} {r['ops_per_sec']:>10.1f} {r['p50_ms']:>10.3f} {r['p99_ms']:>10.3f} {r['errors']:>7}")
+
+    return '\n'.join(lines)
+
+
+def compare_reports(base: dict, current: dict):
+    """
+    对比两次结果，ops/sec变大、p99变小为改善；结果格式版本或数据库不同时不对比
+
+    :return:
+        str
+    """
+    if base.get('schema') != current.get('schema'):
+        return f"结果格式版本不同(schema {base.get('schema')} != {current.get('schema')})，不能对比"
+
+    base_db, current_db = base['meta'].get('db_vendor'), current['meta'].get('db_vendor')
+    if base_db != current_db:
+        return f"数据库不同({base_db} != {current_db})，不能对比"
+
+    lines = [f"base {base['meta'].get('commit', '')[:12]} -> current {current['meta'].get('commit', '')[:12]}"]
+    if base.get('params') != current.get('params'):
+        lines.append(f"警告：测试参数不同, base={base.get('params')}, current={current.get('params')}")
+
+    lines.append(f"{'scenario':<10} {'ops/sec base':>13} {'current':>10} {'change':>8} "
+                 f"{'p99 base':>10} {'current':>10} {'change':>8}")
+    for name, r in current['results'].items():
+        b = base['results'].get(name)
+        if not b or 'error' in b or 'error' in r:
+            lines.append(f'{name:<10} 无可对比结果')
+            continue
+
+        lines.append(
+            f"{name:<10} {b['ops_per_sec']:>13.1f} {r['ops_per_sec']:>10.1f} "
+            f"{_change(b['ops_per_sec'], r['ops_per_sec']):>8} "
+            f"{b['p99_ms']:>10.3f} {r['p99_ms']:>10.3f} {_change(b['p99_ms'], r['p99_ms']):>8}"
+        )
+
+    return '\n'.join(lines)
@@ -0,0 +1,193 @@
+"""
+性能测试场景
+
+每个场景setup()准备count次操作需要的数据，run_once(i)是被计时的第i次操作，teardown()清理；
+操作通过与接口相同的VmBuilder、VmInstance、HostMacIPScheduler等完成，宿主机连接为libvirt test驱动，rbd为内存实现
+"""
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from compute.managers import HostManager
+from network.managers import MacIPManager
+from utils.ev_libvirt.virt import VmDomain
+from vms.models import Vm
+from vms.scheduler import HostMacIPScheduler
+from vms.vm_builder import VmBuilder
+from vms.vminstance import VmInstance
+from .fixtures import BenchEnv
+
+
+class Scenario:
+    name = ''
+
+    def __init__(self, env: BenchEnv):
+        self.env = env
+
+    def setup(self, count: int):
+        pass
+
+    def run_once(self, i: int):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+    def create_vm(self, host=None):
+        """
+        :param host: 指定宿主机，默认由调度选择
+        """
+        kwargs = {'host_id': host.id} if host is not None else {'group_id': self.env.group.id}
+        return VmBuilder().create_vm(image_id=self.env.image.id, vcpu=1, mem=1, vlan_id=0, user=self.env.user,
+                                     remarks='bench', **kwargs)
+
+    @staticmethod
+    def delete_vms(vms: list):
+        for vm in vms:
+            vm = Vm.objects.select_related('host', 'mac_ip').filter(uuid=vm.uuid).first()
+            if vm is not None:
+                VmInstance(vm).delete(force=True)
+
+
+class CreateScenario(Scenario):
+    """
+    创建虚拟机：调度宿主机和ip、克隆系统盘、保存元数据、define
+    """
+    name = 'create'
+
+    def __init__(self, env: BenchEnv):
+        super().__init__(env)
+        self.vms = []
+
+    def run_once(self, i: int):
+        self.vms.append(self.create_vm())
+
+    def teardown(self):
+        self.delete_vms(self.vms)
+
+
+class DeleteScenario(Scenario):
+    """
+    删除虚拟机：归档、undefine、释放资源、重命名系统盘
+    """
+    name = 'delete'
+
+    def __init__(self, env: BenchEnv):
+        super().__init__(env)
+        self.vms = []
+
+    def setup(self, count: int):
+        self.vms = [self.create_vm() for _ in range(count)]
+
+    def run_once(self, i: int):
+        VmInstance(self.vms[i]).delete()
+
+    def teardown(self):
+        self.delete_vms(self.vms)
+
+
+class _PoolScenario(Scenario):
+    """
+    在固定数量的虚拟机上循环操作
+    """
+    pool_size = 50
+    start_ratio = 0.0   # 开机的虚拟机占比
+
+    def __init__(self, env: BenchEnv):
+        super().__init__(env)
+        self.vms = []
+
+    def setup(self, count: int):
+        self.vms = [self.create_vm() for _ in range(min(count, self.pool_size))]
+        for vm in self.vms[:int(len(self.vms) * self.start_ratio)]:
+            VmDomain(host_ip=vm.host.ipv4, vm_uuid=vm.hex_uuid).start()
+
+    def teardown(self):
+        self.delete_vms(self.vms)
+
+
+class StatusScenario(_PoolScenario):
+    """
+    查询虚拟机运行状态(libvirt)
+    """
+    name = 'status'
+    start_ratio = 0.5
+
+    def run_once(self, i: int):
+        vm = self.vms[i % len(self.vms)]
+        VmInstance(vm).status()
+
+
+class StatsScenario(_PoolScenario):
+    """
+    查询虚拟机cpu、内存、硬盘io、网络io统计信息
+    """
+    name = 'stats'
+    start_ratio = 1.0
+
+    def run_once(self, i: int):
+        vm = self.vms[i % len(self.vms)]
+        VmInstance(vm).get_stats()
+
+
+class MigrateScenario(_PoolScenario):
+    """
+    静态迁移关机的虚拟机到同组的下一个宿主机
+    """
+    name = 'migrate'
+
+    def setup(self, count: int):
+        if len(self.env.hosts) < 2:
+            raise Exception('迁移测试至少需要2个宿主机')
+
+        self.vms = [self.create_vm(host=self.env.hosts[0]) for _ in range(min(count, self.pool_size))]
+
+    def run_once(self, i: int):
+        idx = i % len(self.vms)
+        vm = self.vms[idx]
+        host_ids = [h.id for h in self.env.hosts]
+        dst_id = host_ids[(host_ids.index(vm.host_id) + 1) % len(host_ids)]
+        self.vms[idx] = VmInstance(vm).migrate(host_id=dst_id)
+
+
+class ListScenario(_PoolScenario):
+    """
+    虚拟机列表接口(GET api/v3/vms/)，一页100个
+    """
+    name = 'list'
+    pool_size = 100
+
+    def setup(self, count: int):
+        super().setup(self.pool_size)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.env.user)
+        self.url = reverse('api:vms-list')
+
+    def run_once(self, i: int):
+        response = self.client.get(self.url, data={'limit': 100})
+        if response.status_code != 200:
+            raise Exception(f'list vms error, status={response.status_code}')
+
+
+class ScheduleScenario(Scenario):
+    """
+    调度：按宿主机组调度策略选择宿主机、申请资源和ip
+    """
+    name = 'schedule'
+
+    def __init__(self, env: BenchEnv):
+        super().__init__(env)
+        self.claimed = []
+
+    def run_once(self, i: int):
+        host, macip = HostMacIPScheduler().schedule(vcpu=1, mem=1, groups=[self.env.group], user=self.env.user)
+        self.claimed.append((host, macip))
+
+    def teardown(self):
+        for host, macip in self.claimed:
+            HostManager().free_to_host(host_id=host.id, vcpu=1, mem=1)
+            MacIPManager().free_used_ip(ip_id=macip.id)
+
+
+SCENARIOS = {s.name: s for s in [
+    CreateScenario, DeleteScenario, StatusScenario, StatsScenario, MigrateScenario, ListScenario, ScheduleScenario
+]}
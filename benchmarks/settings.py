@@ -0,0 +1,36 @@
+"""
+离线性能测试配置，不需要KVM宿主机和ceph集群
+
+* 宿主机libvirt连接使用test驱动，每个宿主机一个独立的test驱动实例(testnode.xml)；
+  设置环境变量EVCLOUD_BENCH_LIBVIRT_URI=test:///default时所有宿主机共用一个实例，静态迁移测试无意义
+* rbd使用内存实现benchmarks.fake_rbd.MemoryRbdManager
+* 数据库默认sqlite，测试时创建测试库，结束后删除；设置环境变量EVCLOUD_BENCH_DB_ENGINE等使用其他数据库，
+  生产环境使用mysql，sqlite的结果只用于sqlite结果之间对比，结果json中记录数据库(meta.db_vendor)，不同数据库的结果不对比
+
+DJANGO_SETTINGS_MODULE=benchmarks.settings python -m benchmarks
+"""
+import os
+import tempfile
+from pathlib import Path
+
+from django_site.settings import *
+
+
+BENCH_DIR = Path(__file__).resolve().parent
+
+LIBVIRT_CONNECT_URI = os.environ.get('EVCLOUD_BENCH_LIBVIRT_URI', f'test://{BENCH_DIR / "testnode.xml"}')
+RBD_MANAGER_CLASS = 'benchmarks.fake_rbd.MemoryRbdManager'
+
+DATABASES = {
+    'default': {
+        'ENGINE': os.environ.get('EVCLOUD_BENCH_DB_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('EVCLOUD_BENCH_DB_NAME', os.path.join(tempfile.gettempdir(), 'evcloud_bench.sqlite3')),
+        'HOST': os.environ.get('EVCLOUD_BENCH_DB_HOST', ''),
+        'PORT': os.environ.get('EVCLOUD_BENCH_DB_PORT', ''),
+        'USER': os.environ.get('EVCLOUD_BENCH_DB_USER', ''),
+        'PASSWORD': os.environ.get('EVCLOUD_BENCH_DB_PASSWORD', ''),
+    }
+}
+
+# 运行中生成的ceph配置文件等写到临时目录
+BASE_DIR = Path(tempfile.gettempdir()) / 'evcloud_bench'
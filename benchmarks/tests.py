@@ -0,0 +1,72 @@
+from django.test import SimpleTestCase
+
+from ceph.managers import RadosError, ImageExistsError, ImageNotExistsError
+from . import fake_rbd
+from .fake_rbd import MemoryRbdManager
+from .runner import percentile, compare_reports, RESULT_SCHEMA
+
+
+class MemoryRbdTests(SimpleTestCase):
+    def setUp(self):
+        fake_rbd.reset()
+        self.rbd = MemoryRbdManager(pool_name='pool', ceph_id=1)
+
+    def test_clone_snap_resize(self):
+        rbd = self.rbd
+        self.assertTrue(rbd.create_image(name='base', size=10))
+        self.assertIsNone(rbd.create_image(name='base', size=10))
+        rbd.create_snap(image_name='base', snap_name='s1')
+        with self.assertRaises(RadosError):     # 未protect的快照不能克隆
+            rbd.clone_image(snap_image_name='base', snap_name='s1', new_image_name='vm1')
+
+        rbd.create_snap(image_name='base', snap_name='s2', protected=True)
+        self.assertTrue(rbd.clone_image(snap_image_name='base', snap_name='s2', new_image_name='vm1'))
+        with self.assertRaises(ImageExistsError):
+            rbd.clone_image(snap_image_name='base', snap_name='s2', new_image_name='vm1')
+
+        self.assertEqual(rbd.get_rbd_image_size('vm1'), 10)
+        self.assertTrue(rbd.resize_rbd_image('vm1', size=20))
+        self.assertIsNone(rbd.resize_rbd_image('vm1', size=5))
+        self.assertEqual(rbd.get_rbd_image_size('vm1'), 20)
+        self.assertEqual([s['name'] for s in rbd.list_image_snaps('base')], ['s1', 's2'])
+
+        # 有子镜像的快照不能删除，有快照的镜像不能删除
+        with self.assertRaises(RadosError):
+            rbd.remove_snap(image_name='base', snap='s2')
+        with self.assertRaises(RadosError):
+            rbd.remove_image('base')
+
+        # 重命名后父子关系保持，flatten后可删除快照
+        rbd.rename_image('vm1', 'vm1-deleted')
+        self.assertFalse(rbd.image_exists('vm1'))
+        with self.assertRaises(RadosError):
+            rbd.remove_snap(image_name='base', snap='s2')
+
+        rbd.flatten_image('vm1-deleted')
+        self.assertTrue(rbd.remove_snap(image_name='base', snap='s2'))
+        rbd.create_snap(image_name='vm1-deleted', snap_name='s')
+        rbd.resize_rbd_image('vm1-deleted', size=30)
+        rbd.image_rollback_to_snap('vm1-deleted', snap='s')
+        self.assertEqual(rbd.get_rbd_image_size('vm1-deleted'), 20)
+        with self.assertRaises(ImageNotExistsError):
+            rbd.get_rbd_image('vm1')
+
+        # 不同pool互不影响
+        self.assertEqual(MemoryRbdManager(pool_name='other', ceph_id=1).list_images(), [])
+        self.assertEqual(sorted(MemoryRbdManager(pool_name='pool', ceph_id=1).list_images()), ['base', 'vm1-deleted'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 100)
+        self.assertEqual(percentile([], 0.99), 0.0)
+
+    def test_compare_reports(self):
+        result = {'ops_per_sec': 100.0, 'p99_ms': 2.0}
+        base = {'schema': RESULT_SCHEMA, 'meta': {'db_vendor': 'mysql'}, 'params': {}, 'results': {'create': result}}
+        current = {'schema': RESULT_SCHEMA, 'meta': {'db_vendor': 'mysql'}, 'params': {},
+                   'results': {'create': dict(result, ops_per_sec=110.0)}}
+        self.assertIn('+10.0%', compare_reports(base, current))
+
+        current['meta']['db_vendor'] = 'sqlite'
+        self.assertIn('数据库不同', compare_reports(base, current))
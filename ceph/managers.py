@@ -1,4 +1,10 @@
+import contextlib
 import os
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
 
 import rados    # yum install python36-rbd.x86_64 python-rados.x86_64
 import rbd
@@ -21,6 +27,251 @@ class ImageNotExistsError(RadosError):
     pass
 
 
+RADOS_HEALTH_CHECK_INTERVAL = getattr(settings, 'RADOS_HEALTH_CHECK_INTERVAL', 30)
+RADOS_CONNECT_TIMEOUT = str(getattr(settings, 'RADOS_CONNECT_TIMEOUT', 10))
+# rbd管理接口类的导入路径，默认RbdManager；离线性能测试时替换为内存实现，如'benchmarks.fake_rbd.MemoryRbdManager'
+RBD_MANAGER_CLASS = getattr(settings, 'RBD_MANAGER_CLASS', '')
+# 说明集群连接可能已失效的错误，不同版本的rados、rbd模块中不一定都有
+CONNECTION_ERRORS = tuple(
+    getattr(m, name) for m, name in (
+        (rados, 'IOError'), (rados, 'TimedOut'), (rados, 'ConnectionShutdown'), (rados, 'RadosStateError'),
+        (rbd, 'Timeout'), (rbd, 'ConnectionShutdown')
+    ) if hasattr(m, name)
+)
+
+
+class RadosClusterPool:
+    """
+    进程内已连接ceph集群的Rados对象池，每个ceph集群一个Rados对象，并缓存各pool的IoCtx
+
+    * 以ceph集群配置id(或配置文件路径)为键，配置文件或keyring文件修改时间变化时重建连接
+    * 复用前检查连接状态，超过RADOS_HEALTH_CHECK_INTERVAL秒未检查时向集群查询一次，失效时重建连接
+    * uwsgi fork出的子进程不复用父进程的连接
+    """
+    def __init__(self, health_check_interval: int = RADOS_HEALTH_CHECK_INTERVAL):
+        self.health_check_interval = health_check_interval
+        self._orphans = []  # fork前父进程的Rados对象，子进程中不可用，也不能shutdown，保留引用防止被回收时关闭连接
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._clusters = {}     # {ceph_key: (version, rados.Rados, last_check_time)}，检查时间为连接或最近一次向集群查询的时间，复用不更新
+        self._ioctxs = {}       # {(ceph_key, pool_name): rados.Ioctx}
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+
+    def _after_fork(self):
+        """
+        进程fork后，父进程的连接在子进程不可用，丢弃并重置（锁也可能在fork时被其他线程持有）
+        """
+        if self._pid == os.getpid():
+            return
+
+        self._orphans.extend(c[1] for c in self._clusters.values())
+        self._orphans.extend(self._ioctxs.values())
+        self._reset()
+
+    @staticmethod
+    def _file_mtime(path: str):
+        try:
+            return os.path.getmtime(path) if path else None
+        except OSError:
+            return None
+
+    def _get_key_lock(self, ceph_key):
+        with self._lock:
+            self._check_fork()
+            lock = self._key_locks.get(ceph_key)
+            if lock is None:
+                lock = threading.Lock()
+                self._key_locks[ceph_key] = lock
+
+            return lock
+
+    @staticmethod
+    def _shutdown(cluster):
+        try:
+            cluster.shutdown()
+        except Exception:
+            pass
+
+    @staticmethod
+    def is_healthy(cluster, probe: bool = False):
+        """
+        连接是否有效
+
+        :param probe: True时向集群查询一次确认
+        """
+        try:
+            if cluster.state != 'connected':
+                return False
+
+            if probe:
+                cluster.get_cluster_stats()
+            return True
+        except rados.Error:
+            return False
+
+    def _pop_cluster(self, ceph_key):
+        """
+        移除集群的连接和所有IoCtx，需要持有self._lock
+        """
+        item = self._clusters.pop(ceph_key, None)
+        for k in [k for k in self._ioctxs if k[0] == ceph_key]:
+            self._ioctxs.pop(k, None)
+
+        return item
+
+    def invalidate(self, ceph_key, cluster=None):
+        """
+        连接已失效，从池中移除集群的连接
+
+        移除的连接可能还被其他线程使用，不主动shutdown，最后一个引用释放时自动关闭
+
+        :param ceph_key: ceph集群键
+        :param cluster: 只有池中的连接是此连接时才移除；None时不检查
+        """
+        with self._lock:
+            self._check_fork()
+            item = self._clusters.get(ceph_key)
+            if item is None or (cluster is not None and item[1] is not cluster):
+                return
+
+            self._pop_cluster(ceph_key)
+
+    def get(self, ceph_key, conf_file: str, keyring_file: str):
+        """
+        获取已连接到ceph集群的Rados对象，池中没有有效的连接时建立新连接
+
+        :param ceph_key: ceph集群键，一般为ceph集群配置id
+        :param conf_file: ceph配置文件路径
+        :param keyring_file: keyring文件路径
+        :return:
+            rados.Rados()
+        :raise: RadosError
+        """
+        version = (conf_file, self._file_mtime(conf_file), keyring_file, self._file_mtime(keyring_file))
+        with self._get_key_lock(ceph_key):
+            with self._lock:
+                item = self._clusters.get(ceph_key)
+
+            if item is not None:
+                old_version, cluster, last_check_time = item
+                now = time.monotonic()
+                probe = now - last_check_time >= self.health_check_interval
+                if old_version == version and self.is_healthy(cluster, probe=probe):
+                    with self._lock:
+                        self.hits += 1
+                        item = self._clusters.get(ceph_key)
+                        if probe and item is not None and item[1] is cluster:
+                            self._clusters[ceph_key] = (version, cluster, now)
+
+                    return cluster
+
+                with self._lock:    # 配置文件已修改或连接失效，旧连接最后一个引用释放时自动关闭
+                    self._pop_cluster(ceph_key)
+                    self.reconnects += 1
+
+            with self._lock:
+                self.misses += 1
+
+            cluster = self.connect(conf_file=conf_file, keyring_file=keyring_file)
+            with self._lock:
+                self._clusters[ceph_key] = (version, cluster, time.monotonic())
+
+        return cluster
+
+    def get_ioctx(self, ceph_key, cluster, pool_name: str):
+        """
+        获取集群pool的IoCtx，同一集群连接的同一pool共用一个IoCtx，不要close
+
+        :param ceph_key: ceph集群键
+        :param cluster: get()返回的Rados对象
+        :param pool_name: pool名称
+        :return:
+            rados.Ioctx()
+        :raise: RadosError
+        """
+        key = (ceph_key, pool_name)
+        with self._lock:
+            self._check_fork()
+            ioctx = self._ioctxs.get(key)
+            item = self._clusters.get(ceph_key)
+            pooled = item is not None and item[1] is cluster
+
+        if ioctx is not None and pooled:
+            return ioctx
+
+        try:
+            ioctx = cluster.open_ioctx(pool_name)
+        except rados.Error as e:
+            raise RadosError(f'open ioctx error, {str(e)}')
+
+        if pooled:
+            with self._lock:
+                ioctx = self._ioctxs.setdefault(key, ioctx)
+
+        return ioctx
+
+    @staticmethod
+    def connect(conf_file: str, keyring_file: str):
+        """
+        建立到ceph集群的连接
+
+        :return:
+            rados.Rados()
+        :raise: RadosError
+        """
+        try:
+            conf = {'client_mount_timeout': RADOS_CONNECT_TIMEOUT, 'rados_mon_op_timeout': RADOS_CONNECT_TIMEOUT,
+                    'rados_osd_op_timeout': RADOS_CONNECT_TIMEOUT}
+            if keyring_file:
+                conf['keyring'] = keyring_file
+            cluster = rados.Rados(conffile=conf_file, conf=conf)
+            cluster.connect()
+            return cluster
+        except rados.Error as e:
+            msg = e.args[0] if e.args else f'error connecting to the cluster, {str(e)}'
+            raise RadosError(msg)
+
+    def close_all(self):
+        with self._lock:
+            self._check_fork()
+            clusters = [c[1] for c in self._clusters.values()]
+            self._clusters.clear()
+            self._ioctxs.clear()
+
+        for cluster in clusters:
+            self._shutdown(cluster)
+
+    def stats(self):
+        """
+        连接池统计信息
+        """
+        with self._lock:
+            self._check_fork()
+            return {
+                'pid': self._pid,
+                'size': len(self._clusters),
+                'ioctxs': len(self._ioctxs),
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects
+            }
+
+
+rados_pool = RadosClusterPool()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=rados_pool._after_fork)
+
+
 def get_rbd_manager(ceph: CephCluster, pool_name: str):
     """
     获取一个rbd管理接口对象
@@ -33,6 +284,9 @@ def get_rbd_manager(ceph: CephCluster, pool_name: str):
 
     :raise RadosError
     """
+    if RBD_MANAGER_CLASS:
+        return import_string(RBD_MANAGER_CLASS)(pool_name=pool_name, ceph_id=ceph.id)
+
     conf_file = ceph.config_file
     keyring_file = ceph.keyring_file
     # 当水平部署多个服务时，在后台添加ceph配置时，只有其中一个服务保存了配置文件，要检查当前服务是否保存到配置文件了
@@ -41,15 +295,16 @@ def get_rbd_manager(ceph: CephCluster, pool_name: str):
         conf_file = ceph.config_file
         keyring_file = ceph.keyring_file
 
-    return RbdManager(conf_file=conf_file, keyring_file=keyring_file, pool_name=pool_name)
+    return RbdManager(conf_file=conf_file, keyring_file=keyring_file, pool_name=pool_name, ceph_id=ceph.id)
 
 
 class RbdManager:
     """
     ceph rbd 操作管理接口
     """
-    def __init__(self, conf_file: str, keyring_file: str, pool_name: str):
+    def __init__(self, conf_file: str, keyring_file: str, pool_name: str, ceph_id=None):
         """
+        :param ceph_id: ceph集群配置id，用于从进程内连接池复用集群连接；None时以配置文件路径区分集群
         raise RadosError
         """
         if not os.path.exists(conf_file):
@@ -61,8 +316,9 @@ class RbdManager:
         self._keyring_file = keyring_file
 
         self.pool_name = pool_name
+        self._ceph_key = ceph_id if ceph_id is not None else conf_file
         self._cluster = None
-        self._cluster = self.get_cluster()    # 与ceph连接的Rados对象
+        self._cluster = self.get_cluster()    # 与ceph连接的Rados对象，进程内共用
 
     def __enter__(self):
         self.get_cluster()
@@ -76,34 +332,47 @@ class RbdManager:
         self.shutdown()
 
     def shutdown(self):
-        """关闭与ceph的连接"""
-        if self._cluster:
-            self._cluster.shutdown()
-            self._cluster = None
+        """释放对集群连接的引用，连接由连接池管理，不关闭"""
+        self._cluster = None
 
     def get_cluster(self):
         """
-        获取已连接到ceph集群的Rados对象
+        获取已连接到ceph集群的Rados对象，从进程内连接池获取
         :return:
             success: Rados()
         :raises: class:`RadosError`
         """
-        if self._cluster:
-            if self._cluster.state == 'connected':
-                return self._cluster
-            else:
-                self.shutdown()
+        if self._cluster and self._cluster.state == 'connected':
+            return self._cluster
 
+        self._cluster = rados_pool.get(
+            ceph_key=self._ceph_key, conf_file=self._conf_file, keyring_file=self._keyring_file)
+        return self._cluster
+
+    def get_ioctx(self):
+        """
+        获取pool的IoCtx，连接池中共用，不要close
+
+        :return:
+            rados.Ioctx()
+        :raises: class:`RadosError`
+        """
+        cluster = self.get_cluster()
+        return rados_pool.get_ioctx(ceph_key=self._ceph_key, cluster=cluster, pool_name=self.pool_name)
+
+    @contextlib.contextmanager
+    def open_ioctx(self):
+        """
+        使用pool的IoCtx，退出时不关闭；操作出现rados连接错误时从连接池移除集群连接，下次使用时重建
+        """
+        cluster = self.get_cluster()
+        ioctx = rados_pool.get_ioctx(ceph_key=self._ceph_key, cluster=cluster, pool_name=self.pool_name)
         try:
-            conf = {'client_mount_timeout': '10', 'rados_mon_op_timeout': '10', 'rados_osd_op_timeout': '10'}
-            if self._keyring_file:
-                conf['keyring'] = self._keyring_file
-            self._cluster = rados.Rados(conffile=self._conf_file, conf=conf)
-            self._cluster.connect()
-            return self._cluster
-        except rados.Error as e:
-            msg = e.args[0] if e.args else f'error connecting to the cluster, {str(e)}'
-            raise RadosError(msg)
+            yield ioctx
+        except CONNECTION_ERRORS:
+            rados_pool.invalidate(ceph_key=self._ceph_key, cluster=cluster)
+            self._cluster = None
+            raise
 
     def create_snap(self, image_name: str, snap_name: str, protected: bool = False):
         """
@@ -118,9 +387,8 @@ class RbdManager:
 
         :raise class: `RadosError`
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 with rbd.Image(ioctx=ioctx, name=image_name) as image:
                     image.create_snap(snap_name)  # Create a snapshot of the image.
                     if protected:
@@ -142,9 +410,8 @@ class RbdManager:
 
         :raise class: `RadosError`
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 rbd.RBD().rename(ioctx=ioctx, src=image_name, dest=new_name)
         except rbd.ImageNotFound:
             raise RadosError('rename_image error: image not found')
@@ -166,9 +433,8 @@ class RbdManager:
 
         :raise class: `RadosError`
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 rbd.RBD().remove(ioctx=ioctx, name=image_name)
         except rbd.ImageNotFound:
             return True
@@ -194,9 +460,8 @@ class RbdManager:
         if not snap_name:
             raise RadosError(f'clone_image error:invalid param "snap_name"')
 
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as p_ioctx:
+            with self.open_ioctx() as p_ioctx:
                 c_ioctx = p_ioctx   # 克隆的image元数据保存在同一个pool，通过data_pool参数可指定数据块存储到data_pool
                 rbd.RBD().clone(p_ioctx=p_ioctx, p_name=snap_image_name, p_snapname=snap_name, c_ioctx=c_ioctx,
                                 c_name=new_image_name, data_pool=data_pool)
@@ -217,9 +482,8 @@ class RbdManager:
 
         :raise class: `RadosError`
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 return rbd.RBD().list(ioctx)  # 返回 Image name list
         except Exception as e:
             raise RadosError(f'rename_image error:{str(e)}')
@@ -237,9 +501,8 @@ class RbdManager:
 
         :raises: FunctionNotSupported, RadosError
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 rbd.RBD().create(ioctx=ioctx, name=name, size=size, old_format=False, data_pool=data_pool)
         except rbd.ImageExists:
             return None
@@ -256,9 +519,8 @@ class RbdManager:
             list    # success
         :raises: RadosError
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 with rbd.Image(ioctx=ioctx, name=name) as image:
                     return list(image.list_snaps())
         except Exception as e:
@@ -276,9 +538,8 @@ class RbdManager:
             #("RBD image not found (error opening image b'760f89a2bf7c4eb0b1a790d1c98f132a' at snapshot None)",)  # 镜像不存在时
             # ("RBD image not found (error checking if snapshot b'760f89a2bf7c4eb0b1a790d1c98f132a'@b'760f89a2bf7c4eb0b1a790d1c98f132a-20240305_092624' is protected)",) # 快照不存在时
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 with rbd.Image(ioctx=ioctx, name=image_name) as image:
                     if image.is_protected_snap(snap):   # protected snap check
                         image.unprotect_snap(snap)
@@ -299,9 +560,8 @@ class RbdManager:
             True    # success
         :raises: RadosError
         """
-        cluster = self.get_cluster()
         try:
-            with cluster.open_ioctx(self.pool_name) as ioctx:
+            with self.open_ioctx() as ioctx:
                 with rbd.Image(ioctx=ioctx, name=image_name) as image:
                     image.rollback_to_snap(snap)
         except Exception as e:
@@ -336,9 +596,8 @@ class RbdManager:
             rbd.Image()
         :raises: RadosError, ImageNotExistsError
         """
-        cluster = self.get_cluster()
         try:
-            ioctx = cluster.open_ioctx(self.pool_name)
+            ioctx = self.get_ioctx()
             image = rbd.Image(ioctx=ioctx, name=image_name)
             return image
         except rbd.ImageNotFound:
@@ -348,10 +607,11 @@ class RbdManager:
 
     @staticmethod
     def close_rbd_image(image):
+        """
+        关闭rbd image，image使用的IoCtx由连接池管理，不关闭
+        """
         try:
             image.close()
-            if hasattr(image, 'ioctx'):
-                image.ioctx.close()
         except Exception:
             pass
 
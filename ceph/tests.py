@@ -1,6 +1,8 @@
+from unittest import mock
+
 from django.test import TestCase
 
-from .managers import RbdManager
+from .managers import RbdManager, RadosClusterPool, rados_pool
 
 
 CONF_FILE = '/home/uwsgi/evcloud/data/ceph/conf/2.conf'
@@ -55,6 +57,51 @@ class RbdManagerTestCase(TestCase):
         ok = self.mgr.image_exists(self.image_name)
         self.assertFalse(ok, msg='[Failed] image_exists')
 
+    def test_shared_cluster(self):
+        mgr2 = RbdManager(conf_file=CONF_FILE, keyring_file=KEYRING_FILE, pool_name=self.pool_name)
+        self.assertIs(mgr2.get_cluster(), self.mgr.get_cluster(), msg='[Failed] shared cluster')
+        self.assertIs(mgr2.get_ioctx(), self.mgr.get_ioctx(), msg='[Failed] shared ioctx')
+
+        # 释放引用不关闭共用的连接
+        mgr2.shutdown()
+        self.assertEqual(self.mgr.get_cluster().state, 'connected')
+        self.assertFalse(self.mgr.image_exists('test_image_not_exists'))
+
+        rados_pool.invalidate(ceph_key=CONF_FILE)
+        mgr3 = RbdManager(conf_file=CONF_FILE, keyring_file=KEYRING_FILE, pool_name=self.pool_name)
+        self.assertIsNot(mgr3.get_cluster(), self.mgr.get_cluster(), msg='[Failed] reconnect')
+        self.assertGreaterEqual(rados_pool.stats()['misses'], 2)
+
     def tearDown(self):
         self.mgr.remove_image(self.image_name)
         self.mgr.remove_image(self.image_rename)
+
+
+
+class FakeCluster:
+    state = 'connected'
+
+    def __init__(self):
+        self.probes = 0
+
+    def get_cluster_stats(self):
+        self.probes += 1
+
+
+class RadosClusterPoolTestCase(TestCase):
+    def test_health_check_interval(self):
+        pool = RadosClusterPool(health_check_interval=30)
+        cluster = FakeCluster()
+        pool._clusters['test'] = (('test.conf', None, 'test.keyring', None), cluster, 1000)
+
+        # 频繁复用的连接也按检查间隔向集群查询
+        for now in [1010, 1020, 1029]:
+            with mock.patch('ceph.managers.time.monotonic', return_value=now):
+                self.assertIs(pool.get('test', conf_file='test.conf', keyring_file='test.keyring'), cluster)
+        self.assertEqual(cluster.probes, 0)
+
+        for now in [1030, 1040, 1059, 1060]:
+            with mock.patch('ceph.managers.time.monotonic', return_value=now):
+                self.assertIs(pool.get('test', conf_file='test.conf', keyring_file='test.keyring'), cluster)
+        self.assertEqual(cluster.probes, 2)
+        self.assertEqual(pool.stats()['hits'], 7)
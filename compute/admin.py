@@ -6,7 +6,9 @@ from django.utils.translation import gettext_lazy as _
 from pcservers.models import PcServer
 from image.models import Image
 from .models import Center, Group, Host
+from .managers import HostManager
 from utils.ev_libvirt.virt import VirtHost, VirHostDown
+from utils.errors import ComputeError
 
 
 @admin.register(Center)
@@ -26,7 +28,7 @@ class CenterAdmin(admin.ModelAdmin):
 @admin.register(Group)
 class GroupAdmin(admin.ModelAdmin):
     list_display_links = ('name',)
-    list_display = ('id', 'name', 'center', 'enable', 'desc')
+    list_display = ('id', 'name', 'center', 'enable', 'placement_strategy', 'desc')
     list_filter = ['center']
     search_fields = ['name']
     filter_horizontal = ['users']
@@ -72,32 +74,18 @@ class HostAdmin(admin.ModelAdmin):
         """
         更新宿主机的资源使用量
         """
-        failed_hosts = []
-        for host in queryset:
-            try:
-                # if host.ipv4 == '127.0.0.1':
-                #     s = Image.objects.filter(vm_uuid__isnull=False).aggregate(vcpu_now=Sum('vm_vcpu'),
-                #                                                               mem_now=Sum('vm_mem'),
-                #                                                               count=Count('pk'))
-                #     vcpu_allocated = s.get('vcpu_now')
-                #     mem_allocated = s.get('mem_now')
-                #     vm_num = s.get('count')
-                # else:
-                s = host.stats_vcpu_mem_vms_now()
-                vcpu_allocated = s.get('vcpu')
-                mem_allocated = s.get('mem')
-                vm_num = s.get('vm_num')
-                host.vcpu_allocated = vcpu_allocated
-                host.mem_allocated = mem_allocated
-                host.vm_created = vm_num
-                host.save(update_fields=['vcpu_allocated', 'mem_allocated', 'vm_created'])
-            except Exception:
-                failed_hosts.append(host.ipv4)
+        try:
+            report = HostManager.reconcile_host_quotas(host_ids=[host.id for host in queryset])
+        except ComputeError as e:
+            self.message_user(request, f"更新宿主机失败: {str(e)}", level=messages.ERROR)
+            return
 
+        failed_hosts = [d['ipv4'] for d in report if not d['updated']]
         if failed_hosts:
-            self.message_user(request, f"更新宿主机失败{len(failed_hosts)}个: {failed_hosts}", level=messages.ERROR)
+            self.message_user(request, f"宿主机资源有并发修改未更新{len(failed_hosts)}个，请重试: {failed_hosts}",
+                              level=messages.ERROR)
         else:
-            self.message_user(request, "所选宿主机都更新成功", level=messages.SUCCESS)
+            self.message_user(request, f"所选宿主机都更新成功，校正{len(report)}个", level=messages.SUCCESS)
 
     @admin.display(description=_('真实物理资源'))
     def pc_server_resource(self, obj):
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from utils.loggers import config_script_logger
+from compute.telemetry import HostTelemetryCollector
+
+
+class Command(BaseCommand):
+    '''
+    宿主机资源采集服务
+    '''
+
+    help = """
+            周期性并行采集所有启用宿主机的cpu、内存和大页内存信息，保存每个宿主机最新的资源快照
+            python manage.py host_telemetry_collector [--interval 60] [--workers 16] [--once]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', default=60, dest='interval', type=int,
+            help='采集间隔（秒），应小于HOST_TELEMETRY_MAX_AGE',
+        )
+        parser.add_argument(
+            '--workers', default=16, dest='workers', type=int,
+            help='同时采集的宿主机数',
+        )
+        parser.add_argument(
+            '--once', default=False, dest='once', action='store_true',
+            help='只采集一次',
+        )
+
+    def handle(self, *args, **options):
+        logger = config_script_logger(name='host-telemetry-collector', filename='host_telemetry_collector.log',
+                                      stdout=True)
+        collector = HostTelemetryCollector(interval=options['interval'], workers=options['workers'], logger=logger)
+        if options['once']:
+            ok, failed = collector.run_once()
+            self.stdout.write(self.style.SUCCESS(f'Successfully collect host telemetry, ok={ok}, failed={failed}.'))
+            return
+
+        self.stdout.write(self.style.SUCCESS('Start host telemetry collector.'))
+        try:
+            collector.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Exit.'))
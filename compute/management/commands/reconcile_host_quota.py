@@ -0,0 +1,67 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from compute.managers import HostManager
+from utils.errors import ComputeError
+
+
+class Command(BaseCommand):
+    '''
+    校正宿主机已分配资源
+    '''
+
+    help = """
+            一条统计语句计算所有宿主机上虚拟机的vcpu、内存和数量，与宿主机记录的已分配资源不一致的批量更新，并输出漂移报告；
+            有未完成的迁移任务、正在批量创建虚拟机、最近申请过资源的宿主机跳过，不校正；
+            可由crontab定时执行，或者指定--interval周期执行
+            python manage.py reconcile_host_quota [--host-id 1 --host-id 2] [--dry-run] [--json] [--interval 0]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host-id', default=None, dest='host_ids', type=int, action='append',
+                            help='只校正指定的宿主机，可多次指定，默认所有宿主机')
+        parser.add_argument('--dry-run', default=False, dest='dry_run', action='store_true',
+                            help='只输出漂移报告，不更新')
+        parser.add_argument('--json', default=False, dest='json', action='store_true',
+                            help='漂移报告以json输出')
+        parser.add_argument('--interval', default=0, dest='interval', type=int,
+                            help='周期执行的间隔（秒），0只执行一次')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            try:
+                report = HostManager.reconcile_host_quotas(host_ids=options['host_ids'], dry_run=options['dry_run'])
+            except ComputeError as e:
+                if options['interval'] <= 0:
+                    raise CommandError(str(e))
+
+                self.stderr.write(str(e))
+            else:
+                self.write_report(report, as_json=options['json'])
+
+            if options['interval'] <= 0:
+                break
+
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                break
+
+        self.stdout.write(self.style.SUCCESS('Successfully reconcile host quota.'))
+
+    def write_report(self, report: list, as_json: bool = False):
+        if as_json:
+            self.stdout.write(json.dumps(report))
+            return
+
+        for d in report:
+            changes = ', '.join(f'{f}: {d[f][0]} -> {d[f][1]}' for f in ['vcpu_allocated', 'mem_allocated', 'vm_created']
+                                if d[f][0] != d[f][1])
+            status = 'updated' if d['updated'] else 'not updated'
+            self.stdout.write(f"host({d['host_id']}, {d['ipv4']}) {status}, {changes}")
+
+        self.stdout.write(f'drifted hosts={len(report)}, updated={sum(1 for d in report if d["updated"])}')
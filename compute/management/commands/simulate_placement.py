@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from compute.placement import PLACEMENT_STRATEGIES
+from compute.placement_sim import PlacementSimulator, generate_trace, load_trace
+
+
+class Command(BaseCommand):
+    '''
+    宿主机调度策略模拟
+    '''
+
+    help = """
+            回放创建/删除虚拟机事件序列，对比各调度策略的拒绝率和资源碎片率；数据库修改全部回滚
+            python manage.py simulate_placement [--trace trace.jsonl] [--events 2000] [--strategy best_fit]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trace', default='', dest='trace', help='事件序列文件，每行一个json事件，不指定时随机生成')
+        parser.add_argument('--events', default=2000, dest='events', type=int, help='随机生成的事件数')
+        parser.add_argument('--delete-ratio', default=0.4, dest='delete_ratio', type=float, help='随机生成的删除事件占比')
+        parser.add_argument('--seed', default=0, dest='seed', type=int, help='随机数种子')
+        parser.add_argument('--strategy', default='', dest='strategy', choices=[''] + list(PLACEMENT_STRATEGIES),
+                            help='只模拟指定的策略，默认模拟全部策略')
+        parser.add_argument('--hosts', default=20, dest='hosts', type=int, help='宿主机数')
+        parser.add_argument('--host-vcpu', default=64, dest='host_vcpu', type=int, help='每个宿主机vcpu数')
+        parser.add_argument('--host-mem', default=256, dest='host_mem', type=int, help='每个宿主机内存大小(GB)')
+        parser.add_argument('--vm-limit', default=64, dest='vm_limit', type=int, help='每个宿主机虚拟机数量上限')
+
+    def handle(self, *args, **options):
+        if options['trace']:
+            try:
+                trace = load_trace(options['trace'])
+            except Exception as e:
+                raise CommandError(f'加载事件序列文件错误，{str(e)}')
+        else:
+            trace = generate_trace(num_events=options['events'], delete_ratio=options['delete_ratio'],
+                                   seed=options['seed'])
+
+        strategies = [options['strategy']] if options['strategy'] else list(PLACEMENT_STRATEGIES)
+        simulator = PlacementSimulator(hosts=options['hosts'], host_vcpu=options['host_vcpu'],
+                                       host_mem=options['host_mem'], vm_limit=options['vm_limit'])
+        self.stdout.write(f'events={len(trace)}, hosts={options["hosts"]}')
+        for name in strategies:
+            r = simulator.run(strategy=name, trace=trace)
+            self.stdout.write(
+                f"{r['strategy']:<14} creates={r['creates']}, rejected={r['rejected']}, "
+                f"rejection_rate={r['rejection_rate']:.2%}, fragmentation_avg={r['fragmentation_avg']:.2%}, "
+                f"fragmentation_final={r['fragmentation_final']:.2%}, hosts_used={r['hosts_used']}"
+            )
+
+        self.stdout.write(self.style.SUCCESS('Successfully simulate placement.'))
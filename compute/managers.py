@@ -1,11 +1,15 @@
 import ipaddress
-import random
+from datetime import timedelta
 
+from django.conf import settings
 from django.db import transaction
-from django.db.models import Sum, Subquery, Count, Q
+from django.db.models import Sum, Subquery, Count, Q, F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.utils.functional import cached_property
 
 from compute.models import Center, Group, Host
+from compute.placement import get_group_placement_strategy, PLACEMENT_CANDIDATES
 from network.models import Vlan, MacIP
 from image.models import Image
 from ceph.models import CephPool
@@ -14,6 +18,8 @@ from utils.errors import ComputeError
 from vpn.manager import VPNManager
 
 
+HOST_QUOTA_RECONCILE_GRACE = getattr(settings, 'HOST_QUOTA_RECONCILE_GRACE', 300)
+
 class DefaultSum(Sum):
     """
     累加结果为None时，返回默认值, 只是用于int和float
@@ -296,6 +302,28 @@ class CenterManager:
             vcpu_allocated=DefaultSum('group_set__hosts_set__vcpu_allocated'),
             vm_created=DefaultSum('group_set__hosts_set__vm_created')).all()
 
+    @staticmethod
+    def get_center_rollups():
+        """
+        按数据中心汇总启用的宿主机资源，一次GROUP BY查询
+
+        :return:
+            {
+                center_id: {'mem_total': int, 'mem_allocated': int, 'vcpu_total': int, 'vcpu_allocated': int,
+                            'real_cpu': int, 'vm_created': int, 'vm_limit': int}
+            }
+        """
+        qs = Host.objects.filter(enable=True).values('group__center_id').annotate(
+            mem_total=DefaultSum('mem_total'),
+            mem_allocated=DefaultSum('mem_allocated'),
+            vcpu_total=DefaultSum('vcpu_total'),
+            vcpu_allocated=DefaultSum('vcpu_allocated'),
+            real_cpu=DefaultSum('real_cpu'),
+            vm_created=DefaultSum('vm_created'),
+            vm_limit=DefaultSum('vm_limit')
+        ).order_by()
+        return {r.pop('group__center_id'): r for r in qs}
+
     def get_all_center_cpn_mem_stat(self, ):
         """获取数据中心内存、cpu资源"""
         quota= {
@@ -316,44 +344,29 @@ class CenterManager:
             "vpn_invalid":0, # vpn 无效数
         }
 
-        qs = Center.objects.all()
-        if not qs:
+        rollups = self.get_center_rollups()
+        if not rollups and not Center.objects.exists():
             return quota, False
 
-        quota_qs = Host.objects.filter(enable=True)
-        for center in qs:
-
-            group_ids = list(Group.objects.filter(center_id=center.id).values_list('id', flat=True))
-            if group_ids:
-                quota_qs = quota_qs.filter(group_id__in=group_ids)
-            else:
-                quota_qs = quota_qs.none()
-
-            center_quota = quota_qs.aggregate(
-                mem_total=DefaultSum('mem_total'),
-                mem_allocated=DefaultSum('mem_allocated'),
-                vcpu_total=DefaultSum('vcpu_total'),
-                vcpu_allocated=DefaultSum('vcpu_allocated'),
-                real_cpu=DefaultSum('real_cpu'),
-                vm_created=DefaultSum('vm_created'),
-                vm_limit=DefaultSum('vm_limit')
-            )
-
-            quota["mem_total"] = quota["mem_total"] + center_quota["mem_total"]
-            quota["mem_allocated"] = quota["mem_allocated"] + center_quota["mem_allocated"]
-            quota["vcpu_total"] = quota["vcpu_total"] + center_quota["vcpu_total"]
-            quota["vcpu_allocated"] = quota["vcpu_allocated"] + center_quota["vcpu_allocated"]
-            quota["real_cpu"] = quota["real_cpu"] + center_quota["real_cpu"]
-            quota["vm_created"] = quota["vm_created"] + center_quota["vm_created"]
-            quota["vm_limit"] = quota["vm_limit"] + center_quota["vm_limit"]
+        for center_quota in rollups.values():
+            for key, val in center_quota.items():
+                quota[key] = quota[key] + val
 
         return quota, True
 
+    @staticmethod
+    def _rate(used, total):
+        if not total:
+            return 0.0
+
+        return float(f'{used / total:.2f}')
 
     def get_stat_all_center(self, user):
         """汇总数据中心信息
 
             云主机数、云硬盘数、已用IP地址 总IP数、IP使用率、已用cpu、总计cpu数 cpu使用率、内存、vpn
+
+            查询数固定，不随数据中心数量增加
         """
 
         quota, flag = self.get_all_center_cpn_mem_stat()
@@ -372,36 +385,22 @@ class CenterManager:
         quota.update(ip_data)
 
         # 使用率
-        ip_rate = quota["ips_used"]/quota["ips_total"]
-        cpu_rate = quota["vcpu_allocated"]/quota["vcpu_total"]
-        mem_rate = quota["mem_allocated"]/quota["mem_total"]
-        quota["ips_rate"] = float(f'{ip_rate:.2f}')
-        quota["cpu_rate"] = float(f'{cpu_rate:.2f}')
-        quota["mem_rate"] = float(f'{mem_rate:.2f}')
+        quota["ips_rate"] = self._rate(quota["ips_used"], quota["ips_total"])
+        quota["cpu_rate"] = self._rate(quota["vcpu_allocated"], quota["vcpu_total"])
+        quota["mem_rate"] = self._rate(quota["mem_allocated"], quota["mem_total"])
 
         # 云硬盘
         group_qs = GroupManager().get_group_queryset()
         vdisk_all = group_qs.aggregate(vdisk_num=Count('quota_set__vdisk_set'))
         quota.update(vdisk_all)
         # VPN
-        qs = VPNManager().get_vpn_queryset()
-        if not qs:
-            quota["vpn_total"]=0
-            quota["vpn_active"]=0
-            quota["vpn_invalid"]=0
-            quota["vpn_online"]=0
-            return quota
-
-        vpn_total = qs.count()
-        vpn_active = qs.filter(active=True).count()
-        vpn_invalid = qs.filter(active=False).count()
-        vpn_online = VPNManager().vpn_login_num()
-
-        quota["vpn_total"] = vpn_total
-        quota["vpn_active"] = vpn_active
-        quota["vpn_invalid"] = vpn_invalid
-        quota["vpn_online"] = vpn_online
-
+        vpn_data = VPNManager().get_vpn_queryset().aggregate(
+            vpn_total=Count('id'),
+            vpn_active=Count('id', filter=Q(active=True)),
+            vpn_invalid=Count('id', filter=Q(active=False)),
+        )
+        quota.update(vpn_data)
+        quota["vpn_online"] = VPNManager().vpn_login_num() if vpn_data['vpn_total'] else 0
         return quota
 
 
@@ -860,6 +859,8 @@ class HostManager:
         """
         向宿主机申请资源
 
+        不加锁，一条条件更新语句完成资源检查和扣除，更新行数决定是否成功
+
         :param host_id: 宿主机id
         :param vcpu: 要申请的cpu数
         :param mem: 要申请的内存大小
@@ -868,52 +869,90 @@ class HostManager:
             None    #宿主机不存在
         :raise ComputeError
         """
-        with transaction.atomic():
-            host = Host.objects.select_for_update().filter(id=host_id).first()
-            if not host:
-                return None
+        return HostManager.claim_batch_from_host(host_id=host_id, vcpu=vcpu, mem=mem, count=1)
+
+    @staticmethod
+    def claim_batch_from_host(host_id: int, vcpu: int, mem: int, count: int):
+        """
+        向宿主机一次申请多个虚拟机的资源，一条条件更新语句完成
+
+        UPDATE host SET vcpu_allocated = vcpu_allocated + vcpu*count, mem_allocated = mem_allocated + mem*count
+        WHERE id = host_id AND vcpu_total >= vcpu_allocated + vcpu*count AND mem_total >= mem_allocated + mem*count
+        AND vm_limit >= vm_created + count
+
+        已创建虚拟机数量vm_created不在此处增加，仍在每个虚拟机创建成功后增加
+
+        :param host_id: 宿主机id
+        :param vcpu: 每个虚拟机要申请的cpu数
+        :param mem: 每个虚拟机要申请的内存大小
+        :param count: 虚拟机数量
+        :return:
+            Host()  # success
+            None    #宿主机不存在
+        :raise ComputeError
+        """
+        if count <= 0:
+            raise ComputeError(msg='参数有误，申请的虚拟机数量必须是一个正整数')
+
+        cpu_delta = max(vcpu, 0) * count
+        mem_delta = max(mem, 0) * count
+        try:
+            rows = Host.objects.filter(
+                id=host_id,
+                vcpu_total__gte=F('vcpu_allocated') + cpu_delta,
+                mem_total__gte=F('mem_allocated') + mem_delta,
+                vm_limit__gte=F('vm_created') + count
+            ).update(vcpu_allocated=F('vcpu_allocated') + cpu_delta, mem_allocated=F('mem_allocated') + mem_delta,
+                     claim_time=timezone.now())
+            host = Host.objects.filter(id=host_id).first()
+        except Exception as e:
+            raise ComputeError(msg=f'向宿主机申请资源时失败，{str(e)}')
 
-            # 宿主机是否满足资源需求
-            if not host.meet_needs(vcpu=vcpu, mem=mem):
-                raise ComputeError(msg='宿主机没有足够的资源')
+        if rows > 0:
+            return host
 
-            # 申请资源
-            if not host.claim(vcpu=vcpu, mem=mem):
-                raise ComputeError(msg='向宿主机申请资源时失败')
+        if host is None:
+            return None
 
-        return host
+        raise ComputeError(msg='宿主机没有足够的资源')
 
     @staticmethod
-    def free_to_host(host_id: int, vcpu: int, mem: int):
+    def free_to_host(host_id: int, vcpu: int, mem: int, count: int = 1):
         """
-        释放从宿主机申请的资源
+        释放从宿主机申请的资源，一条更新语句完成，已分配资源不会减到小于0
 
         :param host_id: 宿主机id
-        :param vcpu: 要申请的cpu数
-        :param mem: 要申请的内存大小
+        :param vcpu: 每个虚拟机要释放的cpu数
+        :param mem: 每个虚拟机要释放的内存大小
+        :param count: 虚拟机数量，默认1
         :return:
             True    # success
             False   # failed
         """
-        # 释放资源
-        with transaction.atomic():
-            try:
-                host = Host.objects.select_for_update().filter(id=host_id).first()
-                if not host:
-                    return False
+        cpu_delta = max(vcpu, 0) * count
+        mem_delta = max(mem, 0) * count
+        if cpu_delta == mem_delta == 0:
+            return True
+
+        try:
+            rows = Host.objects.filter(id=host_id).update(
+                vcpu_allocated=Greatest(F('vcpu_allocated') - cpu_delta, Value(0)),
+                mem_allocated=Greatest(F('mem_allocated') - mem_delta, Value(0))
+            )
+        except Exception:
+            return False
 
-                return host.free(vcpu=vcpu, mem=mem)
-            except Exception:
-                return False
+        return rows > 0
 
-    def filter_meet_requirements(self, hosts: list, vcpu: int, mem: int, claim=False):
+    def filter_meet_requirements(self, hosts: list, vcpu: int, mem: int, claim=False, user=None):
         """
-        筛选满足申请资源要求的宿主机
+        筛选满足申请资源要求的宿主机，按宿主机组的调度策略选择
 
         :param hosts: 宿主机列表
         :param vcpu: 要申请的cpu数
         :param mem: 要申请的内存大小
         :param claim: True:立即申请资源
+        :param user: 虚拟机所有者，反亲和调度策略使用
         :return:
             Host()  # success
             None    # 没有足够的资源的宿主机
@@ -936,16 +975,18 @@ class HostManager:
         if not isinstance(mem, int) or mem <= 0:
             raise ComputeError(msg='参数有误，mem必须是一个正整数')
 
-        random.shuffle(hosts)  # 随机打乱
-        for host in hosts:
-            # 宿主机是否满足资源需求
-            if not host.meet_needs(vcpu=vcpu, mem=mem):
-                continue
+        strategy = get_group_placement_strategy(hosts[0].group)
+        qs = Host.objects.filter(id__in=[h.id for h in hosts])
+        candidates = strategy.rank(qs, vcpu=vcpu, mem=mem, user=user, limit=PLACEMENT_CANDIDATES)
+        if not claim:  # 不立即申请资源
+            return candidates[0] if candidates else None
 
-            if not claim:  # 立即申请资源
+        for host in candidates:
+            try:
+                host = self.claim_from_host(host_id=host.id, vcpu=vcpu, mem=mem)
+            except ComputeError:    # 资源已被并发占用，尝试下一个
                 continue
 
-            host = self.claim_from_host(host_id=host.id, vcpu=vcpu, mem=mem)
             if host:
                 return host
 
@@ -975,3 +1016,121 @@ class HostManager:
         host.mem_allocated = mem_allocated
         host.vm_created = vm_num
         host.save(update_fields=['vcpu_allocated', 'mem_allocated', 'vm_created'])
+
+    @staticmethod
+    def reconcile_host_quotas(host_ids: list = None, dry_run: bool = False):
+        """
+        校正宿主机已分配资源，一条GROUP BY语句统计所有宿主机上虚拟机的vcpu、内存和数量，
+        与宿主机记录的已分配资源不一致(漂移)的宿主机批量更新
+
+        统计和更新之间已分配资源有变化(有并发的申请、释放资源)的宿主机本次跳过，不覆盖并发的修改；
+        有未完成的迁移任务、正在批量创建虚拟机、最近申请过资源(HOST_QUOTA_RECONCILE_GRACE秒内)的宿主机
+        已申请的资源可能还没有对应的虚拟机记录，不校正
+
+        :param host_ids: 宿主机id列表，None时所有宿主机
+        :param dry_run: True只统计漂移，不更新
+        :return:
+            [
+                {
+                    'host_id': int, 'ipv4': str, 'updated': bool,
+                    'vcpu_allocated': (old: int, new: int),
+                    'mem_allocated': (old: int, new: int),
+                    'vm_created': (old: int, new: int)
+                },
+            ]       # 有漂移的宿主机
+        :raise ComputeError
+        """
+        from vms.models import Vm
+
+        fields = ['vcpu_allocated', 'mem_allocated', 'vm_created']
+        hosts_qs = Host.objects.all()
+        vms_qs = Vm.objects.filter(vm_status=Vm.VmStatus.NORMAL.value, host__isnull=False)
+        if host_ids is not None:
+            hosts_qs = hosts_qs.filter(id__in=host_ids)
+            vms_qs = vms_qs.filter(host_id__in=host_ids)
+
+        try:
+            hosts = list(hosts_qs.only('id', 'ipv4', *fields))
+            sums = {
+                s['host']: (s['vcpu'], s['mem'], s['vm_num']) for s in vms_qs.values('host').annotate(
+                    vcpu=DefaultSum('vcpu'), mem=DefaultSum('mem'), vm_num=Count('pk')).order_by()
+            }
+        except Exception as e:
+            raise ComputeError(msg=f'统计宿主机已分配资源时错误，{str(e)}')
+
+        busy_ids = HostManager._busy_host_ids(host_ids=host_ids)
+        drifts = {}
+        for host in hosts:
+            if host.id in busy_ids:
+                continue
+
+            old = tuple(getattr(host, f) for f in fields)
+            new = sums.get(host.id, (0, 0, 0))
+            if old != new:
+                drifts[host.id] = (host, old, new)
+
+        if not drifts or dry_run:
+            return HostManager._drift_report(drifts, updated_ids=set())
+
+        try:
+            with transaction.atomic():
+                locked = Host.objects.select_for_update().filter(id__in=list(drifts)).only('id', *fields)
+                objs = []
+                for h in locked:
+                    host, old, new = drifts[h.id]
+                    if tuple(getattr(h, f) for f in fields) != old:     # 统计后有并发修改
+                        continue
+
+                    for f, val in zip(fields, new):
+                        setattr(h, f, val)
+                    objs.append(h)
+
+                Host.objects.bulk_update(objs, fields=fields, batch_size=500)
+        except Exception as e:
+            raise ComputeError(msg=f'更新宿主机已分配资源时错误，{str(e)}')
+
+        return HostManager._drift_report(drifts, updated_ids={h.id for h in objs})
+
+    @staticmethod
+    def _busy_host_ids(host_ids: list = None):
+        """
+        有未完成的迁移任务(源或目标宿主机)、未完成的批量创建虚拟机任务项、最近申请过资源的宿主机；
+        单个虚拟机创建时先申请资源，创建成功后才有虚拟机记录
+
+        :param host_ids: 宿主机id列表，None时所有宿主机
+        :return: set
+        :raise ComputeError
+        """
+        from vms.models import MigrateTask, VmBatchJob, VmBatchJobItem
+
+        tasks_qs = MigrateTask.objects.filter(status__in=[MigrateTask.Status.WAITING, MigrateTask.Status.IN_PROCESS])
+        items_qs = VmBatchJobItem.objects.filter(
+            job__status=VmBatchJob.Status.RUNNING, host__isnull=False,
+            status__in=[VmBatchJobItem.Status.PENDING, VmBatchJobItem.Status.CLONING, VmBatchJobItem.Status.DEFINING])
+        claimed_qs = Host.objects.filter(claim_time__gte=timezone.now() - timedelta(seconds=HOST_QUOTA_RECONCILE_GRACE))
+        if host_ids is not None:
+            tasks_qs = tasks_qs.filter(Q(src_host_id__in=host_ids) | Q(dst_host_id__in=host_ids))
+            items_qs = items_qs.filter(host_id__in=host_ids)
+            claimed_qs = claimed_qs.filter(id__in=host_ids)
+
+        try:
+            busy_ids = set(items_qs.values_list('host_id', flat=True).distinct())
+            busy_ids.update(claimed_qs.values_list('id', flat=True))
+            for src_id, dst_id in tasks_qs.values_list('src_host_id', 'dst_host_id'):
+                busy_ids.update([src_id, dst_id])
+        except Exception as e:
+            raise ComputeError(msg=f'查询宿主机未完成的任务时错误，{str(e)}')
+
+        busy_ids.discard(None)
+        return busy_ids
+
+    @staticmethod
+    def _drift_report(drifts: dict, updated_ids: set):
+        report = []
+        for host_id, (host, old, new) in drifts.items():
+            item = {'host_id': host_id, 'ipv4': host.ipv4, 'updated': host_id in updated_ids}
+            for f, o, n in zip(['vcpu_allocated', 'mem_allocated', 'vm_created'], old, new):
+                item[f] = (o, n)
+            report.append(item)
+
+        return report
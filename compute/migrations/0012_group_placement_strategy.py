@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compute', '0011_center_ssh_public'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='placement_strategy',
+            field=models.CharField(blank=True, choices=[('', '系统默认'), ('best_fit', '最佳适配(优先填满)'), ('spread', '最差适配(分散)'), ('weighted', '加权评分'), ('anti_affinity', '用户反亲和'), ('random', '随机')], default='', help_text='创建虚拟机时选择宿主机的策略，默认使用系统配置的策略', max_length=32, verbose_name='宿主机调度策略'),
+        ),
+    ]
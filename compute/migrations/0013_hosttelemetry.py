@@ -0,0 +1,37 @@
+# Generated by Django 4.2.9 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compute', '0012_group_placement_strategy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostTelemetry',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('host_ipv4', models.GenericIPAddressField(unique=True, verbose_name='宿主机IP')),
+                ('cpus', models.IntegerField(default=0, verbose_name='物理CPU数')),
+                ('cpu_mhz', models.IntegerField(default=0, verbose_name='CPU频率(MHz)')),
+                ('cpu_usage', models.FloatField(default=None, help_text='由相邻两次采集的CPU累计时间计算，首次采集时为空', null=True, verbose_name='CPU使用率(%)')),
+                ('mem_total', models.BigIntegerField(default=0, verbose_name='总内存(KiB)')),
+                ('mem_free', models.BigIntegerField(default=0, verbose_name='空闲内存(KiB)')),
+                ('mem_cached', models.BigIntegerField(default=0, verbose_name='缓存内存(KiB)')),
+                ('mem_buffers', models.BigIntegerField(default=0, verbose_name='缓冲内存(KiB)')),
+                ('hugepage_size', models.IntegerField(default=0, verbose_name='大页大小(KiB)')),
+                ('hugepages_total', models.IntegerField(default=0, verbose_name='大页总数')),
+                ('hugepages_free', models.IntegerField(default=0, verbose_name='空闲大页数')),
+                ('error', models.CharField(blank=True, default='', max_length=255, verbose_name='采集错误')),
+                ('update_time', models.DateTimeField(db_index=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '宿主机资源快照',
+                'verbose_name_plural': '宿主机资源快照',
+                'db_table': 'compute_host_telemetry',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 22:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compute', '0013_hosttelemetry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='claim_time',
+            field=models.DateTimeField(blank=True, default=None, help_text='申请的资源在虚拟机创建完成前没有对应的虚拟机记录，校正已分配资源时跳过', null=True, verbose_name='最近申请资源时间'),
+        ),
+    ]
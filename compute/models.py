@@ -4,6 +4,7 @@ from django.db import models
 from django.db.models import F, Sum, Count
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from pcservers.models import PcServer
@@ -82,6 +83,14 @@ class Group(models.Model):
 
     组用于权限隔离，某一个用户创建的虚拟机只能创建在指定的组的宿主机上，无权使用其他组的宿主机
     """
+    class PlacementStrategy(models.TextChoices):
+        DEFAULT = '', _('系统默认')
+        BEST_FIT = 'best_fit', _('最佳适配(优先填满)')
+        SPREAD = 'spread', _('最差适配(分散)')
+        WEIGHTED = 'weighted', _('加权评分')
+        ANTI_AFFINITY = 'anti_affinity', _('用户反亲和')
+        RANDOM = 'random', _('随机')
+
     id = models.AutoField(primary_key=True)
     center = models.ForeignKey(Center, on_delete=models.CASCADE, related_name='group_set',
                                verbose_name=_('组所属的数据中心'))
@@ -89,6 +98,9 @@ class Group(models.Model):
     enable = models.BooleanField(default=True, verbose_name=_('启用宿主机组'))
     desc = models.CharField(max_length=200, default='', blank=True, verbose_name=_('描述'))
     users = models.ManyToManyField(to=User, blank=True, related_name='group_set')  # 有权访问此组的用户
+    placement_strategy = models.CharField(
+        verbose_name=_('宿主机调度策略'), max_length=32, choices=PlacementStrategy.choices, default='', blank=True,
+        help_text=_('创建虚拟机时选择宿主机的策略，默认使用系统配置的策略'))
 
     def __str__(self):
         return self.name
@@ -144,6 +156,8 @@ class Host(models.Model):
     mem_allocated = models.IntegerField(default=0, verbose_name=_('已用内存(GB)'))
     vm_limit = models.IntegerField(default=10, verbose_name=_('本地虚拟机数量上限'))
     vm_created = models.IntegerField(default=0, verbose_name=_('本地已创建虚拟机数量'))
+    claim_time = models.DateTimeField(verbose_name=_('最近申请资源时间'), null=True, blank=True, default=None,
+                                      help_text=_('申请的资源在虚拟机创建完成前没有对应的虚拟机记录，校正已分配资源时跳过'))
     enable = models.BooleanField(default=True, verbose_name=_('启用宿主机'))
     desc = models.CharField(max_length=200, default='', blank=True, verbose_name=_('描述'))
 
@@ -278,6 +292,8 @@ class Host(models.Model):
         if mem_delta != 0:
             filters['mem_total__gte'] = F('mem_allocated') + mem_delta
             updates['mem_allocated'] = F('mem_allocated') + mem_delta
+        if cpu_delta > 0 or mem_delta > 0:
+            updates['claim_time'] = timezone.now()
 
         try:
             r = Host.objects.filter(id=self.id, **filters).update(**updates)
@@ -396,3 +412,32 @@ class Host(models.Model):
         # if self.ipv4 == '127.0.0.1':
         #     raise ComputeError(msg='127.0.0.1为镜像专用宿主机，不能删除')
         super().delete(using=using, keep_parents=keep_parents)
+
+
+class HostTelemetry(models.Model):
+    """
+    宿主机资源使用快照，由宿主机资源采集服务(manage.py host_telemetry_collector)定期更新，每个宿主机一行
+    """
+    id = models.AutoField(primary_key=True)
+    host_ipv4 = models.GenericIPAddressField(verbose_name=_('宿主机IP'), unique=True)
+    cpus = models.IntegerField(verbose_name=_('物理CPU数'), default=0)
+    cpu_mhz = models.IntegerField(verbose_name=_('CPU频率(MHz)'), default=0)
+    cpu_usage = models.FloatField(verbose_name=_('CPU使用率(%)'), null=True, default=None,
+                                  help_text=_('由相邻两次采集的CPU累计时间计算，首次采集时为空'))
+    mem_total = models.BigIntegerField(verbose_name=_('总内存(KiB)'), default=0)
+    mem_free = models.BigIntegerField(verbose_name=_('空闲内存(KiB)'), default=0)
+    mem_cached = models.BigIntegerField(verbose_name=_('缓存内存(KiB)'), default=0)
+    mem_buffers = models.BigIntegerField(verbose_name=_('缓冲内存(KiB)'), default=0)
+    hugepage_size = models.IntegerField(verbose_name=_('大页大小(KiB)'), default=0)
+    hugepages_total = models.IntegerField(verbose_name=_('大页总数'), default=0)
+    hugepages_free = models.IntegerField(verbose_name=_('空闲大页数'), default=0)
+    error = models.CharField(verbose_name=_('采集错误'), max_length=255, blank=True, default='')
+    update_time = models.DateTimeField(verbose_name=_('更新时间'), db_index=True)
+
+    class Meta:
+        db_table = 'compute_host_telemetry'
+        verbose_name = _('宿主机资源快照')
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f'{self.host_ipv4}[{self.update_time}]'
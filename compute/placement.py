@@ -0,0 +1,175 @@
+"""
+宿主机调度策略
+
+每个策略在一个查询中完成宿主机的筛选和排序：在宿主机查询集上注解剩余资源和评分，
+过滤掉不满足资源需求的宿主机，按评分排序后取前几个作为候选宿主机
+"""
+from django.conf import settings
+from django.db.models import F, FloatField, IntegerField, OuterRef, Subquery, Count, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from compute.models import Group
+from utils.errors import ComputeError
+
+
+PLACEMENT_DEFAULT_STRATEGY = getattr(settings, 'PLACEMENT_DEFAULT_STRATEGY', Group.PlacementStrategy.BEST_FIT.value)
+PLACEMENT_WEIGHTS = getattr(settings, 'PLACEMENT_WEIGHTS', {'vcpu': 1.0, 'mem': 1.0, 'vm': 0.5})
+PLACEMENT_CANDIDATES = 5    # 调度时取排名靠前的宿主机数，排名第一的宿主机资源被并发占用时依次尝试后面的
+
+
+def _ratio(numerator, total_field: str):
+    """
+    剩余资源占总量的比例表达式，总量为0时为NULL
+    """
+    return Cast(numerator, FloatField()) / Cast(NullIf(F(total_field), Value(0)), FloatField())
+
+
+class BasePlacementStrategy:
+    """
+    宿主机调度策略基类，子类实现order_queryset()对已注解剩余资源的查询集排序
+    """
+    name = ''
+
+    @staticmethod
+    def annotate_free(queryset, vcpu: int, mem: int):
+        """
+        注解宿主机剩余资源和放置虚拟机后的剩余资源比例
+
+        free_vcpu、free_mem、free_vm：剩余vcpu、内存、可创建虚拟机数
+        left_score：放置虚拟机后剩余vcpu和内存占总量比例之和，越小说明放置后越满
+        """
+        return queryset.annotate(
+            free_vcpu=F('vcpu_total') - F('vcpu_allocated'),
+            free_mem=F('mem_total') - F('mem_allocated'),
+            free_vm=F('vm_limit') - F('vm_created'),
+        ).annotate(
+            left_score=(_ratio(F('free_vcpu') - vcpu, 'vcpu_total') + _ratio(F('free_mem') - mem, 'mem_total'))
+        )
+
+    def order_queryset(self, queryset, vcpu: int, mem: int, user=None):
+        raise NotImplementedError
+
+    def rank(self, queryset, vcpu: int, mem: int, user=None, limit: int = None):
+        """
+        筛选满足资源需求的宿主机并按策略排序
+
+        :param queryset: 宿主机查询集
+        :param vcpu: 要申请的cpu数
+        :param mem: 要申请的内存大小
+        :param user: 虚拟机所有者，反亲和策略使用
+        :param limit: 最多返回的宿主机数，默认不限制
+        :return:
+            [Host()]    # 排名靠前的在前，可能为空
+        """
+        qs = self.annotate_free(queryset, vcpu=vcpu, mem=mem)
+        qs = qs.filter(free_vcpu__gte=vcpu, free_mem__gte=mem, free_vm__gt=0)
+        qs = self.order_queryset(qs, vcpu=vcpu, mem=mem, user=user)
+        if limit:
+            qs = qs[:limit]
+
+        return list(qs)
+
+
+class BestFitStrategy(BasePlacementStrategy):
+    """
+    最佳适配，优先放置到放置后剩余资源最少的宿主机，尽量填满宿主机，为大规格虚拟机保留完整的宿主机
+    """
+    name = Group.PlacementStrategy.BEST_FIT.value
+
+    def order_queryset(self, queryset, vcpu: int, mem: int, user=None):
+        return queryset.order_by('left_score', 'id')
+
+
+class SpreadStrategy(BasePlacementStrategy):
+    """
+    最差适配，优先放置到剩余资源最多的宿主机，虚拟机分散到各宿主机上
+    """
+    name = Group.PlacementStrategy.SPREAD.value
+
+    def order_queryset(self, queryset, vcpu: int, mem: int, user=None):
+        return queryset.order_by('-left_score', 'id')
+
+
+class WeightedStrategy(BasePlacementStrategy):
+    """
+    加权评分，按放置后剩余vcpu、内存、可创建虚拟机数比例的加权和排序，评分高的优先，权重由PLACEMENT_WEIGHTS配置
+    """
+    name = Group.PlacementStrategy.WEIGHTED.value
+
+    def __init__(self, weights: dict = None):
+        self.weights = weights if weights is not None else PLACEMENT_WEIGHTS
+
+    def order_queryset(self, queryset, vcpu: int, mem: int, user=None):
+        w_vcpu = float(self.weights.get('vcpu', 0))
+        w_mem = float(self.weights.get('mem', 0))
+        w_vm = float(self.weights.get('vm', 0))
+        score = (
+            Value(w_vcpu) * _ratio(F('free_vcpu') - vcpu, 'vcpu_total')
+            + Value(w_mem) * _ratio(F('free_mem') - mem, 'mem_total')
+            + Value(w_vm) * _ratio(F('free_vm') - 1, 'vm_limit')
+        )
+        return queryset.annotate(weighted_score=score).order_by('-weighted_score', 'id')
+
+
+class AntiAffinityStrategy(BasePlacementStrategy):
+    """
+    用户反亲和，优先放置到该用户虚拟机最少的宿主机，数量相同时分散放置；未指定用户时同分散策略
+    """
+    name = Group.PlacementStrategy.ANTI_AFFINITY.value
+
+    def order_queryset(self, queryset, vcpu: int, mem: int, user=None):
+        if not user:
+            return queryset.order_by('-left_score', 'id')
+
+        from vms.models import Vm
+
+        owner_vms = Vm.objects.filter(host=OuterRef('pk'), user=user).order_by().values('host').annotate(
+            c=Count('pk')).values('c')
+        queryset = queryset.annotate(owner_vms=Coalesce(Subquery(owner_vms, output_field=IntegerField()), 0))
+        return queryset.order_by('owner_vms', '-left_score', 'id')
+
+
+class RandomStrategy(BasePlacementStrategy):
+    """
+    随机选择满足资源需求的宿主机
+    """
+    name = Group.PlacementStrategy.RANDOM.value
+
+    def order_queryset(self, queryset, vcpu: int, mem: int, user=None):
+        return queryset.order_by('?')
+
+
+PLACEMENT_STRATEGIES = {
+    s.name: s for s in (BestFitStrategy, SpreadStrategy, WeightedStrategy, AntiAffinityStrategy, RandomStrategy)
+}
+
+
+def get_placement_strategy(name: str = None):
+    """
+    获取调度策略
+
+    :param name: 策略名称，为空时使用默认策略PLACEMENT_DEFAULT_STRATEGY
+    :return:
+        BasePlacementStrategy()
+    :raise ComputeError
+    """
+    if not name:
+        name = PLACEMENT_DEFAULT_STRATEGY
+
+    strategy_class = PLACEMENT_STRATEGIES.get(name)
+    if strategy_class is None:
+        raise ComputeError(msg=f'无效的宿主机调度策略"{name}"')
+
+    return strategy_class()
+
+
+def get_group_placement_strategy(group):
+    """
+    获取宿主机组的调度策略
+
+    :param group: 宿主机组Group()
+    :return:
+        BasePlacementStrategy()
+    :raise ComputeError
+    """
+    return get_placement_strategy(getattr(group, 'placement_strategy', None))
@@ -0,0 +1,196 @@
+"""
+宿主机调度策略模拟
+
+在一个最终回滚的数据库事务中创建临时的宿主机组和宿主机，按创建/删除虚拟机的事件序列回放，
+使用真实的调度策略查询和宿主机资源申请释放流程，统计各策略的拒绝率和资源碎片率
+"""
+import json
+import random
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from compute.models import Center, Group, Host
+from compute.managers import HostManager
+from compute.placement import get_placement_strategy
+
+
+User = get_user_model()
+
+DEFAULT_FLAVORS = ((1, 2, 30), (2, 4, 30), (4, 8, 20), (8, 16, 12), (16, 32, 6), (32, 64, 2))     # (vcpu, mem, 权重)
+
+
+class _Rollback(Exception):
+    pass
+
+
+def generate_trace(num_events: int = 2000, flavors=DEFAULT_FLAVORS, owners: int = 10,
+                   delete_ratio: float = 0.4, seed: int = 0):
+    """
+    生成创建/删除虚拟机事件序列
+
+    :param num_events: 事件数
+    :param flavors: 虚拟机规格 ((vcpu, mem, 权重),)
+    :param owners: 虚拟机所有者数
+    :param delete_ratio: 删除事件占比
+    :param seed: 随机数种子
+    :return:
+        [{'op': 'create', 'id': 'vm1', 'vcpu': 2, 'mem': 4, 'owner': 'u1'}, {'op': 'delete', 'id': 'vm1'}]
+    """
+    rand = random.Random(seed)
+    specs = [(f[0], f[1]) for f in flavors]
+    weights = [f[2] for f in flavors]
+    live = []
+    trace = []
+    for i in range(num_events):
+        if live and rand.random() < delete_ratio:
+            vm_id = live.pop(rand.randrange(len(live)))
+            trace.append({'op': 'delete', 'id': vm_id})
+        else:
+            vcpu, mem = rand.choices(specs, weights=weights)[0]
+            vm_id = f'vm{i}'
+            live.append(vm_id)
+            trace.append({'op': 'create', 'id': vm_id, 'vcpu': vcpu, 'mem': mem, 'owner': f'u{rand.randrange(owners)}'})
+
+    return trace
+
+
+def load_trace(path: str):
+    """
+    从文件加载事件序列，每行一个json事件，格式同generate_trace()
+    """
+    trace = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                trace.append(json.loads(line))
+
+    return trace
+
+
+class PlacementSimulator:
+    """
+    调度策略模拟器
+    """
+    def __init__(self, hosts: int = 20, host_vcpu: int = 64, host_mem: int = 256, vm_limit: int = 64):
+        self.hosts = hosts
+        self.host_vcpu = host_vcpu
+        self.host_mem = host_mem
+        self.vm_limit = vm_limit
+
+    def run(self, strategy: str, trace: list):
+        """
+        回放事件序列，所有数据库修改最终回滚
+
+        :param strategy: 调度策略名称
+        :param trace: 事件序列
+        :return: dict
+            {
+                'strategy': 'best_fit', 'creates': 1200, 'rejected': 10, 'rejection_rate': 0.0083,
+                'fragmentation_avg': 0.12, 'fragmentation_final': 0.2, 'hosts_used': 15
+            }
+        """
+        result = {}
+        try:
+            with transaction.atomic():
+                result = self._run(strategy=strategy, trace=trace)
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        return result
+
+    def _setup(self):
+        center = Center(name=f'placement-sim-{uuid.uuid4().hex[:8]}', location='sim')
+        center.save()
+        group = Group(center=center, name='placement-sim')
+        group.save(force_insert=True)
+        Host.objects.bulk_create([
+            Host(group=group, ipv4=f'198.18.{i // 250}.{i % 250 + 1}', vcpu_total=self.host_vcpu, mem_total=self.host_mem,
+                 vm_limit=self.vm_limit, real_cpu=self.host_vcpu, real_mem=self.host_mem)
+            for i in range(self.hosts)
+        ])
+        return group
+
+    def _run(self, strategy: str, trace: list):
+        from vms.models import Vm
+
+        placement = get_placement_strategy(strategy)
+        group = self._setup()
+        host_qs = Host.objects.filter(group=group)
+        host_manager = HostManager()
+        max_vcpu = max((e['vcpu'] for e in trace if e['op'] == 'create'), default=1)
+        max_mem = max((e['mem'] for e in trace if e['op'] == 'create'), default=1)
+        users = {}
+        vms = {}
+        creates = rejected = 0
+        frag_sum = 0.0
+        frag_count = 0
+        for event in trace:
+            if event['op'] == 'create':
+                creates += 1
+                owner = event.get('owner') or 'sim'
+                if owner not in users:
+                    users[owner], _ = User.objects.get_or_create(username=f'placement-sim-{owner}')
+
+                vcpu, mem = event['vcpu'], event['mem']
+                host = None
+                for h in placement.rank(host_qs, vcpu=vcpu, mem=mem, user=users[owner], limit=1):
+                    host = host_manager.claim_from_host(host_id=h.id, vcpu=vcpu, mem=mem)
+
+                if host is None:
+                    rejected += 1
+                    continue
+
+                vm = Vm(uuid=uuid.uuid4().hex, name=event['id'], vcpu=vcpu, mem=mem, disk=uuid.uuid4().hex,
+                        user=users[owner], host=host, xml='')
+                vm.save(force_insert=True)
+                host.vm_created_num_add_1()
+                vms[event['id']] = vm
+            elif event['op'] == 'delete':
+                vm = vms.pop(event['id'], None)
+                if vm is None:  # 创建时被拒绝的
+                    continue
+
+                host_manager.free_to_host(host_id=vm.host_id, vcpu=vm.vcpu, mem=vm.mem)
+                vm.host.vm_created_num_sub_1()
+                vm.delete()
+            else:
+                continue
+
+            frag_sum += self.fragmentation(host_qs, vcpu=max_vcpu, mem=max_mem)
+            frag_count += 1
+
+        return {
+            'strategy': placement.name,
+            'creates': creates,
+            'rejected': rejected,
+            'rejection_rate': rejected / creates if creates else 0,
+            'fragmentation_avg': frag_sum / frag_count if frag_count else 0,
+            'fragmentation_final': self.fragmentation(host_qs, vcpu=max_vcpu, mem=max_mem),
+            'hosts_used': host_qs.filter(vm_created__gt=0).count(),
+        }
+
+    @staticmethod
+    def fragmentation(host_qs, vcpu: int, mem: int):
+        """
+        资源碎片率，无法放下指定规格虚拟机的宿主机上的剩余内存占全部剩余内存的比例
+
+        :param host_qs: 宿主机查询集
+        :param vcpu: 规格vcpu，一般为最大规格
+        :param mem: 规格内存，一般为最大规格
+        :return:
+            float   # 0-1
+        """
+        total_free = 0
+        stranded = 0
+        for vcpu_total, vcpu_allocated, mem_total, mem_allocated, vm_limit, vm_created in host_qs.values_list(
+                'vcpu_total', 'vcpu_allocated', 'mem_total', 'mem_allocated', 'vm_limit', 'vm_created'):
+            free_mem = max(mem_total - mem_allocated, 0)
+            total_free += free_mem
+            if vcpu_total - vcpu_allocated < vcpu or free_mem < mem or vm_limit <= vm_created:
+                stranded += free_mem
+
+        return stranded / total_free if total_free else 0.0
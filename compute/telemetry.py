@@ -0,0 +1,204 @@
+"""
+宿主机资源使用快照
+
+采集服务(manage.py host_telemetry_collector)周期性通过libvirt连接池并行采集所有启用宿主机的
+cpu(getInfo, getCPUStats)、内存(getMemoryStats)和大页内存(getFreePages)信息，每个宿主机保存最新的一条快照(HostTelemetry)；
+报表等页面只读取快照，请求中不再连接宿主机和ssh
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from utils.db import bulk_upsert
+from utils.ev_libvirt.virt import VirtHost
+from .models import Host, HostTelemetry
+
+
+# 快照有效期（秒），超过时认为采集服务异常，快照不可用
+HOST_TELEMETRY_MAX_AGE = getattr(settings, 'HOST_TELEMETRY_MAX_AGE', 300)
+
+
+def compute_cpu_usage(prev: dict, cur: dict):
+    """
+    由相邻两次采集的cpu累计时间(纳秒)计算cpu使用率
+
+    :param prev: getCPUStats()返回值，kernel, user, idle, iowait
+    :param cur: getCPUStats()返回值
+    :return:
+        float   # 使用率 %
+        None    # 无效，如宿主机重启计数器被重置
+    """
+    if not prev or not cur:
+        return None
+
+    deltas = {k: cur.get(k, 0) - prev.get(k, 0) for k in ('kernel', 'user', 'idle', 'iowait')}
+    if min(deltas.values()) < 0:
+        return None
+
+    total = sum(deltas.values())
+    if total <= 0:
+        return None
+
+    busy = deltas['kernel'] + deltas['user']
+    return round(busy / total * 100, 2)
+
+
+def build_snapshot(host_ipv4: str, telemetry: dict, prev_cpu_stats: dict = None):
+    """
+    由VirtHost.get_telemetry()的采集结果构建快照
+
+    :return: HostTelemetry()    # 未保存
+    """
+    info = telemetry['info']
+    mem = telemetry['mem_stats']
+    hugepages = telemetry['hugepages']
+    return HostTelemetry(
+        host_ipv4=host_ipv4, cpus=info[2], cpu_mhz=info[3],
+        cpu_usage=compute_cpu_usage(prev=prev_cpu_stats, cur=telemetry['cpu_stats']),
+        mem_total=mem.get('total', 0), mem_free=mem.get('free', 0),
+        mem_cached=mem.get('cached', 0), mem_buffers=mem.get('buffers', 0),
+        hugepage_size=hugepages['size'], hugepages_total=hugepages['total'], hugepages_free=hugepages['free'],
+        error='', update_time=timezone.now()
+    )
+
+
+class HostTelemetryCollector:
+    """
+    宿主机资源采集器，内存中保留每个宿主机上一次的cpu累计时间，用于计算cpu使用率
+    """
+    def __init__(self, interval: int = 60, workers: int = 16, logger=None):
+        """
+        :param interval: 采集间隔（秒）
+        :param workers: 同时采集的宿主机数
+        """
+        self.interval = interval
+        self.workers = workers
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self._last_cpu_stats = {}   # {host_ipv4: dict}
+
+    @staticmethod
+    def _get_host_telemetry(host: VirtHost):
+        try:
+            return host.get_telemetry()
+        finally:
+            host.close()
+
+    def collect(self):
+        """
+        并行采集所有启用宿主机的资源信息；采集失败的宿主机只更新错误信息，保留上次的数据
+
+        :return:
+            (
+                [HostTelemetry()],  # 采集成功的快照，未保存
+                {host_ipv4: str}    # 采集失败的宿主机和错误信息
+            )
+        """
+        hosts = []
+        failed = {}
+        for ipv4 in Host.objects.filter(enable=True).values_list('ipv4', flat=True):
+            try:
+                hosts.append(VirtHost(host_ipv4=ipv4))  # 初始化需要查询数据库，在当前线程创建
+            except Exception as e:
+                failed[ipv4] = str(e)
+
+        snapshots = []
+        if not hosts:
+            return snapshots, failed
+
+        with ThreadPoolExecutor(max_workers=max(min(len(hosts), self.workers), 1)) as executor:
+            futures = [(h.host_ipv4, executor.submit(self._get_host_telemetry, h)) for h in hosts]
+            for ipv4, future in futures:
+                try:
+                    telemetry = future.result()
+                except Exception as e:
+                    failed[ipv4] = str(e)
+                    continue
+
+                snapshots.append(build_snapshot(
+                    host_ipv4=ipv4, telemetry=telemetry, prev_cpu_stats=self._last_cpu_stats.get(ipv4)))
+                self._last_cpu_stats[ipv4] = telemetry['cpu_stats']
+
+        for ipv4, err in failed.items():
+            self.logger.warning(f'collect telemetry of host({ipv4}) error, {err}')
+
+        return snapshots, failed
+
+    def run_once(self):
+        snapshots, failed = self.collect()
+        HostTelemetryManager.save_snapshots(snapshots)
+        HostTelemetryManager.save_errors(failed)
+        return len(snapshots), len(failed)
+
+    def run_forever(self):
+        while True:
+            start = time.time()
+            close_old_connections()
+            try:
+                self.run_once()
+            except Exception as e:
+                self.logger.error(f'collect host telemetry error, {str(e)}')
+
+            time.sleep(max(self.interval - (time.time() - start), 0))
+
+
+class HostTelemetryManager:
+    """
+    宿主机资源快照管理
+    """
+    UPDATE_FIELDS = [
+        'cpus', 'cpu_mhz', 'cpu_usage', 'mem_total', 'mem_free', 'mem_cached', 'mem_buffers',
+        'hugepage_size', 'hugepages_total', 'hugepages_free', 'error', 'update_time'
+    ]
+
+    @staticmethod
+    def save_snapshots(snapshots: list):
+        """
+        保存快照，每个宿主机只保留最新的一条
+        """
+        if snapshots:
+            bulk_upsert(HostTelemetry, snapshots, batch_size=200, unique_fields=['host_ipv4'],
+                        update_fields=HostTelemetryManager.UPDATE_FIELDS)
+
+        return len(snapshots)
+
+    @staticmethod
+    def save_errors(failed: dict):
+        """
+        记录采集失败的错误信息，不修改快照数据和更新时间，快照过期后不再可用
+
+        :param failed: {host_ipv4: str}
+        """
+        for ipv4, err in failed.items():
+            HostTelemetry.objects.filter(host_ipv4=ipv4).update(error=err[:255])
+
+    @staticmethod
+    def get_snapshots(ipv4s: list = None, max_age: int = HOST_TELEMETRY_MAX_AGE):
+        """
+        查询有效期内的宿主机资源快照
+
+        :param ipv4s: 宿主机ip列表，None时所有
+        :param max_age: 快照有效期（秒）
+        :return:
+            {host_ipv4: HostTelemetry()}
+        """
+        qs = HostTelemetry.objects.filter(update_time__gte=timezone.now() - timedelta(seconds=max_age))
+        if ipv4s is not None:
+            qs = qs.filter(host_ipv4__in=ipv4s)
+
+        return {s.host_ipv4: s for s in qs}
+
+    @staticmethod
+    def get_snapshot(host_ipv4: str, max_age: int = HOST_TELEMETRY_MAX_AGE):
+        """
+        查询宿主机有效期内的资源快照
+
+        :return:
+            HostTelemetry()
+            None    # 没有或已过期
+        """
+        return HostTelemetryManager.get_snapshots(ipv4s=[host_ipv4], max_age=max_age).get(host_ipv4)
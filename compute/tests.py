@@ -1,3 +1,227 @@
+from datetime import timedelta
+
 from django.test import TestCase
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+
+from compute.models import Center, Group, Host, HostTelemetry
+from compute.managers import HostManager, CenterManager
+from compute.placement import get_placement_strategy
+from compute.placement_sim import PlacementSimulator, generate_trace
+from compute.telemetry import HostTelemetryManager, build_snapshot, compute_cpu_usage
+from utils.errors import ComputeError
+
+
+User = get_user_model()
+
+
+class PlacementTests(TestCase):
+    def setUp(self):
+        center = Center(name='test', location='test')
+        center.save()
+        self.group = Group(center=center, name='test')
+        self.group.save(force_insert=True)
+        # 剩余 vcpu/mem：h1 4/8，h2 12/24，h3 2/2(不满足)
+        self.h1 = Host(group=self.group, ipv4='10.0.0.1', vcpu_total=16, vcpu_allocated=12, mem_total=32,
+                       mem_allocated=24, vm_limit=10)
+        self.h2 = Host(group=self.group, ipv4='10.0.0.2', vcpu_total=16, vcpu_allocated=4, mem_total=32,
+                       mem_allocated=8, vm_limit=10)
+        self.h3 = Host(group=self.group, ipv4='10.0.0.3', vcpu_total=16, vcpu_allocated=14, mem_total=32,
+                       mem_allocated=30, vm_limit=10)
+        for h in [self.h1, self.h2, self.h3]:
+            h.save(force_insert=True)
+
+    def test_rank(self):
+        qs = Host.objects.filter(group=self.group)
+        ranked = get_placement_strategy('best_fit').rank(qs, vcpu=2, mem=4)
+        self.assertEqual([h.id for h in ranked], [self.h1.id, self.h2.id])
+        ranked = get_placement_strategy('spread').rank(qs, vcpu=2, mem=4)
+        self.assertEqual([h.id for h in ranked], [self.h2.id, self.h1.id])
+        ranked = get_placement_strategy('weighted').rank(qs, vcpu=2, mem=4, limit=1)
+        self.assertEqual([h.id for h in ranked], [self.h2.id])
+        ranked = get_placement_strategy('random').rank(qs, vcpu=8, mem=16)
+        self.assertEqual([h.id for h in ranked], [self.h2.id])
+
+        # vm数量达到上限
+        Host.objects.filter(id=self.h1.id).update(vm_created=10)
+        ranked = get_placement_strategy('best_fit').rank(qs, vcpu=2, mem=4)
+        self.assertEqual([h.id for h in ranked], [self.h2.id])
+
+        with self.assertRaises(ComputeError):
+            get_placement_strategy('test')
+
+    def test_anti_affinity(self):
+        from vms.models import Vm
+
+        user = User.objects.create(username='test')
+        Vm(uuid='test1', name='test1', vcpu=1, mem=1, disk='test1', user=user, host=self.h2, xml='').save()
+        qs = Host.objects.filter(group=self.group)
+        ranked = get_placement_strategy('anti_affinity').rank(qs, vcpu=2, mem=4, user=user)
+        self.assertEqual([h.id for h in ranked], [self.h1.id, self.h2.id])
+        ranked = get_placement_strategy('anti_affinity').rank(qs, vcpu=2, mem=4)
+        self.assertEqual([h.id for h in ranked], [self.h2.id, self.h1.id])
+
+    def test_reconcile_host_quotas(self):
+        from vms.models import Vm
+
+        user = User.objects.create(username='test')
+        for i in range(2):
+            Vm(uuid=f'test{i}', name=f'test{i}', vcpu=2, mem=4, disk=f'test{i}', user=user, host=self.h2, xml='').save()
+        Vm(uuid='test2', name='test2', vcpu=2, mem=4, disk='test2', user=user, host=self.h3, xml='',
+           vm_status=Vm.VmStatus.SHELVE.value).save()
+
+        report = HostManager.reconcile_host_quotas(dry_run=True)
+        drifts = {d['host_id']: d for d in report}
+        self.assertEqual(set(drifts), {self.h1.id, self.h2.id, self.h3.id})
+        self.assertEqual(drifts[self.h2.id]['vm_created'], (0, 2))
+        self.assertEqual(drifts[self.h2.id]['vcpu_allocated'], (4, 4))
+        self.assertEqual(drifts[self.h3.id]['mem_allocated'], (30, 0))     # 搁置的虚拟机不占用宿主机资源
+        self.assertFalse(any(d['updated'] for d in report))
+        self.h1.refresh_from_db()
+        self.assertEqual(self.h1.vcpu_allocated, 12)
+
+        report = HostManager.reconcile_host_quotas(host_ids=[self.h1.id, self.h2.id])
+        self.assertEqual(len(report), 2)
+        self.assertTrue(all(d['updated'] for d in report))
+        for h in [self.h1, self.h2, self.h3]:
+            h.refresh_from_db()
+        self.assertEqual((self.h1.vcpu_allocated, self.h1.mem_allocated, self.h1.vm_created), (0, 0, 0))
+        self.assertEqual((self.h2.vcpu_allocated, self.h2.mem_allocated, self.h2.vm_created), (4, 8, 2))
+        self.assertEqual(self.h3.vcpu_allocated, 14)
+        self.assertEqual(HostManager.reconcile_host_quotas(host_ids=[self.h1.id, self.h2.id]), [])
+
+    def test_reconcile_skip_busy_hosts(self):
+        from vms.models import MigrateTask, VmBatchJob, VmBatchJobItem
+
+        # 有未完成迁移任务、批量创建任务的宿主机已申请的资源还没有虚拟机记录，不校正
+        MigrateTask.objects.create(vm_uuid='test', src_host=self.h1, src_host_ipv4=self.h1.ipv4,
+                                   dst_host_ipv4='10.0.0.100', status=MigrateTask.Status.IN_PROCESS)
+        job = VmBatchJob.objects.create(id='test', total=1, image_id=1, vcpu=2, mem=4)
+        VmBatchJobItem.objects.create(job=job, index=0, vm_uuid='test', host=self.h2)
+        report = HostManager.reconcile_host_quotas()
+        self.assertEqual([d['host_id'] for d in report], [self.h3.id])
+
+        MigrateTask.objects.update(status=MigrateTask.Status.COMPLETE)
+        VmBatchJob.objects.update(status=VmBatchJob.Status.COMPLETE)
+        report = HostManager.reconcile_host_quotas()
+        self.assertEqual({d['host_id'] for d in report}, {self.h1.id, self.h2.id})
+
+    def test_reconcile_skip_claimed_hosts(self):
+        # 单个虚拟机创建时先申请资源，虚拟机记录还没有保存，不校正
+        Host.objects.update(vcpu_allocated=0, mem_allocated=0)
+        HostManager.claim_from_host(host_id=self.h1.id, vcpu=2, mem=4)
+        self.assertEqual(HostManager.reconcile_host_quotas(), [])
+        self.h1.refresh_from_db()
+        self.assertEqual((self.h1.vcpu_allocated, self.h1.mem_allocated), (2, 4))
+
+        # 超过时间仍没有虚拟机记录的按漂移校正
+        Host.objects.filter(id=self.h1.id).update(claim_time=timezone.now() - timedelta(hours=1))
+        report = HostManager.reconcile_host_quotas()
+        self.assertEqual([(d['host_id'], d['updated']) for d in report], [(self.h1.id, True)])
+        self.h1.refresh_from_db()
+        self.assertEqual((self.h1.vcpu_allocated, self.h1.mem_allocated), (0, 0))
+
+    def test_claim_free(self):
+        host = HostManager.claim_from_host(host_id=self.h1.id, vcpu=4, mem=8)
+        self.assertEqual(host.vcpu_allocated, 16)
+        self.assertEqual(host.mem_allocated, 32)
+        with self.assertRaises(ComputeError):
+            HostManager.claim_from_host(host_id=self.h1.id, vcpu=1, mem=1)
+
+        self.assertIsNone(HostManager.claim_from_host(host_id=0, vcpu=1, mem=1))
+
+        # 一次申请多个虚拟机的资源
+        host = HostManager.claim_batch_from_host(host_id=self.h2.id, vcpu=2, mem=4, count=5)
+        self.assertEqual(host.vcpu_allocated, 14)
+        self.assertEqual(host.mem_allocated, 28)
+        Host.objects.filter(id=self.h2.id).update(vm_created=8)
+        with self.assertRaises(ComputeError):   # 超过虚拟机数量上限
+            HostManager.claim_batch_from_host(host_id=self.h2.id, vcpu=0, mem=0, count=3)
+
+        self.assertTrue(HostManager.free_to_host(host_id=self.h2.id, vcpu=2, mem=4, count=5))
+        self.h2.refresh_from_db()
+        self.assertEqual(self.h2.vcpu_allocated, 4)
+        self.assertEqual(self.h2.mem_allocated, 8)
+        self.assertTrue(HostManager.free_to_host(host_id=self.h2.id, vcpu=100, mem=100))
+        self.h2.refresh_from_db()
+        self.assertEqual(self.h2.vcpu_allocated, 0)
+        self.assertEqual(self.h2.mem_allocated, 0)
+        self.assertFalse(HostManager.free_to_host(host_id=0, vcpu=1, mem=1))
+
+    def test_simulator(self):
+        trace = generate_trace(num_events=200, seed=1)
+        simulator = PlacementSimulator(hosts=4, host_vcpu=32, host_mem=64, vm_limit=20)
+        for name in ['best_fit', 'spread']:
+            r = simulator.run(strategy=name, trace=trace)
+            self.assertEqual(r['strategy'], name)
+            self.assertEqual(r['creates'], len([e for e in trace if e['op'] == 'create']))
+            self.assertTrue(0 <= r['rejection_rate'] <= 1)
+            self.assertTrue(0 <= r['fragmentation_avg'] <= 1)
+
+        # 模拟的数据回滚
+        self.assertFalse(Group.objects.filter(name='placement-sim').exists())
+
+
+class CenterStatTests(TestCase):
+    def add_center(self, name: str, hosts: int):
+        center = Center(name=name, location=name)
+        center.save()
+        group = Group(center=center, name=name)
+        group.save(force_insert=True)
+        for i in range(hosts):
+            Host(group=group, ipv4=f'10.{center.id}.0.{i}', vcpu_total=16, vcpu_allocated=4, mem_total=32,
+                 mem_allocated=8, real_cpu=8, vm_limit=10, vm_created=1).save(force_insert=True)
+
+    def test_stat_all_center(self):
+        from vpn.models import VPNAuth
+
+        quota, flag = CenterManager().get_all_center_cpn_mem_stat()
+        self.assertFalse(flag)
+
+        self.add_center(name='c1', hosts=2)
+        self.add_center(name='c2', hosts=1)
+        VPNAuth(username='u1', active=True).save()
+        VPNAuth(username='u2', active=False).save()
+        with self.assertNumQueries(5):
+            quota = CenterManager().get_stat_all_center(user=None)
+
+        self.assertEqual(quota['vcpu_total'], 48)   # 所有数据中心的宿主机
+        self.assertEqual(quota['mem_allocated'], 24)
+        self.assertEqual(quota['vm_created'], 3)
+        self.assertEqual(quota['cpu_rate'], 0.25)
+        self.assertEqual(quota['ips_rate'], 0.0)
+        self.assertEqual((quota['vpn_total'], quota['vpn_active'], quota['vpn_invalid']), (2, 1, 1))
+
+        # 查询数不随数据中心数量增加
+        for i in range(5):
+            self.add_center(name=f'c{i + 3}', hosts=2)
+        with self.assertNumQueries(5):
+            quota = CenterManager().get_stat_all_center(user=None)
+        self.assertEqual(quota['vcpu_total'], 16 * 13)
+
+
+class HostTelemetryTests(TestCase):
+    def test_snapshot(self):
+        telemetry = {
+            'info': ['x86_64', 257000, 64, 2400, 2, 2, 16, 2],
+            'cpu_stats': {'kernel': 300, 'user': 700, 'idle': 3000, 'iowait': 0},
+            'mem_stats': {'total': 263000000, 'free': 1000000, 'buffers': 2000, 'cached': 3000},
+            'hugepages': {'size': 1048576, 'total': 240, 'free': 40}
+        }
+        prev = {'kernel': 100, 'user': 300, 'idle': 1600, 'iowait': 0}
+        self.assertEqual(compute_cpu_usage(prev=prev, cur=telemetry['cpu_stats']), 30.0)
+        self.assertIsNone(compute_cpu_usage(prev=telemetry['cpu_stats'], cur=prev))    # 计数器被重置
+        self.assertIsNone(compute_cpu_usage(prev=None, cur=prev))
+
+        HostTelemetryManager.save_snapshots([build_snapshot('10.0.0.1', telemetry),
+                                             build_snapshot('10.0.0.2', telemetry)])
+        telemetry['hugepages']['free'] = 20
+        HostTelemetryManager.save_snapshots([build_snapshot('10.0.0.1', telemetry, prev_cpu_stats=prev)])
+        self.assertEqual(HostTelemetry.objects.count(), 2)
+        s = HostTelemetryManager.get_snapshot('10.0.0.1')
+        self.assertEqual((s.cpus, s.cpu_usage, s.hugepages_total, s.hugepages_free), (64, 30.0, 240, 20))
 
-# Create your tests here.
+        HostTelemetryManager.save_errors({'10.0.0.2': 'connect error'})
+        HostTelemetry.objects.filter(host_ipv4='10.0.0.2').update(update_time=timezone.now() - timedelta(hours=1))
+        self.assertIsNone(HostTelemetryManager.get_snapshot('10.0.0.2'))
+        self.assertEqual(list(HostTelemetryManager.get_snapshots()), ['10.0.0.1'])
@@ -300,6 +300,42 @@ SIMPLE_JWT = {
 
 # vnc
 VNCSERVER_BASE_PORT = 5900
+NOVNC_TOKEN_KEEP_DAYS = 3          # novnc token记录保留天数，由定时任务清理(manage.py purge_novnc_token)
+
+# libvirt宿主机连接池，每个进程独立
+LIBVIRT_CONN_POOL_MAX_SIZE = 32     # 每个进程最多缓存的宿主机连接数
+LIBVIRT_KEEPALIVE_INTERVAL = 5      # keepalive探测间隔（秒）
+LIBVIRT_KEEPALIVE_COUNT = 3         # keepalive连续无响应次数，超过后连接被关闭
+RADOS_HEALTH_CHECK_INTERVAL = 30    # ceph集群连接复用时超过此时间（秒）未检查则向集群查询一次确认连接有效，每个进程独立
+RADOS_CONNECT_TIMEOUT = 10          # ceph集群连接和mon、osd操作超时时间（秒）
+VM_DOMAIN_STATE_CACHE_TTL = 60      # 虚拟机运行状态缓存有效期（秒），由domain_state_collector服务维护
+VMS_STATUS_BATCH_MAX_WORKERS = 16   # 批量查询虚拟机状态时并行查询宿主机的最大线程数
+VM_METRICS_RINGS = ((10, 360), (300, 2016))    # 虚拟机监控指标降采样规格（采样间隔秒, 采样点数），10秒保留1小时，5分钟保留7天
+PLACEMENT_DEFAULT_STRATEGY = 'best_fit'    # 宿主机组未指定调度策略时使用的策略，best_fit, spread, weighted, anti_affinity, random
+PLACEMENT_WEIGHTS = {'vcpu': 1.0, 'mem': 1.0, 'vm': 0.5}   # weighted策略宿主机剩余vcpu、内存、虚拟机数量比例的权重
+VM_BATCH_CREATE_MAX = 200            # 批量创建虚拟机一次最多创建的数量
+VM_BATCH_CREATE_WORKERS = 8         # 批量创建虚拟机克隆系统盘和定义虚拟机的并发线程数
+MIRROR_IMAGE_PULL_STREAM = True     # 公共镜像下载不落地，分段并发下载直接写入rbd镜像
+MIRROR_IMAGE_PUSH_STREAM = True     # 公共镜像上传不导出本地文件，从rbd镜像已分配的数据直接生成稀疏qcow2上传
+MIRROR_IMAGE_TRANSFER_WORKERS = 4   # 公共镜像传输并发数
+MIRROR_IMAGE_TRANSFER_CHUNK_SIZE = 16 * 1024 ** 2   # 公共镜像传输每个分段的最大大小（字节）
+HOST_TELEMETRY_MAX_AGE = 300        # 宿主机资源快照有效期（秒），由host_telemetry_collector服务定期更新
+HOST_QUOTA_RECONCILE_GRACE = 300    # 校正宿主机已分配资源时跳过此时间（秒）内申请过资源的宿主机，申请的资源可能还没有虚拟机记录
+JOB_WORKERS = 8                     # 后台任务执行服务(manage.py run_workers)同时执行的任务数
+JOB_LEASE_SECONDS = 60              # 后台任务租约时间（秒），执行服务退出后超过此时间未续约的任务被回收
+JOB_HOST_CONCURRENCY = 2            # 每个宿主机同时执行的同类型后台任务数，如动态迁移
+JOB_RETRY_DELAY = 30                # 可重试的后台任务第一次重试的间隔（秒），之后每次加倍
+JOB_LIVE_MIGRATE_TIMEOUT = 6 * 3600     # 动态迁移后台任务超时时间（秒）
+JOB_VM_BATCH_CREATE_TIMEOUT = 3600      # 批量创建虚拟机后台任务超时时间（秒）
+LIVE_MIGRATE_DEST_URI = 'qemu+ssh://{host_ipv4}/system?no_tty=1'   # 点对点动态迁移时源宿主机连接目标宿主机的uri，源宿主机需能免密连接
+LIVE_MIGRATE_MONITOR_INTERVAL = 2   # 动态迁移进度(jobStats)采样间隔（秒）
+HOST_EVACUATE_PARALLEL = 4          # 宿主机疏散时从此宿主机同时迁出的虚拟机数
+HOST_EVACUATE_DEST_PARALLEL = 2     # 宿主机疏散时每个目标宿主机同时迁入的虚拟机数
+JOB_HOST_EVACUATE_TIMEOUT = 24 * 3600   # 宿主机疏散后台任务超时时间（秒）
+REBALANCE_MAX_MOVES = 10            # 宿主机组负载均衡(manage.py rebalance_hosts)每个宿主机组每次运行的迁移数上限
+REBALANCE_MAX_MOVES_PER_HOST = 2    # 宿主机组负载均衡每个宿主机每次运行迁入和迁出的虚拟机总数上限
+REBALANCE_UTIL_WEIGHT = 0.5         # 宿主机负载中实际内存使用率(宿主机资源快照)的权重，其余为内存分配率
+REBALANCE_MIN_IMPROVEMENT = 0.001   # 宿主机组负载均衡每次迁移负载标准差的最小下降量
 # NOVNC_SERVER_PORT = 84  # novnc代理服务websockify的端口； 默认为80（需要通过nginx代理）
 
 # 日志配置
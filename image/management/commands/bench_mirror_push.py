@@ -0,0 +1,130 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from django.core.management.base import BaseCommand, CommandError
+
+from image.transfer import ChunkPusher, FileSource, HttpChunkWriter
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    模拟公共镜像服务的分块上传接口 POST api/v2/obj/<bucket>/<path>?offset=，
+    每个连接的带宽和每个请求的延迟可配置，数据写入server.target_fd
+    """
+    protocol_version = 'HTTP/1.1'   # keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes = b'{}'):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        try:
+            offset = int(parse_qs(url.query)['offset'][0])
+        except (KeyError, ValueError):
+            return self._reply(400, b'{"code": "InvalidOffset"}')
+
+        if not url.path.startswith('/api/v2/obj/'):
+            return self._reply(404)
+
+        if hashlib.md5(data).hexdigest() != self.headers.get('Content-MD5'):
+            return self._reply(400, b'{"code": "BadDigest"}')
+
+        delay = self.server.latency
+        if self.server.bandwidth:
+            delay += len(data) / self.server.bandwidth
+        time.sleep(delay)
+
+        os.pwrite(self.server.target_fd, data, offset)
+        with self.server.lock:
+            self.server.requests += 1
+        self._reply(200)
+
+
+class Command(BaseCommand):
+    '''
+    公共镜像分块上传性能测试
+    '''
+
+    help = """
+            在本地启动一个模拟公共镜像服务的HTTP服务，对比不同并发数分块上传一个临时文件的耗时和吞吐量
+            python manage.py bench_mirror_push [--size 256] [--chunk-size 16] [--workers 1,4,8] [--latency 20] [--bandwidth 50]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', default=256, dest='size', type=int, help='测试文件大小(MB)')
+        parser.add_argument('--chunk-size', default=16, dest='chunk_size', type=int, help='分块大小(MB)')
+        parser.add_argument('--workers', default='1,4,8', dest='workers', help='并发数，多个用逗号分隔')
+        parser.add_argument('--latency', default=20, dest='latency', type=float, help='模拟服务每个请求的延迟(毫秒)')
+        parser.add_argument('--bandwidth', default=50, dest='bandwidth', type=float,
+                            help='模拟服务每个连接的带宽(MB/s)，0不限制')
+
+    def handle(self, *args, **options):
+        try:
+            workers_list = [int(w) for w in options['workers'].split(',') if w.strip()]
+        except ValueError:
+            raise CommandError('--workers参数无效')
+
+        size = options['size'] * 1024 ** 2
+        chunk_size = options['chunk_size'] * 1024 ** 2
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source.qcow2')
+            with open(source, 'wb') as f:
+                for _ in range(options['size']):
+                    f.write(os.urandom(1024 ** 2))
+            with open(source, 'rb') as f:
+                source_md5 = hashlib.md5(f.read()).hexdigest()
+
+            server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+            server.daemon_threads = True
+            server.lock = threading.Lock()
+            server.latency = options['latency'] / 1000
+            server.bandwidth = options['bandwidth'] * 1024 ** 2
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            url = f'http://127.0.0.1:{server.server_address[1]}/'
+            try:
+                for workers in workers_list:
+                    target = os.path.join(tmpdir, f'target-{workers}')
+                    server.target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+                    server.connections = server.requests = 0
+                    try:
+                        writer = HttpChunkWriter(url=url, bucket_name='bench', objpath='bench/source.qcow2',
+                                                 bucket_token='bench')
+                        with FileSource(source) as src:
+                            r = ChunkPusher(source=src, write=writer.write, chunk_size=chunk_size,
+                                            workers=workers).run()
+                    finally:
+                        os.close(server.target_fd)
+
+                    with open(target, 'rb') as f:
+                        ok = hashlib.md5(f.read()).hexdigest() == source_md5
+
+                    self.stdout.write(
+                        f"workers={workers}, chunks={r['chunks']}, elapsed={r['seconds']:.2f}s, "
+                        f"throughput={size / r['seconds'] / 1024 ** 2:.1f}MB/s, "
+                        f"requests={server.requests}, connections={server.connections}, verified={ok}"
+                    )
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        self.stdout.write(self.style.SUCCESS('Successfully benchmark mirror image push.'))
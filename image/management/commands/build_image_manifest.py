@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from image.models import Image
+from image.managers import ImageChunkManager
+from image.transfer import build_rbd_manifest
+
+
+class Command(BaseCommand):
+    '''
+    计算镜像数据块清单
+    '''
+
+    help = """
+            计算镜像的数据块清单(4MiB分块SHA-256摘要)，下载公共镜像时用于从本地镜像复制相同的数据块；
+            默认只计算还没有清单的镜像
+            python manage.py build_image_manifest [--image-id 1] [--rebuild]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--image-id', default=None, dest='image_id', type=int, help='只计算指定的镜像')
+        parser.add_argument('--rebuild', default=False, dest='rebuild', action='store_true', help='重新计算已有清单的镜像')
+
+    def handle(self, *args, **options):
+        qs = Image.objects.select_related('ceph_pool__ceph').all()
+        if options['image_id']:
+            qs = qs.filter(id=options['image_id'])
+        if not options['rebuild']:
+            qs = qs.filter(chunks__isnull=True)
+
+        ok = failed = 0
+        for image in qs.distinct():
+            try:
+                rbd = image.get_rbd_manager()
+                rbd_image = rbd.get_rbd_image(image_name=image.base_image)
+                try:
+                    manifest = build_rbd_manifest(rbd_image)
+                finally:
+                    rbd.close_rbd_image(rbd_image)
+
+                ImageChunkManager.save_manifest(image=image, manifest=manifest)
+            except Exception as e:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f'image(id={image.id}, {image.base_image}) error, {str(e)}'))
+                continue
+
+            ok += 1
+            self.stdout.write(f'image(id={image.id}, {image.base_image}) chunks={len(manifest["chunks"])}')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully build image manifest, ok={ok}, failed={failed}.'))
@@ -1,6 +1,7 @@
+from django.db import transaction
 from django.db.models import Q
 
-from .models import Image, MirrorImageTask, VmXmlTemplate
+from .models import Image, ImageChunk, MirrorImageTask, VmXmlTemplate
 from compute.managers import CenterManager, ComputeError
 from utils.errors import ImageError, BadRequestError, Error
 
@@ -141,6 +142,49 @@ class ImageManager:
         return VmXmlTemplate.objects.all()
 
 
+class ImageChunkManager:
+    """
+    镜像数据块清单管理
+    """
+    @staticmethod
+    def save_manifest(image: Image, manifest: dict):
+        """
+        保存镜像的数据块清单，替换已有的
+        """
+        objs = [ImageChunk(image=image, index=i, digest=d) for i, d in manifest['chunks'].items()]
+        with transaction.atomic():
+            ImageChunk.objects.filter(image=image).delete()
+            ImageChunk.objects.bulk_create(objs, batch_size=1000)
+
+    @staticmethod
+    def find_local_chunks(digests, exclude_image_id: int = None):
+        """
+        查找本地镜像中已有的数据块，每个摘要取一个
+
+        :param digests: 数据块摘要
+        :param exclude_image_id: 不包含此镜像的数据块
+        :return:
+            {digest: (Image(), index)}
+        """
+        digests = list(set(digests))
+        images = {}
+        found = {}
+        for i in range(0, len(digests), 500):
+            qs = ImageChunk.objects.filter(digest__in=digests[i:i + 500])
+            if exclude_image_id:
+                qs = qs.exclude(image_id=exclude_image_id)
+
+            for image_id, index, digest in qs.values_list('image_id', 'index', 'digest'):
+                if digest not in found:
+                    found[digest] = (image_id, index)
+                    images[image_id] = None
+
+        for image in Image.objects.select_related('ceph_pool__ceph').filter(id__in=list(images)):
+            images[image.id] = image
+
+        return {d: (images[image_id], index) for d, (image_id, index) in found.items() if images.get(image_id)}
+
+
 class MirrorImageManager:
     """公共镜像任务管理"""
 
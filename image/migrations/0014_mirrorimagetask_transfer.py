@@ -0,0 +1,43 @@
+# Generated by Django 4.2.9 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0013_alter_mirrorimagetask_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='transfer_size',
+            field=models.BigIntegerField(default=0, verbose_name='传输文件大小（字节）'),
+        ),
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='transfer_chunk_size',
+            field=models.IntegerField(default=0, verbose_name='传输分块大小（字节）'),
+        ),
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='transfer_done',
+            field=models.TextField(blank=True, default='', help_text='已完成的分块序号区间，如"0-9,12"，用于中断后继续传输', verbose_name='已传输的分块'),
+        ),
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='transfer_bytes',
+            field=models.BigIntegerField(default=0, verbose_name='已传输字节数'),
+        ),
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='transfer_speed',
+            field=models.BigIntegerField(default=0, verbose_name='传输速度（字节/秒）'),
+        ),
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='transfer_eta',
+            field=models.IntegerField(default=0, verbose_name='预计剩余时间（秒）'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.9 on 2026-10-18 17:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0014_mirrorimagetask_transfer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField(verbose_name='块序号')),
+                ('digest', models.CharField(max_length=64, verbose_name='SHA-256摘要')),
+                ('image', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='image.image', verbose_name='镜像')),
+            ],
+            options={
+                'verbose_name': '镜像数据块',
+                'verbose_name_plural': '镜像数据块',
+                'db_table': 'image_chunk',
+                'indexes': [models.Index(fields=['digest'], name='image_chunk_digest_idx')],
+                'unique_together': {('image', 'index')},
+            },
+        ),
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='dedup_bytes',
+            field=models.BigIntegerField(default=0, help_text='下载时从本地已有镜像复制相同数据块的字节数', verbose_name='本地复制字节数'),
+        ),
+        migrations.AddField(
+            model_name='mirrorimagetask',
+            name='transfer_seconds',
+            field=models.IntegerField(default=0, verbose_name='传输耗时（秒）'),
+        ),
+    ]
@@ -219,6 +219,8 @@ class Image(models.Model):
         except RadosError as e:
             raise Exception(f'create_snap error, {str(e)}')
         self.snap = snap_name
+        if self.pk:     # 镜像数据已更新，已记录的数据块清单失效
+            ImageChunk.objects.filter(image_id=self.pk).delete()
         return True
 
     def delete(self, using=None, keep_parents=False):
@@ -307,6 +309,29 @@ class Image(models.Model):
         return self.ceph_pool.ceph.center
 
 
+class ImageChunk(models.Model):
+    """
+    镜像数据块，镜像虚拟磁盘按固定大小分块的SHA-256摘要，用于镜像下载时从本地已有镜像复制相同的数据块；
+    全零的块不记录
+    """
+    image = models.ForeignKey(to=Image, on_delete=models.CASCADE, related_name='chunks', db_constraint=False,
+                              verbose_name=_('镜像'))
+    index = models.IntegerField(verbose_name=_('块序号'))
+    digest = models.CharField(verbose_name=_('SHA-256摘要'), max_length=64)
+
+    class Meta:
+        db_table = 'image_chunk'
+        verbose_name = _('镜像数据块')
+        verbose_name_plural = _('镜像数据块')
+        unique_together = ('image', 'index')
+        indexes = [
+            models.Index(fields=['digest'], name='image_chunk_digest_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.image_id}-{self.index}'
+
+
 class MirrorImageTask(models.Model):
     """公共镜像任务表"""
 
@@ -380,6 +405,16 @@ class MirrorImageTask(models.Model):
     download_or_upload_status = models.BooleanField(verbose_name=_('下载或上传完成'), default=False)
     create_os_image = models.BooleanField(verbose_name=_('创建操作系统镜像完成'), default=False)
     xml_tpl_search = models.CharField(verbose_name=_('xml模板关键字查询'), max_length=255, null=True, blank=True, default=None)
+    transfer_size = models.BigIntegerField(verbose_name=_('传输文件大小（字节）'), default=0)
+    transfer_chunk_size = models.IntegerField(verbose_name=_('传输分块大小（字节）'), default=0)
+    transfer_done = models.TextField(verbose_name=_('已传输的分块'), default='', blank=True,
+                                     help_text='已完成的分块序号区间，如"0-9,12"，用于中断后继续传输')
+    transfer_bytes = models.BigIntegerField(verbose_name=_('已传输字节数'), default=0)
+    transfer_speed = models.BigIntegerField(verbose_name=_('传输速度（字节/秒）'), default=0)
+    transfer_eta = models.IntegerField(verbose_name=_('预计剩余时间（秒）'), default=0)
+    dedup_bytes = models.BigIntegerField(verbose_name=_('本地复制字节数'), default=0,
+                                         help_text='下载时从本地已有镜像复制相同数据块的字节数')
+    transfer_seconds = models.IntegerField(verbose_name=_('传输耗时（秒）'), default=0)
 
 
     class Meta:
@@ -1,5 +1,4 @@
 # 公共镜像上传
-import hashlib
 import os
 import subprocess
 import sys
@@ -10,6 +9,7 @@ from pathlib import Path
 import math
 import requests
 from django import setup
+from django.conf import settings
 from django.utils import timezone
 
 # 将项目路径添加到系统搜寻路径当中，查找方式为从当前脚本开始，找到要调用的django项目的路径
@@ -22,6 +22,12 @@ from image.models import MirrorImageTask, Image
 from utils.loggers import config_script_logger
 from ceph.models import CephCluster, CephPool
 from ceph.managers import get_rbd_manager
+from image.managers import ImageChunkManager
+from image.transfer import (
+    HttpRangeReader, HttpChunkWriter, ChunkPusher, FileSource, UnsupportedImageError, manifest_pull_to_rbd,
+    rbd_sparse_qcow2, build_rbd_manifest, manifest_dumps, manifest_loads,
+    encode_chunk_ranges, decode_chunk_ranges, MIRROR_IMAGE_TRANSFER_CHUNK_SIZE
+)
 
 mirror_image_task_logger = config_script_logger(name='app-mirror-image-task', filename='app_mirror_image_task.log')
 
@@ -31,6 +37,11 @@ parser.add_argument('-o', '--operate', type=str, help='上传下载（push/pull
 args = parser.parse_args()
 
 read_chunk_size = (1024 ** 2) * 100
+# 下载镜像时不落地，分段并发下载直接写入rbd镜像；镜像格式不支持时使用本地暂存文件的方式
+pull_stream = getattr(settings, 'MIRROR_IMAGE_PULL_STREAM', True)
+# 上传镜像时不导出本地文件，直接从rbd镜像已分配的数据生成稀疏qcow2分块上传
+push_stream = getattr(settings, 'MIRROR_IMAGE_PUSH_STREAM', True)
+MANIFEST_SUFFIX = '.manifest.json'   # 镜像数据块清单对象路径后缀
 
 
 class MirrorImageHandler:
@@ -167,6 +178,7 @@ class MirrorImageHandler:
 
     def export_rbd_image(self, export_image_path, image_name, linux_node):
         """
+        导出ceph rbd镜像为qcow2文件，只读取rbd镜像已分配的数据，生成稀疏的qcow2文件
 
         :param export_image_path: 导出镜像路径(包括镜像名称)
         :param image_name: 镜像名称
@@ -188,23 +200,23 @@ class MirrorImageHandler:
             except Exception as e:
                 raise Exception(f'创建({image_local_path_dir})路径失败：{str(e)}')
 
-        # 定义导出镜像为 qcow2 格式的命令
-        # export_command = f'rbd export {cpeh_pool_name}/{image_name} {export_image_path} --format=qcow2'
-        export_command = f'qemu-img convert -f raw -O qcow2 rbd:{cpeh_pool_name}/{image_name} {export_image_path}'
-
-        # 使用 subprocess 运行命令
-        process = subprocess.Popen(export_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-
-        # 检查命令是否成功执行
-        if process.returncode == 0:
-            msg = f'节点 {linux_node} - 成功从池 {cpeh_pool_name} 导出镜像 {image_name} 到 {export_image_path}，格式为 qcow2。'
-            mirror_image_task_logger.info(msg)
-        else:
-            msg = f'节点 {linux_node} - 导出 {image_name} 到 qcow2 格式失败。错误信息: {stderr.decode("utf-8")}'
+        try:
+            rbd = get_rbd_manager(ceph=ceph.ceph, pool_name=cpeh_pool_name)
+            image = rbd.get_rbd_image(image_name=image_name)
+            try:
+                qcow2 = rbd_sparse_qcow2(image)
+                qcow2.write_to(export_image_path)
+            finally:
+                rbd.close_rbd_image(image)
+        except Exception as e:
+            msg = f'节点 {linux_node} - 导出 {image_name} 到 qcow2 格式失败。错误信息: {str(e)}'
             mirror_image_task_logger.error(msg)
             raise Exception(msg)
 
+        msg = f'节点 {linux_node} - 成功从池 {cpeh_pool_name} 导出镜像 {image_name} 到 {export_image_path}，格式为 qcow2，' \
+              f'虚拟大小 {qcow2.virtual_size}，已分配 {qcow2.allocated_size}，文件大小 {qcow2.size}。'
+        mirror_image_task_logger.info(msg)
+
     def import_rbd_image(self, import_image_path, image_name, linux_node, cpeh_pool_name):
         """
 
@@ -235,47 +247,6 @@ class MirrorImageHandler:
             raise Exception(msg)
             # 数据库有标记是否重新下载，旧的会删除
 
-    def read_in_chunks(self, file_path, chunk_size=read_chunk_size):
-        try:
-            with open(file_path, 'rb') as file:
-                while True:
-                    chunk = file.read(chunk_size)
-                    if not chunk:
-                        break
-                    yield chunk
-        except FileNotFoundError:
-            return Exception(f"Error: The file '{file_path}' was not found.")
-        except Exception as e:
-            return Exception(f"Error reading file '{file_path}': {e}")
-
-    def request_upload_chunk(self, chunk, url, bucket_token, bucket_name, objpath, offset):
-        """上传块"""
-        if not url.endswith('/'):
-            url = url + '/'
-
-        if objpath.startswith('/'):
-            objpath = objpath.split('/', 1)[1]
-
-        url = f'{url}api/v2/obj/{bucket_name}/{objpath}?offset={offset}'
-
-        # print(f'{offset} - {len(chunk)} - {url}')
-
-        m = hashlib.md5()
-        m.update(chunk)
-
-        header = {
-            "Authorization": f"BucketToken {bucket_token}",
-            'Content-MD5': m.hexdigest()
-        }
-
-        req = requests.post(
-            url=url, data=chunk, headers=header
-        )
-        if req.status_code == 200:
-            return
-        else:
-            raise Exception(f'上传块错误: {req.text}')
-
     def get_remote_image(self, url, bucket_name, objpath, bucket_token):
         url = f'{url}api/v1/metadata/{bucket_name}/{objpath}/'
 
@@ -368,27 +339,186 @@ class MirrorImageHandler:
             offset += chunk_size
             count += 1
 
+    def get_remote_manifest(self, url, task: MirrorImageTask):
+        """
+        获取公共镜像的数据块清单，与镜像文件一起存储，对象路径为镜像文件路径加后缀.manifest.json
+
+        :return:
+            dict    # manifest_loads()
+            None    # 没有清单
+        """
+        objpath = task.file_path + MANIFEST_SUFFIX
+        try:
+            obj = self.get_remote_image(url=url, bucket_name=task.bucket_name, objpath=objpath, bucket_token=task.token)
+        except Exception as e:
+            mirror_image_task_logger.info(f'任务({task.id}) 公共镜像没有数据块清单：{str(e)}')
+            return None
+
+        reader = HttpRangeReader(url=url, bucket_name=task.bucket_name, objpath=objpath, bucket_token=task.token)
+        try:
+            return manifest_loads(reader.read(0, obj['si']).decode('utf-8'))
+        except Exception as e:
+            mirror_image_task_logger.warning(f'任务({task.id}) 获取公共镜像数据块清单错误：{str(e)}')
+            return None
+
+    def get_local_chunks(self, manifest):
+        """
+        本地镜像中已有的数据块
+
+        :return:
+            {digest: (RbdManager(), rbd镜像名称, 块序号)}
+        """
+        managers = {}
+        local_chunks = {}
+        for digest, (image, index) in ImageChunkManager.find_local_chunks(manifest['chunks'].values()).items():
+            if image.id not in managers:
+                try:
+                    managers[image.id] = image.get_rbd_manager()
+                except Exception as e:
+                    mirror_image_task_logger.warning(f'镜像(id={image.id})的ceph不可用：{str(e)}')
+                    managers[image.id] = None
+
+            if managers[image.id] is not None:
+                local_chunks[digest] = (managers[image.id], image.base_image, index)
+
+        return local_chunks
+
+    def stream_download_image(self, task: MirrorImageTask, ceph_pool):
+        """
+        流式下载镜像，分段并发下载直接写入ceph rbd镜像，不使用本地暂存文件；
+        公共镜像有数据块清单时，本地已有的数据块从本地镜像复制，只下载缺少的数据块
+
+        :return:
+            (int, dict or None)     # 镜像大小GB, 数据块清单
+        :raise: UnsupportedImageError, Exception
+        """
+        url = task.mirrors_image_service_url
+        if not url.endswith('/'):
+            url = url + '/'
+
+        remote_image_obj = self.get_remote_image(url=url, bucket_name=task.bucket_name, objpath=task.file_path,
+                                                 bucket_token=task.token)
+        reader = HttpRangeReader(url=url, bucket_name=task.bucket_name, objpath=task.file_path,
+                                 bucket_token=task.token)
+        rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+
+        def progress(downloaded, total):
+            mirror_image_task_logger.info(f'任务({task.id}) 已下载 {downloaded}/{total}')
+
+        manifest = self.get_remote_manifest(url=url, task=task)
+        r, manifest, reason = manifest_pull_to_rbd(
+            reader=reader, file_size=remote_image_obj['si'], rbd_manager=rbd, image_name=task.mirror_image_base_image,
+            manifest=manifest, local_chunks=self.get_local_chunks, progress=progress)
+        if reason:
+            mirror_image_task_logger.warning(f'任务({task.id}) 数据块清单不可用，已下载完整镜像：{reason}')
+
+        task.transfer_bytes = r['downloaded']
+        task.dedup_bytes = r['copied']
+        task.transfer_seconds = int(r['seconds'])
+        task.save(update_fields=['transfer_bytes', 'dedup_bytes', 'transfer_seconds'])
+        mirror_image_task_logger.info(
+            f'任务({task.id}) 流式下载镜像 {task.file_path} 到 {ceph_pool.pool_name}/{task.mirror_image_base_image} 成功，'
+            f'格式 {r["format"]}，虚拟大小 {r["virtual_size"]}，下载 {r["downloaded"]}，本地复制 {r["copied"]}，'
+            f'耗时 {r["seconds"]:.1f}s')
+        return self.conversion_file_unit(r['virtual_size']), manifest
+
     def upload_image(self, image_path, image_task):
-        """上传镜像"""
+        """上传本地镜像文件"""
         if not os.path.exists(image_path):
             raise Exception(f'未找到 {image_path} 文件')
 
-        chunks = self.read_in_chunks(file_path=image_path)
+        with FileSource(image_path) as source:
+            self.upload_source(source=source, image_task=image_task, desc=image_path)
 
-        offset = 0
-        count = 1
-        for chunk in chunks:
-            try:
-                # print(f'第 {count} 块 ')
-                self.request_upload_chunk(chunk=chunk, url=image_task.mirrors_image_service_url,
-                                          bucket_token=image_task.token, bucket_name=image_task.bucket_name,
-                                          objpath=image_task.file_path, offset=offset)
-            except Exception as e:
-                mirror_image_task_logger.error(
-                    f'镜像地址：{image_path}， 上传偏移：{offset}, 上传到远程：{image_task.mirrors_image_service_url}, 上传远程的位置：{image_task.file_path}，{str(e)} ')
-                raise e
-            offset += len(chunk)
-            count += 1
+    def upload_source(self, source, image_task, desc: str):
+        """
+        上传镜像，分块并发上传，从任务记录的已完成分块继续
+
+        :param source: 数据源，FileSource()或SparseQcow2Image()
+        :param desc: 数据源描述，用于日志
+        """
+        chunk_size = MIRROR_IMAGE_TRANSFER_CHUNK_SIZE
+        if image_task.transfer_size != source.size or image_task.transfer_chunk_size != chunk_size:
+            image_task.transfer_done = ''
+
+        def checkpoint(p: ChunkPusher):
+            image_task.transfer_size = p.file_size
+            image_task.transfer_chunk_size = p.chunk_size
+            image_task.transfer_done = encode_chunk_ranges(p.done)
+            image_task.transfer_bytes = p.bytes_done
+            image_task.transfer_speed = p.speed
+            image_task.transfer_eta = p.eta
+            image_task.save(update_fields=['transfer_size', 'transfer_chunk_size', 'transfer_done', 'transfer_bytes',
+                                           'transfer_speed', 'transfer_eta'])
+
+        writer = HttpChunkWriter(url=image_task.mirrors_image_service_url, bucket_name=image_task.bucket_name,
+                                 objpath=image_task.file_path, bucket_token=image_task.token)
+        pusher = ChunkPusher(source=source, write=writer.write, chunk_size=chunk_size,
+                             done=decode_chunk_ranges(image_task.transfer_done), checkpoint=checkpoint)
+        try:
+            r = pusher.run()
+        except Exception as e:
+            mirror_image_task_logger.error(
+                f'镜像：{desc}， 已上传分块：{image_task.transfer_done}, 上传到远程：{image_task.mirrors_image_service_url}, 上传远程的位置：{image_task.file_path}，{str(e)} ')
+            raise e
+
+        image_task.transfer_seconds = int(r['seconds'])
+        image_task.save(update_fields=['transfer_seconds'])
+        mirror_image_task_logger.info(
+            f'任务({image_task.id}) 上传镜像 {desc} 成功，本次上传 {r["pushed"]}/{r["chunks"]} 块，'
+            f'{r["bytes"]} 字节，耗时 {r["seconds"]:.1f}s，速度 {r["speed"]} B/s')
+
+    def stream_upload_image(self, task):
+        """
+        直接从ceph rbd镜像生成稀疏qcow2并上传，不导出本地文件；
+        生成的qcow2文件由rbd镜像已分配的数据确定，镜像数据不变时可以从已完成的分块继续上传
+        """
+        ceph = self.get_ceph_pool()
+        rbd = get_rbd_manager(ceph=ceph.ceph, pool_name=ceph.pool_name)
+        image = rbd.get_rbd_image(image_name=task.mirror_image_base_image)
+        try:
+            qcow2 = rbd_sparse_qcow2(image)
+            mirror_image_task_logger.info(
+                f'任务({task.id}) 镜像 {ceph.pool_name}/{task.mirror_image_base_image} 虚拟大小 {qcow2.virtual_size}，'
+                f'已分配 {qcow2.allocated_size}，qcow2文件大小 {qcow2.size}')
+            self.upload_source(source=qcow2, image_task=task, desc=f'{ceph.pool_name}/{task.mirror_image_base_image}')
+        finally:
+            rbd.close_rbd_image(image)
+
+    def upload_manifest(self, task):
+        """
+        上传镜像的数据块清单，从ceph rbd镜像当前的数据计算并更新记录；
+        已记录的清单可能在镜像更新后过期，与上传的镜像数据不一致，不使用
+        """
+        image = Image.objects.filter(base_image=task.mirror_image_base_image).first()
+        ceph = self.get_ceph_pool()
+        rbd = get_rbd_manager(ceph=ceph.ceph, pool_name=ceph.pool_name)
+        rbd_image = rbd.get_rbd_image(image_name=task.mirror_image_base_image)
+        try:
+            manifest = build_rbd_manifest(rbd_image)
+            if image:
+                ImageChunkManager.save_manifest(image=image, manifest=manifest)
+        finally:
+            rbd.close_rbd_image(rbd_image)
+
+        writer = HttpChunkWriter(url=task.mirrors_image_service_url, bucket_name=task.bucket_name,
+                                 objpath=task.file_path + MANIFEST_SUFFIX, bucket_token=task.token)
+        writer.write(manifest_dumps(manifest).encode('utf-8'), 0)
+
+    def can_resume_upload(self, task, image_local_path):
+        """
+        本地导出的镜像文件是否可以继续上传：导出已完成，文件还在（同一节点），且与记录的上传进度一致
+        """
+        if not task.transfer_done or not task.export_date_complate:
+            return False
+
+        if task.export_date and task.export_date > task.export_date_complate:
+            return False    # 导出未完成
+
+        try:
+            return os.path.getsize(image_local_path) == task.transfer_size
+        except OSError:
+            return False
 
     def push_image(self, task):
 
@@ -398,6 +528,17 @@ class MirrorImageHandler:
 
         image_local_path = f'{task.update_local_path}{task.mirror_image_base_image}'
 
+        if push_stream:
+            return self.push_stream_image(task=task)
+
+        if self.can_resume_upload(task=task, image_local_path=image_local_path):
+            mirror_image_task_logger.info(f'任务({task.id}) 从已上传的分块（{task.transfer_done}）继续上传')
+            return self.push_upload_image(task=task, image_local_path=image_local_path)
+
+        task.transfer_done = ''
+        task.transfer_bytes = 0
+        task.save(update_fields=['transfer_done', 'transfer_bytes'])
+
         # 删除镜像
         try:
             self.delete_local_image(image_local_path)
@@ -431,7 +572,33 @@ class MirrorImageHandler:
 
         task.export_date_complate = timezone.now()
         task.save(update_fields=['export_date_complate'])
+        return self.push_upload_image(task=task, image_local_path=image_local_path)
+
+    def push_stream_image(self, task):
+        if task.status == MirrorImageTask.NONESTATUS:
+            mirror_image_task_logger.error(f'任务({task.id}) 未上传镜像前停止服务')
+            return
+
+        task.export_date = timezone.now()
+        task.save(update_fields=['export_date'])
+        try:
+            self.stream_upload_image(task)
+            self.upload_manifest(task)
+        except Exception as e:
+            msg = f'上传镜像时：{str(e)}'
+            mirror_image_task_logger.error(msg)
+            task.error_msg = msg
+            task.status = 5
+            task.save(update_fields=['error_msg', 'status'])
+            return
 
+        task.export_date_complate = timezone.now()
+        task.status = 4  # 上传完成
+        task.download_or_upload_status = True  # 上传完成
+        task.transfer_eta = 0
+        task.save(update_fields=['export_date_complate', 'status', 'download_or_upload_status', 'transfer_eta'])
+
+    def push_upload_image(self, task, image_local_path):
         if task.status == MirrorImageTask.NONESTATUS:
             mirror_image_task_logger.error(f'任务({task.id}) 未上传镜像前停止服务')
             return
@@ -439,6 +606,7 @@ class MirrorImageHandler:
         # 上传镜像
         try:
             self.upload_image(image_local_path, task)
+            self.upload_manifest(task)
         except Exception as e:
             msg = f'上传镜像时：{str(e)}'
             mirror_image_task_logger.error(msg)
@@ -449,7 +617,8 @@ class MirrorImageHandler:
 
         task.status = 4  # 上传完成
         task.download_or_upload_status = True  # 上传完成
-        task.save(update_fields=['status', 'download_or_upload_status'])
+        task.transfer_eta = 0
+        task.save(update_fields=['status', 'download_or_upload_status', 'transfer_eta'])
 
         # 删除镜像
         try:
@@ -503,6 +672,35 @@ class MirrorImageHandler:
             mirror_image_task_logger.error(f'任务({task.id}) 未下载镜像前停止服务')
             return
 
+        if download_flag and pull_stream:
+            task.import_date = timezone.now()
+            task.save(update_fields=['import_date'])
+            try:
+                size, manifest = self.stream_download_image(task=task, ceph_pool=ceph_pool)
+            except UnsupportedImageError as e:
+                mirror_image_task_logger.warning(f'任务({task.id}) 不能流式下载，使用本地暂存文件的方式：{str(e)}')
+            except Exception as e:
+                msg = f'从公共镜像流式下载时：{str(e)}'
+                mirror_image_task_logger.error(msg)
+                task.error_msg = msg
+                task.status = 6
+                task.save(update_fields=['error_msg', 'status'])
+                return
+            else:
+                task.mirror_image_size = size
+                task.download_or_upload_status = True
+                task.import_date_complate = timezone.now()
+                task.status = 2  # 下载完成
+                task.save(update_fields=['mirror_image_size', 'download_or_upload_status', 'import_date_complate',
+                                         'status'])
+                image = self.pull_image_create_os_image(task=task, ceph_pool=ceph_pool)
+                if image and manifest and image.base_image == task.mirror_image_base_image:
+                    try:
+                        ImageChunkManager.save_manifest(image=image, manifest=manifest)
+                    except Exception as e:
+                        mirror_image_task_logger.error(f'任务({task.id}) 保存镜像数据块清单时：{str(e)}')
+                return
+
         if download_flag:
             # 查询本地镜像是否存在：如果存在删除
             try:
@@ -553,32 +751,44 @@ class MirrorImageHandler:
         task.status = 2  # 下载完成
         task.save(update_fields=['import_date_complate', 'status'])
 
-        if task.status == MirrorImageTask.NONESTATUS:
-            mirror_image_task_logger.error(f'任务({task.id}) 未创建操作系统镜像信息前停止服务')
+        if not self.pull_image_create_os_image(task=task, ceph_pool=ceph_pool):
             return
 
+        # 删除镜像
         try:
-            self.create_os_image(ceph_id=ceph_pool.id, task=task)
+            self.delete_local_image(image_local_path)
         except Exception as e:
-            msg = f'创建操作系统镜像数据时：{str(e)}'
+            msg = f'镜像导入后删除本地镜像时：{str(e)}'
             mirror_image_task_logger.error(msg)
             task.error_msg = msg
-            task.status = 6
-            task.save(update_fields=['error_msg', 'status'])
+            task.save(update_fields=['error_msg'])
             return
 
-        task.create_os_image = True
-        task.save(update_fields=['create_os_image'])
+    def pull_image_create_os_image(self, task: MirrorImageTask, ceph_pool):
+        """
+        镜像导入ceph后创建操作系统镜像数据
+
+        :return:
+            Image() # 成功
+            None    # 失败或任务已停止
+        """
+        if task.status == MirrorImageTask.NONESTATUS:
+            mirror_image_task_logger.error(f'任务({task.id}) 未创建操作系统镜像信息前停止服务')
+            return None
 
-        # 删除镜像
         try:
-            self.delete_local_image(image_local_path)
+            image = self.create_os_image(ceph_id=ceph_pool.id, task=task)
         except Exception as e:
-            msg = f'镜像导入后删除本地镜像时：{str(e)}'
+            msg = f'创建操作系统镜像数据时：{str(e)}'
             mirror_image_task_logger.error(msg)
             task.error_msg = msg
-            task.save(update_fields=['error_msg'])
-            return
+            task.status = 6
+            task.save(update_fields=['error_msg', 'status'])
+            return None
+
+        task.create_os_image = True
+        task.save(update_fields=['create_os_image'])
+        return image
 
     # def ceph_image_exists_delete(self, task):   # 不能删除镜像,如果已经有用在此建立虚拟机会很危险
     #     """导出"""
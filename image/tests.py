@@ -1,3 +1,297 @@
+import os
+import struct
+import tempfile
+import zlib
+from unittest import mock
+
 from django.test import TestCase
 
-# Create your tests here.
+from ceph.models import CephCluster, CephPool
+from .models import Image, ImageChunk
+from .transfer import (
+    ImageLayout, StreamPuller, ChunkPusher, FileSource, SparseQcow2Image, TransferError, UnsupportedImageError,
+    plan_fetch_ranges, encode_chunk_ranges, decode_chunk_ranges, chunk_digest, dedup_pull_to_rbd, manifest_dumps,
+    manifest_loads, select_chunk_extents, manifest_pull_to_rbd
+)
+
+
+CLUSTER = 512
+
+
+def build_qcow2(version: int = 3, backing: bool = False):
+    """
+    构造一个簇大小512字节的qcow2镜像，虚拟磁盘8个簇：
+    簇0、1数据'a'、'b'(文件中连续)，簇2未分配，簇3全零标记，簇4压缩的'c'，簇5数据全零
+    """
+    virtual_size = CLUSTER * 8
+    header = struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', version, 4096 if backing else 0, 0, 9, virtual_size, 0,
+                         1, CLUSTER, 0, 0, 0, 0)
+    if version >= 3:
+        header += struct.pack('>QQQII', 0, 0, 0, 4, 104)
+
+    comp = zlib.compressobj(9, zlib.DEFLATED, -12)
+    compressed = comp.compress(b'c' * CLUSTER) + comp.flush()
+    l2 = [0] * (CLUSTER // 8)
+    l2[0] = 3 * CLUSTER
+    l2[1] = 4 * CLUSTER
+    l2[3] = 1
+    l2[4] = (1 << 62) | (6 * CLUSTER)    # 1个扇区
+    l2[5] = 5 * CLUSTER
+    data = bytearray(CLUSTER * 7)
+    data[:len(header)] = header
+    data[CLUSTER:CLUSTER + 8] = struct.pack('>Q', 2 * CLUSTER)
+    data[2 * CLUSTER:3 * CLUSTER] = struct.pack(f'>{CLUSTER // 8}Q', *l2)
+    data[3 * CLUSTER:4 * CLUSTER] = b'a' * CLUSTER
+    data[4 * CLUSTER:5 * CLUSTER] = b'b' * CLUSTER
+    data[6 * CLUSTER:6 * CLUSTER + len(compressed)] = compressed
+    return bytes(data)
+
+
+class StreamPullerTests(TestCase):
+    def test_qcow2_layout(self):
+        data = build_qcow2()
+        layout = ImageLayout.parse(read_range=lambda o, s: data[o:o + s], file_size=len(data))
+        self.assertEqual(layout.format, 'qcow2')
+        self.assertEqual(layout.virtual_size, CLUSTER * 8)
+        self.assertEqual([(e.guest_offset, e.host_offset, e.compressed) for e in layout.extents],
+                         [(0, 3 * CLUSTER, False), (4 * CLUSTER, 6 * CLUSTER, True), (5 * CLUSTER, 5 * CLUSTER, False)])
+        self.assertEqual(layout.extents[0].length, 2 * CLUSTER)
+
+        ranges = plan_fetch_ranges(layout.extents, chunk_size=CLUSTER * 4, max_gap=0)
+        self.assertEqual([(r.offset, r.length) for r in ranges], [(3 * CLUSTER, 4 * CLUSTER)])
+        ranges = plan_fetch_ranges(layout.extents, chunk_size=CLUSTER, max_gap=0)
+        self.assertEqual(len(ranges), 4)
+
+        bad = build_qcow2(backing=True)
+        with self.assertRaises(UnsupportedImageError):
+            ImageLayout.parse(read_range=lambda o, s: bad[o:o + s], file_size=len(bad))
+
+    def test_stream_pull(self):
+        reads = []
+
+        def read_range(offset, size):
+            reads.append((offset, size))
+            return data[offset:offset + size]
+
+        writes = []
+
+        def write(buf, offset):
+            writes.append((offset, len(buf)))
+            disk[offset:offset + len(buf)] = buf
+
+        data = build_qcow2()
+        disk = bytearray(CLUSTER * 8)
+        r = StreamPuller(read_range=read_range, file_size=len(data), workers=2, chunk_size=CLUSTER * 2).run(write=write)
+        self.assertEqual(bytes(disk), b'a' * CLUSTER + b'b' * CLUSTER + bytes(2 * CLUSTER) + b'c' * CLUSTER
+                         + bytes(3 * CLUSTER))
+        self.assertEqual(r['written'], 3 * CLUSTER)     # 全零簇不写入
+        self.assertEqual(sorted(writes), [(0, 2 * CLUSTER), (4 * CLUSTER, CLUSTER)])
+
+        # raw格式
+        data = b'x' * 1000
+        disk = bytearray(1000)
+        r = StreamPuller(read_range=read_range, file_size=len(data), chunk_size=300).run(write=write)
+        self.assertEqual(r['format'], 'raw')
+        self.assertEqual(bytes(disk), data)
+
+    def test_sparse_qcow2_roundtrip(self):
+        virtual_size = CLUSTER * 300 + 100
+        disk = bytearray(virtual_size)
+        extents = [(0, 1000), (CLUSTER * 70, CLUSTER * 3), (virtual_size - 50, 50)]
+        for offset, length in extents:
+            disk[offset:offset + length] = os.urandom(length)
+
+        reads = []
+
+        def read_data(offset, length):
+            reads.append((offset, length))
+            return bytes(disk[offset:offset + length])
+
+        image = SparseQcow2Image(virtual_size=virtual_size, extents=extents, read_data=read_data, cluster_bits=9)
+        self.assertEqual(len(image.data_clusters), 2 + 3 + 1)
+        self.assertEqual(image.size, image.data_offset + 6 * CLUSTER)
+        # 分块读取与整体读取一致
+        whole = image.read(0, image.size)
+        self.assertEqual(b''.join(image.read(o, 333) for o in range(0, image.size, 333)), whole)
+        self.assertTrue(all(o + n <= virtual_size for o, n in reads))   # 只读取已分配的区间
+
+        out = bytearray(virtual_size)
+
+        def write(buf, offset):
+            out[offset:offset + len(buf)] = buf
+
+        r = StreamPuller(read_range=lambda o, n: whole[o:o + n], file_size=len(whole), workers=2).run(write=write)
+        self.assertEqual(r['format'], 'qcow2')
+        self.assertEqual(r['virtual_size'], virtual_size)
+        self.assertEqual(bytes(out), bytes(disk))
+
+
+class ChunkPusherTests(TestCase):
+    def test_resume(self):
+        self.assertEqual(encode_chunk_ranges({0, 1, 2, 5, 7, 8}), '0-2,5,7-8')
+        self.assertEqual(decode_chunk_ranges('0-2,5,7-8'), {0, 1, 2, 5, 7, 8})
+        self.assertEqual(decode_chunk_ranges(''), set())
+
+        data = os.urandom(1000)
+        remote = bytearray(1000)
+        fail_offsets = {300}
+
+        def write(buf, offset):
+            if offset in fail_offsets:
+                raise TransferError('test')
+            remote[offset:offset + len(buf)] = buf
+
+        checkpoints = []
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            with FileSource(f.name) as source:
+                pusher = ChunkPusher(source=source, write=write, chunk_size=100, workers=3,
+                                     checkpoint=lambda p: checkpoints.append(encode_chunk_ranges(p.done)))
+                with self.assertRaises(TransferError):
+                    pusher.run()
+
+            self.assertNotIn(3, pusher.done)
+            self.assertEqual(decode_chunk_ranges(checkpoints[-1]), pusher.done)
+
+            # 从记录的已完成分块继续上传
+            fail_offsets.clear()
+            uploaded = []
+            with FileSource(f.name) as source:
+                pusher = ChunkPusher(source=source, write=lambda b, o: (uploaded.append(o), write(b, o)),
+                                     chunk_size=100, workers=3, done=decode_chunk_ranges(checkpoints[-1]))
+                r = pusher.run()
+            self.assertEqual(r['chunks'], 10)
+            self.assertIn(300, uploaded)
+            self.assertEqual(len(uploaded), r['pushed'])
+            self.assertEqual(pusher.bytes_done, 1000)
+            self.assertEqual(bytes(remote), data)
+
+
+class MemRbdImage:
+    def __init__(self, size: int):
+        self.data = bytearray(size)
+
+    def size(self):
+        return len(self.data)
+
+    def read(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+    def write(self, data, offset):
+        self.data[offset:offset + len(data)] = data
+
+    def flush(self):
+        pass
+
+
+class MemRbdManager:
+    """
+    内存中的RbdManager，只实现镜像传输用到的接口
+    """
+    def __init__(self, pool_name: str = 'test'):
+        self.pool_name = pool_name
+        self.images = {}
+
+    def create_image(self, name, size, data_pool=None):
+        if name in self.images:
+            return None
+        self.images[name] = MemRbdImage(size)
+        return True
+
+    def get_rbd_image(self, image_name):
+        return self.images[image_name]
+
+    @staticmethod
+    def close_rbd_image(image):
+        pass
+
+    def remove_image(self, image_name):
+        self.images.pop(image_name, None)
+        return True
+
+
+class RangeReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.bytes_read = 0
+
+    def read(self, offset, size):
+        self.bytes_read += size
+        return self.data[offset:offset + size]
+
+
+class DedupPullTests(TestCase):
+    def test_dedup_pull(self):
+        block = 4096
+        virtual_size = block * 8
+        v1 = bytearray(virtual_size)
+        v1[:block * 6] = os.urandom(block * 6)
+        v2 = bytearray(v1)
+        v2[block * 2:block * 3] = os.urandom(block)     # v2只修改了块2，块6、7全零
+
+        chunks = {}
+        for i in range(8):
+            data = bytes(v2[i * block:(i + 1) * block])
+            if data.count(0) != len(data):
+                chunks[i] = chunk_digest(data)
+        manifest = manifest_loads(manifest_dumps({'chunk_size': block, 'virtual_size': virtual_size, 'chunks': chunks}))
+        self.assertEqual(manifest['chunks'], chunks)
+        self.assertEqual(manifest_loads(manifest_dumps(manifest) + '  }garbage')['chunks'], chunks)
+
+        remote = SparseQcow2Image(virtual_size=virtual_size, extents=[(0, block * 6)],
+                                  read_data=lambda o, n: bytes(v2[o:o + n]), cluster_bits=9)
+        remote_file = remote.read(0, remote.size)
+        self.assertEqual(len(select_chunk_extents(ImageLayout.parse(
+            lambda o, n: remote_file[o:o + n], len(remote_file)).extents, {2}, block)), 1)
+
+        # 本地已有v1镜像
+        local = MemRbdManager()
+        local.create_image('v1', virtual_size)
+        local.images['v1'].write(bytes(v1), 0)
+        local_chunks = {chunk_digest(bytes(v1[i * block:(i + 1) * block])): (local, 'v1', i) for i in range(6)}
+        local_chunks[chunks[3]] = (local, 'v1', 4)     # 错误的本地块，校验不一致时改为下载
+
+        target = MemRbdManager()
+        reader = RangeReader(remote_file)
+        r = dedup_pull_to_rbd(reader=reader, file_size=len(remote_file), rbd_manager=target, image_name='v2',
+                              manifest=manifest, local_chunks=local_chunks, workers=2)
+        self.assertEqual(bytes(target.images['v2'].data), bytes(v2))
+        self.assertEqual(r['copied'], block * 4)    # 块0、1、4、5
+        self.assertEqual(r['downloaded'], block * 2)    # 块2、3
+        self.assertLess(reader.bytes_read, len(remote_file))
+
+        # 下载的数据校验不一致时删除镜像
+        bad = bytearray(remote_file)
+        bad[-1] ^= 0xff
+        with self.assertRaises(TransferError):
+            dedup_pull_to_rbd(reader=RangeReader(bytes(bad)), file_size=len(bad), rbd_manager=target,
+                              image_name='v3', manifest=manifest, local_chunks={}, workers=2)
+        self.assertNotIn('v3', target.images)
+
+    def test_stale_manifest(self):
+        block = 4096
+        virtual_size = block * 4
+        v1 = os.urandom(virtual_size)
+        v2 = v1[:block] + os.urandom(block) + v1[block * 2:]   # 镜像更新后清单仍是v1的
+        stale = {'chunk_size': block, 'virtual_size': virtual_size,
+                 'chunks': {i: chunk_digest(v1[i * block:(i + 1) * block]) for i in range(4)}}
+        remote = SparseQcow2Image(virtual_size=virtual_size, extents=[(0, virtual_size)],
+                                  read_data=lambda o, n: v2[o:o + n], cluster_bits=9)
+        remote_file = remote.read(0, remote.size)
+
+        target = MemRbdManager()
+        r, manifest, reason = manifest_pull_to_rbd(
+            reader=RangeReader(remote_file), file_size=len(remote_file), rbd_manager=target, image_name='v2',
+            manifest=stale, local_chunks=lambda m: {})
+        self.assertIsNone(manifest)
+        self.assertIn('数据块1校验', reason)
+        self.assertEqual(r['copied'], 0)
+        self.assertEqual(bytes(target.images['v2'].data), v2)
+
+        # 镜像更新快照后，已记录的数据块清单失效
+        ImageChunk.objects.create(image_id=1, index=0, digest=stale['chunks'][0])
+        image = Image(id=1, base_image='v2', snap='old', ceph_pool=CephPool(pool_name='test', ceph=CephCluster()))
+        with mock.patch('image.models.get_rbd_manager'):
+            image.create_snap()
+        self.assertFalse(ImageChunk.objects.filter(image_id=1).exists())
@@ -0,0 +1,1090 @@
+"""
+公共镜像传输
+
+镜像下载不落地：解析远程qcow2镜像的元数据(L1/L2表)，得到每个数据簇在镜像文件中的位置和在虚拟磁盘中的偏移，
+把数据簇合并为若干文件区间，多线程并发分段下载，校验后直接写入目标rbd镜像对应的偏移；
+未分配和全零的簇不下载或不写入，rbd镜像保持稀疏。内存中同时只保留几个分段，不需要本地暂存文件
+
+镜像上传：按rbd镜像已分配的数据区间(diff_iterate)直接生成稀疏qcow2文件，只读取已分配的数据，未分配的区间在L2表中为空洞；
+文件按固定大小分块，多个keep-alive连接并发上传，已完成的分块记录到任务中，中断后从未完成的分块继续
+
+数据块去重：镜像虚拟磁盘按4MiB分块计算SHA-256摘要作为数据块清单，随镜像文件一起上传；下载时先获取清单，
+本地已有镜像中相同的数据块直接从本地rbd镜像复制，只下载缺少的数据块
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from django.conf import settings
+
+
+MIRROR_IMAGE_TRANSFER_WORKERS = getattr(settings, 'MIRROR_IMAGE_TRANSFER_WORKERS', 4)
+MIRROR_IMAGE_TRANSFER_CHUNK_SIZE = getattr(settings, 'MIRROR_IMAGE_TRANSFER_CHUNK_SIZE', 16 * 1024 ** 2)
+MIRROR_IMAGE_TRANSFER_RETRY = 3
+MIRROR_IMAGE_TRANSFER_TIMEOUT = 60
+IMAGE_CHUNK_SIZE = 4 * 1024 ** 2    # 镜像数据块清单的块大小
+MERGE_MAX_GAP = 1024 ** 2   # 两个数据区间间隔不超过此大小时合并为一个分段下载，间隔的数据丢弃
+
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_COPIED = 1 << 63
+QCOW2_ZERO = 1
+QCOW2_INCOMPAT_DATA_FILE = 1 << 2
+QCOW2_INCOMPAT_COMPRESSION = 1 << 3
+QCOW2_INCOMPAT_EXTL2 = 1 << 4
+
+
+class TransferError(Exception):
+    pass
+
+
+class UnsupportedImageError(TransferError):
+    """
+    镜像格式不支持流式传输，需要使用本地暂存文件的方式
+    """
+    pass
+
+
+class ManifestMismatchError(TransferError):
+    """
+    按数据块清单下载的数据校验摘要不一致，清单与镜像数据不一致(如镜像更新后清单已过期)
+    """
+    pass
+
+
+class Extent:
+    """
+    镜像文件中的一段数据
+
+    :param guest_offset: 在虚拟磁盘中的偏移
+    :param host_offset: 在镜像文件中的偏移
+    :param length: 在镜像文件中的长度
+    :param compressed: 是否是压缩的簇，压缩簇解压后为一个簇大小
+    """
+    __slots__ = ('guest_offset', 'host_offset', 'length', 'compressed')
+
+    def __init__(self, guest_offset: int, host_offset: int, length: int, compressed: bool = False):
+        self.guest_offset = guest_offset
+        self.host_offset = host_offset
+        self.length = length
+        self.compressed = compressed
+
+    def __repr__(self):
+        return f'Extent({self.guest_offset}, {self.host_offset}, {self.length}, {self.compressed})'
+
+
+class ImageLayout:
+    """
+    镜像文件的数据布局
+
+    :param fmt: 'qcow2' or 'raw'
+    :param virtual_size: 虚拟磁盘大小
+    :param cluster_size: 簇大小，压缩簇解压后的大小
+    :param extents: [Extent()]，按guest_offset排序，不包含未分配和全零的簇
+    """
+    def __init__(self, fmt: str, virtual_size: int, cluster_size: int, extents: list):
+        self.format = fmt
+        self.virtual_size = virtual_size
+        self.cluster_size = cluster_size
+        self.extents = extents
+
+    @property
+    def allocated_size(self):
+        return sum(e.length for e in self.extents)
+
+    @classmethod
+    def parse(cls, read_range, file_size: int, map_func=map):
+        """
+        解析镜像文件的数据布局，不是qcow2格式时按raw格式处理
+
+        :param read_range: 读取镜像文件数据的函数，read_range(offset, size) -> bytes
+        :param file_size: 镜像文件大小
+        :param map_func: 并发读取L2表使用的map函数
+        :return:
+            ImageLayout()
+        :raise: UnsupportedImageError, TransferError
+        """
+        header = read_range(0, min(file_size, 4096))
+        if header[:4] != QCOW2_MAGIC:
+            return cls(fmt='raw', virtual_size=file_size, cluster_size=file_size,
+                       extents=[Extent(0, 0, file_size)] if file_size else [])
+
+        return cls._parse_qcow2(header=header, read_range=read_range, file_size=file_size, map_func=map_func)
+
+    @classmethod
+    def _parse_qcow2(cls, header: bytes, read_range, file_size: int, map_func=map):
+        if len(header) < 72:
+            raise TransferError('qcow2镜像头不完整')
+
+        (version, backing_file_offset, _, cluster_bits, virtual_size, crypt_method,
+         l1_size, l1_table_offset) = struct.unpack('>IQIIQIIQ', header[4:48])
+        if backing_file_offset:
+            raise UnsupportedImageError('qcow2镜像有backing file')
+        if crypt_method:
+            raise UnsupportedImageError('qcow2镜像已加密')
+
+        incompatible = 0
+        compression_type = 0
+        if version >= 3:
+            incompatible = struct.unpack('>Q', header[72:80])[0]
+            header_length = struct.unpack('>I', header[100:104])[0]
+            if header_length > 104 and (incompatible & QCOW2_INCOMPAT_COMPRESSION):
+                compression_type = header[104]
+
+        if incompatible & (QCOW2_INCOMPAT_DATA_FILE | QCOW2_INCOMPAT_EXTL2):
+            raise UnsupportedImageError('qcow2镜像使用了外部数据文件或扩展L2表')
+        if compression_type != 0:
+            raise UnsupportedImageError('qcow2镜像压缩格式不是zlib')
+
+        cluster_size = 1 << cluster_bits
+        l2_entries = cluster_size // 8
+        l1 = struct.unpack(f'>{l1_size}Q', read_range(l1_table_offset, l1_size * 8)) if l1_size else ()
+        l2_tables = [(i, e & QCOW2_OFFSET_MASK) for i, e in enumerate(l1) if e & QCOW2_OFFSET_MASK]
+
+        def read_l2(item):
+            index, offset = item
+            data = read_range(offset, cluster_size)
+            if len(data) != cluster_size:
+                raise TransferError(f'读取qcow2 L2表(offset={offset})不完整')
+            return index, struct.unpack(f'>{l2_entries}Q', data)
+
+        csize_shift = 62 - (cluster_bits - 8)
+        csize_mask = (1 << (cluster_bits - 8)) - 1
+        coffset_mask = (1 << csize_shift) - 1
+        extents = []
+        for l1_index, l2 in sorted(map_func(read_l2, l2_tables)):
+            base = l1_index * l2_entries * cluster_size
+            for i, entry in enumerate(l2):
+                guest_offset = base + i * cluster_size
+                if guest_offset >= virtual_size:
+                    break
+
+                if entry & QCOW2_COMPRESSED:
+                    host_offset = entry & coffset_mask
+                    nb_sectors = ((entry >> csize_shift) & csize_mask) + 1
+                    length = min(nb_sectors * 512 - (host_offset & 511), file_size - host_offset)
+                    extents.append(Extent(guest_offset, host_offset, length, compressed=True))
+                    continue
+
+                host_offset = entry & QCOW2_OFFSET_MASK
+                if not host_offset or (version >= 3 and entry & QCOW2_ZERO):
+                    continue    # 未分配或全零
+
+                length = min(cluster_size, virtual_size - guest_offset)
+                last = extents[-1] if extents else None
+                if (last is not None and not last.compressed and last.guest_offset + last.length == guest_offset
+                        and last.host_offset + last.length == host_offset):
+                    last.length += length
+                else:
+                    extents.append(Extent(guest_offset, host_offset, length))
+
+        return cls(fmt='qcow2', virtual_size=virtual_size, cluster_size=cluster_size, extents=extents)
+
+
+class FetchRange:
+    """
+    一次下载的镜像文件区间，包含一个或多个数据区间
+    """
+    __slots__ = ('offset', 'length', 'extents')
+
+    def __init__(self, offset: int, length: int, extents: list):
+        self.offset = offset
+        self.length = length
+        self.extents = extents
+
+
+def plan_fetch_ranges(extents: list, chunk_size: int = MIRROR_IMAGE_TRANSFER_CHUNK_SIZE,
+                      max_gap: int = MERGE_MAX_GAP):
+    """
+    按镜像文件中的偏移把数据区间合并为下载分段，每个分段不超过chunk_size，大的数据区间会被拆分
+
+    :return:
+        [FetchRange()]
+    """
+    pieces = []
+    for e in sorted(extents, key=lambda x: x.host_offset):
+        if e.compressed or e.length <= chunk_size:
+            pieces.append(e)
+            continue
+
+        for start in range(0, e.length, chunk_size):
+            pieces.append(Extent(e.guest_offset + start, e.host_offset + start, min(chunk_size, e.length - start)))
+
+    ranges = []
+    cur = None
+    for e in pieces:
+        if cur is not None:
+            end = e.host_offset + e.length
+            if 0 <= e.host_offset - (cur.offset + cur.length) <= max_gap and end - cur.offset <= chunk_size:
+                cur.length = end - cur.offset
+                cur.extents.append(e)
+                continue
+
+        cur = FetchRange(offset=e.host_offset, length=e.length, extents=[e])
+        ranges.append(cur)
+
+    return ranges
+
+
+class BucketClient:
+    """
+    公共镜像服务存储桶对象访问，每个线程使用一个keep-alive的requests.Session
+    """
+    def __init__(self, url: str, bucket_name: str, objpath: str, bucket_token: str,
+                 retry: int = MIRROR_IMAGE_TRANSFER_RETRY, timeout: int = MIRROR_IMAGE_TRANSFER_TIMEOUT):
+        if not url.endswith('/'):
+            url = url + '/'
+
+        if objpath.startswith('/'):
+            objpath = objpath.split('/', 1)[1]
+
+        self.url = url
+        self.bucket_name = bucket_name
+        self.objpath = objpath
+        self.headers = {"Authorization": f"BucketToken {bucket_token}"}
+        self.retry = retry
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            self._local.session = session
+
+        return session
+
+    def _reset_session(self):
+        session = getattr(self._local, 'session', None)
+        self._local.session = None
+        if session is not None:
+            session.close()
+
+    def _request(self, method: str, url: str, check, desc: str, **kwargs):
+        """
+        发送请求，失败时重试
+
+        :param check: 检查响应的函数，check(response) -> 错误信息，成功时返回None
+        :raise: TransferError
+        """
+        err = None
+        for i in range(self.retry):
+            try:
+                r = self._get_session().request(method=method, url=url, timeout=self.timeout, **kwargs)
+                err = check(r)
+                if err is None:
+                    return r
+            except requests.RequestException as e:
+                err = str(e)
+                self._reset_session()
+
+            time.sleep(i + 1)
+
+        raise TransferError(f'{desc}错误: {err}')
+
+
+class HttpRangeReader(BucketClient):
+    """
+    从公共镜像服务分段读取对象
+    """
+    def read(self, offset: int, size: int):
+        """
+        读取对象的一段数据，长度不对时重试
+
+        :raise: TransferError
+        """
+        def check(r):
+            if r.status_code != 200:
+                return f'status_code={r.status_code}, {r.text[:200]}'
+            if len(r.content) != size:
+                return f'size={len(r.content)}'
+            return None
+
+        r = self._request(method='GET', url=f'{self.url}api/v1/obj/{self.bucket_name}/{self.objpath}/',
+                          params={'offset': offset, 'size': size}, check=check,
+                          desc=f'下载块(offset={offset}, size={size})')
+        return r.content
+
+
+class HttpChunkWriter(BucketClient):
+    """
+    向公共镜像服务对象的指定偏移写入数据
+    """
+    def write(self, data, offset: int):
+        """
+        :raise: TransferError
+        """
+        headers = {'Content-MD5': hashlib.md5(data).hexdigest()}
+
+        def check(r):
+            return None if r.status_code == 200 else f'status_code={r.status_code}, {r.text[:200]}'
+
+        self._request(method='POST', url=f'{self.url}api/v2/obj/{self.bucket_name}/{self.objpath}',
+                      params={'offset': offset}, data=data, headers=headers, check=check,
+                      desc=f'上传块(offset={offset}, size={len(data)})')
+
+
+class StreamPuller:
+    """
+    镜像流式下载写入目标，不使用本地暂存文件
+
+    :param read_range: 读取远程镜像文件数据的函数，read_range(offset, size) -> bytes
+    :param file_size: 远程镜像文件大小
+    :param workers: 并发下载数
+    :param chunk_size: 每个下载分段的最大大小
+    """
+    def __init__(self, read_range, file_size: int, workers: int = MIRROR_IMAGE_TRANSFER_WORKERS,
+                 chunk_size: int = MIRROR_IMAGE_TRANSFER_CHUNK_SIZE):
+        self.read_range = read_range
+        self.file_size = file_size
+        self.workers = max(workers, 1)
+        self.chunk_size = chunk_size
+        self.layout = None
+        self.downloaded = 0
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def parse_layout(self):
+        """
+        :return:
+            ImageLayout()
+        :raise: UnsupportedImageError, TransferError
+        """
+        if self.layout is None:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                self.layout = ImageLayout.parse(read_range=self.read_range, file_size=self.file_size,
+                                                map_func=executor.map)
+
+        return self.layout
+
+    def _decode(self, fetch: FetchRange, data: bytes):
+        """
+        解出下载分段中的各数据区间
+
+        :return:
+            [(guest_offset, bytes)]
+        """
+        layout = self.layout
+        buf = memoryview(data)
+        items = []
+        for e in fetch.extents:
+            start = e.host_offset - fetch.offset
+            piece = buf[start:start + e.length]
+            if e.compressed:
+                try:
+                    piece = zlib.decompressobj(-12).decompress(piece, layout.cluster_size)
+                except zlib.error as exc:
+                    raise TransferError(f'解压qcow2压缩簇(offset={e.host_offset})错误: {str(exc)}')
+
+                length = min(layout.cluster_size, layout.virtual_size - e.guest_offset)
+                if len(piece) < length:
+                    raise TransferError(f'qcow2压缩簇(offset={e.host_offset})解压后数据不完整')
+                piece = piece[:length]
+
+            items.append((e.guest_offset, piece))
+
+        return items
+
+    @staticmethod
+    def _merge_writes(items):
+        """
+        跳过全零数据，合并虚拟磁盘中连续的数据，减少写入次数
+        """
+        pending = []
+        pending_offset = None
+        pending_end = None
+        for offset, piece in items:
+            if bytes(piece).count(0) == len(piece):
+                continue
+
+            if pending and offset == pending_end:
+                pending.append(piece)
+                pending_end += len(piece)
+                continue
+
+            if pending:
+                yield pending_offset, b''.join(pending)
+
+            pending = [piece]
+            pending_offset = offset
+            pending_end = offset + len(piece)
+
+        if pending:
+            yield pending_offset, b''.join(pending)
+
+    def _fetch_and_write(self, fetch: FetchRange, write):
+        data = self.read_range(fetch.offset, fetch.length)
+        if len(data) != fetch.length:
+            raise TransferError(f'下载块(offset={fetch.offset}, size={fetch.length})不完整')
+
+        written = 0
+        for offset, piece in self._merge_writes(self._decode(fetch, data)):
+            write(piece, offset)
+            written += len(piece)
+
+        with self._lock:
+            self.downloaded += fetch.length
+            self.written += written
+
+    def run(self, write, progress=None, extents: list = None):
+        """
+        下载镜像数据并写入目标，写入前目标虚拟磁盘应全为零
+
+        :param write: 写入函数，write(data, offset)，需要线程安全，如rbd.Image().write
+        :param progress: 进度回调，progress(downloaded, total)
+        :param extents: 只下载这些数据区间，默认下载镜像所有的数据区间
+        :return:
+            dict    # {'format', 'virtual_size', 'allocated_size', 'downloaded', 'written', 'seconds'}
+        :raise: UnsupportedImageError, TransferError
+        """
+        start = time.time()
+        layout = self.parse_layout()
+        if extents is None:
+            extents = layout.extents
+        ranges = plan_fetch_ranges(extents, chunk_size=self.chunk_size)
+        total = sum(r.length for r in ranges)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # 限制在途的分段数，内存中最多保留2倍并发数的分段
+            pending = set()
+            try:
+                for fetch in ranges:
+                    if len(pending) >= self.workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for f in done:
+                            f.result()
+                        if progress:
+                            progress(self.downloaded, total)
+
+                    pending.add(executor.submit(self._fetch_and_write, fetch, write))
+
+                for f in pending:
+                    f.result()
+            except Exception:
+                for f in pending:
+                    f.cancel()
+                raise
+
+        if progress:
+            progress(self.downloaded, total)
+
+        return {
+            'format': layout.format,
+            'virtual_size': layout.virtual_size,
+            'allocated_size': layout.allocated_size,
+            'downloaded': self.downloaded,
+            'written': self.written,
+            'seconds': time.time() - start
+        }
+
+
+def pull_image_to_rbd(reader: HttpRangeReader, file_size: int, rbd_manager, image_name: str,
+                      workers: int = MIRROR_IMAGE_TRANSFER_WORKERS, chunk_size: int = MIRROR_IMAGE_TRANSFER_CHUNK_SIZE,
+                      progress=None):
+    """
+    公共镜像流式下载直接写入rbd镜像，失败时删除已创建的rbd镜像
+
+    :param reader: 远程镜像读取对象
+    :param file_size: 远程镜像文件大小
+    :param rbd_manager: 目标pool的RbdManager()
+    :param image_name: 要创建的rbd镜像名称
+    :return:
+        dict    # StreamPuller.run()
+    :raise: UnsupportedImageError, TransferError
+    """
+    puller = StreamPuller(read_range=reader.read, file_size=file_size, workers=workers, chunk_size=chunk_size)
+    layout = puller.parse_layout()  # 不支持的格式在创建rbd镜像前报错
+    if rbd_manager.create_image(name=image_name, size=layout.virtual_size) is None:
+        raise TransferError(f'rbd镜像({image_name})已存在')
+
+    try:
+        image = rbd_manager.get_rbd_image(image_name=image_name)
+        try:
+            result = puller.run(write=image.write, progress=progress)
+            image.flush()
+        finally:
+            rbd_manager.close_rbd_image(image)
+    except Exception as e:
+        try:
+            rbd_manager.remove_image(image_name=image_name)
+        except Exception:
+            pass
+
+        if isinstance(e, TransferError):
+            raise e
+        raise TransferError(f'写入rbd镜像({image_name})错误: {str(e)}')
+
+    return result
+
+
+def rbd_allocated_extents(image, whole_object: bool = True):
+    """
+    通过rbd.Image.diff_iterate获取rbd镜像已分配的数据区间，克隆的镜像包含父镜像的数据区间；
+    rbd镜像开启object-map、fast-diff特性时不需要读取数据
+
+    :param image: rbd.Image()
+    :param whole_object: 按rados对象粒度返回，更快但区间更粗
+    :return:
+        [(offset, length)]  # 按offset排序，相邻的已合并
+    """
+    extents = []
+
+    def cb(offset, length, exists):
+        if not exists:
+            return 0
+
+        if extents and extents[-1][0] + extents[-1][1] == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+        else:
+            extents.append((offset, length))
+        return 0
+
+    image.diff_iterate(0, image.size(), None, cb, include_parent=True, whole_object=whole_object)
+    extents.sort()
+    merged = []
+    for offset, length in extents:
+        if merged and merged[-1][0] + merged[-1][1] >= offset:
+            end = max(merged[-1][0] + merged[-1][1], offset + length)
+            merged[-1] = (merged[-1][0], end - merged[-1][0])
+        else:
+            merged.append((offset, length))
+
+    return merged
+
+
+class SparseQcow2Image:
+    """
+    由虚拟磁盘已分配的数据区间生成的稀疏qcow2镜像文件，不生成完整文件，按需读取文件的任意区间
+
+    文件布局：镜像头、refcount表、refcount块、L1表、L2表、数据簇(按虚拟磁盘偏移排序)；
+    只包含已分配区间覆盖的簇，其他簇在L2表中为未分配(读为零)。元数据在构造时生成，
+    数据簇在读取时从数据源读取，同样的区间和数据生成的文件完全相同，可以分块续传
+
+    :param virtual_size: 虚拟磁盘大小
+    :param extents: 已分配的数据区间[(offset, length)]
+    :param read_data: 读取虚拟磁盘数据的函数，read_data(offset, length) -> bytes，需要线程安全，如rbd.Image().read
+    :param cluster_bits: 簇大小位数，默认64KiB
+    """
+    def __init__(self, virtual_size: int, extents, read_data, cluster_bits: int = 16):
+        self.virtual_size = virtual_size
+        self.read_data = read_data
+        self.cluster_bits = cluster_bits
+        self.cluster_size = cs = 1 << cluster_bits
+
+        clusters = set()
+        for offset, length in extents:
+            end = min(offset + length, virtual_size)
+            if end > offset:
+                clusters.update(range(offset // cs, (end + cs - 1) // cs))
+        self.data_clusters = sorted(clusters)   # 第k个数据簇对应的虚拟磁盘簇号
+
+        l2_entries = cs // 8
+        vclusters = (virtual_size + cs - 1) // cs
+        self.l1_size = (vclusters + l2_entries - 1) // l2_entries
+        l1_clusters = (self.l1_size * 8 + cs - 1) // cs
+        l2_tables = sorted({c // l2_entries for c in self.data_clusters})
+
+        refs_per_block = cs // 2    # refcount_order=4，每个引用计数2字节
+        rb_clusters = rt_clusters = 1
+        while True:
+            total = 1 + rt_clusters + rb_clusters + l1_clusters + len(l2_tables) + len(self.data_clusters)
+            rb = (total + refs_per_block - 1) // refs_per_block
+            rt = (rb * 8 + cs - 1) // cs
+            if rb == rb_clusters and rt == rt_clusters:
+                break
+            rb_clusters, rt_clusters = rb, rt
+
+        rt_offset = cs
+        rb_offset = rt_offset + rt_clusters * cs
+        l1_offset = rb_offset + rb_clusters * cs
+        l2_offset = l1_offset + l1_clusters * cs
+        self.data_offset = l2_offset + len(l2_tables) * cs
+        self.size = self.data_offset + len(self.data_clusters) * cs
+        self.allocated_size = len(self.data_clusters) * cs
+
+        meta = bytearray(self.data_offset)
+        struct.pack_into('>4sIQIIQIIQQIIQQQQII', meta, 0, QCOW2_MAGIC, 3, 0, 0, cluster_bits, virtual_size, 0,
+                         self.l1_size, l1_offset, rt_offset, rt_clusters, 0, 0, 0, 0, 0, 4, 104)
+        for i in range(rb_clusters):
+            struct.pack_into('>Q', meta, rt_offset + i * 8, rb_offset + i * cs)
+        meta[rb_offset:rb_offset + total * 2] = b'\x00\x01' * total     # 每个簇引用计数为1
+        l2_index = {}
+        for j, t in enumerate(l2_tables):
+            l2_index[t] = l2_offset + j * cs
+            struct.pack_into('>Q', meta, l1_offset + t * 8, (l2_offset + j * cs) | QCOW2_COPIED)
+        for k, c in enumerate(self.data_clusters):
+            struct.pack_into('>Q', meta, l2_index[c // l2_entries] + (c % l2_entries) * 8,
+                             (self.data_offset + k * cs) | QCOW2_COPIED)
+        self._meta = bytes(meta)
+
+    def read(self, offset: int, length: int):
+        """
+        读取生成的qcow2文件的一段数据
+        """
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b''
+
+        parts = []
+        if offset < self.data_offset:
+            parts.append(self._meta[offset:min(end, self.data_offset)])
+            offset = self.data_offset
+
+        cs = self.cluster_size
+        k = (offset - self.data_offset) // cs
+        while offset < end:
+            # 合并虚拟磁盘中连续的数据簇一次读取
+            k_end = k + 1
+            last = (end - 1 - self.data_offset) // cs
+            while k_end <= last and self.data_clusters[k_end] == self.data_clusters[k_end - 1] + 1:
+                k_end += 1
+
+            skip = offset - (self.data_offset + k * cs)
+            run_end = min(end, self.data_offset + k_end * cs)
+            guest_start = self.data_clusters[k] * cs + skip
+            guest_end = guest_start + (run_end - offset)
+            data_length = min(guest_end, self.virtual_size) - guest_start
+            data = self.read_data(guest_start, data_length) if data_length > 0 else b''
+            parts.append(data)
+            if len(data) < guest_end - guest_start:     # 最后一个簇超出虚拟磁盘大小的部分补零
+                parts.append(bytes(guest_end - guest_start - len(data)))
+
+            offset = run_end
+            k = k_end
+
+        return b''.join(parts)
+
+    def write_to(self, path: str, chunk_size: int = MIRROR_IMAGE_TRANSFER_CHUNK_SIZE):
+        """
+        生成qcow2文件到本地
+        """
+        with open(path, 'wb') as f:
+            for offset in range(0, self.size, chunk_size):
+                f.write(self.read(offset, min(chunk_size, self.size - offset)))
+
+
+def rbd_sparse_qcow2(image, cluster_bits: int = 16):
+    """
+    rbd镜像生成稀疏qcow2镜像文件，只读取已分配的数据
+
+    :param image: rbd.Image()，读取期间不能关闭，数据不能被修改
+    :return:
+        SparseQcow2Image()
+    """
+    return SparseQcow2Image(virtual_size=image.size(), extents=rbd_allocated_extents(image), read_data=image.read,
+                            cluster_bits=cluster_bits)
+
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def build_rbd_manifest(image, chunk_size: int = IMAGE_CHUNK_SIZE, workers: int = MIRROR_IMAGE_TRANSFER_WORKERS):
+    """
+    计算rbd镜像的数据块清单，只读取已分配的块，全零的块不记录
+
+    :param image: rbd.Image()
+    :return:
+        dict    # {'chunk_size': 4194304, 'virtual_size': 10737418240, 'chunks': {index: digest}}
+    """
+    virtual_size = image.size()
+    indexes = set()
+    for offset, length in rbd_allocated_extents(image):
+        indexes.update(range(offset // chunk_size, (min(offset + length, virtual_size) + chunk_size - 1) // chunk_size))
+
+    def digest(index):
+        offset = index * chunk_size
+        data = image.read(offset, min(chunk_size, virtual_size - offset))
+        if data.count(0) == len(data):
+            return index, None
+        return index, chunk_digest(data)
+
+    chunks = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for index, d in executor.map(digest, sorted(indexes)):
+            if d is not None:
+                chunks[index] = d
+
+    return {'chunk_size': chunk_size, 'virtual_size': virtual_size, 'chunks': chunks}
+
+
+def manifest_dumps(manifest: dict):
+    """
+    数据块清单序列化为json，与镜像文件一起上传到公共镜像服务
+    """
+    return json.dumps({
+        'version': 1, 'chunk_size': manifest['chunk_size'], 'virtual_size': manifest['virtual_size'],
+        'chunks': sorted([i, d] for i, d in manifest['chunks'].items())
+    }, separators=(',', ':'))
+
+
+def manifest_loads(text: str):
+    """
+    解析数据块清单json，忽略json之后的数据(远程对象可能比本次写入的长)
+
+    :raise: TransferError
+    """
+    try:
+        data, _ = json.JSONDecoder().raw_decode(text.strip())
+        return {
+            'chunk_size': int(data['chunk_size']), 'virtual_size': int(data['virtual_size']),
+            'chunks': {int(i): str(d) for i, d in data['chunks']}
+        }
+    except (ValueError, KeyError, TypeError) as e:
+        raise TransferError(f'数据块清单无效: {str(e)}')
+
+
+def select_chunk_extents(extents: list, indexes: set, chunk_size: int):
+    """
+    截取镜像数据区间中与指定数据块重叠的部分，压缩簇不能截取，重叠时整个保留
+
+    :return:
+        [Extent()]
+    """
+    selected = []
+    for e in extents:
+        first = e.guest_offset // chunk_size
+        last = (e.guest_offset + max(e.length, 1) - 1) // chunk_size
+        if e.compressed:
+            if any(i in indexes for i in range(first, last + 1)):
+                selected.append(e)
+            continue
+
+        for i in range(first, last + 1):
+            if i not in indexes:
+                continue
+
+            start = max(e.guest_offset, i * chunk_size)
+            end = min(e.guest_offset + e.length, (i + 1) * chunk_size)
+            prev = selected[-1] if selected else None
+            if (prev is not None and not prev.compressed and prev.guest_offset + prev.length == start
+                    and prev.host_offset + prev.length == e.host_offset + start - e.guest_offset):
+                prev.length += end - start
+            else:
+                selected.append(Extent(start, e.host_offset + start - e.guest_offset, end - start))
+
+    return selected
+
+
+def dedup_pull_to_rbd(reader: HttpRangeReader, file_size: int, rbd_manager, image_name: str, manifest: dict,
+                      local_chunks: dict, workers: int = MIRROR_IMAGE_TRANSFER_WORKERS,
+                      chunk_size: int = MIRROR_IMAGE_TRANSFER_CHUNK_SIZE, progress=None):
+    """
+    按数据块清单下载镜像到rbd镜像：本地已有的数据块从本地rbd镜像复制，只下载缺少的数据块，
+    每个数据块写入后校验SHA-256摘要；失败时删除已创建的rbd镜像
+
+    :param reader: 远程镜像读取对象
+    :param file_size: 远程镜像文件大小
+    :param rbd_manager: 目标pool的RbdManager()
+    :param image_name: 要创建的rbd镜像名称
+    :param manifest: 远程镜像的数据块清单，manifest_loads()
+    :param local_chunks: 本地已有的数据块，{digest: (RbdManager(), rbd镜像名称, 块序号)}
+    :return:
+        dict    # {'format', 'virtual_size', 'downloaded', 'copied', 'written', 'seconds'}
+    :raise: UnsupportedImageError, ManifestMismatchError, TransferError
+    """
+    start = time.time()
+    block = manifest['chunk_size']
+    puller = StreamPuller(read_range=reader.read, file_size=file_size, workers=workers, chunk_size=chunk_size)
+    layout = puller.parse_layout()
+    if layout.virtual_size != manifest['virtual_size']:
+        raise UnsupportedImageError('数据块清单与镜像大小不一致')
+
+    if rbd_manager.create_image(name=image_name, size=layout.virtual_size) is None:
+        raise TransferError(f'rbd镜像({image_name})已存在')
+
+    def block_length(index):
+        return min(block, layout.virtual_size - index * block)
+
+    try:
+        target = rbd_manager.get_rbd_image(image_name=image_name)
+        try:
+            # 从本地rbd镜像复制相同的数据块，摘要不一致的(本地镜像已修改)改为下载
+            groups = {}
+            for index, digest in manifest['chunks'].items():
+                src = local_chunks.get(digest)
+                if src is not None:
+                    mgr, src_name, src_index = src
+                    groups.setdefault((mgr.pool_name, src_name), (mgr, []))[1].append((index, digest, src_index))
+
+            copied = set()
+            for (_, src_name), (mgr, items) in groups.items():
+                try:
+                    src_image = mgr.get_rbd_image(image_name=src_name)
+                except Exception:
+                    continue
+
+                def copy(item):
+                    index, digest, src_index = item
+                    data = src_image.read(src_index * block, block_length(index))
+                    if chunk_digest(data) != digest:
+                        return None
+                    target.write(data, index * block)
+                    return index
+
+                try:
+                    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                        copied.update(i for i in executor.map(copy, items) if i is not None)
+                finally:
+                    mgr.close_rbd_image(src_image)
+
+            missing = set(manifest['chunks']) - copied
+            extents = select_chunk_extents(layout.extents, missing, block)
+            result = puller.run(write=target.write, progress=progress, extents=extents)
+
+            def verify(index):
+                return chunk_digest(target.read(index * block, block_length(index))) == manifest['chunks'][index]
+
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                bad = [i for i, ok in zip(sorted(missing), executor.map(verify, sorted(missing))) if not ok]
+            if bad:
+                raise ManifestMismatchError(f'数据块{encode_chunk_ranges(bad)}校验SHA-256摘要不一致')
+
+            target.flush()
+        finally:
+            rbd_manager.close_rbd_image(target)
+    except Exception as e:
+        try:
+            rbd_manager.remove_image(image_name=image_name)
+        except Exception:
+            pass
+
+        if isinstance(e, TransferError):
+            raise e
+        raise TransferError(f'写入rbd镜像({image_name})错误: {str(e)}')
+
+    return {
+        'format': layout.format,
+        'virtual_size': layout.virtual_size,
+        'downloaded': result['downloaded'],
+        'copied': sum(block_length(i) for i in copied),
+        'written': result['written'],
+        'seconds': time.time() - start
+    }
+
+
+def manifest_pull_to_rbd(reader: HttpRangeReader, file_size: int, rbd_manager, image_name: str, manifest: dict,
+                         local_chunks, progress=None):
+    """
+    有数据块清单时按清单下载镜像到rbd镜像，清单不可用或与镜像数据不一致时不使用清单下载完整镜像
+
+    :param manifest: 远程镜像的数据块清单，None时直接下载完整镜像
+    :param local_chunks: 本地已有的数据块，函数local_chunks(manifest)，只在使用清单时调用
+    :return:
+        (
+            dict,           # 下载结果，dedup_pull_to_rbd()
+            dict or None,   # 使用的数据块清单，没有使用清单时为None
+            str             # 清单不可用的原因
+        )
+    :raise: UnsupportedImageError, TransferError
+    """
+    reason = ''
+    if manifest is not None:
+        try:
+            r = dedup_pull_to_rbd(reader=reader, file_size=file_size, rbd_manager=rbd_manager, image_name=image_name,
+                                  manifest=manifest, local_chunks=local_chunks(manifest), progress=progress)
+            return r, manifest, reason
+        except (UnsupportedImageError, ManifestMismatchError) as e:
+            reason = str(e)
+
+    r = pull_image_to_rbd(reader=reader, file_size=file_size, rbd_manager=rbd_manager, image_name=image_name,
+                          progress=progress)
+    r['copied'] = 0
+    return r, None, reason
+
+
+def encode_chunk_ranges(indexes):
+    """
+    分块序号集合编码为区间字符串，如{0, 1, 2, 5} -> '0-2,5'
+    """
+    parts = []
+    start = prev = None
+    for i in sorted(indexes):
+        if prev is not None and i == prev + 1:
+            prev = i
+            continue
+
+        if start is not None:
+            parts.append(f'{start}-{prev}' if prev != start else f'{start}')
+        start = prev = i
+
+    if start is not None:
+        parts.append(f'{start}-{prev}' if prev != start else f'{start}')
+
+    return ','.join(parts)
+
+
+def decode_chunk_ranges(value: str):
+    """
+    区间字符串解码为分块序号集合，encode_chunk_ranges()的逆操作
+    """
+    indexes = set()
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+
+        if '-' in part:
+            start, end = part.split('-', 1)
+            indexes.update(range(int(start), int(end) + 1))
+        else:
+            indexes.add(int(part))
+
+    return indexes
+
+
+class FileSource:
+    """
+    本地文件数据源，可多线程并发读取
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.size = os.path.getsize(file_path)
+        self._fd = os.open(file_path, os.O_RDONLY)
+
+    def read(self, offset: int, length: int):
+        return os.pread(self._fd, length, offset)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class ChunkPusher:
+    """
+    数据分块并发上传，可从已完成的分块继续上传
+
+    :param source: 数据源，有size属性和线程安全的read(offset, length)方法，如FileSource()、SparseQcow2Image()
+    :param write: 上传函数，write(data, offset)，需要线程安全，如HttpChunkWriter().write
+    :param chunk_size: 分块大小
+    :param workers: 同时上传的分块数
+    :param done: 已上传完成的分块序号集合
+    :param checkpoint: 进度回调，checkpoint(pusher)，在调用run()的线程中调用，可以读取done、bytes_done、speed、eta
+    :param checkpoint_interval: 两次进度回调的最小间隔（秒），结束时总会回调一次
+    """
+    def __init__(self, source, write, chunk_size: int = MIRROR_IMAGE_TRANSFER_CHUNK_SIZE,
+                 workers: int = MIRROR_IMAGE_TRANSFER_WORKERS, done: set = None, checkpoint=None,
+                 checkpoint_interval: float = 2):
+        self.source = source
+        self.write = write
+        self.chunk_size = chunk_size
+        self.workers = max(workers, 1)
+        self.file_size = source.size
+        self.num_chunks = (self.file_size + chunk_size - 1) // chunk_size
+        self.done = {i for i in (done or ()) if 0 <= i < self.num_chunks}
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.bytes_done = sum(self.chunk_length(i) for i in self.done)
+        self.bytes_sent = 0     # 本次上传的字节数
+        self.speed = 0
+        self.eta = 0
+        self._start = None
+        self._last_checkpoint = 0
+
+    def chunk_length(self, index: int):
+        return min(self.chunk_size, self.file_size - index * self.chunk_size)
+
+    def _push_chunk(self, index: int):
+        offset = index * self.chunk_size
+        data = self.source.read(offset, self.chunk_length(index))
+        if len(data) != self.chunk_length(index):
+            raise TransferError(f'读取数据(offset={offset})不完整')
+
+        self.write(data, offset)
+        return index
+
+    def _on_done(self, index: int, force: bool = False):
+        if index is not None:
+            self.done.add(index)
+            length = self.chunk_length(index)
+            self.bytes_done += length
+            self.bytes_sent += length
+
+        now = time.monotonic()
+        elapsed = now - self._start
+        if elapsed > 0:
+            self.speed = int(self.bytes_sent / elapsed)
+            self.eta = int((self.file_size - self.bytes_done) / self.speed) if self.speed else 0
+
+        if self.checkpoint and (force or now - self._last_checkpoint >= self.checkpoint_interval):
+            self._last_checkpoint = now
+            self.checkpoint(self)
+
+    def _collect(self, futures):
+        """
+        记录已完成的分块
+
+        :return:
+            Exception or None   # 第一个上传失败的错误
+        """
+        err = None
+        for f in futures:
+            if f.cancelled():
+                continue
+
+            try:
+                index = f.result()
+            except Exception as e:
+                err = err or e
+            else:
+                self._on_done(index)
+
+        return err
+
+    def run(self):
+        """
+        上传未完成的分块，出错时已完成的分块仍会通过checkpoint回调保存
+
+        :return:
+            dict    # {'size', 'chunks', 'pushed', 'bytes', 'seconds', 'speed'}
+        :raise: TransferError
+        """
+        self._start = time.monotonic()
+        todo = [i for i in range(self.num_chunks) if i not in self.done]
+        err = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for index in todo:
+                if len(pending) >= self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    err = self._collect(done)
+                    if err is not None:
+                        break
+
+                pending.add(executor.submit(self._push_chunk, index))
+
+            if err is not None:
+                for f in pending:
+                    f.cancel()
+
+            err = self._collect(pending) or err    # 等待在途的分块
+
+        self._on_done(None, force=True)
+        if err is not None:
+            if isinstance(err, TransferError):
+                raise err
+            raise TransferError(str(err))
+
+        return {
+            'size': self.file_size,
+            'chunks': self.num_chunks,
+            'pushed': len(todo),
+            'bytes': self.bytes_sent,
+            'seconds': time.monotonic() - self._start,
+            'speed': self.speed
+        }
@@ -0,0 +1,138 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from network.managers import VlanManager, MacIPManager
+from network.models import Vlan, MacIP
+
+
+def locked_apply_for_free_ip(vlan_id: int):
+    """
+    原来的申请方式，作为对照：SELECT ... FOR UPDATE 第一个未使用的ip
+    """
+    with transaction.atomic():
+        ip = MacIP.objects.select_for_update().filter(vlan=vlan_id, used=False, enable=True).first()
+        if not ip:
+            return None
+
+        ip.used = True
+        ip.save(update_fields=['used'])
+
+    return ip
+
+
+class Command(BaseCommand):
+    '''
+    MAC IP并发申请性能测试
+    '''
+
+    help = """
+            创建一个临时/22子网，多线程并发申请ip，输出吞吐量和延迟，测试完删除临时子网；
+            需要在MySQL等支持并发写的数据库上运行
+            python manage.py bench_macip_alloc [--workers 50] [--total 1000] [--strategy optimistic|locked|all]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default=50, dest='workers', type=int, help='并发线程数')
+        parser.add_argument('--total', default=1000, dest='total', type=int, help='申请ip总数，不能超过子网ip数')
+        parser.add_argument(
+            '--strategy', default='all', dest='strategy', choices=['optimistic', 'locked', 'all'],
+            help='optimistic(条件更新无锁申请)；locked(select_for_update)；all(都测试)',
+        )
+        parser.add_argument('--subnet', default='10.254.0.0', dest='subnet', help='临时/22子网地址，不能与已有ip冲突')
+
+    def handle(self, *args, **options):
+        strategies = ['optimistic', 'locked'] if options['strategy'] == 'all' else [options['strategy']]
+        vlan = self.create_vlan(subnet=options['subnet'])
+        try:
+            for strategy in strategies:
+                MacIP.objects.filter(vlan=vlan).update(used=False)
+                result = self.run_bench(
+                    vlan_id=vlan.id, strategy=strategy, workers=options['workers'], total=options['total'])
+                self.stdout.write(
+                    f"[{strategy}] workers={result['workers']}, allocated={result['allocated']}, "
+                    f"failed={result['failed']}, duplicated={result['duplicated']}, "
+                    f"elapsed={result['elapsed']:.3f}s, ops/sec={result['ops']:.1f}, "
+                    f"p50={result['p50'] * 1000:.2f}ms, p99={result['p99'] * 1000:.2f}ms"
+                )
+        finally:
+            MacIP.objects.filter(vlan=vlan).delete()
+            vlan.delete()
+
+    @staticmethod
+    def create_vlan(subnet: str):
+        vlan = Vlan(
+            br='br-bench', name='bench-macip-alloc', subnet_ip=subnet, net_mask='255.255.252.0',
+            gateway=subnet, dns_server='', dhcp_config='', enable=True
+        )
+        vlan.save(force_insert=True)
+        first = subnet.rsplit('.', 2)[0]
+        second = int(subnet.rsplit('.', 2)[1])
+        try:
+            ip_macs = VlanManager.generate_subips(
+                vlan=vlan, from_ip=f'{first}.{second}.1', to_ip=f'{first}.{second + 3}.254')
+            MacIP.objects.bulk_create([MacIP(vlan=vlan, ipv4=ip, mac=mac) for ip, mac in ip_macs], batch_size=500)
+        except Exception as e:
+            MacIP.objects.filter(vlan=vlan).delete()
+            vlan.delete()
+            raise CommandError(f'创建临时子网失败，{str(e)}')
+
+        return vlan
+
+    @staticmethod
+    def run_bench(vlan_id: int, strategy: str, workers: int, total: int):
+        if strategy == 'optimistic':
+            apply_ip = lambda: MacIPManager.apply_for_free_ip(vlan_id=vlan_id)
+        else:
+            apply_ip = lambda: locked_apply_for_free_ip(vlan_id=vlan_id)
+
+        lock = threading.Lock()
+        latencies = []
+        ip_ids = []
+        counter = {'remain': total, 'failed': 0}
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if counter['remain'] <= 0:
+                            return
+                        counter['remain'] -= 1
+
+                    t = time.perf_counter()
+                    try:
+                        ip = apply_ip()
+                    except Exception:
+                        ip = None
+                    d = time.perf_counter() - t
+                    with lock:
+                        latencies.append(d)
+                        if ip is None:
+                            counter['failed'] += 1
+                        else:
+                            ip_ids.append(ip.id)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        n = len(latencies)
+        return {
+            'workers': workers,
+            'allocated': len(ip_ids),
+            'failed': counter['failed'],
+            'duplicated': len(ip_ids) - len(set(ip_ids)),
+            'elapsed': elapsed,
+            'ops': len(ip_ids) / elapsed if elapsed > 0 else 0,
+            'p50': latencies[int(n * 0.5)] if n else 0,
+            'p99': latencies[min(int(n * 0.99), n - 1)] if n else 0,
+        }
@@ -1,16 +1,24 @@
 from io import StringIO
 import io
+import logging
+import random
 import re
 
 from ipaddress import IPv4Address, AddressValueError, IPv6Address, IPv4Network, IPv6Network
 from django.db import transaction
-from django.db.models import Subquery
+from django.db.models import Subquery, Min, Max
 
 from .models import Vlan, MacIP, ShieldVlan
 from utils.errors import NetworkError
 from compute.managers import CenterManager, GroupManager
 
 
+MACIP_APPLY_CANDIDATES = 8      # 申请ip时每次随机选取的候选ip数
+MACIP_APPLY_MAX_RETRY = 5       # 候选ip都被其他请求占用时重新选取的次数
+
+logger = logging.getLogger(__name__)
+
+
 # def generate_mac(mac_start):
 #     """
 #     ipv6 生成mcip
@@ -432,17 +440,45 @@ class MacIPManager:
             True: 有
             False: 没有
         """
-        qs = MacIP.get_all_free_ip_in_vlan(vlan_id)
-        if qs.count() > 0:
-            return True
+        return MacIP.get_all_free_ip_in_vlan(vlan_id).exists()
+
+    @staticmethod
+    def _claim_ip(qs):
+        """
+        条件更新(UPDATE ... WHERE used=False)方式占用ip，不加锁，更新行数决定是否成功
 
-        return False
+        :return:
+            True    # 成功
+            False   # 已被其他请求占用
+        """
+        return qs.filter(used=False, enable=True).update(used=True) > 0
+
+    @staticmethod
+    def _random_free_ip_ids(vlan_id: int, num: int):
+        """
+        从子网中随机位置开始取num个未使用的ip的id，避免并发申请都竞争第一个未使用的ip
+        """
+        agg = MacIP.objects.filter(vlan=vlan_id).aggregate(min_id=Min('id'), max_id=Max('id'))
+        min_id, max_id = agg['min_id'], agg['max_id']
+        if min_id is None:
+            return []
+
+        pivot = random.randint(min_id, max_id)
+        qs = MacIP.get_all_free_ip_in_vlan(vlan_id).order_by('id')
+        ids = list(qs.filter(id__gte=pivot).values_list('id', flat=True)[:num])
+        if len(ids) < num:
+            ids += list(qs.filter(id__lt=pivot).values_list('id', flat=True)[:num - len(ids)])
+
+        random.shuffle(ids)
+        return ids
 
     @staticmethod
     def apply_for_free_ip(vlan_id: int = 0, ipv4: str = ''):
         """
         申请一个未使用的ip，申请成功的ip不再使用时需要通过free_used_ip()释放
 
+        无锁方式：随机选取候选ip，通过条件更新占用，冲突时换下一个候选，候选都冲突时重新选取
+
         :param vlan_id: 子网id
         :param ipv4: 指定要申请的ip
         :return:
@@ -452,25 +488,60 @@ class MacIPManager:
         if not vlan_id and not ipv4:
             return None
 
-        with transaction.atomic():
-            qs_ips = MacIP.objects.select_for_update().filter(used=False, enable=True).select_related('vlan')
+        try:
             if ipv4:
-                qs_ips = qs_ips.filter(ipv4=ipv4)
+                qs = MacIP.objects.filter(ipv4=ipv4)
+                if vlan_id and vlan_id > 0:
+                    qs = qs.filter(vlan=vlan_id)
 
-            if vlan_id and vlan_id > 0:
-                qs_ips = qs_ips.filter(vlan=vlan_id)
+                if not MacIPManager._claim_ip(qs):
+                    return None
 
-            ip = qs_ips.first()
-            if not ip:
-                return None
+                return MacIP.objects.select_related('vlan').filter(ipv4=ipv4).first()
 
-            ip.used = True
-            try:
-                ip.save(update_fields=['used'])
-            except Exception as e:
-                return None
+            for _ in range(MACIP_APPLY_MAX_RETRY):
+                ids = MacIPManager._random_free_ip_ids(vlan_id=vlan_id, num=MACIP_APPLY_CANDIDATES)
+                if not ids:
+                    return None
 
-        return ip
+                for ip_id in ids:
+                    if MacIPManager._claim_ip(MacIP.objects.filter(id=ip_id)):
+                        return MacIP.objects.select_related('vlan').filter(id=ip_id).first()
+        except Exception as e:
+            return None
+
+        return None
+
+    @staticmethod
+    def apply_for_free_ips(vlan_id: int, num: int):
+        """
+        一次申请多个未使用的ip，批量创建虚拟机时使用，申请成功的ip不再使用时需要通过free_used_ip()释放
+
+        与apply_for_free_ip()相同的无锁方式：随机选取候选ip，逐个通过条件更新占用，被并发占用的跳过，不足时重新选取
+
+        :param vlan_id: 子网id
+        :param num: 要申请的ip数
+        :return:
+            [MacIP()]   # 可能少于num个，子网没有足够的ip
+        """
+        claimed_ids = []
+        try:
+            for _ in range(MACIP_APPLY_MAX_RETRY):
+                need = num - len(claimed_ids)
+                if need <= 0:
+                    break
+
+                ids = MacIPManager._random_free_ip_ids(vlan_id=vlan_id, num=need)
+                if not ids:
+                    break
+
+                for ip_id in ids:
+                    if MacIPManager._claim_ip(MacIP.objects.filter(id=ip_id)):
+                        claimed_ids.append(ip_id)
+        except Exception as e:
+            logger.error(f'申请子网(vlan_id={vlan_id})的ip时错误，已申请{len(claimed_ids)}个，{str(e)}')
+
+        return list(MacIP.objects.select_related('vlan').filter(id__in=claimed_ids))
 
     @staticmethod
     def free_used_ip(ip_id: int = 0, ipv4: str = ''):
@@ -483,21 +554,18 @@ class MacIPManager:
             True    # success
             False   # failed
         """
+        if ip_id > 0:
+            qs = MacIP.objects.filter(id=ip_id)
+        elif ipv4:
+            qs = MacIP.objects.filter(ipv4=ipv4)
+        else:
+            return False
+
         try:
-            with transaction.atomic():
-                if ip_id > 0:
-                    ip = MacIP.objects.select_for_update().filter(id=ip_id).first()
-                elif ipv4:
-                    ip = MacIP.objects.select_for_update().filter(ipv4=ipv4).first()
-                else:
-                    return False
-
-                if not ip:
-                    return False
-
-                if not ip.set_free():
-                    return False
-            return True
+            if qs.filter(used=True).update(used=False) > 0:
+                return True
+
+            return qs.exists()    # 已是未使用状态
         except Exception as e:
             return False
 
@@ -516,4 +584,4 @@ class MacIPManager:
         if qs.count() > 0 or flag:
             return qs
 
-        return None
\ No newline at end of file
+        return None
\ No newline at end of file
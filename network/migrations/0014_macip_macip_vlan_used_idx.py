@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0013_remove_vlan_image_specialized'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='macip',
+            index=models.Index(fields=['vlan', 'used'], name='macip_vlan_used_idx'),
+        ),
+    ]
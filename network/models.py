@@ -132,6 +132,9 @@ class MacIP(models.Model):
         ordering = ['id']
         verbose_name = _('MAC IP地址')
         verbose_name_plural = _('07_MAC IP地址')
+        indexes = [
+            models.Index(fields=['vlan', 'used'], name='macip_vlan_used_idx')
+        ]
 
     def __str__(self):
         return self.ipv4
@@ -178,7 +181,7 @@ class MacIP(models.Model):
             return True
 
         try:
-            r = self.objects.filter(id=self.id, used=False).update(used=True)  # 乐观锁方式,
+            r = MacIP.objects.filter(id=self.id, used=False).update(used=True)  # 乐观锁方式,
         except Exception as e:
             return False
         if r > 0:  # 更新行数
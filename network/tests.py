@@ -1,3 +1,71 @@
-from django.test import TestCase
+import threading
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from network.models import Vlan, MacIP
+from network.managers import MacIPManager
+
+
+def create_vlan(num: int):
+    vlan = Vlan.objects.create(br='br0', name='test', subnet_ip='10.0.0.0', net_mask='255.255.255.0',
+                               gateway='10.0.0.1', dns_server='10.0.0.1', dhcp_config='')
+    MacIP.objects.bulk_create([
+        MacIP(vlan=vlan, mac=f'c8:00:0a:00:00:{i + 2:02x}', ipv4=f'10.0.0.{i + 2}') for i in range(num)])
+    return vlan
+
+
+class MacIPAllocatorTests(TestCase):
+    def setUp(self):
+        self.vlan = create_vlan(num=4)
+
+    def test_claim_ip(self):
+        qs = MacIP.objects.filter(ipv4='10.0.0.2')
+        self.assertTrue(MacIPManager._claim_ip(qs))
+        self.assertFalse(MacIPManager._claim_ip(qs))    # 已被使用的ip条件更新不到
+        self.assertTrue(qs.get().used)
+
+        qs = MacIP.objects.filter(ipv4='10.0.0.3')
+        qs.update(enable=False)
+        self.assertFalse(MacIPManager._claim_ip(qs))    # 未开启使用的ip不能占用
+        self.assertFalse(qs.get().used)
+
+    def test_apply_free(self):
+        ip = MacIPManager.apply_for_free_ip(ipv4='10.0.0.2')
+        self.assertEqual(ip.ipv4, '10.0.0.2')
+        self.assertIsNone(MacIPManager.apply_for_free_ip(ipv4='10.0.0.2'))
+
+        # 释放的ip可以再次申请
+        self.assertTrue(MacIPManager.free_used_ip(ip_id=ip.id))
+        self.assertTrue(MacIPManager.free_used_ip(ip_id=ip.id))     # 已是未使用状态
+        self.assertEqual(MacIPManager.apply_for_free_ip(ipv4='10.0.0.2').id, ip.id)
+
+        ips = MacIPManager.apply_for_free_ips(vlan_id=self.vlan.id, num=5)
+        self.assertEqual(sorted(i.ipv4 for i in ips), ['10.0.0.3', '10.0.0.4', '10.0.0.5'])
+        self.assertIsNone(MacIPManager.apply_for_free_ip(vlan_id=self.vlan.id))
+        self.assertTrue(MacIPManager.free_used_ip(ipv4='10.0.0.4'))
+        self.assertEqual(MacIPManager.apply_for_free_ip(vlan_id=self.vlan.id).ipv4, '10.0.0.4')
+
+
+class MacIPConcurrentTests(TransactionTestCase):
+    def test_concurrent_claim(self):
+        vlan = create_vlan(num=1)
+        barrier = threading.Barrier(4)
+        results = []
+
+        def claim():
+            try:
+                barrier.wait()
+                results.append(MacIPManager.apply_for_free_ip(vlan_id=vlan.id))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # 同一个ip只有一个请求申请成功
+        self.assertEqual(len([ip for ip in results if ip is not None]), 1)
+        self.assertEqual(MacIP.objects.filter(used=True).count(), 1)
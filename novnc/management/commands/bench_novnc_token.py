@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import queue
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from novnc.token_plugin_mysql.token_plugin_mysql import TokenLookup, TokenLookupService
+
+
+class Command(BaseCommand):
+    '''
+    novnc token插件查询性能测试
+    '''
+
+    help = """
+            使用本地sqlite数据库模拟novnc_token表，与websockify部署方式相同每个控制台会话fork一个子进程查询token，
+            对比每次查询新建数据库连接、子进程内连接池+缓存、查询服务进程(连接池+缓存)三种方式，
+            并发打开大量控制台会话时的耗时、查询延迟和数据库连接数
+            python manage.py bench_novnc_token [--sessions 1000] [--concurrency 60] [--lookups 2] [--connect-latency 5]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', default=1000, dest='sessions', type=int, help='控制台会话数')
+        parser.add_argument('--concurrency', default=60, dest='concurrency', type=int, help='同时打开的会话数')
+        parser.add_argument('--lookups', default=2, dest='lookups', type=int, help='每个会话查询token的次数(重连)')
+        parser.add_argument('--connect-latency', default=5, dest='connect_latency', type=float,
+                            help='模拟每次建立数据库连接的耗时(毫秒)')
+        parser.add_argument('--pool-size', default=4, dest='pool_size', type=int, help='连接池大小')
+
+    def handle(self, *args, **options):
+        connect_latency = options['connect_latency'] / 1000
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, 'novnc.db')
+            tokens = [str(uuid.uuid4()) for _ in range(options['sessions'])]
+            with sqlite3.connect(db_path) as conn:
+                conn.execute('CREATE TABLE novnc_token (token VARCHAR(64) UNIQUE, ip VARCHAR(64), port VARCHAR(32))')
+                conn.executemany('INSERT INTO novnc_token (token, ip, port) VALUES (?, ?, ?)',
+                                 [(t, f'10.0.0.{i % 250}', str(5900 + i % 100)) for i, t in enumerate(tokens)])
+
+            ctx = multiprocessing.get_context('fork')
+            connects = ctx.Value('i', 0)    # 所有进程建立的数据库连接数
+
+            def connect():
+                time.sleep(connect_latency)
+                with connects.get_lock():
+                    connects.value += 1
+                return sqlite3.connect(db_path, check_same_thread=False)
+
+            def legacy_lookup(token):
+                conn = connect()
+                try:
+                    cur = conn.cursor()
+                    cur.execute(f"SELECT ip,port FROM novnc_token WHERE token = '{token}';")
+                    return cur.fetchone()
+                finally:
+                    conn.close()
+
+            per_process = TokenLookup(connect=connect, pool_size=options['pool_size'], placeholder='?')
+            pooled = TokenLookup(connect=connect, pool_size=options['pool_size'], placeholder='?')
+            service = TokenLookupService(get_lookup=lambda: pooled, address=os.path.join(tmpdir, 'lookup.sock'))
+            service_process = ctx.Process(target=service.serve_forever, daemon=True)
+            service_process.start()
+            time.sleep(0.5)
+            try:
+                for name, lookup in (('connect-per-lookup', legacy_lookup), ('per-process pool+cache', per_process.lookup),
+                                     ('lookup service', service.request)):
+                    connects.value = 0
+                    r = self.run_sessions(ctx=ctx, lookup=lookup, tokens=tokens, concurrency=options['concurrency'],
+                                          lookups=options['lookups'])
+                    self.stdout.write(
+                        f"{name}: sessions={len(tokens)}, elapsed={r['seconds']:.2f}s, "
+                        f"sessions/s={len(tokens) / r['seconds']:.0f}, p50={r['p50'] * 1000:.2f}ms, "
+                        f"p99={r['p99'] * 1000:.2f}ms, db_connects={connects.value}, failed={r['failed']}"
+                    )
+            finally:
+                service_process.terminate()
+                service_process.join()
+
+        self.stdout.write(self.style.SUCCESS('Successfully benchmark novnc token lookup.'))
+
+    @staticmethod
+    def run_sessions(ctx, lookup, tokens, concurrency: int, lookups: int):
+        """
+        与websockify相同，每个会话fork一个子进程查询token，同时运行的子进程最多concurrency个
+
+        :return:
+            {'seconds': float, 'failed': int, 'p50': float, 'p99': float}
+        """
+        results = ctx.Queue()
+
+        def session(token):
+            seconds = []
+            failed = 0
+            for _ in range(lookups):
+                start = time.monotonic()
+                try:
+                    ok = lookup(token) is not None
+                except Exception:
+                    ok = False
+                seconds.append(time.monotonic() - start)
+                failed += 0 if ok else 1
+            results.put((seconds, failed))
+
+        latencies = []
+        failed = started = done = 0
+        procs = []
+        start = time.monotonic()
+        while done < len(tokens):
+            while started < len(tokens) and started - done < concurrency:
+                p = ctx.Process(target=session, args=(tokens[started],))
+                p.start()
+                procs.append(p)
+                started += 1
+
+            try:
+                seconds, n_failed = results.get(timeout=60)
+            except queue.Empty:
+                raise Exception('session process no response')
+
+            done += 1
+            latencies += seconds
+            failed += n_failed
+            for p in [p for p in procs if not p.is_alive()]:
+                p.join()
+                procs.remove(p)
+
+        for p in procs:
+            p.join()
+
+        seconds = time.monotonic() - start
+        latencies.sort()
+        return {
+            'seconds': seconds, 'failed': failed,
+            'p50': latencies[len(latencies) // 2], 'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        }
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from novnc.manager import NovncTokenManager, NOVNC_TOKEN_KEEP_DAYS
+
+
+class Command(BaseCommand):
+    '''
+    清理novnc token记录
+    '''
+
+    help = """
+            批量清理novnc token记录：同一宿主机vnc端口只保留最新的token，删除保留天数之前的token；
+            可由crontab定时执行，或者指定--interval周期执行
+            python manage.py purge_novnc_token [--keep-days 3] [--interval 0]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-days', default=NOVNC_TOKEN_KEEP_DAYS, dest='keep_days', type=int,
+                            help='token记录保留天数')
+        parser.add_argument('--interval', default=0, dest='interval', type=int,
+                            help='周期执行的间隔（秒），0只执行一次')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            superseded, outdated = NovncTokenManager.purge_tokens(keep_days=options['keep_days'])
+            self.stdout.write(f'superseded={superseded}, outdated={outdated}')
+            if options['interval'] <= 0:
+                break
+
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                break
+
+        self.stdout.write(self.style.SUCCESS('Successfully purge novnc token.'))
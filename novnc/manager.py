@@ -3,40 +3,81 @@
 # @desc:    novnc token管理模块。完成读写novnc的token配置文件到数据库
 
 import uuid
-import subprocess
+import threading
+from collections import OrderedDict
+from xml.etree import ElementTree
 
 from django.conf import settings
 from django.utils import timezone
 
 from .models import Token
 from utils.errors import NovncError
+from utils.ev_libvirt.virt import VirtHost, VirtError
+
+NOVNC_TOKEN_KEEP_DAYS = getattr(settings, 'NOVNC_TOKEN_KEEP_DAYS', 3)
+GRAPHICS_CACHE_MAX_SIZE = 4096
+
+
+class GraphicsInfoCache:
+    """
+    虚拟机graphics信息缓存，键为(宿主机ip, 虚拟机uuid)，记录获取时虚拟机的运行id；
+    虚拟机每次启动运行id都会变化，重启后缓存自动失效
+    """
+    def __init__(self, max_size: int = GRAPHICS_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()      # {(hostip, vm_uuid): (domain_id, protocol_type, port)}
+        self._lock = threading.Lock()
+
+    def get(self, hostip: str, vm_uuid: str, domain_id: int):
+        key = (hostip, vm_uuid)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            if item[0] != domain_id:
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return item[1], item[2]
+
+    def set(self, hostip: str, vm_uuid: str, domain_id: int, protocol_type: str, port: int):
+        with self._lock:
+            self._data[(hostip, vm_uuid)] = (domain_id, protocol_type, port)
+            self._data.move_to_end((hostip, vm_uuid))
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+graphics_cache = GraphicsInfoCache()
 
 
 class NovncTokenManager(object):
-    def generate_token(self, vmid: str, hostip: str, sshkey: str):
+    def generate_token(self, vmid: str, hostip: str, sshkey: str = None):
         """
         创建虚拟机vnc url
 
         :param vmid:
         :param hostip:
+        :param sshkey: 不再使用，通过宿主机libvirt连接池获取虚拟机信息
         :return:
             (vnc_id:str, vnc_url:str)   # success
 
         :raise: NovncError
         """
-        protocol_type, port = self.get_vm_graphics_info(vmid, hostip, sshkey)
+        protocol_type, port = self.get_vm_graphics_info(vmid, hostip)
         port = str(port)
         now = timezone.now()
-        # 删除该hostip和vncport的历史token记录
+        # 删除该hostip和vncport的历史token记录，端口被其他虚拟机使用后旧token不能再访问
         Token.objects.filter(ip=hostip, port=port, expiretime__lt=now).delete()
-        # 创建新的token记录
+        # 创建新的token记录；其他过期的token记录批量清理(manage.py purge_novnc_token)
         token = str(uuid.uuid4())
         Token.objects.create(token=token, ip=hostip, port=port, expiretime=now)
- 
-        # 删除（一年前 到 3天前）之间有更新的，现在过期的所有token记录
-        start_time = now - timezone.timedelta(days=365)     # print(start_time);
-        end_time = now - timezone.timedelta(days=3)         # print(end_time);
-        Token.objects.filter(updatetime__range=(start_time, end_time)).filter(expiretime__lt=now).delete()
 
         # 原url: 返回的（url_alise） -> 指向（url_source） 目录在 novnc 板块中
         # ip/novnc/?vncid=xxtype=vnc -> ip/novnc_nginx/novnc/vnc_lite.html?path=websockify/?token=xx
@@ -53,12 +94,71 @@ class NovncTokenManager(object):
         Token.objects.filter(token=str(vncid)).delete()
 
     @staticmethod
-    def get_vm_graphics_info(vmid, hostip, sshkey):
+    def purge_tokens(keep_days: int = NOVNC_TOKEN_KEEP_DAYS, batch_size: int = 1000):
         """
-        获取虚拟机的graphics display
+        清理token记录：同一宿主机vnc端口只保留最新的token，以及删除keep_days天前的token
+
+        :return:
+            (superseded: int, outdated: int)    # 删除的数量
+        """
+        now = timezone.now()
+        outdated, _ = Token.objects.filter(updatetime__lt=now - timezone.timedelta(days=keep_days),
+                                           expiretime__lt=now).delete()
+
+        latest = set()
+        superseded_ids = []
+        qs = Token.objects.filter(expiretime__lt=now).order_by('-id').values_list('id', 'ip', 'port')
+        for token_id, ip, port in qs.iterator():
+            if (ip, port) in latest:
+                superseded_ids.append(token_id)
+            else:
+                latest.add((ip, port))
+
+        superseded = 0
+        for i in range(0, len(superseded_ids), batch_size):
+            count, _ = Token.objects.filter(id__in=superseded_ids[i:i + batch_size]).delete()
+            superseded += count
+
+        return superseded, outdated
+
+    @staticmethod
+    def parse_graphics_xml(xml_desc: str):
+        """
+        从虚拟机xml中解析第一个可用的graphics display
+
+        :return:
+            (
+                protocol_type: str  # vnc or spice
+                port: int           # post
+            )
+            None    # 没有
+        """
+        try:
+            root = ElementTree.fromstring(xml_desc)
+        except ElementTree.ParseError:
+            return None
+
+        for graphics in root.iterfind('./devices/graphics'):
+            protocol_type = graphics.get('type')
+            if protocol_type not in ('vnc', 'spice'):
+                continue
+
+            # spice://127.0.0.1?tls-port=5910 只有tls端口时使用tls端口
+            for attr in ('port', 'tlsPort'):
+                port = graphics.get(attr, '')
+                if port.isdigit() and int(port) > 0:
+                    return protocol_type, int(port)
+
+        return None
+
+    @staticmethod
+    def get_vm_graphics_info(vmid, hostip, sshkey=None):
+        """
+        获取虚拟机的graphics display，通过宿主机libvirt连接池读取运行中虚拟机的xml，结果按虚拟机运行id缓存
 
         :param vmid:
         :param hostip:
+        :param sshkey: 不再使用
         :return:
             (
                 protocol_type: str  # vnc or spice
@@ -66,38 +166,31 @@ class NovncTokenManager(object):
             )
         :raise: NovncError
         """
-        # spice[vnc]://localhost:5910 ; spice://127.0.0.1?tls-port=5910
         try:
             vm_uuid = str(uuid.UUID(vmid))
         except ValueError:
             vm_uuid = vmid
 
-        cmd = f'ssh -i {sshkey} {hostip} virsh domdisplay {vm_uuid}'
-        # cmd = f'ssh {hostip} virsh vncdisplay {vmid}'
-        res, info = subprocess.getstatusoutput(cmd)
-        if res != 0:
-            raise NovncError(msg=info)
-
-        protocol_type = ''
-        port = False
-        for line in info.split('\n'):
-            line = line.strip()
-            if line.startswith('spice') or line.startswith('vnc'):
-                protocol_type, line = line.split('://')
-                if 'tls-port' in line:
-                    _, port = line.split('tls-port=')
-                else:
-                    _, port = line.split(':')
-
-                if port.isdigit():
-                    if protocol_type == 'spice':
-                        port = int(port)
-                    else:
-                        port = settings.VNCSERVER_BASE_PORT + int(port)
-
-                    break
-
-        if not port:
+        try:
+            domain = VirtHost(host_ipv4=hostip).get_domain(vm_uuid=vm_uuid)
+            domain_id = domain.ID()
+            if domain_id < 0:
+                raise NovncError(msg='虚拟机未运行')
+
+            info = graphics_cache.get(hostip=hostip, vm_uuid=vm_uuid, domain_id=domain_id)
+            if info is not None:
+                return info
+
+            info = NovncTokenManager.parse_graphics_xml(domain.XMLDesc())
+        except NovncError:
+            raise
+        except VirtError as e:
+            raise NovncError(msg=str(e))
+        except Exception as e:
+            raise NovncError(msg=f'Get graphics display info failed, {str(e)}')
+
+        if info is None:
             raise NovncError(msg='Get graphics display info failed.')
 
-        return protocol_type, port
+        graphics_cache.set(hostip=hostip, vm_uuid=vm_uuid, domain_id=domain_id, protocol_type=info[0], port=info[1])
+        return info
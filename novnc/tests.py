@@ -1,3 +1,115 @@
+import os
+import sqlite3
+import stat
+import tempfile
+from unittest import mock
+
 from django.test import TestCase
+from django.utils import timezone
+
+from .manager import NovncTokenManager, GraphicsInfoCache
+from .models import Token
+from .token_plugin_mysql import token_plugin_mysql
+from .token_plugin_mysql.token_plugin_mysql import TokenLookup, TokenLookupService, TokenLookupError, TokenMysql
+
+
+class TokenLookupTests(TestCase):
+    def test_pooled_cached_lookup(self):
+        conns = []
+
+        def connect():
+            conn = sqlite3.connect(':memory:', check_same_thread=False)
+            conn.execute('CREATE TABLE novnc_token (token VARCHAR(64), ip VARCHAR(64), port VARCHAR(32))')
+            conn.execute("INSERT INTO novnc_token VALUES ('t1', '10.0.0.1', '5901')")
+            conns.append(conn)
+            return conn
+
+        lookup = TokenLookup(connect=connect, pool_size=2, placeholder='?')
+        self.assertEqual(lookup.lookup('t1'), ['10.0.0.1', '5901'])
+        self.assertIsNone(lookup.lookup("x' OR '1'='1"))    # 参数化查询
+        self.assertIsNone(lookup.lookup('t2'))
+        self.assertEqual(len(conns), 1)     # 复用连接
+
+        conns[0].execute("UPDATE novnc_token SET port = '5902'")
+        self.assertEqual(lookup.lookup('t1'), ['10.0.0.1', '5901'])     # 缓存
+        lookup.cache.clear()
+        self.assertEqual(lookup.lookup('t1'), ['10.0.0.1', '5902'])
+
+        # 出错的连接被丢弃，重试新连接
+        conns[0].close()
+        lookup.cache.clear()
+        self.assertEqual(lookup.lookup('t1'), ['10.0.0.1', '5901'])
+        self.assertEqual(len(conns), 2)
+
+    def test_lookup_service(self):
+        class FakeLookup:
+            def lookup(self, token):
+                if token == 'error':
+                    raise Exception('db\nerror')
+                return ['10.0.0.1', '5901'] if token == 't1' else None
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        address = os.path.join(tmpdir.name, 'lookup.sock')
+        open(address, 'w').close()  # 上次未清理的socket文件
+        service = TokenLookupService(get_lookup=FakeLookup, address=address)
+        service.start()
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(address).st_mode), 0o600)
+            self.assertEqual(service.request('t1'), ['10.0.0.1', '5901'])
+            self.assertIsNone(service.request('t2'))
+            with self.assertRaises(TokenLookupError):
+                service.request('error')
+
+            # 查询服务不可用时直接查询数据库
+            plugin = TokenMysql('mysql')
+            with mock.patch.object(token_plugin_mysql, 'get_token_lookup', FakeLookup):
+                self.assertEqual(plugin.lookup('t1'), ['10.0.0.1', '5901'])
+                plugin._service = service
+                self.assertEqual(plugin.lookup('t1'), ['10.0.0.1', '5901'])
+                self.assertIsNone(plugin.lookup('t1\nt2'))
+                self.assertIsNone(plugin.lookup('error'))
+        finally:
+            service.close()
+
+        self.assertFalse(os.path.exists(address))
+
+
+class NovncTokenManagerTests(TestCase):
+    def test_parse_graphics_xml(self):
+        xml = """<domain type='kvm'><devices>
+            <graphics type='spice' autoport='yes' tlsPort='5910'><listen type='address' address='0.0.0.0'/></graphics>
+            <graphics type='vnc' port='5901' autoport='yes' listen='0.0.0.0'/>
+        </devices></domain>"""
+        self.assertEqual(NovncTokenManager.parse_graphics_xml(xml), ('spice', 5910))
+        xml = "<domain><devices><graphics type='vnc' port='-1' autoport='yes'/></devices></domain>"
+        self.assertIsNone(NovncTokenManager.parse_graphics_xml(xml))
+        self.assertIsNone(NovncTokenManager.parse_graphics_xml('not xml'))
+
+        cache = GraphicsInfoCache(max_size=1)
+        cache.set(hostip='10.0.0.1', vm_uuid='a', domain_id=3, protocol_type='vnc', port=5901)
+        self.assertEqual(cache.get(hostip='10.0.0.1', vm_uuid='a', domain_id=3), ('vnc', 5901))
+        self.assertIsNone(cache.get(hostip='10.0.0.1', vm_uuid='a', domain_id=4))    # 虚拟机重启过
+        self.assertIsNone(cache.get(hostip='10.0.0.1', vm_uuid='a', domain_id=3))
+
+    def test_purge_tokens(self):
+        now = timezone.now()
+        Token.objects.create(token='t1', ip='10.0.0.1', port='5901', expiretime=now)
+        Token.objects.create(token='t2', ip='10.0.0.1', port='5901', expiretime=now)
+        Token.objects.create(token='t3', ip='10.0.0.1', port='5902', expiretime=now)
+        Token.objects.create(token='t4', ip='10.0.0.2', port='5901', expiretime=now)
+        Token.objects.filter(token='t4').update(updatetime=now - timezone.timedelta(days=5))
+
+        superseded, outdated = NovncTokenManager.purge_tokens(keep_days=3)
+        self.assertEqual((superseded, outdated), (1, 1))
+        self.assertEqual(set(Token.objects.values_list('token', flat=True)), {'t2', 't3'})
+
+    def test_generate_token_deletes_superseded(self):
+        now = timezone.now()
+        Token.objects.create(token='old', ip='10.0.0.1', port='5901', expiretime=now)
+        Token.objects.create(token='other', ip='10.0.0.1', port='5902', expiretime=now)
+        with mock.patch.object(NovncTokenManager, 'get_vm_graphics_info', return_value=('vnc', 5901)):
+            token, url = NovncTokenManager().generate_token(vmid='test', hostip='10.0.0.1')
 
-# Create your tests here.
+        self.assertIn(token, url)
+        self.assertEqual(set(Token.objects.values_list('token', flat=True)), {token, 'other'})
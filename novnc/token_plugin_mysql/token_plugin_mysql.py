@@ -1,65 +1,407 @@
 #!/usr/bin/env python36
 # -*- coding: utf-8 -*-
+"""
+websockify token插件，从evcloud数据库novnc_token表查询token对应的宿主机ip和vnc端口
 
+* 数据库连接放在一个小的连接池中复用，不再每个websocket连接都新建一个数据库连接，出错时连接被丢弃，不会泄漏；
+* 查询使用参数化的sql，token不再拼接到sql中；
+* token -> (ip, port)的查询结果缓存一小段时间(LRU)，同时打开大量控制台时减少对数据库的查询；未找到的token不缓存。
+
+websockify每个websocket连接fork一个子进程处理，子进程中的连接池和缓存随子进程退出而丢弃，
+所以连接池和缓存放在单独运行的查询服务进程(python3 token_plugin_mysql.py serve，systemd服务evcloud_novnc_token)中，
+websockify子进程通过unix socket查询；socket文件权限0600，websockify需以同一用户(root)运行；
+查询服务不可用时，子进程直接查询数据库。
+websockify的线程模式(--libserver)不支持token插件，不能使用；查询服务也不放在websockify主进程的线程中，
+主进程每个连接fork一次，fork时持有GIL，大量控制台同时打开时查询线程得不到执行。
+"""
 import os
+import socket
+import socketserver
 import sys
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
 
-import MySQLdb  # pip3 install mysqlclient 或者 dnf install python3-mysql.x86_64
 
-# from config import db_Ip, db_User, db_Password, db_DefaultDB, db_Port, db_Table
-sys.path.append('/home/uwsgi/evcloud/django_site')
-import security as settings
-db_Ip = settings.DATABASES['default']['HOST']
-db_Port = int(settings.DATABASES['default']['PORT'])
-db_User = settings.DATABASES['default']['USER']
-db_Password = settings.DATABASES['default']['PASSWORD']
-db_DefaultDB = settings.DATABASES['default']['NAME']
+SITE_DIR = '/home/uwsgi/evcloud/django_site'
 db_Table = 'novnc_token'
+LOOKUP_SERVICE_ADDRESS = '/var/run/evcloud_novnc_token.sock'     # 查询服务的unix socket文件，只有root可访问
 
 # mariadb setting
 #db_Ip        = '127.0.0.1';
-#db_Port      = 3306; 
+#db_Port      = 3306;
 #db_User      = 'root';
-#db_Password  = ''; 
+#db_Password  = '';
 #db_DefaultDB = 'evcloud'
 
 
-class TokenMysql(object):
-    def __init__(self, src):
-        self._server = src
+def load_settings():
+    """
+    加载evcloud敏感信息配置文件security.py
+    """
+    if SITE_DIR not in sys.path:
+        sys.path.append(SITE_DIR)
+
+    import security
+    return security
+
+
+def mysql_connect_func(settings):
+    """
+    返回创建数据库连接的函数
+
+    :param settings: security配置模块
+    """
+    import MySQLdb  # pip3 install mysqlclient 或者 dnf install python3-mysql.x86_64
+
+    db = settings.DATABASES['default']
+    params = {
+        'host': db['HOST'], 'port': int(db['PORT']), 'user': db['USER'], 'password': db['PASSWORD'],
+        'database': db['NAME'], 'charset': 'utf8mb4', 'connect_timeout': 5, 'autocommit': True
+    }
+
+    def connect():
+        return MySQLdb.connect(**params)
+
+    return connect
+
+
+class ConnectionPool:
+    """
+    数据库连接池，最多同时存在size个连接，空闲连接后进先出复用
+    """
+    def __init__(self, connect, size: int = 4, timeout: float = 5, max_idle: float = 300):
+        """
+        :param connect: 创建连接的函数
+        :param size: 连接数上限
+        :param timeout: 等待空闲连接的超时时间(秒)
+        :param max_idle: 空闲超过此时间(秒)的连接不再使用，避免使用已被数据库服务端断开的连接
+        """
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self.connects = 0
+
+    def _check_fork(self):
+        """
+        fork的子进程不能使用父进程的连接(socket是共享的)，直接丢弃，不能close
+        """
+        if self._pid != os.getpid():
+            self._reset()
 
     @staticmethod
-    def lookup(token):
+    def _close(conn):
         try:
-            # mysql_conn = MySQLdb.connect(db_Ip, db_User, db_Password, db_DefaultDB, db_Port, charset='utf8')
-            mysql_conn = MySQLdb.connect(host=db_Ip, port=db_Port, user=db_User, password=db_Password,
-                                         database=db_DefaultDB, charset='utf8mb4')
-            # mysql_conn = mysql.connector.connect(**config) # tidb
-        except:
-            print(f'connect to the server faild!server:{db_Ip}')
-            return None
- 
-        sql_string = f"SELECT ip,port FROM {db_Table} WHERE token = '{token}';"
-        mysql_cur = mysql_conn.cursor()    # mysql cursor
+            conn.close()
+        except Exception:
+            pass
+
+    def _get_idle(self):
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except Empty:
+                return None
+
+            if time.monotonic() - idle_since <= self.max_idle:
+                return conn
+
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        取一个连接，使用中出错的连接被关闭丢弃，否则放回连接池
+
+        :raise: TimeoutError, 数据库连接错误
+        """
+        self._check_fork()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError('wait for database connection timeout')
+
+        conn = None
         try:
-            mysql_cur.execute(sql_string)
-        except:
-            print('mysql select failed!')
+            conn = self._get_idle()
+            if conn is None:
+                conn = self._connect()
+                self.connects += 1
+
+            yield conn
+        except BaseException:
+            if conn is not None:
+                self._close(conn)
+            raise
+        else:
+            self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        self._check_fork()
+        while True:
+            conn = self._get_idle()
+            if conn is None:
+                break
+            self._close(conn)
+
+
+class TTLCache:
+    """
+    有过期时间的LRU缓存
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expire = item
+                if expire > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._data[key]
+
+            self.misses += 1
             return None
 
-        result = mysql_cur.fetchone()
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TokenLookup:
+    """
+    通过连接池查询token对应的宿主机ip和端口，查询结果缓存
+    """
+    def __init__(self, connect, table: str = db_Table, pool_size: int = 4, cache_size: int = 1024,
+                 cache_ttl: float = 10, placeholder: str = '%s'):
+        """
+        :param connect: 创建数据库连接的函数
+        :param placeholder: 数据库驱动的sql参数占位符，MySQLdb为%s，sqlite3为?
+        """
+        self.pool = ConnectionPool(connect=connect, size=pool_size)
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.sql = f'SELECT ip, port FROM {table} WHERE token = {placeholder}'
+
+    def _query(self, token: str):
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(self.sql, (token,))
+                return cur.fetchone()
+            finally:
+                cur.close()
+
+    def lookup(self, token: str):
+        """
+        :return:
+            [ip, port]
+            None    # token未找到
+        :raise: 数据库错误
+        """
+        value = self.cache.get(token)
+        if value is not None:
+            return list(value)
+
+        try:
+            result = self._query(token)
+        except TimeoutError:
+            raise
+        except Exception:
+            result = self._query(token)     # 连接可能已被服务端断开，重试一次新连接
+
         if result is None:
             return None  # token未找到
 
         ip, port = result
-        mysql_cur.close()
-        mysql_conn.close()
+        self.cache.set(token, (ip, port))
+        return [ip, port]
+
+
+_token_lookup = None
+_token_lookup_lock = threading.Lock()
+
+
+def get_token_lookup():
+    global _token_lookup
+
+    if _token_lookup is None:
+        with _token_lookup_lock:
+            if _token_lookup is None:
+                settings = load_settings()
+                _token_lookup = TokenLookup(
+                    connect=mysql_connect_func(settings), table=db_Table,
+                    pool_size=getattr(settings, 'NOVNC_TOKEN_DB_POOL_SIZE', 4),
+                    cache_size=getattr(settings, 'NOVNC_TOKEN_CACHE_SIZE', 1024),
+                    cache_ttl=getattr(settings, 'NOVNC_TOKEN_CACHE_TTL', 10)
+                )
+
+    return _token_lookup
+
+
+class TokenLookupError(Exception):
+    pass
+
+
+class _LookupServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128    # 大量控制台同时打开时，默认的5会使子进程连接失败(EAGAIN)
+
+
+class TokenLookupService:
+    """
+    token查询服务，websockify的子进程通过unix socket查询，所有子进程共享查询服务的连接池和缓存
+
+    协议：每个连接一次查询，请求为"token\\n"，响应为"ip port\\n"，token未找到为"\\n"，查询出错为"!错误信息\\n"
+    """
+    def __init__(self, get_lookup, address: str = None, timeout: float = 5):
+        """
+        :param get_lookup: 返回TokenLookup对象的函数
+        :param address: unix socket文件路径
+        :param timeout: 查询的超时时间(秒)
+        """
+        self._get_lookup = get_lookup
+        self.address = address or LOOKUP_SERVICE_ADDRESS
+        self.timeout = timeout
+        self._server = None
+
+    def _handle(self, token: str):
+        try:
+            result = self._get_lookup().lookup(token)
+        except Exception as e:
+            return '!' + str(e).replace('\n', ' ')
+
+        if result is None:
+            return ''
+
+        ip, port = result
+        return f'{ip} {port}'
+
+    def start(self):
+        """
+        在后台线程中运行查询服务
+
+        :raise: OSError
+        """
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                token = self.rfile.readline(1024).decode('utf-8', errors='replace').strip()
+                self.wfile.write((service._handle(token) + '\n').encode('utf-8'))
+
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        server = _LookupServer(self.address, Handler)
+        os.chmod(self.address, 0o600)
+        threading.Thread(target=server.serve_forever, name='novnc-token-lookup', daemon=True).start()
+        self._server = server
+
+    def serve_forever(self):
+        """
+        运行查询服务，直到进程被结束
+
+        :raise: OSError
+        """
+        self.start()
+        while True:
+            time.sleep(3600)
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def request(self, token: str):
+        """
+        向查询服务查询token
+
+        :return:
+            [ip, port]
+            None    # token未找到
+        :raise: OSError     # 查询服务不可用
+        :raise: TokenLookupError    # 查询服务查询数据库出错
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+            sock.sendall((token + '\n').encode('utf-8'))
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(1024)
+                if not chunk:
+                    raise ConnectionError('token lookup service closed the connection')
+                data += chunk
+
+        line = data.decode('utf-8').strip()
+        if line.startswith('!'):
+            raise TokenLookupError(line[1:])
+
+        if not line:
+            return None
+
+        ip, port = line.split(' ', 1)
         return [ip, port]
 
 
+class TokenMysql(object):
+    def __init__(self, src):
+        self._server = src
+        self._service = TokenLookupService(get_lookup=get_token_lookup)
+
+    def lookup(self, token):
+        if '\n' in token or '\r' in token:
+            return None
+
+        try:
+            try:
+                return self._service.request(token)
+            except OSError as e:
+                print(f'token lookup service unavailable, {str(e)}')
+
+            return get_token_lookup().lookup(token)
+        except Exception as e:
+            print(f'lookup token failed, {str(e)}')
+            return None
+
+
 # 主程序 run by itself
 if __name__ == '__main__':
+    if sys.argv[1:] == ['serve']:
+        TokenLookupService(get_lookup=get_token_lookup).serve_forever()
+
     print("Welcome to use this progress ,by hai! hai@cnic.cn")
     print(time.strftime('服务器当前时间： %Y-%m-%d %H:%M:%S', time.localtime(time.time())))
     programPath = os.path.realpath(__file__)
@@ -8,9 +8,9 @@ from django.db.models import Q
 
 from compute.models import Host
 from compute.managers import CenterManager, GroupManager, HostManager
+from compute.telemetry import HostTelemetryManager
 
 from pcservers.models import Room
-from utils.ev_libvirt.virt import VmDomain
 
 
 
@@ -59,27 +59,31 @@ class ReportsListView(View):
                       context={'centers': centers, 'groups': groups, 'hosts': hosts, 'room': room, 'quota': quota})
 
 
-def get_host_cpu_men_info(host_ipv4):
+def get_host_cpu_men_info(host_ipv4, snapshot=None):
+    """
+    宿主机cpu、大页内存信息，从宿主机资源快照读取(manage.py host_telemetry_collector)，不连接宿主机
+
+    :param snapshot: 宿主机资源快照HostTelemetry()，批量查询时传入；None时查询
+    :raise: ValueError
+    """
     try:
         base_host = HostManager().get_host_by_ipv4(host_ipv4=host_ipv4)
     except Exception as e:
         raise e
 
-    host = VmDomain(host_ip=host_ipv4, vm_uuid='').host
-    if not host:
-        raise ValueError(f'无效的IP地址, 无法查到宿主机。')
-
-    host_info = host.get_info()  # 获取cpu
+    if snapshot is None:
+        snapshot = HostTelemetryManager.get_snapshot(host_ipv4=host_ipv4)
+    if not snapshot:
+        raise ValueError(f'没有宿主机资源快照或快照已过期，请检查宿主机资源采集服务。')
 
-    cpu_h = host_info[2]  # 物理cpu
-    cpu_x = host_info[2] * 4  # 虚拟cpu  默认 4倍
+    cpu_h = snapshot.cpus  # 物理cpu
+    cpu_x = snapshot.cpus * 4  # 虚拟cpu  默认 4倍
     cpu_y = base_host.vcpu_allocated  # 已分配
     per = 100 * float(cpu_y) / float(cpu_x)
     cpu_p = f'{per:.2f}'  # %
 
-    host_mem = host.get_hugepages()  # 获取大页内存 dict
-    mem_all = int(host_mem['HugePages_Total'])
-    mem_x = mem_all - int(host_mem['HugePages_Free'])  # 已使用的大页内存
+    mem_all = snapshot.hugepages_total  # 大页内存
+    mem_x = mem_all - snapshot.hugepages_free  # 已使用的大页内存
     per = 0
     try:
         if mem_all != 0 and mem_x != 0:
@@ -181,10 +185,11 @@ class ReportsHostBatchDetection(View):
             return
 
         ip_list_data = {} # {ip:[]}
+        snapshots = HostTelemetryManager.get_snapshots(ipv4s=ip_list['ip_list'])
         for ip in ip_list['ip_list']:
 
             try:
-                data = get_host_cpu_men_info(host_ipv4=ip)
+                data = get_host_cpu_men_info(host_ipv4=ip, snapshot=snapshots.get(ip))
             except Exception as e:
                 ip_list_data[ip] = ['未检测', '未检测', '未检测' ]
                 continue
@@ -0,0 +1,24 @@
+from django.db import connections
+
+
+def bulk_upsert(model, objs: list, unique_fields: list, update_fields: list, batch_size: int = None):
+    """
+    批量插入，唯一键冲突时更新update_fields
+
+    mysql(ON DUPLICATE KEY UPDATE)不支持指定冲突的唯一键，传unique_fields会抛出NotSupportedError，
+    此时按表上任意唯一键冲突更新，model上除自增主键外应只有unique_fields一个唯一键
+
+    :param model: 模型类
+    :param objs: 模型对象列表
+    :param unique_fields: 判断冲突的唯一键字段
+    :param update_fields: 冲突时更新的字段
+    :param batch_size: 每批插入的数量
+    """
+    manager = model._default_manager
+    if not connections[manager.db].features.supports_update_conflicts_with_target:
+        unique_fields = None
+
+    return manager.bulk_create(
+        objs, batch_size=batch_size, update_conflicts=True, unique_fields=unique_fields,
+        update_fields=update_fields
+    )
@@ -1,11 +1,23 @@
+import os
 import subprocess
+import threading
 import time
+from collections import OrderedDict
+from xml.etree import ElementTree
 
 import libvirt
-from xml.etree import ElementTree
+from django.conf import settings
 
 from compute.managers import HostManager
 
+LIBVIRT_CONN_POOL_MAX_SIZE = getattr(settings, 'LIBVIRT_CONN_POOL_MAX_SIZE', 32)
+LIBVIRT_KEEPALIVE_INTERVAL = getattr(settings, 'LIBVIRT_KEEPALIVE_INTERVAL', 5)
+LIBVIRT_KEEPALIVE_COUNT = getattr(settings, 'LIBVIRT_KEEPALIVE_COUNT', 3)
+# 点对点动态迁移时源宿主机连接目标宿主机的uri
+LIVE_MIGRATE_DEST_URI = getattr(settings, 'LIVE_MIGRATE_DEST_URI', 'qemu+ssh://{host_ipv4}/system?no_tty=1')
+# 设置后所有宿主机都通过此uri连接，不再通过ssh连接宿主机，用于离线性能测试，如'test:///default'；可包含{host_ipv4}
+LIBVIRT_CONNECT_URI = getattr(settings, 'LIBVIRT_CONNECT_URI', '')
+
 VIR_DOMAIN_NOSTATE = 0  # no state
 VIR_DOMAIN_RUNNING = 1  # the domain is running
 VIR_DOMAIN_BLOCKED = 2  # the domain is blocked on resource
@@ -198,6 +210,316 @@ def wrap_error(err: libvirt.libvirtError, msg=''):
     return VirtError(code=err_code, msg=msg, err=err)
 
 
+def is_conn_broken_error(err: libvirt.libvirtError):
+    """
+    是否是与宿主机的连接已失效的错误，此类错误需要重建连接
+    """
+    return err.get_error_code() in (VirErrorNumber.VIR_ERR_INVALID_CONN, VirErrorNumber.VIR_ERR_RPC)
+
+
+_event_loop_lock = threading.Lock()
+_event_loop_pid = None
+
+
+def _run_event_loop():
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except Exception:
+            time.sleep(1)
+
+
+def ensure_event_loop():
+    """
+    确保当前进程已注册并运行libvirt默认事件循环，连接keepalive和域事件回调都依赖事件循环
+
+    必须在打开连接之前调用；fork后的子进程没有事件循环线程，需要重新启动
+
+    :return:
+        True    # 事件循环已运行
+        False   # 启动失败
+    """
+    global _event_loop_pid
+
+    pid = os.getpid()
+    if _event_loop_pid == pid:
+        return True
+
+    with _event_loop_lock:
+        if _event_loop_pid == pid:
+            return True
+
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except libvirt.libvirtError:
+            return False
+
+        t = threading.Thread(target=_run_event_loop, name='libvirt-event-loop', daemon=True)
+        t.start()
+        _event_loop_pid = pid
+
+    return True
+
+
+class VirtConnectionPool:
+    """
+    进程内宿主机libvirt连接池，以宿主机ipv4为键缓存连接
+
+    * 连接开启keepalive，复用前通过isAlive()检查连接是否有效，失效时重建连接
+    * 缓存的连接数有上限，超出时移除最久未使用的连接
+    * 记录每个连接被VirtHost使用的引用数，移除的连接没有被使用时立即关闭，否则最后一个引用释放(release())时关闭；
+      注册了close回调的连接被libvirt持有引用，不会自动回收，必须注销回调并close
+    * uwsgi fork出的子进程不复用父进程的连接
+    """
+    def __init__(self, max_size: int = LIBVIRT_CONN_POOL_MAX_SIZE):
+        self.max_size = max(max_size, 1)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._conns = OrderedDict()     # {host_ipv4: libvirt.virConnect}
+        self._refs = {}                 # {libvirt.virConnect: 引用数}
+        self._retired = set()           # 已移出连接池，仍被使用的连接
+        self._pending_close = []        # close回调中移出连接池的连接，不能在回调中关闭，稍后关闭
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.evictions = 0
+
+    def _check_fork(self):
+        """
+        进程fork后，父进程的连接在子进程不可用，直接丢弃（不能close，会影响父进程）
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _get_host_lock(self, host_ipv4: str):
+        with self._lock:
+            self._check_fork()
+            lock = self._host_locks.get(host_ipv4)
+            if lock is None:
+                lock = threading.Lock()
+                self._host_locks[host_ipv4] = lock
+
+            return lock
+
+    @staticmethod
+    def is_alive(conn):
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    @staticmethod
+    def _close_conn(conn):
+        try:
+            conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def _close_conns(self, conns: list):
+        for conn in conns:
+            self._close_conn(conn)
+
+    def _retire(self, conn, to_close: list, in_callback: bool = False):
+        """
+        已移出连接池的连接，没有被使用的加入to_close，由调用者在锁外关闭；调用时需持有self._lock
+        """
+        if self._refs.get(conn, 0) > 0:
+            self._retired.add(conn)
+        elif in_callback:
+            self._pending_close.append(conn)
+        else:
+            to_close.append(conn)
+
+    def _take_pending_close(self, to_close: list):
+        to_close += self._pending_close
+        self._pending_close = []
+
+    def _remove(self, host_ipv4: str, conn=None, in_callback: bool = False):
+        to_close = []
+        with self._lock:
+            self._check_fork()
+            cur = self._conns.get(host_ipv4)
+            if cur is not None and (conn is None or cur is conn):
+                self._conns.pop(host_ipv4, None)
+                self._retire(cur, to_close=to_close, in_callback=in_callback)
+
+            if not in_callback:
+                self._take_pending_close(to_close)
+
+        self._close_conns(to_close)
+
+    def invalidate(self, host_ipv4: str, conn=None):
+        """
+        连接已失效，从连接池移除宿主机的连接
+
+        移除的连接没有被使用时立即关闭，否则在最后一个引用释放(release())时关闭
+
+        :param host_ipv4: 宿主机ip
+        :param conn: 只有连接池中的连接是此连接时才移除；None时不检查
+        """
+        self._remove(host_ipv4=host_ipv4, conn=conn)
+
+    def release(self, conn):
+        """
+        释放get()获取的连接的引用，已移出连接池的连接最后一个引用释放时关闭
+        """
+        with self._lock:
+            self._check_fork()
+            n = self._refs.get(conn)
+            if n is None:
+                return
+
+            if n > 1:
+                self._refs[conn] = n - 1
+                return
+
+            del self._refs[conn]
+            if conn not in self._retired:
+                return
+
+            self._retired.discard(conn)
+
+        self._close_conn(conn)
+
+    def _on_conn_closed(self, conn, reason, host_ipv4):
+        """
+        连接被关闭(keepalive超时、宿主机断开等)时的回调，从连接池移除；
+        回调中注销回调会死锁，连接在之后的连接池操作中关闭
+        """
+        self._remove(host_ipv4=host_ipv4, conn=conn, in_callback=True)
+
+    def _setup_conn(self, conn, host_ipv4: str):
+        try:
+            conn.setKeepAlive(LIBVIRT_KEEPALIVE_INTERVAL, LIBVIRT_KEEPALIVE_COUNT)
+        except libvirt.libvirtError:
+            pass
+
+        try:
+            conn.registerCloseCallback(self._on_conn_closed, host_ipv4)
+        except libvirt.libvirtError:
+            pass
+
+    def peek(self, host_ipv4: str):
+        """
+        获取连接池中宿主机有效的连接，不会建立新连接，不增加引用数，只用于检查宿主机连接是否正常
+
+        :return:
+            libvirt.virConnect  # 有效的连接
+            None                # 没有
+        """
+        with self._lock:
+            self._check_fork()
+            conn = self._conns.get(host_ipv4)
+
+        if conn is not None and self.is_alive(conn):
+            return conn
+
+        return None
+
+    def get(self, host_ipv4: str, opener):
+        """
+        获取宿主机的连接，连接池中没有有效的连接时，通过opener建立新连接；连接的引用数加1，使用完后调用release()
+
+        :param host_ipv4: 宿主机ip
+        :param opener: 建立新连接的函数，无参数，返回libvirt.virConnect
+        :return:
+            libvirt.virConnect
+
+        :raise: opener抛出的错误
+        """
+        with self._get_host_lock(host_ipv4):
+            with self._lock:
+                conn = self._conns.get(host_ipv4)
+
+            if conn is not None:
+                if self.is_alive(conn):
+                    with self._lock:
+                        self.hits += 1
+                        if host_ipv4 in self._conns:
+                            self._conns.move_to_end(host_ipv4)
+                        self._refs[conn] = self._refs.get(conn, 0) + 1
+
+                    return conn
+
+                self.invalidate(host_ipv4=host_ipv4, conn=conn)
+                with self._lock:
+                    self.reconnects += 1
+
+            with self._lock:
+                self.misses += 1
+
+            ensure_event_loop()
+            conn = opener()
+            self._setup_conn(conn, host_ipv4=host_ipv4)
+            to_close = []
+            with self._lock:
+                self._conns[host_ipv4] = conn
+                self._refs[conn] = self._refs.get(conn, 0) + 1
+                while len(self._conns) > self.max_size:
+                    _, evicted = self._conns.popitem(last=False)     # 最久未使用的连接
+                    self._retire(evicted, to_close=to_close)
+                    self.evictions += 1
+
+                self._take_pending_close(to_close)
+
+        self._close_conns(to_close)
+        return conn
+
+    def close_all(self):
+        """
+        移除所有连接，没有被使用的立即关闭，其他的最后一个引用释放时关闭
+        """
+        to_close = []
+        with self._lock:
+            self._check_fork()
+            for conn in self._conns.values():
+                self._retire(conn, to_close=to_close)
+            self._conns.clear()
+            self._take_pending_close(to_close)
+
+        self._close_conns(to_close)
+
+    def stats(self):
+        """
+        连接池统计信息
+        """
+        with self._lock:
+            self._check_fork()
+            return {
+                'pid': self._pid,
+                'size': len(self._conns),
+                'in_use': len(self._refs),
+                'retired': len(self._retired),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'evictions': self.evictions
+            }
+
+
+conn_pool = VirtConnectionPool()
+
+# getAllDomainStats查询的统计类型
+DOMAIN_STATS_TYPES = (
+    libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_BALLOON |
+    libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK
+)
+MEMORY_STATS_PERIOD = 5             # 虚拟机内存统计周期（秒）
+MEMORY_STATS_RETRY_INTERVAL = 600   # 同一虚拟机重新尝试开启内存统计的间隔（秒）
+_host_active_cpus = {}              # {host_ipv4: int}
+_memory_stats_enabled = {}          # {(host_ipv4, vm_uuid): timestamp}
+
+
 class VirtHost:
     VirtError = VirtError
 
@@ -212,12 +534,16 @@ class VirtHost:
         self.close()
 
     def close(self):
-        if isinstance(self._conn, libvirt.virConnect) or hasattr(self._conn, 'close'):
-            self._conn.close()
+        """
+        连接由连接池管理，这里只释放对连接的引用，已移出连接池的连接最后一个引用释放时由连接池关闭
+        """
+        conn, self._conn = self._conn, None
+        if conn is not None and self.host_ipv4:
+            conn_pool.release(conn)
 
     def host_alive(self, times=3, timeout=3):
         """
-        检测宿主机是否可访问
+        检测宿主机是否可访问，连接池中有此宿主机有效的连接时不再ping
 
         :param times: ping次数
         :param timeout:
@@ -225,6 +551,9 @@ class VirtHost:
             True    # 可访问
             False   # 不可
         """
+        if LIBVIRT_CONNECT_URI or (self.host_ipv4 and conn_pool.peek(self.host_ipv4) is not None):
+            return True
+
         cmd = f'ping -c {times} -i 0.1 -W {timeout} {self.host_ipv4}'
         res, info = subprocess.getstatusoutput(cmd)
         if res == 0:
@@ -243,7 +572,9 @@ class VirtHost:
         :raise VirtError(), VirHostDown()
         """
         host_ip = self.host_ipv4
-        if host_ip:
+        if LIBVIRT_CONNECT_URI:
+            name = LIBVIRT_CONNECT_URI.format(host_ipv4=host_ip)
+        elif host_ip:
             if not self.host_alive() or not self.ssh_key:
                 raise VirHostDown(msg='无法访问宿主机')
             name = f'qemu+ssh://{host_ip}/system?no_tty=1&keyfile={self.ssh_key}'      # no_tty如果设置为非零值，如果它无法自动登录到远程计算机，它将阻止ssh询问密码
@@ -257,13 +588,46 @@ class VirtHost:
 
     def get_connection(self):
         """
+        从连接池获取与宿主机的连接
+
         :raise VirtError(), VirHostDown()
         """
         if self._conn is None:
-            self._conn = self.open_connection()
+            if self.host_ipv4:
+                self._conn = conn_pool.get(host_ipv4=self.host_ipv4, opener=self.open_connection)
+            else:
+                self._conn = self.open_connection()
 
         return self._conn
 
+    def reconnect(self):
+        """
+        丢弃已失效的连接，重新建立连接
+
+        :raise VirtError(), VirHostDown()
+        """
+        if self._conn is not None and self.host_ipv4:
+            conn_pool.invalidate(host_ipv4=self.host_ipv4, conn=self._conn)
+
+        self.close()
+        return self.get_connection()
+
+    def _call_with_reconnect(self, func):
+        """
+        在与宿主机的连接上执行操作，连接失效(VIR_ERR_INVALID_CONN, VIR_ERR_RPC)时重建连接并重试一次
+
+        :param func: 参数为libvirt.virConnect的函数
+        :raise VirtError(), VirHostDown(), libvirt.libvirtError
+        """
+        conn = self.get_connection()
+        try:
+            return func(conn)
+        except libvirt.libvirtError as e:
+            if not is_conn_broken_error(e):
+                raise
+
+        return func(self.reconnect())
+
     @property
     def connection(self):
         return self.get_connection()
@@ -279,9 +643,8 @@ class VirtHost:
 
         :raise VirtError()
         """
-        conn = self.get_connection()
         try:
-            dom = conn.defineXML(xml_desc)
+            dom = self._call_with_reconnect(lambda conn: conn.defineXML(xml_desc))
             return dom
         except libvirt.libvirtError as e:
             raise wrap_error(err=e)
@@ -297,9 +660,8 @@ class VirtHost:
 
         :raise VirtError(), VirDomainNotExist(), VirHostDown()
         """
-        conn = self.get_connection()
         try:
-            return conn.lookupByUUIDString(vm_uuid)
+            return self._call_with_reconnect(lambda conn: conn.lookupByUUIDString(vm_uuid))
         except libvirt.libvirtError as e:
             raise wrap_error(err=e)
 
@@ -394,6 +756,43 @@ class VirtHost:
         except libvirt.libvirtError as e:
             raise wrap_error(err=e)
 
+    def list_domains_status(self):
+        """
+        一次查询宿主机上所有虚拟机的当前状态码
+
+        优先使用getAllDomainStats(VIR_DOMAIN_STATS_STATE)一次RPC获取所有虚拟机状态，
+        libvirt不支持时使用listAllDomains()逐个获取状态
+
+        :return:
+            success: {vm_uuid(hex): state_code:int}
+
+        :raise VirtError(), VirHostDown()
+        """
+        def _all_domain_stats(conn):
+            ret = {}
+            for domain, stats in conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE):
+                ret[VmDomain.get_hex_uuid_from_domain(domain)] = stats.get('state.state', VIR_DOMAIN_NOSTATE)
+
+            return ret
+
+        def _list_all_domains(conn):
+            ret = {}
+            for domain in conn.listAllDomains():
+                ret[VmDomain.get_hex_uuid_from_domain(domain)] = domain.state()[0]
+
+            return ret
+
+        try:
+            return self._call_with_reconnect(_all_domain_stats)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != VirErrorNumber.VIR_ERR_NO_SUPPORT:
+                raise wrap_error(err=e)
+
+        try:
+            return self._call_with_reconnect(_list_all_domains)
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+
     def is_shutoff(self, vm_uuid: str):
         """
         虚拟机是否关机状态
@@ -632,35 +1031,150 @@ class VirtHost:
         return c.getMaxVcpus(type='kvm')
 
     def get_info(self):
-        c = self.connection
-        return c.getInfo()
+        return self._call_with_reconnect(lambda conn: conn.getInfo())
 
-    def get_hugepages(self):
-        """获取大页内存"""
+    def get_active_cpus(self) -> int:
+        """
+        宿主机活动的物理cpu数，进程内缓存
+
+        :raises: VirtError
+        """
+        num = _host_active_cpus.get(self.host_ipv4)
+        if num is None:
+            try:
+                num = self.get_info()[2]    # host_active_processor_count
+            except libvirt.libvirtError as e:
+                raise wrap_error(err=e)
+
+            _host_active_cpus[self.host_ipv4] = num
+
+        return num
+
+    def get_domains_stats(self, domains: list = None):
+        """
+        一次RPC(getAllDomainStats)获取宿主机上虚拟机的cpu、内存、硬盘io、网络io等统计信息
+
+        :param domains: 要查询的虚拟机列表[libvirt.virDomain]; None(宿主机上所有虚拟机)
+        :return:
+            [VmStatsRecord]
+
+        :raises: VirtError
+        """
+        def _get_stats(conn):
+            if domains is None:
+                return conn.getAllDomainStats(DOMAIN_STATS_TYPES)
+
+            return conn.domainListGetStats(domains, DOMAIN_STATS_TYPES)
+
+        host_cpus = self.get_active_cpus()
+        try:
+            domains_stats = self._call_with_reconnect(_get_stats)
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+
+        timestamp = time.time()
+        records = []
+        for domain, stats in domains_stats:
+            vm_uuid = VmDomain.get_hex_uuid_from_domain(domain)
+            record = VmStatsRecord.from_domain_stats(
+                vm_uuid=vm_uuid, stats=stats, host_cpus=host_cpus, timestamp=timestamp)
+            records.append(record)
+            if record.state == VIR_DOMAIN_RUNNING and 'balloon.unused' not in stats:
+                self._enable_memory_stats(domain=domain, vm_uuid=vm_uuid, timestamp=timestamp)
 
-        ip = f'{self.host_ipv4}'
-        key = f'{self.ssh_key}'
+        return records
 
-        line = ['ssh', '-i', key, ip, 'cat /proc/meminfo  | grep -E "HugePages_Total|HugePages_Free"']
+    def _enable_memory_stats(self, domain: libvirt.virDomain, vm_uuid: str, timestamp: float):
+        """
+        虚拟机未开启内存统计时没有balloon.unused，开启一次统计周期；
+        同一虚拟机一段时间内只尝试一次，避免每次查询都设置
+        """
+        key = (self.host_ipv4, vm_uuid)
+        last = _memory_stats_enabled.get(key)
+        if last is not None and timestamp - last < MEMORY_STATS_RETRY_INTERVAL:
+            return
+
+        if len(_memory_stats_enabled) >= 10000:
+            _memory_stats_enabled.clear()
+
+        _memory_stats_enabled[key] = timestamp
+        try:
+            domain.setMemoryStatsPeriod(MEMORY_STATS_PERIOD)
+        except libvirt.libvirtError:
+            pass
 
+    @staticmethod
+    def _hugepages_from_conn(conn):
+        """
+        宿主机capabilities中各NUMA节点的大页数量，getFreePages获取空闲数量；有多种大页大小时取已配置的最大的大页
+
+        :return:
+            {'size': int(KiB), 'total': int, 'free': int}
+        """
+        caps = ElementTree.fromstring(conn.getCapabilities())
+        cells = []
+        totals = {}     # {page_size: total}
+        for cell in caps.iterfind('./host/topology/cells/cell'):
+            cells.append(int(cell.get('id')))
+            for pages in cell.iterfind('pages'):
+                size = int(pages.get('size'))
+                totals[size] = totals.get(size, 0) + int(pages.text or 0)
+
+        if not totals:
+            return {'size': 0, 'total': 0, 'free': 0}
+
+        base_size = min(totals)     # 普通内存页
+        sizes = [size for size, total in totals.items() if size > base_size and total > 0]
+        if not sizes:
+            return {'size': 0, 'total': 0, 'free': 0}
+
+        size = max(sizes)
+        free_pages = conn.getFreePages([size], min(cells), len(cells))    # {cell: {page_size: free}}
+        free = sum(v.get(size, 0) for v in free_pages.values())
+        return {'size': size, 'total': totals[size], 'free': free}
+
+    def get_hugepages(self):
+        """
+        获取大页内存
+
+        :return:
+            {'HugePages_Total': str, 'HugePages_Free': str}
+        :raises: VirtError
+        """
         try:
-            p = subprocess.check_output(line, stderr=subprocess.STDOUT, timeout=5)
-        except subprocess.TimeoutExpired as time_e:
-            raise ValueError(f'{time_e}')
-        except subprocess.CalledProcessError as call_e:
-            raise ValueError(f'{call_e.output.decode(encoding="utf-8")}')
+            info = self._call_with_reconnect(self._hugepages_from_conn)
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
 
-        p = p.decode(encoding="utf-8").split('\n')
+        return {'HugePages_Total': str(info['total']), 'HugePages_Free': str(info['free'])}
 
-        d = {}
-        for i in p:
-            if not i:
-                break
-            i = i.replace(' ','')
-            men = i.split(':')   # ['HugePages_Total', ' 0'] ['HugePages_Free', '  0']
-            d[men[0]] = men[1].strip()
+    def get_telemetry(self):
+        """
+        一次获取宿主机cpu、内存、大页内存信息(getInfo, getCPUStats, getMemoryStats, getFreePages)
 
-        return d
+        :return:
+            {
+                'info': list,       # getInfo()
+                'cpu_stats': dict,  # 所有cpu的累计时间(纳秒) kernel, user, idle, iowait
+                'mem_stats': dict,  # KiB total, free, buffers, cached
+                'hugepages': dict,  # {'size': int(KiB), 'total': int, 'free': int}
+                'timestamp': float
+            }
+        :raises: VirtError
+        """
+        def _get(conn):
+            return {
+                'info': conn.getInfo(),
+                'cpu_stats': conn.getCPUStats(libvirt.VIR_NODE_CPU_STATS_ALL_CPUS),
+                'mem_stats': conn.getMemoryStats(libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS),
+                'hugepages': self._hugepages_from_conn(conn),
+                'timestamp': time.time()
+            }
+
+        try:
+            return self._call_with_reconnect(_get)
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
 
     def get_defined_domain_num(self) -> int:
         """
@@ -668,9 +1182,8 @@ class VirtHost:
 
         :raises: VirtError
         """
-        conn = self.connection
         try:
-            num = conn.numOfDefinedDomains()
+            num = self._call_with_reconnect(lambda conn: conn.numOfDefinedDomains())
         except libvirt.libvirtError as e:
             raise wrap_error(err=e)
 
@@ -686,13 +1199,23 @@ class VmStatsRecord:
                  host_cpus, guest_cpus,
                  total_mem_kb, cur_mem_kb,
                  disk_rd_bytes, disk_wr_bytes,
-                 net_rx_bytes, net_tx_bytes):
+                 net_rx_bytes, net_tx_bytes,
+                 vm_uuid: str = '', state: int = VIR_DOMAIN_NOSTATE,
+                 disk_rd_reqs: int = 0, disk_wr_reqs: int = 0):
+        self.vm_uuid = vm_uuid
+        self.state = state
         self.timestamp = timestamp
         self.cpu_time_abs = cpu_time_abs
         self.host_cpus = host_cpus
         self.guest_cpus = guest_cpus
         self.total_mem_kb = total_mem_kb
         self.cur_mem_kb = cur_mem_kb
+        self.disk_rd_bytes = disk_rd_bytes
+        self.disk_wr_bytes = disk_wr_bytes
+        self.disk_rd_reqs = disk_rd_reqs
+        self.disk_wr_reqs = disk_wr_reqs
+        self.net_rx_bytes = net_rx_bytes
+        self.net_tx_bytes = net_tx_bytes
         self.disk_rd_kb = disk_rd_bytes // 1024
         self.disk_wr_kb = disk_wr_bytes // 1024
         self.net_rx_kb = net_rx_bytes // 1024
@@ -714,6 +1237,46 @@ class VmStatsRecord:
             'curr_mem_percent': self.curr_mem_percent
         }
 
+    @classmethod
+    def from_domain_stats(cls, vm_uuid: str, stats: dict, host_cpus: int, timestamp):
+        """
+        由getAllDomainStats返回的一个虚拟机的统计信息构建
+
+        :param stats: {'state.state': 1, 'cpu.time': xx, 'balloon.current': xx, 'block.0.rd.bytes': xx, ...}
+        """
+        state = stats.get('state.state', VIR_DOMAIN_NOSTATE)
+        total_mem_kb = stats.get('balloon.current', 1)
+        cur_mem_kb = max(0, total_mem_kb - stats.get('balloon.unused', total_mem_kb))
+
+        if state in [VIR_DOMAIN_SHUTOFF, VIR_DOMAIN_CRASHED]:     # offline
+            return cls(
+                timestamp=timestamp, cpu_time_abs=0, host_cpus=host_cpus, guest_cpus=0,
+                total_mem_kb=total_mem_kb, cur_mem_kb=cur_mem_kb,
+                disk_rd_bytes=0, disk_wr_bytes=0, net_rx_bytes=0, net_tx_bytes=0,
+                vm_uuid=vm_uuid, state=state
+            )
+
+        disk_rd_bytes = disk_wr_bytes = disk_rd_reqs = disk_wr_reqs = 0
+        for i in range(stats.get('block.count', 0)):
+            disk_rd_bytes += stats.get(f'block.{i}.rd.bytes', 0)
+            disk_wr_bytes += stats.get(f'block.{i}.wr.bytes', 0)
+            disk_rd_reqs += stats.get(f'block.{i}.rd.reqs', 0)
+            disk_wr_reqs += stats.get(f'block.{i}.wr.reqs', 0)
+
+        net_rx_bytes = net_tx_bytes = 0
+        for i in range(stats.get('net.count', 0)):
+            net_rx_bytes += stats.get(f'net.{i}.rx.bytes', 0)
+            net_tx_bytes += stats.get(f'net.{i}.tx.bytes', 0)
+
+        return cls(
+            timestamp=timestamp, cpu_time_abs=stats.get('cpu.time', 0),
+            host_cpus=host_cpus, guest_cpus=stats.get('vcpu.current', 0),
+            total_mem_kb=total_mem_kb, cur_mem_kb=cur_mem_kb,
+            disk_rd_bytes=disk_rd_bytes, disk_wr_bytes=disk_wr_bytes,
+            net_rx_bytes=net_rx_bytes, net_tx_bytes=net_tx_bytes,
+            vm_uuid=vm_uuid, state=state, disk_rd_reqs=disk_rd_reqs, disk_wr_reqs=disk_wr_reqs
+        )
+
     @property
     def curr_mem_percent(self):
         if self._curr_mem_percent == 0:
@@ -724,6 +1287,53 @@ class VmStatsRecord:
         return self._curr_mem_percent
 
 
+def build_migrate_params(options: dict, dest_xml: str = None, undefine_source: bool = True):
+    """
+    由动态迁移参数构建virDomain.migrateToURI3()的params和flags
+
+    :param options: {
+            'auto_converge': bool,  # 自动收敛，脏页速率高时限制虚拟机cpu
+            'postcopy': bool,       # 允许切换到post-copy(切换由调用者执行migrateStartPostCopy)
+            'compression': str,     # 压缩方法，xbzrle、mt，空不压缩
+            'parallel': int,        # 并行连接数，大于1时有效
+            'bandwidth': int        # 带宽上限（MiB/s），0不限制
+        }
+    :param dest_xml: 目标宿主机上虚拟机的xml
+    :param undefine_source: 迁移后删除源宿主机上虚拟机的定义
+    :return:
+        (params: dict, flags: int)
+    """
+    flags = libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_PERSIST_DEST | libvirt.VIR_MIGRATE_PEER2PEER
+    if undefine_source:
+        flags |= libvirt.VIR_MIGRATE_UNDEFINE_SOURCE
+
+    params = {}
+    if dest_xml:
+        params[libvirt.VIR_MIGRATE_PARAM_DEST_XML] = dest_xml
+
+    if options.get('auto_converge'):
+        flags |= libvirt.VIR_MIGRATE_AUTO_CONVERGE
+
+    if options.get('postcopy'):
+        flags |= libvirt.VIR_MIGRATE_POSTCOPY
+
+    compression = options.get('compression')
+    if compression:
+        flags |= libvirt.VIR_MIGRATE_COMPRESSED
+        params[libvirt.VIR_MIGRATE_PARAM_COMPRESSION] = compression
+
+    parallel = options.get('parallel', 0)
+    if parallel and parallel > 1:
+        flags |= libvirt.VIR_MIGRATE_PARALLEL
+        params[libvirt.VIR_MIGRATE_PARAM_PARALLEL_CONNECTIONS] = int(parallel)
+
+    bandwidth = options.get('bandwidth', 0)
+    if bandwidth and bandwidth > 0:
+        params[libvirt.VIR_MIGRATE_PARAM_BANDWIDTH] = int(bandwidth)
+
+    return params, flags
+
+
 class VmDomain:
     """
     宿主机上虚拟机实例
@@ -1132,143 +1742,119 @@ class VmDomain:
             return True
         return False
 
-    def live_migrate(self, dest_host_conn, undefine_source: bool = True):
+    def live_migrate(self, dest_host_ipv4: str, options: dict = None, undefine_source: bool = True):
         """
+        点对点(peer-to-peer)动态迁移，由源宿主机libvirtd直接连接目标宿主机完成迁移，调用阻塞直到迁移结束；
+        迁移过程中可以在其他线程通过get_job_stats()查询进度，abort_job()取消迁移
+
+        :param dest_host_ipv4: 目标宿主机ip，按LIVE_MIGRATE_DEST_URI构建目标宿主机连接uri
+        :param options: 迁移参数，见build_migrate_params()
+        :param undefine_source: 迁移后删除源宿主机上虚拟机的定义
         :raise VirtError(), VirHostDown()
         """
-        flags = libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_PERSIST_DEST
-        if undefine_source:
-            flags |= libvirt.VIR_MIGRATE_UNDEFINE_SOURCE
-
         src_domain = self.domain
+        dest_uri = LIVE_MIGRATE_DEST_URI.format(host_ipv4=dest_host_ipv4)
         try:
-            params = {}
-            d_xml = src_domain.XMLDesc()
-            params[libvirt.VIR_MIGRATE_PARAM_DEST_XML] = d_xml
-            domain = src_domain.migrate3(dconn=dest_host_conn, params=params, flags=flags)
+            params, flags = build_migrate_params(
+                options=options if options else {}, dest_xml=src_domain.XMLDesc(), undefine_source=undefine_source)
+            src_domain.migrateToURI3(dest_uri, params, flags)
         except libvirt.libvirtError as e:
             raise wrap_error(err=e)
 
-        self.domain = domain
-        return domain
-
-    def get_stats(self):
-        """
-        :raises: VirtError
+    def get_job_stats(self):
         """
-        if self.is_shutoff():
-            pass
+        查询虚拟机当前作业(如迁移)的统计信息
 
-        # vm memory
-        total_mem_kb, cur_mem_kb = self._mem_stats()
-
-        # vm network
-        net_rx_bytes, net_tx_bytes = self._net_io_stats()
-
-        # vm cpu
-        disk_rx_bytes, disk_wr_bytes = self._disk_io_stats()
-
-        # vm cpu
-        host_cpus, guest_cpus, cpu_time_abs, timestamp = self._cpu_stats()
-
-        return VmStatsRecord(
-            timestamp=timestamp,
-            cpu_time_abs=cpu_time_abs,
-            host_cpus=host_cpus,
-            guest_cpus=guest_cpus,
-            disk_rd_bytes=disk_rx_bytes,
-            disk_wr_bytes=disk_wr_bytes,
-            net_rx_bytes=net_rx_bytes,
-            net_tx_bytes=net_tx_bytes,
-            cur_mem_kb=cur_mem_kb,
-            total_mem_kb=total_mem_kb
-        )
-
-    def _cpu_stats(self):
-        host_cpus = 0
-        guest_cpus = 0
-        cpu_time_abs = 0
-        timestamp = time.time()
+        :return:
+            dict    # virDomain.jobStats()，没有作业时type为VIR_DOMAIN_JOB_NONE
+        :raise VirtError()
+        """
         try:
-            host_info = self.host.get_connection().getInfo()
-            host_cpus = host_info[2]        # host_active_processor_count
-
-            info = self.domain.info()
-            state = info[0]
-            guest_cpus = info[3]
-            cpu_time_abs = info[4]
-            if state in [libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_CRASHED]:  # offline
-                return host_cpus, 0, 0, timestamp
-        except Exception as e:
-            pass
-
-        return host_cpus, guest_cpus, cpu_time_abs, timestamp
+            return self.domain.jobStats()
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
 
-    def _disk_io_stats(self):
-        rd_bytes = 0
-        wr_bytes = 0
-        domain = self.domain
-        if not domain.isActive():
-            return 0, 0
+    @staticmethod
+    def parse_migrate_job_stats(stats: dict):
+        """
+        迁移作业统计信息转换为迁移进度
+
+        :param stats: virDomain.jobStats()
+        :return: {
+                'active': bool,         # 作业是否正在进行
+                'elapsed': int,         # 已用时间（毫秒）
+                'data_total': int,      # 需要传输的数据量（字节）
+                'data_processed': int,
+                'data_remaining': int,
+                'dirty_rate': int,      # 内存脏页速率（字节/秒）
+                'iteration': int,       # 内存迭代次数
+                'bandwidth': int,       # 内存传输速率（字节/秒）
+                'downtime': int,        # 预计停机时间（毫秒）
+                'throttle': int,        # 自动收敛cpu限制 %
+                'postcopy_requests': int    # post-copy阶段目标宿主机的缺页请求数
+            }
+        """
+        return {
+            'active': stats.get('type', libvirt.VIR_DOMAIN_JOB_NONE) in (
+                libvirt.VIR_DOMAIN_JOB_BOUNDED, libvirt.VIR_DOMAIN_JOB_UNBOUNDED),
+            'elapsed': stats.get('time_elapsed', 0),
+            'data_total': stats.get('data_total', 0),
+            'data_processed': stats.get('data_processed', 0),
+            'data_remaining': stats.get('data_remaining', 0),
+            'dirty_rate': stats.get('memory_dirty_rate', 0) * stats.get('memory_page_size', 4096),
+            'iteration': stats.get('memory_iteration', 0),
+            'bandwidth': stats.get('memory_bps', 0),
+            'downtime': stats.get('downtime', 0),
+            'throttle': stats.get('auto_converge_throttle', 0),
+            'postcopy_requests': stats.get('memory_postcopy_requests', 0)
+        }
 
-        tree = ElementTree.fromstring(domain.XMLDesc())
-        devices = tree.findall('devices/disk/target')
-        for d in devices:
-            device = d.get('dev')
+    def abort_job(self):
+        """
+        取消虚拟机当前作业(如迁移)
 
-            try:
-                io = domain.blockStats(device)
-                if io:
-                    rd_bytes += io[1]
-                    wr_bytes += io[3]
-            except libvirt.libvirtError:
-                pass
+        :raise VirtError()
+        """
+        try:
+            return self.domain.abortJob()
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
 
-        return rd_bytes, wr_bytes
+    def migrate_start_postcopy(self):
+        """
+        正在进行的迁移(需以VIR_MIGRATE_POSTCOPY开始)切换到post-copy，虚拟机立即在目标宿主机运行，剩余内存按需传输
 
-    def _net_io_stats(self) -> (int, int):
+        :raise VirtError()
         """
-        :return:
-            (rx: int    # The number of bytes received by network io.
-            tx: int)    # The number of bytes transmitted by the network io.
+        try:
+            return self.domain.migrateStartPostCopy()
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+
+    def migrate_set_max_downtime(self, downtime: int):
         """
-        rx_bytes = 0
-        tx_bytes = 0
+        设置迁移最后阶段允许的最大停机时间
 
+        :param downtime: 毫秒
+        :raise VirtError()
+        """
         try:
-            domain = self.domain
-            if not domain.isActive():
-                return 0, 0
-
-            vm_xml = self.domain.XMLDesc()
-            tree = ElementTree.fromstring(vm_xml)
-            interfaces = tree.findall('devices/interface/target')
-            for i in interfaces:
-                dev = i.get('dev')
-                try:
-                    io_info = self.domain.interfaceStats(dev)
-                    if io_info:
-                        rx_bytes += io_info[0]
-                        tx_bytes += io_info[4]
-                except libvirt.libvirtError as err:
-                    pass
-        except Exception as e:
-            pass
+            return self.domain.migrateSetMaxDowntime(downtime)
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
 
-        return rx_bytes, tx_bytes
+    def get_stats(self):
+        """
+        查询虚拟机的cpu、内存、硬盘io、网络io等统计信息
 
-    def _mem_stats(self):
-        total_mem_kb = 1
-        cur_mem_kb = 0
-        try:
-            self.domain.setMemoryStatsPeriod(5)
-            stats = self.domain.memoryStats()
-            total_mem_kb = stats.get("actual", 1)
-            cur_mem_kb = max(0, total_mem_kb - stats.get("unused", total_mem_kb))
-        except libvirt.libvirtError as err:
-            pass
+        :return: VmStatsRecord
+        :raises: VirtError
+        """
+        records = self.host.get_domains_stats(domains=[self.domain])
+        if not records:
+            raise VirDomainNotExist(msg='未获取到虚拟机的统计信息')
 
-        return total_mem_kb, cur_mem_kb
+        return records[0]
 
 
 class VmStoragePool:
@@ -0,0 +1,32 @@
+from unittest import mock
+
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import TestCase
+from django.utils import timezone
+
+from compute.models import HostTelemetry
+from .db import bulk_upsert
+
+
+class BulkUpsertTests(TestCase):
+    def test_bulk_upsert(self):
+        now = timezone.now()
+        bulk_upsert(HostTelemetry, [HostTelemetry(host_ipv4='10.0.0.1', cpus=8, update_time=now),
+                                    HostTelemetry(host_ipv4='10.0.0.2', cpus=8, update_time=now)],
+                    unique_fields=['host_ipv4'], update_fields=['cpus'])
+        bulk_upsert(HostTelemetry, [HostTelemetry(host_ipv4='10.0.0.1', cpus=16, cpu_mhz=2400, update_time=now)],
+                    unique_fields=['host_ipv4'], update_fields=['cpus'])
+        self.assertEqual(HostTelemetry.objects.count(), 2)
+        t = HostTelemetry.objects.get(host_ipv4='10.0.0.1')
+        self.assertEqual((t.cpus, t.cpu_mhz), (16, 0))     # 只更新update_fields
+
+        # mysql不支持指定冲突的唯一键，不能传unique_fields
+        with mock.patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+                mock.patch.object(QuerySet, 'bulk_create') as bulk_create:
+            bulk_upsert(HostTelemetry, [HostTelemetry(host_ipv4='10.0.0.1')], unique_fields=['host_ipv4'],
+                        update_fields=['cpus'])
+
+        self.assertIsNone(bulk_create.call_args.kwargs['unique_fields'])
+        self.assertTrue(bulk_create.call_args.kwargs['update_conflicts'])
+        self.assertEqual(bulk_create.call_args.kwargs['update_fields'], ['cpus'])
@@ -2,7 +2,10 @@ from django.utils.translation import gettext_lazy as _
 from django.contrib import admin
 from django.contrib import messages
 
-from .models import Vm, VmArchive, VmLog, VmDiskSnap, MigrateTask, Flavor, AttachmentsIP, ErrorLog, VmSharedUser
+from .models import (
+    Vm, VmArchive, VmLog, VmDiskSnap, MigrateTask, Flavor, AttachmentsIP, ErrorLog, VmSharedUser, Job,
+    HostEvacuation, HostEvacuationItem
+)
 
 
 @admin.register(Vm)
@@ -216,3 +219,32 @@ class VmSharedUserAdmin(admin.ModelAdmin):
             return f'{obj.vm_id} 【{obj.vm.mac_ip.ipv4}】'
         except Exception as exc:
             return obj.vm_id
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    admin_order = 8
+    list_display_links = ('id',)
+    list_display = ('id', 'job_type', 'ref_id', 'host_ipv4', 'status', 'attempts', 'max_attempts', 'lease_owner',
+                    'heartbeat_time', 'create_time', 'finish_time')
+    list_filter = ('status', 'job_type')
+    search_fields = ('ref_id', 'host_ipv4', 'error')
+
+
+class HostEvacuationItemInline(admin.TabularInline):
+    model = HostEvacuationItem
+    fields = ('vm_uuid', 'tag', 'dst_host', 'migrate_task', 'status', 'error', 'update_time')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(HostEvacuation)
+class HostEvacuationAdmin(admin.ModelAdmin):
+    admin_order = 9
+    list_display_links = ('id',)
+    list_display = ('id', 'host_ipv4', 'status', 'total', 'src_parallel', 'dst_parallel', 'user', 'create_time',
+                    'complete_time')
+    list_filter = ('status',)
+    search_fields = ('id', 'host_ipv4')
+    inlines = [HostEvacuationItemInline]
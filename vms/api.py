@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
 from func_timeout import FunctionTimedOut
 
 from logrecord.manager import user_operation_record, LogManager
@@ -8,12 +11,19 @@ from compute.managers import HostManager
 from utils.errors import VmError, VmNotExistError
 from utils import errors
 from utils.vm_normal_status import vm_normal_status
+from utils.ev_libvirt.virt import VirtHost, VirtError, VM_STATE, VIR_DOMAIN_HOST_DOWN, VIR_DOMAIN_MISS
 from ceph.managers import check_resource_permissions
-from .manager import VmManager, AttachmentsIPManager, VmSharedUserManager
+from .models import Vm
+from .manager import VmManager, AttachmentsIPManager, VmSharedUserManager, VmDomainStateManager
 from .vminstance import VmInstance
+from .metrics import VmMetricsManager
 from .vm_builder import VmBuilder
 
 
+# 批量查询虚拟机状态时并行查询宿主机的最大线程数
+VMS_STATUS_BATCH_MAX_WORKERS = getattr(settings, 'VMS_STATUS_BATCH_MAX_WORKERS', 16)
+
+
 class VmAPI:
     """
     虚拟机API
@@ -343,8 +353,95 @@ class VmAPI:
         :raise VmError()
         """
         vm = self._get_user_perms_vm(vm_uuid=vm_uuid, user=user, related_fields=('host', 'user'), query_user=False)
+        cached = VmDomainStateManager.get_vm_status(vm=vm)
+        if cached is not None:
+            return cached
+
         return VmInstance(vm=vm).status()
 
+    @staticmethod
+    def _list_host_domains_status(host):
+        """
+        查询一个宿主机上所有虚拟机的状态码
+
+        :param host: VirtHost()
+        :return:
+            {vm_uuid(hex): state_code:int}   # success
+            None                             # 宿主机无法连接
+        """
+        try:
+            return host.list_domains_status()
+        except VirtError:
+            return None
+        finally:
+            host.close()
+
+    def get_vms_status(self, vm_uuids: list, user):
+        """
+        批量获取虚拟机的运行状态
+
+        优先使用运行状态缓存，缓存无效的虚拟机按宿主机分组，每个宿主机只查询一次所有虚拟机的状态，多个宿主机并行查询；
+        与get_vm_status一致不检查用户权限，不存在或搁置的虚拟机不在结果中
+
+        :param vm_uuids: 虚拟机uuid列表
+        :param user: 用户
+        :return:
+            {
+                vm_uuid: {'status_code': int, 'status_text': str}
+            }
+
+        :raise VmError()
+        """
+        try:
+            vms = self._vm_manager.get_vms_queryset().filter(
+                uuid__in=vm_uuids, vm_status=Vm.VmStatus.NORMAL.value).select_related('host').all()
+            vms = list(vms)
+        except Exception as e:
+            raise VmError(msg=str(e))
+
+        result = {}
+        cached = VmDomainStateManager.get_vms_status(vms=vms)
+        host_vms = {}
+        for vm in vms:
+            if vm.host is None:
+                continue
+
+            if vm.hex_uuid in cached:
+                code, msg = cached[vm.hex_uuid]
+                result[vm.hex_uuid] = {'status_code': code, 'status_text': msg}
+                continue
+
+            host_vms.setdefault(vm.host.ipv4, []).append(vm)
+
+        # VirtHost()初始化需要查询数据库，在当前线程创建
+        hosts = {}
+        for ipv4 in host_vms.keys():
+            try:
+                hosts[ipv4] = VirtHost(host_ipv4=ipv4)
+            except Exception:
+                hosts[ipv4] = None
+
+        hosts_status = {}
+        to_query = {ipv4: h for ipv4, h in hosts.items() if h is not None}
+        if to_query:
+            max_workers = min(len(to_query), VMS_STATUS_BATCH_MAX_WORKERS)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {ipv4: executor.submit(self._list_host_domains_status, h) for ipv4, h in to_query.items()}
+                for ipv4, future in futures.items():
+                    hosts_status[ipv4] = future.result()
+
+        for ipv4, h_vms in host_vms.items():
+            domains_status = hosts_status.get(ipv4)
+            for vm in h_vms:
+                if domains_status is None:
+                    code = VIR_DOMAIN_HOST_DOWN
+                else:
+                    code = domains_status.get(vm.hex_uuid.replace('-', ''), VIR_DOMAIN_MISS)
+
+                result[vm.hex_uuid] = {'status_code': code, 'status_text': VM_STATE.get(code, 'no state')}
+
+        return result
+
     def modify_vm_remark(self, vm_uuid: str, remark: str, user, request):
         """
         修改虚拟机备注信息
@@ -692,13 +789,14 @@ class VmAPI:
                               remark='')
         return VmInstance(vm).miss_fix()
 
-    def live_migrate_vm(self, vm_uuid: str, dest_host_id: int, request):
+    def live_migrate_vm(self, vm_uuid: str, dest_host_id: int, request, options: dict = None):
         """
         迁移虚拟机，迁移后强制更新源与目标Host资源分配信息
 
         :param vm_uuid: 虚拟机uuid
         :param dest_host_id: 目标宿主机id
-        :param user: 用户
+        :param request: 请求对象
+        :param options: 迁移参数，自动收敛、post-copy、压缩、并行连接数、带宽、最大停机时间、超时时间
         :return:
             MigrateTask()   # success
 
@@ -706,7 +804,7 @@ class VmAPI:
         """
         vm = self._get_user_perms_vm(vm_uuid=vm_uuid, user=request.user, related_fields=(
             'user', 'host__group', 'image__ceph_pool__ceph'))
-        task = VmInstance(vm).live_migrate(dest_host_id=dest_host_id)
+        task = VmInstance(vm).live_migrate(dest_host_id=dest_host_id, options=options)
         # HostManager.update_host_quota(host_id=vm.host_id)
         # HostManager.update_host_quota(host_id=dest_host_id)
         self.vm_operation_log(request=request, operation_content=f'动态迁移云主机到指定宿主机, 云主机IP：{vm.mac_ip}，指定宿主机IP：{task.dst_host_ipv4}',
@@ -722,6 +820,18 @@ class VmAPI:
         vm = self._get_user_perms_vm(vm_uuid=vm_uuid, user=user, related_fields=('host',))
         return VmInstance(vm).get_stats()
 
+    def get_vm_stats_history(self, vm_uuid: str, user, start: int = None, end: int = None, step: int = None):
+        """
+        查询vm cpu使用率、内存使用率、硬盘和网络速率等监控指标的历史数据
+
+        :param start: 开始时间戳
+        :param end: 结束时间戳
+        :param step: 数据点间隔（秒）
+        :raises: VmError, InvalidParamError
+        """
+        vm = self._get_user_perms_vm(vm_uuid=vm_uuid, user=user)
+        return VmMetricsManager.get_vm_metrics_history(vm_uuid=vm.hex_uuid, start=start, end=end, step=step)
+
     def vm_sys_disk_expand(self, vm_uuid: str, expand_size: int, request):
         """
         vm系统盘扩容，系统盘最大5Tb
@@ -0,0 +1,254 @@
+"""
+虚拟机运行状态采集服务
+
+每个启用的宿主机保持一个注册了虚拟机生命周期事件(VIR_DOMAIN_EVENT_ID_LIFECYCLE)的libvirt连接，
+事件回调在libvirt事件循环线程中只把事件放入队列，由主线程更新数据库中的虚拟机运行状态缓存(VmDomainState)
+"""
+import logging
+import queue
+import time
+
+import libvirt
+from django.db import close_old_connections
+
+from compute.models import Host
+from utils.ev_libvirt.virt import (
+    VirtHost, VirtError, VmDomain, ensure_event_loop, wrap_error,
+    LIBVIRT_KEEPALIVE_INTERVAL, LIBVIRT_KEEPALIVE_COUNT,
+    VIR_DOMAIN_RUNNING, VIR_DOMAIN_PAUSED, VIR_DOMAIN_SHUTDOWN, VIR_DOMAIN_SHUTOFF, VIR_DOMAIN_CRASHED,
+    VIR_DOMAIN_PMSUSPENDED
+)
+from .manager import VmDomainStateManager
+
+
+# 生命周期事件对应的虚拟机状态；不在其中的事件(DEFINED)需要查询虚拟机当前状态
+LIFECYCLE_EVENT_STATE = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED: VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: VIR_DOMAIN_PAUSED,
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: VIR_DOMAIN_SHUTOFF,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: VIR_DOMAIN_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: VIR_DOMAIN_PMSUSPENDED,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: VIR_DOMAIN_CRASHED,
+}
+
+
+class _HostWatch:
+    """
+    一个宿主机的事件连接
+    """
+    def __init__(self, host_ipv4: str):
+        self.host_ipv4 = host_ipv4
+        self.conn = None
+        self.callback_id = None
+        self.last_sync = 0
+        self.last_try_connect = 0
+
+    @property
+    def connected(self):
+        return self.conn is not None
+
+
+class DomainStateCollector:
+    """
+    虚拟机运行状态采集器
+    """
+    QUEUE_EVENT = 'event'
+    QUEUE_CLOSED = 'closed'
+
+    def __init__(self, heartbeat_interval: int = 10, resync_interval: int = 300, host_refresh_interval: int = 60,
+                 logger=None):
+        """
+        :param heartbeat_interval: 检查事件连接、确认状态缓存有效的间隔（秒），应小于VM_DOMAIN_STATE_CACHE_TTL
+        :param resync_interval: 全量同步宿主机所有虚拟机状态的间隔（秒）
+        :param host_refresh_interval: 重新加载启用的宿主机列表的间隔（秒）
+        """
+        self.heartbeat_interval = heartbeat_interval
+        self.resync_interval = resync_interval
+        self.host_refresh_interval = host_refresh_interval
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self._queue = queue.Queue()
+        self._watches = {}      # {host_ipv4: _HostWatch}
+        self._last_host_refresh = 0
+        self._last_heartbeat = 0
+
+    def _lifecycle_callback(self, conn, dom, event, detail, host_ipv4):
+        """
+        libvirt事件循环线程中执行，不能阻塞，只放入队列
+        """
+        try:
+            vm_uuid = VmDomain.get_hex_uuid_from_domain(dom)
+        except libvirt.libvirtError:
+            return
+
+        self._queue.put((self.QUEUE_EVENT, host_ipv4, conn, (vm_uuid, dom, event)))
+
+    def _close_callback(self, conn, reason, host_ipv4):
+        self._queue.put((self.QUEUE_CLOSED, host_ipv4, conn, reason))
+
+    def connect_host(self, watch: _HostWatch):
+        """
+        建立宿主机事件连接，注册生命周期事件，并全量同步一次状态
+
+        :raise VirtError
+        """
+        watch.last_try_connect = time.time()
+        conn = VirtHost(host_ipv4=watch.host_ipv4).open_connection()
+        try:
+            conn.setKeepAlive(LIBVIRT_KEEPALIVE_INTERVAL, LIBVIRT_KEEPALIVE_COUNT)
+            conn.registerCloseCallback(self._close_callback, watch.host_ipv4)
+            callback_id = conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle_callback, watch.host_ipv4)
+        except libvirt.libvirtError as e:
+            self._close_conn(conn)
+            raise wrap_error(err=e)
+
+        watch.conn = conn
+        watch.callback_id = callback_id
+        self.sync_host(watch)
+        self.logger.info(f'host({watch.host_ipv4}) connected')
+
+    def disconnect_host(self, watch: _HostWatch, clear: bool = True):
+        """
+        断开宿主机事件连接；连接断开期间状态无法保证，删除此宿主机的状态缓存
+        """
+        conn = watch.conn
+        if conn is not None:
+            try:
+                if watch.callback_id is not None:
+                    conn.domainEventDeregisterAny(watch.callback_id)
+            except libvirt.libvirtError:
+                pass
+
+            self._close_conn(conn)
+
+        watch.conn = None
+        watch.callback_id = None
+        if clear:
+            VmDomainStateManager.clear_host_states(host_ipv4=watch.host_ipv4)
+
+    @staticmethod
+    def _close_conn(conn):
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def sync_host(self, watch: _HostWatch):
+        """
+        全量同步宿主机上所有虚拟机的状态
+
+        :raise VirtError
+        """
+        states = {}
+        try:
+            for domain, stats in watch.conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE):
+                states[VmDomain.get_hex_uuid_from_domain(domain)] = stats.get('state.state', 0)
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+
+        VmDomainStateManager.sync_host_states(host_ipv4=watch.host_ipv4, states=states)
+        watch.last_sync = time.time()
+
+    def refresh_hosts(self):
+        """
+        按启用的宿主机更新事件连接
+        """
+        ipv4s = set(Host.objects.filter(enable=True).values_list('ipv4', flat=True))
+        for ipv4 in list(self._watches.keys()):
+            if ipv4 not in ipv4s:
+                self.disconnect_host(self._watches.pop(ipv4))
+                self.logger.info(f'host({ipv4}) removed')
+
+        for ipv4 in ipv4s:
+            if ipv4 not in self._watches:
+                self._watches[ipv4] = _HostWatch(host_ipv4=ipv4)
+
+        self._last_host_refresh = time.time()
+
+    def heartbeat(self):
+        """
+        检查事件连接，连接正常的确认状态缓存有效，断开的尝试重连，到期的全量同步
+        """
+        now = time.time()
+        for watch in self._watches.values():
+            try:
+                if watch.connected:
+                    if watch.conn.isAlive() != 1:
+                        self.logger.warning(f'host({watch.host_ipv4}) connection is not alive')
+                        self.disconnect_host(watch)
+                    elif now - watch.last_sync >= self.resync_interval:
+                        self.sync_host(watch)
+                    else:
+                        VmDomainStateManager.touch_host_states(host_ipv4=watch.host_ipv4)
+
+                if not watch.connected and now - watch.last_try_connect >= self.heartbeat_interval:
+                    self.connect_host(watch)
+            except (VirtError, libvirt.libvirtError) as e:
+                self.logger.warning(f'host({watch.host_ipv4}) error, {str(e)}')
+                self.disconnect_host(watch)
+            except Exception as e:
+                self.logger.error(f'host({watch.host_ipv4}) heartbeat error, {str(e)}')
+
+        self._last_heartbeat = time.time()
+
+    def handle_event(self, host_ipv4: str, conn, vm_uuid: str, dom, event: int):
+        watch = self._watches.get(host_ipv4)
+        if watch is None or watch.conn is not conn:    # 已断开的旧连接上的事件
+            return
+
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            VmDomainStateManager.delete_vm_state(vm_uuid=vm_uuid, host_ipv4=host_ipv4)
+            return
+
+        state = LIFECYCLE_EVENT_STATE.get(event)
+        if state is None:
+            try:
+                state = dom.state()[0]
+            except libvirt.libvirtError as e:
+                self.logger.warning(f'get state of vm({vm_uuid}) on host({host_ipv4}) error, {str(e)}')
+                return
+
+        VmDomainStateManager.set_vm_state(vm_uuid=vm_uuid, host_ipv4=host_ipv4, state=state)
+
+    def handle_closed(self, host_ipv4: str, conn, reason):
+        watch = self._watches.get(host_ipv4)
+        if watch is None or watch.conn is not conn:
+            return
+
+        self.logger.warning(f'host({host_ipv4}) connection closed, reason={reason}')
+        self.disconnect_host(watch)
+
+    def _process_queue(self, timeout: float):
+        try:
+            kind, host_ipv4, conn, data = self._queue.get(timeout=max(timeout, 0.01))
+        except queue.Empty:
+            return
+
+        try:
+            if kind == self.QUEUE_EVENT:
+                vm_uuid, dom, event = data
+                self.handle_event(host_ipv4=host_ipv4, conn=conn, vm_uuid=vm_uuid, dom=dom, event=event)
+            elif kind == self.QUEUE_CLOSED:
+                self.handle_closed(host_ipv4=host_ipv4, conn=conn, reason=data)
+        except Exception as e:
+            self.logger.error(f'handle {kind} of host({host_ipv4}) error, {str(e)}')
+
+    def run_forever(self):
+        if not ensure_event_loop():
+            raise VirtError(msg='libvirt事件循环启动失败')
+
+        while True:
+            now = time.time()
+            if now - self._last_host_refresh >= self.host_refresh_interval:
+                close_old_connections()
+                try:
+                    self.refresh_hosts()
+                except Exception as e:
+                    self.logger.error(f'refresh hosts error, {str(e)}')
+
+            if now - self._last_heartbeat >= self.heartbeat_interval:
+                close_old_connections()
+                self.heartbeat()
+
+            self._process_queue(timeout=self._last_heartbeat + self.heartbeat_interval - time.time())
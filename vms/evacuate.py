@@ -0,0 +1,356 @@
+"""
+宿主机疏散
+
+请求中停用宿主机(不再调度新虚拟机到此宿主机)，创建疏散任务后立即返回任务ID；
+后台任务执行服务(manage.py run_workers)中编排迁移：按宿主机组的调度策略为每个虚拟机选择同组的目标宿主机并申请资源，
+运行中的虚拟机动态迁移，关机的虚拟机静态迁移；从源宿主机同时迁出和每个目标宿主机同时迁入的虚拟机数受限
+"""
+import logging
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from compute.models import Host
+from compute.placement import get_group_placement_strategy
+from utils import errors
+from utils.ev_libvirt.virt import VmDomain, VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTOFF
+from .models import Vm, MigrateTask, HostEvacuation, HostEvacuationItem
+from .migrate import VmMigrateManager
+from . import tasks
+
+
+HOST_EVACUATE_PARALLEL = getattr(settings, 'HOST_EVACUATE_PARALLEL', 4)
+HOST_EVACUATE_DEST_PARALLEL = getattr(settings, 'HOST_EVACUATE_DEST_PARALLEL', 2)
+
+
+class HostEvacuator:
+    """
+    宿主机疏散
+    """
+    def __init__(self, logger=None):
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+    @staticmethod
+    def evacuate(host_id: int, user, src_parallel: int = None, dst_parallel: int = None, options: dict = None):
+        """
+        停用宿主机，创建疏散任务，后台迁移宿主机上的所有虚拟机
+
+        :param host_id: 宿主机id
+        :param user: 用户对象
+        :param src_parallel: 从此宿主机同时迁出的虚拟机数，默认HOST_EVACUATE_PARALLEL
+        :param dst_parallel: 每个目标宿主机同时迁入的虚拟机数，默认HOST_EVACUATE_DEST_PARALLEL
+        :param options: 动态迁移参数
+        :return:
+            HostEvacuation()
+
+        :raise: NotFoundError, VmError
+        """
+        host = Host.objects.filter(id=host_id).first()
+        if host is None:
+            raise errors.NotFoundError(msg='宿主机不存在')
+
+        if HostEvacuation.objects.filter(host_id=host.id, status=HostEvacuation.Status.RUNNING).exists():
+            raise errors.VmError(msg='此宿主机正在疏散，请等待疏散任务结束')
+
+        # 先停用，疏散期间不再有新虚拟机调度到此宿主机
+        Host.objects.filter(id=host.id).update(enable=False)
+        vm_uuids = list(Vm.objects.filter(host_id=host.id).values_list('uuid', flat=True))
+        evacuation = HostEvacuation(
+            id=uuid.uuid1().hex, host_id=host.id, host_ipv4=host.ipv4, user=user, total=len(vm_uuids),
+            src_parallel=src_parallel if src_parallel else HOST_EVACUATE_PARALLEL,
+            dst_parallel=dst_parallel if dst_parallel else HOST_EVACUATE_DEST_PARALLEL,
+            options=options if options else {}
+        )
+        if not vm_uuids:
+            evacuation.status = HostEvacuation.Status.COMPLETE
+            evacuation.complete_time = timezone.now()
+
+        evacuation.save(force_insert=True)
+        HostEvacuationItem.objects.bulk_create([
+            HostEvacuationItem(evacuation=evacuation, vm_uuid=vm_uuid) for vm_uuid in vm_uuids
+        ])
+        if not vm_uuids:
+            return evacuation
+
+        try:
+            tasks.submit_host_evacuate(evacuation)
+        except errors.Error as e:
+            evacuation.delete()
+            Host.objects.filter(id=host.id).update(enable=host.enable)    # 恢复停用前的状态
+            raise errors.VmError(msg=f'提交疏散任务错误,{str(e)}')
+
+        return evacuation
+
+    def run(self, evacuation_id: str, cancel_event=None):
+        """
+        后台任务执行服务中执行疏散任务
+
+        :param cancel_event: 后台任务的取消事件，设置后不再开始新的迁移，取消正在进行的动态迁移
+        :return:
+            {'status': str}    # 疏散任务状态
+        """
+        evacuation = HostEvacuation.objects.get(id=evacuation_id)
+        if evacuation.status != HostEvacuation.Status.RUNNING:
+            return {'status': evacuation.status}
+
+        items = list(HostEvacuationItem.objects.filter(
+            evacuation=evacuation, status=HostEvacuationItem.Status.PENDING))
+        self._run(evacuation=evacuation, items=items, cancel_event=cancel_event)
+        self.finish(evacuation)
+        return {'status': evacuation.status}
+
+    def _run(self, evacuation: HostEvacuation, items: list, cancel_event=None):
+        src_parallel = max(evacuation.src_parallel, 1)
+        running = {}            # {future: (HostEvacuationItem(), dst_host_id)}
+        dst_running = Counter()  # {dst_host_id: int}
+        pending = items
+        pending_error = '没有资源足够的目标宿主机'
+        with ThreadPoolExecutor(max_workers=src_parallel) as executor:
+            while pending:
+                if cancel_event is not None and cancel_event.is_set():
+                    pending_error = '疏散任务超时，已取消'
+                    break
+
+                waiting = []
+                for item in pending:
+                    if len(running) >= src_parallel:
+                        waiting.append(item)
+                        continue
+
+                    try:
+                        started = self._start_item(
+                            evacuation=evacuation, item=item, executor=executor, running=running,
+                            dst_running=dst_running, cancel_event=cancel_event)
+                    except Exception as e:
+                        self._set_item_status(item, HostEvacuationItem.Status.FAILED, error=str(e))
+                        continue
+
+                    if not started:     # 可用的目标宿主机同时迁入数已满
+                        waiting.append(item)
+
+                pending = waiting
+                if not running:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                self._handle_done(done=done, running=running, dst_running=dst_running)
+
+            if running:
+                done, _ = wait(list(running))
+                self._handle_done(done=done, running=running, dst_running=dst_running)
+
+        for item in pending:
+            self._set_item_status(item, HostEvacuationItem.Status.FAILED, error=pending_error)
+
+    def _handle_done(self, done, running: dict, dst_running: Counter):
+        for future in done:
+            item, dst_host_id = running.pop(future)
+            dst_running[dst_host_id] -= 1
+            try:
+                future.result()
+            except Exception as e:
+                self.logger.warning(f'evacuate vm({item.vm_uuid}) failed, {str(e)}')
+                self._set_item_status(item, HostEvacuationItem.Status.FAILED, error=str(e))
+            else:
+                self._set_item_status(item, HostEvacuationItem.Status.COMPLETE)
+
+    def _start_item(self, evacuation: HostEvacuation, item: HostEvacuationItem, executor, running: dict,
+                    dst_running: Counter, cancel_event=None):
+        """
+        为虚拟机选择目标宿主机，开始迁移
+
+        :return:
+            True    # 已开始迁移或已处理
+            False   # 可用的目标宿主机同时迁入数已满，稍后再试
+        :raise: VmError
+        """
+        vm = Vm.objects.select_related('host__group', 'user', 'image__ceph_pool__ceph').filter(
+            uuid=item.vm_uuid).first()
+        if vm is None:
+            raise errors.VmError(msg='虚拟机已删除')
+
+        if vm.host_id != evacuation.host_id:
+            self._set_item_status(item, HostEvacuationItem.Status.COMPLETE, error='虚拟机已不在此宿主机')
+            return True
+
+        tag = self.get_migrate_tag(vm)
+        dst_host, busy = self.choose_dest_host(vm=vm, dst_running=dst_running, dst_parallel=evacuation.dst_parallel)
+        if dst_host is None:
+            if busy:
+                return False
+
+            raise errors.VmError(msg='没有资源足够的目标宿主机')
+
+        item.tag = tag
+        item.dst_host = dst_host
+        future = self._submit_migrate(
+            executor=executor, evacuation=evacuation, item=item, vm=vm, tag=tag, dst_host=dst_host,
+            cancel_event=cancel_event)
+        self._set_item_status(item, HostEvacuationItem.Status.MIGRATING)
+        running[future] = (item, dst_host.id)
+        dst_running[dst_host.id] += 1
+        return True
+
+    @staticmethod
+    def get_migrate_tag(vm: Vm):
+        """
+        按虚拟机运行状态确定迁移方式，运行中的动态迁移，关机的静态迁移
+
+        :raise: VmError
+        """
+        code, state = VmDomain(host_ip=vm.host.ipv4, vm_uuid=vm.get_uuid()).status()
+        if code == VIR_DOMAIN_RUNNING:
+            return MigrateTask.Tag.MIGRATE_LIVE
+
+        if code == VIR_DOMAIN_SHUTOFF:
+            return MigrateTask.Tag.MIGRATE_STATIC
+
+        raise errors.VmError(msg=f'虚拟机状态为{state}，不能迁移')
+
+    def _submit_migrate(self, executor, evacuation: HostEvacuation, item: HostEvacuationItem, vm: Vm, tag: str,
+                        dst_host: Host, cancel_event=None):
+        """
+        在线程池中迁移虚拟机；动态迁移的前置检查和目标宿主机资源申请在当前线程完成
+
+        :return:
+            Future()
+        :raise: VmError
+        """
+        if tag == MigrateTask.Tag.MIGRATE_LIVE:
+            m_task = VmMigrateManager().live_migrate_vm(
+                vm=vm, dest_host_id=dst_host.id, options=evacuation.options, submit=False)
+            item.migrate_task = m_task
+            return executor.submit(self._live_migrate, m_task.id, cancel_event)
+
+        return executor.submit(self._static_migrate, vm, dst_host.id)
+
+    @staticmethod
+    def choose_dest_host(vm: Vm, dst_running: Counter, dst_parallel: int):
+        """
+        按宿主机组的调度策略选择同组的其他启用的宿主机
+
+        :param vm: 虚拟机
+        :param dst_running: 每个目标宿主机正在迁入的虚拟机数
+        :param dst_parallel: 每个目标宿主机同时迁入的虚拟机数
+        :return:
+            (
+                Host() or None,
+                bool    # 没有选出宿主机时，是否因为资源足够的宿主机同时迁入数已满
+            )
+        """
+        src_host = vm.host
+        queryset = Host.objects.filter(group_id=src_host.group_id, enable=True).exclude(id=src_host.id)
+        strategy = get_group_placement_strategy(src_host.group)
+        hosts = strategy.rank(queryset, vcpu=vm.vcpu, mem=vm.mem, user=vm.user)
+        for host in hosts:
+            if dst_running[host.id] < dst_parallel:
+                return host, False
+
+        return None, bool(hosts)
+
+    @staticmethod
+    def _live_migrate(m_task_id: int, cancel_event=None):
+        """
+        :raise: VmError     # 迁移失败
+        """
+        try:
+            VmMigrateManager.run_live_migrate_job(m_task_id=m_task_id, cancel_event=cancel_event)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _static_migrate(vm: Vm, host_id: int):
+        """
+        :raise: VmError     # 迁移失败
+        """
+        try:
+            VmMigrateManager().static_migrate(vm=vm, host_id=host_id)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _set_item_status(item: HostEvacuationItem, status: str, error: str = ''):
+        item.status = status
+        item.error = error[:255]
+        item.save(update_fields=['status', 'error', 'tag', 'dst_host', 'migrate_task', 'update_time'])
+
+    @staticmethod
+    def finish(evacuation: HostEvacuation):
+        """
+        根据各虚拟机的迁移结果更新疏散任务状态
+        """
+        completed = HostEvacuationItem.objects.filter(
+            evacuation=evacuation, status=HostEvacuationItem.Status.COMPLETE).count()
+        if completed == evacuation.total:
+            evacuation.status = HostEvacuation.Status.COMPLETE
+        elif completed == 0:
+            evacuation.status = HostEvacuation.Status.FAILED
+        else:
+            evacuation.status = HostEvacuation.Status.PARTIAL
+
+        evacuation.complete_time = timezone.now()
+        evacuation.save(update_fields=['status', 'complete_time'])
+
+    def recover(self, evacuation_id: str):
+        """
+        执行中断的疏散任务善后：未开始迁移的标记失败，正在迁移的按迁移结果标记，
+        未结束的动态迁移任务由任务执行服务的迁移善后处理(VmMigrateManager.recover_orphaned_tasks())
+        """
+        evacuation = HostEvacuation.objects.filter(id=evacuation_id).first()
+        if evacuation is None or evacuation.status != HostEvacuation.Status.RUNNING:
+            return
+
+        items = HostEvacuationItem.objects.select_related('migrate_task').filter(
+            evacuation=evacuation, status__in=[HostEvacuationItem.Status.PENDING, HostEvacuationItem.Status.MIGRATING])
+        for item in items:
+            status, error = HostEvacuationItem.Status.FAILED, '疏散任务执行中断'
+            if item.status == HostEvacuationItem.Status.MIGRATING:
+                if item.migrate_task is not None:
+                    if item.migrate_task.status in [MigrateTask.Status.COMPLETE, MigrateTask.Status.SOME_TODO]:
+                        status, error = HostEvacuationItem.Status.COMPLETE, ''
+                    elif item.migrate_task.status != MigrateTask.Status.FAILED:
+                        error = f'疏散任务执行中断，迁移任务(id={item.migrate_task.id})未结束'
+                elif Vm.objects.filter(uuid=item.vm_uuid, host_id=item.dst_host_id).exists():
+                    status, error = HostEvacuationItem.Status.COMPLETE, ''
+
+            self._set_item_status(item, status, error=error)
+
+        self.finish(evacuation)
+
+    @staticmethod
+    def get_evacuation(host_id: int):
+        """
+        查询宿主机最近一次的疏散任务
+
+        :return:
+            HostEvacuation()
+
+        :raise: NotFoundError
+        """
+        evacuation = HostEvacuation.objects.filter(host_id=host_id).order_by('-create_time').first()
+        if evacuation is None:
+            raise errors.NotFoundError(msg='宿主机没有疏散任务')
+
+        return evacuation
+
+    @staticmethod
+    def get_progress(evacuation: HostEvacuation):
+        """
+        疏散任务进度
+
+        :return: (
+                {'pending': int, 'migrating': int, 'complete': int, 'failed': int},
+                [HostEvacuationItem()]
+            )
+        """
+        items = list(HostEvacuationItem.objects.select_related('dst_host', 'migrate_task').filter(
+            evacuation=evacuation))
+        progress = {s.value: 0 for s in HostEvacuationItem.Status}
+        for item in items:
+            progress[item.status] = progress.get(item.status, 0) + 1
+
+        return progress, items
@@ -0,0 +1,431 @@
+"""
+数据库后台任务队列
+
+web请求中只创建任务记录(JobManager.submit)，任务由独立的执行服务(manage.py run_workers)领取后在线程池中执行，
+uwsgi工作进程回收、重启不影响正在执行的任务。
+
+* 领取任务时设置租约(lease_owner, lease_expires)，执行服务为执行线程未结束的任务定期续约(心跳)；
+* 任务超过超时时间后设置任务的取消事件(get_cancel_event())，执行函数检查到后中止(如取消libvirt迁移作业)并抛出异常，
+  执行线程结束后由此执行服务标记失败并调用任务类型的回收函数善后，回收函数不会与执行函数同时执行；
+* 执行服务退出后租约过期的任务由任一执行服务回收：未达到最多执行次数的重新等待执行，
+  否则标记失败，并调用任务类型的回收函数善后(如检查迁移中的虚拟机实际在哪个宿主机上)；
+* 执行出错的任务按重试间隔指数退避重试；
+* 有宿主机的任务限制每个宿主机同时执行的任务数。
+
+任务类型用register_job()注册，见tasks.py。
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, connection, close_old_connections
+from django.db.models import Count, F
+from django.utils import timezone
+
+from utils import errors
+from .models import Job
+
+
+JOB_WORKERS = getattr(settings, 'JOB_WORKERS', 8)
+JOB_LEASE_SECONDS = getattr(settings, 'JOB_LEASE_SECONDS', 60)
+JOB_HOST_CONCURRENCY = getattr(settings, 'JOB_HOST_CONCURRENCY', 2)
+JOB_RETRY_DELAY = getattr(settings, 'JOB_RETRY_DELAY', 30)
+
+
+@dataclass
+class JobType:
+    name: str
+    handler: Callable                   # handler(job: Job) -> result(可json序列化)，出错抛出异常
+    recover: Callable = None            # recover(job: Job)，任务租约过期或超时取消后标记失败时调用
+    max_attempts: int = 1
+    timeout: int = 3600
+    retry_delay: int = JOB_RETRY_DELAY
+    host_concurrency: int = JOB_HOST_CONCURRENCY
+
+
+_job_types = {}
+_cancel_events = {}     # {job_id: threading.Event()}，本进程执行中任务的取消事件
+
+
+def register_job(name: str, handler, recover=None, max_attempts: int = 1, timeout: int = 3600,
+                 retry_delay: int = JOB_RETRY_DELAY, host_concurrency: int = JOB_HOST_CONCURRENCY):
+    """
+    注册任务类型
+
+    :param name: 任务类型名称
+    :param handler: 执行函数，参数为Job()
+    :param recover: 租约过期或超时取消的任务标记失败后的善后函数，参数为Job()
+    :param max_attempts: 最多执行次数，执行有副作用不能重复执行的任务为1
+    :param timeout: 超时时间(秒)，超时后设置任务的取消事件，执行函数应检查取消事件并中止
+    :param retry_delay: 第一次重试的间隔(秒)，之后每次加倍
+    :param host_concurrency: 每个宿主机同时执行此类型任务的最大数量
+    """
+    _job_types[name] = JobType(name=name, handler=handler, recover=recover, max_attempts=max_attempts,
+                               timeout=timeout, retry_delay=retry_delay, host_concurrency=host_concurrency)
+
+
+def get_job_type(name: str):
+    """
+    :raise: Error   # 未注册
+    """
+    job_type = _job_types.get(name)
+    if job_type is None:
+        raise errors.Error(msg=f'未注册的任务类型"{name}"')
+
+    return job_type
+
+
+def get_job_type_names():
+    """
+    已注册的任务类型名称
+    """
+    return list(_job_types.keys())
+
+
+def get_cancel_event(job_id: int):
+    """
+    执行中任务的取消事件，任务超时或失去租约时设置；执行函数应在耗时操作之间检查，设置后尽快中止并抛出异常
+
+    :return:
+        threading.Event()   # 不在执行服务中执行的任务返回一个不会被设置的事件
+    """
+    event = _cancel_events.get(job_id)
+    return event if event is not None else threading.Event()
+
+
+class JobManager:
+    """
+    后台任务管理
+    """
+    @staticmethod
+    def submit(job_type: str, params: dict = None, ref_id: str = '', host_ipv4: str = None, delay: int = 0):
+        """
+        创建后台任务
+
+        :param job_type: 已注册的任务类型
+        :param params: 任务参数，可json序列化
+        :param ref_id: 关联对象id
+        :param host_ipv4: 任务占用的宿主机
+        :param delay: 延迟执行(秒)
+        :return:
+            Job()
+
+        :raise: Error
+        """
+        jt = get_job_type(job_type)
+        try:
+            return Job.objects.create(
+                job_type=job_type, params=params or {}, ref_id=str(ref_id), host_ipv4=host_ipv4,
+                max_attempts=jt.max_attempts, timeout=jt.timeout, run_after=timezone.now() + timedelta(seconds=delay))
+        except Exception as e:
+            raise errors.Error(msg=f'创建后台任务错误，{str(e)}')
+
+    @staticmethod
+    def claim(owner: str, limit: int, job_types: list = None, lease_seconds: int = JOB_LEASE_SECONDS):
+        """
+        领取可执行的任务，有宿主机的任务不超过每个宿主机的并发数
+
+        等待执行的任务行加锁(SKIP LOCKED)领取，多个执行服务不会领取到同一个任务；
+        宿主机并发数按领取时执行中的任务数检查，多个执行服务同时领取同一宿主机的任务时可能短暂超出
+
+        :param owner: 执行者标识
+        :param limit: 最多领取的数量
+        :param job_types: 只领取这些类型，默认所有已注册的类型
+        :return:
+            [Job()]
+        """
+        if limit <= 0:
+            return []
+
+        job_types = job_types if job_types else list(_job_types)
+        now = timezone.now()
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        with transaction.atomic():
+            qs = Job.objects.select_for_update(skip_locked=skip_locked).filter(
+                status=Job.Status.PENDING, run_after__lte=now, job_type__in=job_types).order_by('id')
+            candidates = list(qs[:limit * 4])
+            if not candidates:
+                return []
+
+            ipv4s = {j.host_ipv4 for j in candidates if j.host_ipv4}
+            running = {}
+            if ipv4s:
+                for r in Job.objects.filter(status=Job.Status.RUNNING, host_ipv4__in=ipv4s).values(
+                        'host_ipv4', 'job_type').annotate(n=Count('id')).order_by():
+                    running[(r['host_ipv4'], r['job_type'])] = r['n']
+
+            ids = []
+            for job in candidates:
+                if job.host_ipv4:
+                    key = (job.host_ipv4, job.job_type)
+                    jt = _job_types.get(job.job_type)
+                    if jt and running.get(key, 0) >= jt.host_concurrency:
+                        continue
+
+                    running[key] = running.get(key, 0) + 1
+
+                ids.append(job.id)
+                if len(ids) >= limit:
+                    break
+
+            if not ids:
+                return []
+
+            Job.objects.filter(id__in=ids, status=Job.Status.PENDING).update(
+                status=Job.Status.RUNNING, lease_owner=owner, lease_expires=now + timedelta(seconds=lease_seconds),
+                heartbeat_time=now, start_time=now, attempts=F('attempts') + 1, error='')
+
+        return list(Job.objects.filter(id__in=ids, status=Job.Status.RUNNING, lease_owner=owner).order_by('id'))
+
+    @staticmethod
+    def heartbeat(owner: str, job_ids: list, lease_seconds: int = JOB_LEASE_SECONDS):
+        """
+        续约执行中的任务
+
+        :return:
+            set()   # 续约成功的任务id，不在其中的任务租约已失去(已被回收)
+        """
+        if not job_ids:
+            return set()
+
+        now = timezone.now()
+        qs = Job.objects.filter(id__in=job_ids, status=Job.Status.RUNNING, lease_owner=owner)
+        qs.update(lease_expires=now + timedelta(seconds=lease_seconds), heartbeat_time=now)
+        return set(Job.objects.filter(id__in=job_ids, status=Job.Status.RUNNING, lease_owner=owner).values_list(
+            'id', flat=True))
+
+    @staticmethod
+    def complete(job: Job, owner: str, result=None):
+        """
+        :return:
+            True    # success
+            False   # 租约已失去
+        """
+        rows = Job.objects.filter(id=job.id, status=Job.Status.RUNNING, lease_owner=owner).update(
+            status=Job.Status.SUCCEEDED, result=result, finish_time=timezone.now(), lease_owner='',
+            lease_expires=None)
+        return rows > 0
+
+    @staticmethod
+    def fail(job: Job, owner: str, error: str, retry: bool = True):
+        """
+        任务执行出错，未达到最多执行次数时延迟重试，否则标记失败
+
+        :return:
+            Job.Status.PENDING  # 将重试
+            Job.Status.FAILED   # 失败
+            None                # 租约已失去
+        """
+        qs = Job.objects.filter(id=job.id, status=Job.Status.RUNNING, lease_owner=owner)
+        now = timezone.now()
+        if retry and job.attempts < job.max_attempts:
+            jt = _job_types.get(job.job_type)
+            delay = (jt.retry_delay if jt else JOB_RETRY_DELAY) * 2 ** max(job.attempts - 1, 0)
+            rows = qs.update(status=Job.Status.PENDING, error=error, run_after=now + timedelta(seconds=delay),
+                             lease_owner='', lease_expires=None)
+            return Job.Status.PENDING if rows else None
+
+        rows = qs.update(status=Job.Status.FAILED, error=error, finish_time=now, lease_owner='', lease_expires=None)
+        return Job.Status.FAILED if rows else None
+
+    @staticmethod
+    def recover_expired(logger=None):
+        """
+        回收租约过期(执行服务已退出，执行线程未结束的任务会一直续约)的任务：
+        未达到最多执行次数的重新等待执行，否则标记失败并调用任务类型的善后函数
+
+        :return:
+            (retried: int, failed: int)
+        """
+        logger = logger if logger else logging.getLogger(__name__)
+        now = timezone.now()
+        retried = failed = 0
+        for job in Job.objects.filter(status=Job.Status.RUNNING, lease_expires__lt=now):
+            qs = Job.objects.filter(id=job.id, status=Job.Status.RUNNING, lease_owner=job.lease_owner,
+                                    lease_expires=job.lease_expires)
+            error = f'任务租约过期(执行者{job.lease_owner}已退出或任务超时)'
+            if job.attempts < job.max_attempts:
+                if qs.update(status=Job.Status.PENDING, error=error, lease_owner='', lease_expires=None):
+                    retried += 1
+                continue
+
+            if not qs.update(status=Job.Status.FAILED, error=error, finish_time=now, lease_owner='',
+                             lease_expires=None):
+                continue
+
+            failed += 1
+            jt = _job_types.get(job.job_type)
+            if jt and jt.recover:
+                try:
+                    jt.recover(job)
+                except Exception as e:
+                    logger.error(f'recover job({job.id}, {job.job_type}) error, {str(e)}')
+
+        return retried, failed
+
+    @staticmethod
+    def has_active_job(job_type: str, ref_id: str):
+        """
+        关联对象是否有等待或正在执行的任务
+        """
+        return Job.objects.filter(job_type=job_type, ref_id=str(ref_id),
+                                  status__in=[Job.Status.PENDING, Job.Status.RUNNING]).exists()
+
+
+class JobWorker:
+    """
+    任务执行服务，一个领取线程，任务在线程池中执行，一个心跳线程为执行中的任务续约
+    """
+    def __init__(self, workers: int = JOB_WORKERS, lease_seconds: int = JOB_LEASE_SECONDS, poll_interval: float = 1,
+                 recover_interval: int = 30, job_types: list = None, logger=None):
+        """
+        :param workers: 同时执行的任务数
+        :param lease_seconds: 租约时间(秒)，每1/3租约时间续约一次
+        :param poll_interval: 没有可执行任务时的查询间隔(秒)
+        :param recover_interval: 回收租约过期任务的间隔(秒)
+        :param job_types: 只执行这些类型的任务，默认所有已注册的类型
+        """
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.recover_interval = recover_interval
+        self.job_types = job_types
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker')
+        self._running = {}      # {job_id: (Job(), 开始时间, 取消事件)}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._recover_hooks = []    # 定期执行的回收函数，参数logger
+
+    def add_recover_hook(self, func):
+        self._recover_hooks.append(func)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run_job(self, job: Job, cancel: threading.Event):
+        jt = _job_types.get(job.job_type)
+        try:
+            if jt is None:
+                JobManager.fail(job, owner=self.owner, error=f'未注册的任务类型"{job.job_type}"', retry=False)
+                return
+
+            try:
+                result = jt.handler(job)
+            except Exception as e:
+                if not cancel.is_set():
+                    status = JobManager.fail(job, owner=self.owner, error=str(e))
+                    self.logger.warning(f'job({job.id}, {job.job_type}) error, {str(e)}, status={status}')
+                    return
+
+                # 超时取消，执行函数已结束，善后
+                status = JobManager.fail(job, owner=self.owner, error=f'任务超时已取消，{str(e)}', retry=False)
+                self.logger.warning(f'job({job.id}, {job.job_type}) cancelled, {str(e)}, status={status}')
+                if status == Job.Status.FAILED and jt.recover:
+                    try:
+                        jt.recover(job)
+                    except Exception as e:
+                        self.logger.error(f'recover job({job.id}, {job.job_type}) error, {str(e)}')
+            else:
+                if not JobManager.complete(job, owner=self.owner, result=result):
+                    self.logger.warning(f'job({job.id}, {job.job_type}) lease lost before complete')
+        except Exception as e:
+            self.logger.error(f'job({job.id}, {job.job_type}) error, {str(e)}')
+        finally:
+            with self._lock:
+                self._running.pop(job.id, None)
+                _cancel_events.pop(job.id, None)
+            connection.close()
+
+    def _heartbeat(self):
+        interval = self.lease_seconds / 3
+        while True:
+            if self._stopped.is_set():  # 退出时继续为执行中的任务续约，直到任务都结束
+                with self._lock:
+                    if not self._running:
+                        return
+                time.sleep(min(interval, 1))
+            else:
+                self._stopped.wait(interval)
+
+            now = time.monotonic()
+            with self._lock:
+                running = list(self._running.values())
+
+            # 执行线程未结束的任务都续约，超时的任务设置取消事件，执行函数中止后由_run_job()善后
+            ids = [job.id for job, start, cancel in running]
+            try:
+                alive = JobManager.heartbeat(owner=self.owner, job_ids=ids, lease_seconds=self.lease_seconds)
+            except Exception as e:
+                self.logger.error(f'job heartbeat error, {str(e)}')
+                continue
+            finally:
+                connection.close()
+
+            for job, start, cancel in running:
+                if cancel.is_set():
+                    continue
+
+                if job.id not in alive:
+                    cancel.set()
+                    self.logger.warning(f'job({job.id}, {job.job_type}) lease lost, cancel it')
+                elif now - start > job.timeout:
+                    cancel.set()
+                    self.logger.warning(f'job({job.id}, {job.job_type}) timeout, cancel it')
+
+    def recover(self):
+        retried, failed = JobManager.recover_expired(logger=self.logger)
+        if retried or failed:
+            self.logger.info(f'recover expired jobs, retried={retried}, failed={failed}')
+
+        for hook in self._recover_hooks:
+            try:
+                hook(self.logger)
+            except Exception as e:
+                self.logger.error(f'recover hook error, {str(e)}')
+
+    def run_forever(self):
+        """
+        stop()后不再领取新任务，等待执行中的任务结束后返回
+        """
+        heartbeat = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+        heartbeat.start()
+        last_recover = 0
+        while not self._stopped.is_set():
+            close_old_connections()
+            try:
+                if time.monotonic() - last_recover >= self.recover_interval:
+                    self.recover()
+                    last_recover = time.monotonic()
+
+                with self._lock:
+                    free = self.workers - len(self._running)
+
+                jobs = JobManager.claim(owner=self.owner, limit=free, job_types=self.job_types,
+                                        lease_seconds=self.lease_seconds)
+            except Exception as e:
+                self.logger.error(f'claim jobs error, {str(e)}')
+                jobs = []
+
+            for job in jobs:
+                self.logger.info(f'run job({job.id}, {job.job_type}), attempts={job.attempts}')
+                cancel = threading.Event()
+                with self._lock:
+                    self._running[job.id] = (job, time.monotonic(), cancel)
+                    _cancel_events[job.id] = cancel
+                self._executor.submit(self._run_job, job, cancel)
+
+            if not jobs:
+                self._stopped.wait(self.poll_interval)
+
+        self._executor.shutdown(wait=True)
+        heartbeat.join()
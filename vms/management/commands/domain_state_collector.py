@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from utils.loggers import config_script_logger
+from vms.domain_state import DomainStateCollector
+
+
+class Command(BaseCommand):
+    '''
+    虚拟机运行状态采集服务
+    '''
+
+    help = """
+            监听所有启用宿主机的虚拟机生命周期事件，维护虚拟机运行状态缓存
+            python manage.py domain_state_collector [--heartbeat 10] [--resync 300] [--host-refresh 60]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--heartbeat', default=10, dest='heartbeat', type=int,
+            help='检查宿主机连接、确认状态缓存有效的间隔（秒），需小于VM_DOMAIN_STATE_CACHE_TTL',
+        )
+        parser.add_argument(
+            '--resync', default=300, dest='resync', type=int,
+            help='全量同步宿主机所有虚拟机状态的间隔（秒）',
+        )
+        parser.add_argument(
+            '--host-refresh', default=60, dest='host_refresh', type=int,
+            help='重新加载启用的宿主机列表的间隔（秒）',
+        )
+
+    def handle(self, *args, **options):
+        logger = config_script_logger(
+            name='vm-domain-state-collector', filename='vm_domain_state_collector.log', stdout=True)
+        collector = DomainStateCollector(
+            heartbeat_interval=options['heartbeat'], resync_interval=options['resync'],
+            host_refresh_interval=options['host_refresh'], logger=logger
+        )
+        self.stdout.write(self.style.SUCCESS('Start vm domain state collector.'))
+        try:
+            collector.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Exit.'))
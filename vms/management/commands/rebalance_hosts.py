@@ -0,0 +1,90 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.loggers import config_script_logger
+from vms.rebalance import (
+    HostRebalancer, REBALANCE_MAX_MOVES, REBALANCE_MAX_MOVES_PER_HOST, REBALANCE_UTIL_WEIGHT, REBALANCE_MIN_IMPROVEMENT
+)
+
+
+class Command(BaseCommand):
+    '''
+    宿主机组负载均衡
+    '''
+
+    help = """
+            按内存分配率和实际内存使用率为宿主机组生成有限次动态迁移的均衡计划，默认只输出计划(dry run)，
+            --execute时提交动态迁移后台任务；--interval时周期性运行
+            python manage.py rebalance_hosts [--group-id 1,2] [--execute] [--max-moves 10] [--interval 3600] [--json]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group-id', default='', dest='group_id', help='宿主机组id，逗号分隔，默认全部宿主机组')
+        parser.add_argument('--execute', default=False, dest='execute', action='store_true',
+                            help='执行迁移计划，默认只输出计划')
+        parser.add_argument('--max-moves', default=REBALANCE_MAX_MOVES, dest='max_moves', type=int,
+                            help='每个宿主机组每次运行的迁移数上限')
+        parser.add_argument('--max-moves-per-host', default=REBALANCE_MAX_MOVES_PER_HOST, dest='max_moves_per_host',
+                            type=int, help='每个宿主机每次运行迁入和迁出的虚拟机总数上限')
+        parser.add_argument('--util-weight', default=REBALANCE_UTIL_WEIGHT, dest='util_weight', type=float,
+                            help='宿主机负载中实际内存使用率的权重，0-1')
+        parser.add_argument('--min-improvement', default=REBALANCE_MIN_IMPROVEMENT, dest='min_improvement',
+                            type=float, help='每次迁移负载标准差的最小下降量')
+        parser.add_argument('--options', default='', dest='options', help='动态迁移参数，json格式')
+        parser.add_argument('--interval', default=0, dest='interval', type=int,
+                            help='周期性运行的间隔（秒），默认只运行一次')
+        parser.add_argument('--json', default=False, dest='json', action='store_true', help='以json格式输出计划')
+
+    def handle(self, *args, **options):
+        try:
+            group_ids = [int(i) for i in options['group_id'].split(',') if i.strip()]
+        except ValueError:
+            raise CommandError('宿主机组id无效')
+
+        try:
+            migrate_options = json.loads(options['options']) if options['options'] else None
+        except json.JSONDecodeError as e:
+            raise CommandError(f'动态迁移参数无效，{str(e)}')
+
+        if not 0 <= options['util_weight'] <= 1:
+            raise CommandError('--util-weight必须在0-1之间')
+
+        logger = config_script_logger(name='host-rebalancer', filename='host_rebalancer.log', stdout=True)
+        rebalancer = HostRebalancer(max_moves=options['max_moves'], max_moves_per_host=options['max_moves_per_host'],
+                                    util_weight=options['util_weight'], min_improvement=options['min_improvement'],
+                                    logger=logger)
+        if options['interval'] > 0:
+            self.stdout.write(self.style.SUCCESS('Start host rebalancer.'))
+            try:
+                rebalancer.run_forever(interval=options['interval'], group_ids=group_ids, execute=options['execute'],
+                                       options=migrate_options)
+            except KeyboardInterrupt:
+                self.stdout.write(self.style.WARNING('Exit.'))
+
+            return
+
+        plans = rebalancer.run_once(group_ids=group_ids, execute=options['execute'], options=migrate_options)
+        if options['json']:
+            self.stdout.write(json.dumps([p.to_dict() for p in plans], indent=2))
+        else:
+            for plan in plans:
+                before, after = plan.imbalance_before, plan.imbalance_after
+                self.stdout.write(
+                    f"group={plan.group_id}, moves={len(plan.moves)}, stddev {before['stddev']:.2%} -> "
+                    f"{after['stddev']:.2%}, spread {before['spread']:.2%} -> {after['spread']:.2%}")
+                for m in plan.moves:
+                    result = ''
+                    if 'migrate_task_id' in m:
+                        result = f", task={m['migrate_task_id']}"
+                    elif 'error' in m:
+                        result = f", error={m['error']}"
+
+                    self.stdout.write(
+                        f"  vm={m['vm_uuid']} ({m['vcpu']}C/{m['mem']}G) {m['src_host_ipv4']}({m['src_load']:.2%}) "
+                        f"-> {m['dst_host_ipv4']}({m['dst_load']:.2%}){result}")
+
+        moves = sum(len(p.moves) for p in plans)
+        action = 'execute' if options['execute'] else 'plan'
+        self.stdout.write(self.style.SUCCESS(f'Successfully {action} host rebalance, groups={len(plans)}, '
+                                             f'moves={moves}.'))
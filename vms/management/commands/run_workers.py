@@ -0,0 +1,48 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from utils.loggers import config_script_logger
+from vms.jobs import JobWorker, JOB_WORKERS, JOB_LEASE_SECONDS, get_job_type_names
+from vms.migrate import VmMigrateManager
+from vms import tasks     # 导入时注册任务类型
+
+
+class Command(BaseCommand):
+    '''
+    后台任务执行服务
+    '''
+
+    help = """
+            领取执行数据库中的后台任务(动态迁移、批量创建虚拟机等)，为执行中的任务续约，回收租约过期的任务；
+            可以在多个服务器上运行多个服务
+            python manage.py run_workers [--workers 8] [--lease 60] [--types live_migrate,vm_batch_create]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default=JOB_WORKERS, dest='workers', type=int, help='同时执行的任务数')
+        parser.add_argument('--lease', default=JOB_LEASE_SECONDS, dest='lease', type=int, help='任务租约时间（秒）')
+        parser.add_argument('--poll-interval', default=1, dest='poll_interval', type=float,
+                            help='没有可执行任务时的查询间隔（秒）')
+        parser.add_argument('--types', default='', dest='types',
+                            help=f'只执行这些类型的任务，逗号分隔，默认所有类型：{",".join(get_job_type_names())}')
+        parser.add_argument('--orphan-grace', default=600, dest='orphan_grace', type=int,
+                            help='没有后台任务的等待或正在迁移的迁移任务，超过此时间（秒）后善后处理')
+
+    def handle(self, *args, **options):
+        logger = config_script_logger(name='job-worker', filename='job_worker.log', stdout=True)
+        job_types = [t.strip() for t in options['types'].split(',') if t.strip()]
+        worker = JobWorker(workers=options['workers'], lease_seconds=options['lease'],
+                           poll_interval=options['poll_interval'], job_types=job_types or None, logger=logger)
+        worker.add_recover_hook(
+            lambda log: VmMigrateManager.recover_orphaned_tasks(grace_seconds=options['orphan_grace'], logger=log))
+
+        def on_signal(signum, frame):
+            logger.info('stopping, wait for running jobs')
+            worker.stop()
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+        self.stdout.write(self.style.SUCCESS(f'Start job worker {worker.owner}.'))
+        worker.run_forever()
+        self.stdout.write(self.style.WARNING('Exit.'))
@@ -0,0 +1,69 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from compute.placement_sim import generate_trace, load_trace
+from vms.rebalance import (
+    RebalanceSimulator, REBALANCE_MAX_MOVES, REBALANCE_MAX_MOVES_PER_HOST, REBALANCE_UTIL_WEIGHT,
+    REBALANCE_MIN_IMPROVEMENT
+)
+
+
+class Command(BaseCommand):
+    '''
+    宿主机组负载均衡模拟
+    '''
+
+    help = """
+            在合成集群上按事件序列随机调度虚拟机后运行负载均衡，输出均衡前后的不均衡度；不访问数据库
+            python manage.py simulate_rebalance [--trace trace.jsonl] [--events 2000] [--hosts 20] [--max-moves 10]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trace', default='', dest='trace', help='事件序列文件，格式同simulate_placement')
+        parser.add_argument('--events', default=2000, dest='events', type=int, help='随机生成的事件数')
+        parser.add_argument('--delete-ratio', default=0.4, dest='delete_ratio', type=float, help='随机生成的删除事件占比')
+        parser.add_argument('--seed', default=0, dest='seed', type=int, help='随机数种子')
+        parser.add_argument('--hosts', default=20, dest='hosts', type=int, help='宿主机数')
+        parser.add_argument('--host-vcpu', default=64, dest='host_vcpu', type=int, help='每个宿主机vcpu数')
+        parser.add_argument('--host-mem', default=256, dest='host_mem', type=int, help='每个宿主机内存大小(GB)')
+        parser.add_argument('--vm-limit', default=64, dest='vm_limit', type=int, help='每个宿主机虚拟机数量上限')
+        parser.add_argument('--util-noise', default=0.2, dest='util_noise', type=float,
+                            help='实际内存使用率相对分配率的随机浮动比例')
+        parser.add_argument('--max-moves', default=REBALANCE_MAX_MOVES, dest='max_moves', type=int,
+                            help='迁移数上限')
+        parser.add_argument('--max-moves-per-host', default=REBALANCE_MAX_MOVES_PER_HOST, dest='max_moves_per_host',
+                            type=int, help='每个宿主机迁入和迁出的虚拟机总数上限')
+        parser.add_argument('--util-weight', default=REBALANCE_UTIL_WEIGHT, dest='util_weight', type=float,
+                            help='宿主机负载中实际内存使用率的权重，0-1')
+        parser.add_argument('--min-improvement', default=REBALANCE_MIN_IMPROVEMENT, dest='min_improvement',
+                            type=float, help='每次迁移负载标准差的最小下降量')
+        parser.add_argument('--json', default=False, dest='json', action='store_true', help='以json格式输出结果')
+
+    def handle(self, *args, **options):
+        if options['trace']:
+            try:
+                trace = load_trace(options['trace'])
+            except Exception as e:
+                raise CommandError(f'加载事件序列文件错误，{str(e)}')
+        else:
+            trace = generate_trace(num_events=options['events'], delete_ratio=options['delete_ratio'],
+                                   seed=options['seed'])
+
+        simulator = RebalanceSimulator(hosts=options['hosts'], host_vcpu=options['host_vcpu'],
+                                       host_mem=options['host_mem'], vm_limit=options['vm_limit'])
+        r = simulator.run(trace=trace, util_noise=options['util_noise'], seed=options['seed'],
+                          max_moves=options['max_moves'], max_moves_per_host=options['max_moves_per_host'],
+                          util_weight=options['util_weight'], min_improvement=options['min_improvement'])
+        if options['json']:
+            self.stdout.write(json.dumps(r, indent=2))
+        else:
+            self.stdout.write(f'events={len(trace)}, hosts={options["hosts"]}, vms={r["vms"]}, moves={r["moves"]}')
+            for name, before, after in (('load', r['before'], r['after']),
+                                        ('mem_allocated', r['alloc_before'], r['alloc_after'])):
+                self.stdout.write(
+                    f"{name:<14} stddev {before['stddev']:.2%} -> {after['stddev']:.2%}, "
+                    f"spread {before['spread']:.2%} -> {after['spread']:.2%}, "
+                    f"max {before['max']:.2%} -> {after['max']:.2%}, min {before['min']:.2%} -> {after['min']:.2%}")
+
+        self.stdout.write(self.style.SUCCESS('Successfully simulate rebalance.'))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from utils.loggers import config_script_logger
+from vms.metrics import VmMetricsSampler
+
+
+class Command(BaseCommand):
+    '''
+    虚拟机监控指标采样服务
+    '''
+
+    help = """
+            周期性采集所有运行中虚拟机的监控指标，计算速率后写入降采样环形序列
+            python manage.py vm_metrics_sampler [--interval 10] [--flush-interval 60]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', default=10, dest='interval', type=int,
+            help='采集间隔（秒），应等于VM_METRICS_RINGS中最小的采样间隔',
+        )
+        parser.add_argument(
+            '--flush-interval', default=60, dest='flush_interval', type=int,
+            help='环形序列写入数据库的最小间隔（秒）',
+        )
+
+    def handle(self, *args, **options):
+        logger = config_script_logger(name='vm-metrics-sampler', filename='vm_metrics_sampler.log', stdout=True)
+        sampler = VmMetricsSampler(
+            interval=options['interval'], flush_interval=options['flush_interval'], logger=logger)
+        self.stdout.write(self.style.SUCCESS('Start vm metrics sampler.'))
+        try:
+            sampler.run_forever()
+        except KeyboardInterrupt:
+            sampler.flush_all()
+            self.stdout.write(self.style.WARNING('Exit.'))
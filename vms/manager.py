@@ -1,12 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db.models import Q
 from django.db import transaction
+from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from compute.managers import CenterManager, GroupManager, ComputeError
-from .models import (Vm, VmArchive, VmLog, Flavor, AttachmentsIP, VmSharedUser)
+from .models import (Vm, VmArchive, VmLog, Flavor, AttachmentsIP, VmSharedUser, VmDomainState)
 from utils.errors import VmError
 from utils import errors
+from utils.db import bulk_upsert
 from network.managers import MacIPManager
+from utils.ev_libvirt.virt import VM_STATE
+
+
+# 虚拟机运行状态缓存的有效期（秒），超过有效期未被采集服务确认的状态视为过期
+VM_DOMAIN_STATE_CACHE_TTL = getattr(settings, 'VM_DOMAIN_STATE_CACHE_TTL', 60)
 
 
 class VmManager:
@@ -466,3 +476,104 @@ class VmSharedUserManager:
             # 删除权限需要变更的和需要删除的
             VmSharedUser.objects.filter(vm_id=vm_id, id__in=delete_ids).delete()
             VmSharedUser.objects.bulk_create(add_users)
+
+
+class VmDomainStateManager:
+    """
+    虚拟机运行状态缓存管理器
+    """
+    @staticmethod
+    def _fresh_time(max_age: int = None):
+        if max_age is None:
+            max_age = VM_DOMAIN_STATE_CACHE_TTL
+
+        return timezone.now() - timedelta(seconds=max_age)
+
+    @staticmethod
+    def get_vms_status(vms, max_age: int = None):
+        """
+        从缓存获取虚拟机的运行状态，缓存过期或缓存的宿主机与虚拟机当前所在宿主机不同的不在结果中
+
+        :param vms: 虚拟机对象列表，需要select_related('host')
+        :param max_age: 缓存有效期（秒），默认VM_DOMAIN_STATE_CACHE_TTL
+        :return:
+            {vm_uuid: (state_code:int, state_str:str)}
+        """
+        vm_hosts = {vm.hex_uuid: vm.host.ipv4 for vm in vms if vm.host is not None}
+        if not vm_hosts:
+            return {}
+
+        try:
+            qs = VmDomainState.objects.filter(
+                vm_uuid__in=list(vm_hosts.keys()), update_time__gte=VmDomainStateManager._fresh_time(max_age)
+            ).values_list('vm_uuid', 'host_ipv4', 'state')
+            rows = list(qs)
+        except Exception:
+            return {}
+
+        ret = {}
+        for vm_uuid, host_ipv4, state in rows:
+            if vm_hosts.get(vm_uuid) != host_ipv4:
+                continue
+
+            ret[vm_uuid] = (state, VM_STATE.get(state, 'no state'))
+
+        return ret
+
+    @staticmethod
+    def get_vm_status(vm, max_age: int = None):
+        """
+        从缓存获取虚拟机的运行状态
+
+        :return:
+            (state_code:int, state_str:str)     # 缓存有效
+            None                                # 没有缓存或已过期
+        """
+        return VmDomainStateManager.get_vms_status(vms=[vm], max_age=max_age).get(vm.hex_uuid)
+
+    @staticmethod
+    def set_vm_state(vm_uuid: str, host_ipv4: str, state: int):
+        """
+        更新一个虚拟机的运行状态缓存
+        """
+        VmDomainState.objects.update_or_create(
+            vm_uuid=vm_uuid, defaults={'host_ipv4': host_ipv4, 'state': state, 'update_time': timezone.now()})
+
+    @staticmethod
+    def delete_vm_state(vm_uuid: str, host_ipv4: str):
+        """
+        删除宿主机上一个虚拟机的运行状态缓存，虚拟机已迁移到其他宿主机的缓存不删除
+        """
+        VmDomainState.objects.filter(vm_uuid=vm_uuid, host_ipv4=host_ipv4).delete()
+
+    @staticmethod
+    def sync_host_states(host_ipv4: str, states: dict):
+        """
+        用宿主机上所有虚拟机的当前状态替换此宿主机的运行状态缓存
+
+        :param host_ipv4: 宿主机IP
+        :param states: {vm_uuid: state_code}
+        """
+        now = timezone.now()
+        objs = [
+            VmDomainState(vm_uuid=vm_uuid, host_ipv4=host_ipv4, state=state, update_time=now)
+            for vm_uuid, state in states.items()
+        ]
+        with transaction.atomic():
+            VmDomainState.objects.filter(host_ipv4=host_ipv4).exclude(vm_uuid__in=list(states.keys())).delete()
+            bulk_upsert(VmDomainState, objs, batch_size=500, unique_fields=['vm_uuid'],
+                        update_fields=['host_ipv4', 'state', 'update_time'])
+
+    @staticmethod
+    def touch_host_states(host_ipv4: str):
+        """
+        宿主机事件连接正常时，确认此宿主机上虚拟机的运行状态缓存仍然有效
+        """
+        return VmDomainState.objects.filter(host_ipv4=host_ipv4).update(update_time=timezone.now())
+
+    @staticmethod
+    def clear_host_states(host_ipv4: str):
+        """
+        宿主机事件连接断开时，删除此宿主机的运行状态缓存
+        """
+        return VmDomainState.objects.filter(host_ipv4=host_ipv4).delete()
@@ -0,0 +1,376 @@
+"""
+虚拟机监控指标时序存储
+
+采样服务(manage.py vm_metrics_sampler)周期性按宿主机批量采集运行中虚拟机的统计信息，
+采集时由相邻两次的累计值计算cpu使用率、IOPS和带宽等速率，写入每个虚拟机的多个降采样环形序列(VmMetricRing)，
+如默认10秒间隔保留1小时、5分钟间隔保留7天；存储大小只与虚拟机数量有关，不随时间增长
+"""
+import array
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from compute.models import Host
+from utils.ev_libvirt.virt import VirtHost, VirtError, VmStatsRecord, VIR_DOMAIN_RUNNING
+from utils import errors
+from utils.db import bulk_upsert
+from .models import VmMetricRing
+
+
+# 指标名称，顺序即打包存储时列的顺序，不能修改已有指标的顺序
+METRICS = (
+    'cpu_percent', 'mem_percent',
+    'disk_rd_iops', 'disk_wr_iops', 'disk_rd_bps', 'disk_wr_bps',
+    'net_rx_bps', 'net_tx_bps',
+)
+# 降采样环形序列规格 ((采样间隔秒, 采样点数), ...)，按采样间隔从小到大
+VM_METRICS_RINGS = tuple(sorted(getattr(settings, 'VM_METRICS_RINGS', ((10, 360), (300, 2016)))))
+# 历史查询一次最多返回的点数
+VM_METRICS_HISTORY_MAX_POINTS = getattr(settings, 'VM_METRICS_HISTORY_MAX_POINTS', 2000)
+
+
+class MetricRing:
+    """
+    固定大小的环形采样序列，时间戳timestamp的采样点在slot=(timestamp // step) % size
+
+    按列打包存储：epochs(int32 * size) + counts(uint16 * size) + 每个指标一列(float32 * size)；
+    epoch=timestamp // step，用于判断slot中的数据是否属于当前轮次；同一slot内的多次采样取平均值
+    """
+    EMPTY_EPOCH = -1
+
+    def __init__(self, step: int, size: int, data: bytes = None):
+        self.step = step
+        self.size = size
+        if data and len(data) == self.packed_size(size):
+            self._unpack(bytes(data))
+        else:
+            self.epochs = array.array('i', [self.EMPTY_EPOCH]) * size
+            self.counts = array.array('H', [0]) * size
+            self.values = array.array('f', [0.0]) * (size * len(METRICS))
+
+    @staticmethod
+    def packed_size(size: int):
+        return size * (array.array('i').itemsize + array.array('H').itemsize +
+                       array.array('f').itemsize * len(METRICS))
+
+    def _unpack(self, data: bytes):
+        self.epochs = array.array('i')
+        self.counts = array.array('H')
+        self.values = array.array('f')
+        i = self.size * self.epochs.itemsize
+        j = i + self.size * self.counts.itemsize
+        self.epochs.frombytes(data[:i])
+        self.counts.frombytes(data[i:j])
+        self.values.frombytes(data[j:])
+
+    def to_bytes(self) -> bytes:
+        return self.epochs.tobytes() + self.counts.tobytes() + self.values.tobytes()
+
+    def add(self, timestamp: float, values):
+        """
+        添加一个采样点
+
+        :param timestamp: 采样时间戳
+        :param values: 按METRICS顺序的指标值
+        """
+        epoch = int(timestamp // self.step)
+        slot = epoch % self.size
+        if self.epochs[slot] != epoch:
+            self.epochs[slot] = epoch
+            self.counts[slot] = 0
+
+        count = min(self.counts[slot] + 1, 0xFFFF)
+        self.counts[slot] = count
+        for m, val in enumerate(values):
+            idx = m * self.size + slot
+            if count == 1:
+                self.values[idx] = val
+            else:
+                self.values[idx] += (val - self.values[idx]) / count
+
+    def points(self, start: float, end: float):
+        """
+        时间范围内的采样点
+
+        :return: 生成器 (timestamp:int, [按METRICS顺序的指标值])
+        """
+        end_epoch = int(end // self.step)
+        start_epoch = max(int(start // self.step), end_epoch - self.size + 1)
+        for epoch in range(start_epoch, end_epoch + 1):
+            slot = epoch % self.size
+            if self.epochs[slot] != epoch:
+                continue
+
+            yield epoch * self.step, [self.values[m * self.size + slot] for m in range(len(METRICS))]
+
+
+def compute_rates(prev: VmStatsRecord, cur: VmStatsRecord):
+    """
+    由相邻两次采集的累计值计算速率
+
+    :return:
+        [按METRICS顺序的指标值]     # success
+        None                        # 间隔无效或计数器被重置（如虚拟机重启）
+    """
+    dt = cur.timestamp - prev.timestamp
+    if dt <= 0:
+        return None
+
+    deltas = (
+        cur.cpu_time_abs - prev.cpu_time_abs,
+        cur.disk_rd_reqs - prev.disk_rd_reqs, cur.disk_wr_reqs - prev.disk_wr_reqs,
+        cur.disk_rd_bytes - prev.disk_rd_bytes, cur.disk_wr_bytes - prev.disk_wr_bytes,
+        cur.net_rx_bytes - prev.net_rx_bytes, cur.net_tx_bytes - prev.net_tx_bytes,
+    )
+    if min(deltas) < 0:
+        return None
+
+    cpu_ns, *io_deltas = deltas
+    cpu_percent = cpu_ns / (dt * 1e9 * max(cur.guest_cpus, 1)) * 100
+    return [min(cpu_percent, 100.0), cur.curr_mem_percent] + [d / dt for d in io_deltas]
+
+
+class VmMetricsSampler:
+    """
+    虚拟机监控指标采样器
+
+    内存中保留运行中虚拟机的上一次采集值和环形序列，环形序列按max(flush_interval, step)间隔写入数据库
+    """
+    def __init__(self, interval: int = 10, flush_interval: int = 60, logger=None):
+        """
+        :param interval: 采集间隔（秒）
+        :param flush_interval: 环形序列写入数据库的最小间隔（秒）
+        """
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self._last_records = {}     # {vm_uuid: VmStatsRecord}
+        self._rings = {}            # {vm_uuid: {step: MetricRing}}
+        self._dirty = set()         # 有未写入数据库的新采样点的环形序列 {(vm_uuid, step)}
+        self._flushed = {}          # {(vm_uuid, step): 上次写入数据库的时间}
+
+    @staticmethod
+    def _get_host_stats(host: VirtHost):
+        try:
+            return host.get_domains_stats()
+        finally:
+            host.close()
+
+    def collect(self):
+        """
+        并行采集所有启用宿主机上运行中虚拟机的统计信息
+
+        :return: [VmStatsRecord]
+        """
+        hosts = []
+        for ipv4 in Host.objects.filter(enable=True).values_list('ipv4', flat=True):
+            try:
+                hosts.append(VirtHost(host_ipv4=ipv4))  # 初始化需要查询数据库，在当前线程创建
+            except Exception as e:
+                self.logger.warning(f'host({ipv4}) error, {str(e)}')
+
+        if not hosts:
+            return []
+
+        records = []
+        with ThreadPoolExecutor(max_workers=min(len(hosts), 16)) as executor:
+            futures = [(h.host_ipv4, executor.submit(self._get_host_stats, h)) for h in hosts]
+            for ipv4, future in futures:
+                try:
+                    records += [r for r in future.result() if r.state == VIR_DOMAIN_RUNNING]
+                except VirtError as e:
+                    self.logger.warning(f'collect stats of host({ipv4}) error, {str(e)}')
+
+        return records
+
+    def _load_rings(self, vm_uuids: list):
+        """
+        从数据库加载虚拟机的环形序列，没有的新建
+        """
+        rows = {}
+        for i in range(0, len(vm_uuids), 500):
+            qs = VmMetricRing.objects.filter(vm_uuid__in=vm_uuids[i:i + 500]).values_list('vm_uuid', 'step', 'data')
+            for vm_uuid, step, data in qs:
+                rows[(vm_uuid, step)] = data
+
+        for vm_uuid in vm_uuids:
+            self._rings[vm_uuid] = {
+                step: MetricRing(step=step, size=size, data=rows.get((vm_uuid, step)))
+                for step, size in VM_METRICS_RINGS
+            }
+
+    def ingest(self, records: list):
+        """
+        计算速率并写入环形序列；本次没有采集到的虚拟机（已关机、已迁走等）写入数据库后从内存移除
+        """
+        new_uuids = [r.vm_uuid for r in records if r.vm_uuid not in self._rings]
+        if new_uuids:
+            self._load_rings(new_uuids)
+
+        current = {}
+        for record in records:
+            current[record.vm_uuid] = record
+            prev = self._last_records.get(record.vm_uuid)
+            if prev is None:
+                continue
+
+            values = compute_rates(prev=prev, cur=record)
+            if values is None:
+                continue
+
+            for step, ring in self._rings[record.vm_uuid].items():
+                ring.add(timestamp=record.timestamp, values=values)
+                self._dirty.add((record.vm_uuid, step))
+
+        gone = [vm_uuid for vm_uuid in self._rings if vm_uuid not in current]
+        if gone:
+            self.flush(vm_uuids=gone)
+            for vm_uuid in gone:
+                for step in self._rings.pop(vm_uuid, {}):
+                    self._flushed.pop((vm_uuid, step), None)
+
+        self._last_records = current
+
+    def flush(self, vm_uuids: list = None):
+        """
+        环形序列写入数据库
+
+        :param vm_uuids: 强制写入这些虚拟机有变化的环形序列；None时只写入有变化且到达写入间隔的
+        """
+        now = time.time()
+        force = set(vm_uuids) if vm_uuids else set()
+        objs = []
+        for key in list(self._dirty):
+            vm_uuid, step = key
+            if vm_uuid not in force and now - self._flushed.get(key, 0) < max(self.flush_interval, step):
+                continue
+
+            ring = self._rings.get(vm_uuid, {}).get(step)
+            if ring is not None:
+                objs.append(VmMetricRing(vm_uuid=vm_uuid, step=step, data=ring.to_bytes(), update_time=timezone.now()))
+
+            self._dirty.discard(key)
+            self._flushed[key] = now
+
+        if objs:
+            bulk_upsert(VmMetricRing, objs, batch_size=200, unique_fields=['vm_uuid', 'step'],
+                        update_fields=['data', 'update_time'])
+
+        return len(objs)
+
+    def flush_all(self):
+        """
+        所有环形序列写入数据库，退出前调用
+        """
+        return self.flush(vm_uuids=list(self._rings.keys()))
+
+    @staticmethod
+    def purge_expired():
+        """
+        删除超过最长保留时间未更新的环形序列（虚拟机已删除或长期关机）
+        """
+        max_keep = max(step * size for step, size in VM_METRICS_RINGS)
+        expired = timezone.now() - timedelta(seconds=max_keep)
+        return VmMetricRing.objects.filter(update_time__lt=expired).delete()
+
+    def run_forever(self):
+        last_purge = 0
+        while True:
+            start = time.time()
+            close_old_connections()
+            try:
+                self.ingest(self.collect())
+                self.flush()
+                if start - last_purge >= 3600:
+                    self.purge_expired()
+                    last_purge = start
+            except Exception as e:
+                self.logger.error(f'sample vm metrics error, {str(e)}')
+
+            time.sleep(max(self.interval - (time.time() - start), 0))
+
+
+class VmMetricsManager:
+    """
+    虚拟机监控指标查询
+    """
+    @staticmethod
+    def choose_ring(start: float, step: int = None, now: float = None):
+        """
+        选择覆盖开始时间、且采样间隔不大于查询间隔的最精细的环形序列；都不覆盖时用保留时间最长的
+
+        :return: (step, size)
+        """
+        if now is None:
+            now = time.time()
+
+        candidates = [(s, n) for s, n in VM_METRICS_RINGS if step is None or s <= step]
+        if not candidates:
+            candidates = [VM_METRICS_RINGS[0]]
+
+        for s, n in candidates:
+            if now - s * n <= start:
+                return s, n
+
+        return candidates[-1]
+
+    @staticmethod
+    def get_vm_metrics_history(vm_uuid: str, start: int = None, end: int = None, step: int = None):
+        """
+        查询虚拟机监控指标历史数据
+
+        :param vm_uuid: 虚拟机uuid
+        :param start: 开始时间戳，默认结束时间前1小时
+        :param end: 结束时间戳，默认当前时间
+        :param step: 返回数据点的间隔（秒），默认所用环形序列的采样间隔，会按采样间隔取整
+        :return:
+            {
+                'start': int, 'end': int, 'step': int,
+                'timestamps': [int, ...],
+                'metrics': {'cpu_percent': [float or None, ...], ...}
+            }
+
+        :raises: InvalidParamError
+        """
+        now = time.time()
+        end = int(now) if end is None else end
+        start = end - 3600 if start is None else start
+        if start >= end:
+            raise errors.InvalidParamError(msg='开始时间必须小于结束时间')
+
+        if step is not None and step <= 0:
+            raise errors.InvalidParamError(msg='step必须大于0')
+
+        ring_step, ring_size = VmMetricsManager.choose_ring(start=start, step=step, now=now)
+        step = ring_step if step is None else max(step // ring_step, 1) * ring_step
+        t0 = start - start % step
+        num = (end - t0) // step + 1
+        if num > VM_METRICS_HISTORY_MAX_POINTS:
+            raise errors.InvalidParamError(
+                msg=f'时间范围内数据点数超过{VM_METRICS_HISTORY_MAX_POINTS}，请增大step或缩小时间范围')
+
+        sums = [[0.0] * num for _ in METRICS]
+        counts = [0] * num
+        row = VmMetricRing.objects.filter(vm_uuid=vm_uuid, step=ring_step).values_list('data', flat=True).first()
+        if row:
+            ring = MetricRing(step=ring_step, size=ring_size, data=row)
+            for ts, values in ring.points(start=start, end=end):
+                i = (ts - t0) // step
+                counts[i] += 1
+                for m, val in enumerate(values):
+                    sums[m][i] += val
+
+        metrics = {}
+        for m, name in enumerate(METRICS):
+            metrics[name] = [round(sums[m][i] / counts[i], 2) if counts[i] else None for i in range(num)]
+
+        return {
+            'start': start, 'end': end, 'step': step,
+            'timestamps': [t0 + i * step for i in range(num)],
+            'metrics': metrics
+        }
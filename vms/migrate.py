@@ -1,19 +1,127 @@
+import logging
+import threading
+import time
 from datetime import timedelta
 
+from django.conf import settings
 from django.utils import timezone
-from django.db import transaction
+from django.db import transaction, connection
 
 from compute.managers import HostManager
 from vdisk.manager import VdiskManager
 from utils.ev_libvirt.virt import (
-    VirtError, VmDomain, VirDomainNotExist, VirHostDown, VirtHost
+    VirtError, VmDomain, VirDomainNotExist, VirHostDown, VirtHost,
+    VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTOFF, VIR_DOMAIN_MISS, VIR_DOMAIN_HOST_DOWN
 )
 from utils import errors
-from .models import (Vm, MigrateTask)
-from .tasks import creat_migrate_vm_task
+from .models import (Vm, MigrateTask, HostEvacuationItem)
+from . import tasks
 from .vm_builder import VmBuilder, get_vm_domain
 
 
+# 动态迁移进度采样间隔（秒）
+LIVE_MIGRATE_MONITOR_INTERVAL = getattr(settings, 'LIVE_MIGRATE_MONITOR_INTERVAL', 2)
+
+
+class LiveMigrateMonitor:
+    """
+    动态迁移监控线程，迁移过程中周期性采样源虚拟机的迁移作业统计(jobStats)写入迁移任务记录；
+    按迁移参数设置最大停机时间、切换post-copy，请求取消、超时或后台任务取消时取消迁移
+    """
+    def __init__(self, m_task_id: int, domain: VmDomain, options: dict, interval: float = LIVE_MIGRATE_MONITOR_INTERVAL,
+                 logger=None, cancel_event: threading.Event = None):
+        """
+        :param m_task_id: 迁移任务id
+        :param domain: 源宿主机上的虚拟机
+        :param options: 迁移参数，max_downtime, postcopy, postcopy_after, timeout
+        :param interval: 采样间隔（秒）
+        :param cancel_event: 后台任务的取消事件
+        """
+        self.m_task_id = m_task_id
+        self.domain = domain
+        self.options = options if options else {}
+        self.cancel_event = cancel_event
+        self.interval = interval
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.aborted = ''       # 取消迁移的原因
+        self.postcopy_started = False
+        self._downtime_set = False
+        self._start = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._start = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name=f'migrate-monitor-{self.m_task_id}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 10)
+
+    def _run(self):
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.sample()
+                except Exception as e:
+                    self.logger.warning(f'sample migrate task({self.m_task_id}) job stats error, {str(e)}')
+        finally:
+            connection.close()
+
+    def _abort_reason(self, abort_requested: bool):
+        if abort_requested:
+            return '迁移已被取消'
+
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return '迁移后台任务超时，已取消'
+
+        timeout = self.options.get('timeout', 0)
+        if timeout and time.monotonic() - self._start >= timeout:
+            return f'迁移超过{timeout}秒未完成，已取消'
+
+        return ''
+
+    def sample(self):
+        """
+        采样一次迁移进度，写入迁移任务记录，并执行最大停机时间、post-copy切换和取消迁移
+
+        :return:
+            dict    # 迁移进度，见VmDomain.parse_migrate_job_stats()
+            None    # 迁移作业未开始或已结束
+        """
+        progress = VmDomain.parse_migrate_job_stats(self.domain.get_job_stats())
+        if not progress['active']:
+            return None
+
+        max_downtime = self.options.get('max_downtime', 0)
+        if max_downtime and not self._downtime_set:
+            self._downtime_set = True
+            self.domain.migrate_set_max_downtime(max_downtime)
+
+        if self.options.get('postcopy') and not self.postcopy_started and \
+                progress['iteration'] >= self.options.get('postcopy_after', 1):
+            self.domain.migrate_start_postcopy()
+            self.postcopy_started = True
+            self.logger.info(f'migrate task({self.m_task_id}) switched to post-copy at iteration {progress["iteration"]}')
+
+        progress['postcopy'] = self.postcopy_started
+        MigrateTask.objects.filter(id=self.m_task_id).update(progress=progress, progress_time=timezone.now())
+
+        # post-copy阶段虚拟机已在目标宿主机运行，不能再取消
+        if not self.aborted and not self.postcopy_started:
+            abort_requested = MigrateTask.objects.filter(
+                id=self.m_task_id).values_list('abort_requested', flat=True).first()
+            reason = self._abort_reason(abort_requested=bool(abort_requested))
+            if reason:
+                self.aborted = reason
+                self.domain.abort_job()
+                self.logger.info(f'migrate task({self.m_task_id}) aborted, {reason}')
+
+        return progress
+
+
 class VmMigrateManager:
     @staticmethod
     def get_migrate_task(_id, user):
@@ -130,12 +238,14 @@ class VmMigrateManager:
 
         return dest_host
 
-    def live_migrate_vm(self, vm: Vm, dest_host_id: int):
+    def live_migrate_vm(self, vm: Vm, dest_host_id: int, options: dict = None, submit: bool = True):
         """
         迁移虚拟机
 
         :param vm: 虚拟机元数据对象
         :param dest_host_id: 目标宿主机id
+        :param options: 迁移参数，见build_migrate_params()和LiveMigrateMonitor
+        :param submit: True(提交后台任务执行迁移)，False(由调用者执行run_live_migrate_job())
         :return:
             MigrateTask()   # success
 
@@ -147,7 +257,8 @@ class VmMigrateManager:
         src_host = vm.host
         m_task = MigrateTask(vm=vm, vm_uuid=vm_uuid, src_host=src_host, src_host_ipv4=src_host.ipv4,
                              dst_host=dest_host, dst_host_ipv4=dest_host.ipv4, migrate_time=timezone.now(),
-                             tag=MigrateTask.Tag.MIGRATE_LIVE, status=MigrateTask.Status.WAITING)
+                             tag=MigrateTask.Tag.MIGRATE_LIVE, status=MigrateTask.Status.WAITING,
+                             options=options if options else {})
 
         # 目标宿主机资源申请
         try:
@@ -161,11 +272,15 @@ class VmMigrateManager:
             dest_host.free(vcpu=vm.vcpu, mem=vm.mem)
             raise errors.VmError(msg=f'创建迁移任务记录错误,{str(r)}')
 
-        r = creat_migrate_vm_task(self.live_migrate_vm_task, m_task_id=m_task.id)
-        if isinstance(r, Exception):
+        if not submit:
+            return m_task
+
+        try:
+            tasks.submit_live_migrate(m_task)
+        except errors.Error as e:
             dest_host.free(vcpu=vm.vcpu, mem=vm.mem)
             m_task.delete()
-            raise errors.VmError(msg=f'创建迁移任务错误,{str(r)}')
+            raise errors.VmError(msg=f'创建迁移任务错误,{str(e)}')
 
         return m_task
 
@@ -187,7 +302,7 @@ class VmMigrateManager:
             raise errors.VmError.from_error(r)
 
     @staticmethod
-    def live_migrate_vm_task(m_task_id):
+    def live_migrate_vm_task(m_task_id, cancel_event: threading.Event = None):
         with transaction.atomic():
             m_task = MigrateTask.objects.select_for_update().select_related(
                 'vm', 'src_host', 'dst_host').filter(id=m_task_id).first()
@@ -197,32 +312,87 @@ class VmMigrateManager:
             if m_task.status != m_task.Status.WAITING:
                 return
 
+            if m_task.abort_requested or (cancel_event is not None and cancel_event.is_set()):
+                VmMigrateManager._do_task_failed(m_task=m_task, message='迁移已被取消')
+                return
+
             m_task.status = m_task.Status.IN_PROCESS
             m_task.do_save(update_fields=['status'])
 
-        VmMigrateManager._live_migrate_vm_task(m_task)
+        VmMigrateManager._live_migrate_vm_task(m_task, cancel_event=cancel_event)
 
     @staticmethod
-    def _live_migrate_vm_task(m_task):
+    def run_live_migrate_job(m_task_id, cancel_event: threading.Event = None):
+        """
+        后台任务执行动态迁移
+
+        :param m_task_id: 迁移任务id
+        :param cancel_event: 后台任务的取消事件，设置后取消迁移(已切换到post-copy的不能取消)
+        :return:
+            {'status': str}    # 迁移任务状态
+
+        :raises: VmError    # 迁移失败
+        """
+        VmMigrateManager.live_migrate_vm_task(m_task_id=m_task_id, cancel_event=cancel_event)
+        m_task = MigrateTask.objects.filter(id=m_task_id).first()
+        if m_task is None:
+            raise errors.VmError(msg=f'迁移任务(id={m_task_id})不存在')
+
+        if m_task.status == m_task.Status.FAILED:
+            raise errors.VmError(msg=f'迁移失败，{m_task.content}')
+
+        return {'status': m_task.status}
+
+    @staticmethod
+    def _live_migrate_vm_task(m_task, cancel_event: threading.Event = None):
         # 迁移虚拟机
         try:
-            dest_host = m_task.dst_host
-            src_host = m_task.src_host
             vm = m_task.vm
             dest_vm_host = VirtHost(host_ipv4=m_task.dst_host_ipv4)
             try:
-                dest_conn = dest_vm_host.get_connection()
+                dest_vm_host.get_connection()   # 源宿主机直接连接目标宿主机迁移，这里只确认目标宿主机可访问
             except VirHostDown as e:
                 raise errors.VmError(msg=f'无法连接宿主机,{str(e)}')
             except VirtError as e:
                 raise errors.VmError(msg=f'连接宿主机失败,{str(e)}')
 
             src_domain = get_vm_domain(vm)
-            src_domain.live_migrate(dest_host_conn=dest_conn, undefine_source=True)
         except Exception as e:
             VmMigrateManager._do_task_failed(m_task=m_task, message=str(e))
             return
 
+        monitor = LiveMigrateMonitor(m_task_id=m_task.id, domain=src_domain, options=m_task.options,
+                                     cancel_event=cancel_event)
+        monitor.start()
+        try:
+            src_domain.live_migrate(
+                dest_host_ipv4=m_task.dst_host_ipv4, options=m_task.options, undefine_source=True)
+        except Exception as e:
+            monitor.stop()
+            message = f'{monitor.aborted}, {str(e)}' if monitor.aborted else str(e)
+            VmMigrateManager._do_task_failed(m_task=m_task, message=message)
+            return
+
+        monitor.stop()
+
+        VmMigrateManager._after_live_migrated(m_task)
+
+    @staticmethod
+    def _after_live_migrated(m_task):
+        """
+        虚拟机已迁移到目标宿主机后，更新虚拟机关联的宿主机和宿主机资源
+
+        迁移线程和中断善后可能同时处理同一迁移任务，条件更新认领正在迁移的任务，只有一方更新宿主机资源
+        """
+        claimed = MigrateTask.objects.filter(id=m_task.id, status=MigrateTask.Status.IN_PROCESS).update(
+            status=MigrateTask.Status.SOME_TODO)
+        if not claimed:
+            return
+
+        m_task.status = m_task.Status.SOME_TODO
+        dest_host = m_task.dst_host
+        src_host = m_task.src_host
+        vm = m_task.vm
         log_msg = ''
         # vm元数据更新关联目标宿主机
         try:
@@ -259,6 +429,136 @@ class VmMigrateManager:
         m_task.migrate_complete_time = timezone.now()
         m_task.do_save()
 
+    @staticmethod
+    def abort_live_migrate(m_task: MigrateTask):
+        """
+        请求取消动态迁移，未开始的迁移不再执行，正在迁移的由迁移监控线程取消；已切换到post-copy的迁移不能取消
+
+        :raises: VmError
+        """
+        if m_task.tag != MigrateTask.Tag.MIGRATE_LIVE:
+            raise errors.VmError(msg='只能取消动态迁移任务')
+
+        if m_task.status not in [MigrateTask.Status.WAITING, MigrateTask.Status.IN_PROCESS]:
+            raise errors.VmError(msg='迁移任务已结束，不能取消')
+
+        if m_task.progress and m_task.progress.get('postcopy'):
+            raise errors.VmError(msg='迁移已切换到post-copy阶段，不能取消')
+
+        m_task.abort_requested = True
+        r = m_task.do_save(update_fields=['abort_requested'])
+        if r is not None:
+            raise errors.VmError.from_error(r)
+
+    @staticmethod
+    def recover_live_migrate_task(m_task_id):
+        """
+        执行中断(任务执行服务退出、uwsgi进程回收等)的动态迁移任务善后：
+        未开始的标记失败；正在迁移的按虚拟机实际所在的宿主机标记完成或失败
+
+        :return:
+            True    # 已处理
+            False   # 宿主机无法连接或虚拟机状态无法判断，稍后再处理
+        """
+        m_task = MigrateTask.objects.select_related('vm', 'src_host', 'dst_host').filter(id=m_task_id).first()
+        if m_task is None or m_task.status not in [MigrateTask.Status.WAITING, MigrateTask.Status.IN_PROCESS]:
+            return True
+
+        vm = m_task.vm
+        if vm is None or m_task.dst_host is None or m_task.src_host is None:
+            m_task.status = m_task.Status.FAILED
+            m_task.content = '迁移任务执行中断，虚拟机或宿主机已删除'
+            m_task.do_save(update_fields=['status', 'content'])
+            return True
+
+        if m_task.status == MigrateTask.Status.WAITING:
+            VmMigrateManager._do_task_failed(m_task=m_task, message='迁移任务执行中断，未开始迁移')
+            return True
+
+        vm_uuid = vm.get_uuid()
+        src_code, _ = VmDomain(host_ip=m_task.src_host_ipv4, vm_uuid=vm_uuid).status()
+        dst_code, _ = VmDomain(host_ip=m_task.dst_host_ipv4, vm_uuid=vm_uuid).status()
+        if VIR_DOMAIN_HOST_DOWN in (src_code, dst_code):
+            return False
+
+        if dst_code == VIR_DOMAIN_RUNNING and src_code in (VIR_DOMAIN_MISS, VIR_DOMAIN_SHUTOFF):
+            VmMigrateManager._after_live_migrated(m_task)
+            return True
+
+        # 点对点迁移由源宿主机libvirtd执行，任务执行服务退出后迁移仍可能在进行
+        if src_code == VIR_DOMAIN_RUNNING:
+            try:
+                src_job = VmDomain(host_ip=m_task.src_host_ipv4, vm_uuid=vm_uuid).get_job_stats()
+            except VirtError:
+                return False
+
+            if VmDomain.parse_migrate_job_stats(src_job)['active']:
+                return False
+
+        if src_code == VIR_DOMAIN_RUNNING and dst_code == VIR_DOMAIN_MISS:
+            VmMigrateManager._do_task_failed(m_task=m_task, message='迁移任务执行中断，虚拟机仍在源宿主机')
+            return True
+
+        m_task.content = f'迁移任务执行中断，源宿主机虚拟机状态{src_code}，目标宿主机虚拟机状态{dst_code}，需要管理员处理'
+        m_task.do_save(update_fields=['content'])
+        return False
+
+    @staticmethod
+    def recover_orphaned_tasks(grace_seconds: int = 600, logger=None):
+        """
+        善后没有对应后台任务的等待迁移、正在迁移的动态迁移任务(如旧版本在uwsgi进程中执行时进程被回收)
+
+        :param grace_seconds: 只处理迁移时间在此时间(秒)之前的迁移任务
+        :return:
+            int     # 已处理的数量
+        """
+        from .jobs import JobManager
+
+        qs = MigrateTask.objects.filter(
+            tag=MigrateTask.Tag.MIGRATE_LIVE, status__in=[MigrateTask.Status.WAITING, MigrateTask.Status.IN_PROCESS],
+            migrate_time__lt=timezone.now() - timedelta(seconds=grace_seconds)).values_list('id', flat=True)
+        evacuating_ids = VmMigrateManager._evacuating_migrate_task_ids()
+        count = 0
+        for m_task_id in qs:
+            if m_task_id in evacuating_ids:
+                continue
+
+            if JobManager.has_active_job(job_type=tasks.LIVE_MIGRATE, ref_id=m_task_id):
+                continue
+
+            try:
+                if VmMigrateManager.recover_live_migrate_task(m_task_id=m_task_id):
+                    count += 1
+            except Exception as e:
+                if logger:
+                    logger.error(f'recover migrate task({m_task_id}) error, {str(e)}')
+
+        return count
+
+    @staticmethod
+    def _evacuating_migrate_task_ids():
+        """
+        执行中的宿主机疏散任务正在迁移的动态迁移任务id，疏散任务在自己的线程池中迁移，没有对应的动态迁移后台任务
+
+        :return:
+            set()
+        """
+        from .jobs import JobManager
+
+        items = HostEvacuationItem.objects.filter(
+            status=HostEvacuationItem.Status.MIGRATING, migrate_task_id__isnull=False
+        ).values_list('evacuation_id', 'migrate_task_id')
+        active = {}     # {evacuation_id: bool}
+        m_task_ids = set()
+        for evacuation_id, m_task_id in items:
+            if evacuation_id not in active:
+                active[evacuation_id] = JobManager.has_active_job(job_type=tasks.HOST_EVACUATE, ref_id=evacuation_id)
+
+            if active[evacuation_id]:
+                m_task_ids.add(m_task_id)
+
+        return m_task_ids
+
     @staticmethod
     def handle_some_todo_migrate_log(task_log: MigrateTask):
         """
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0021_vmshareduser_vm_shared_users_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VmDomainState',
+            fields=[
+                ('vm_uuid', models.CharField(max_length=36, primary_key=True, serialize=False, verbose_name='虚拟机UUID')),
+                ('host_ipv4', models.GenericIPAddressField(db_index=True, verbose_name='宿主机IP')),
+                ('state', models.SmallIntegerField(verbose_name='运行状态码')),
+                ('update_time', models.DateTimeField(verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '虚拟机运行状态缓存',
+                'verbose_name_plural': '虚拟机运行状态缓存',
+                'db_table': 'vm_domain_state',
+            },
+        ),
+    ]
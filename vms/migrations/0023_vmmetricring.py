@@ -0,0 +1,32 @@
+# Generated by Django 4.2.9 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0022_vmdomainstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VmMetricRing',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('vm_uuid', models.CharField(db_index=True, max_length=36, verbose_name='虚拟机UUID')),
+                ('step', models.IntegerField(verbose_name='采样间隔(秒)')),
+                ('data', models.BinaryField(verbose_name='打包的采样数据')),
+                ('update_time', models.DateTimeField(verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '虚拟机监控指标',
+                'verbose_name_plural': '虚拟机监控指标',
+                'db_table': 'vm_metric_ring',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='vmmetricring',
+            constraint=models.UniqueConstraint(fields=('vm_uuid', 'step'), name='unique_vm_metric_ring_step'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.9 on 2026-10-18 14:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('compute', '0012_group_placement_strategy'),
+        ('network', '0014_macip_macip_vlan_used_idx'),
+        ('vms', '0023_vmmetricring'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VmBatchJob',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False, verbose_name='任务ID')),
+                ('status', models.CharField(choices=[('running', '正在创建'), ('complete', '全部成功'), ('partial', '部分失败'), ('failed', '全部失败')], default='running', max_length=16, verbose_name='状态')),
+                ('total', models.IntegerField(verbose_name='虚拟机数量')),
+                ('image_id', models.IntegerField(verbose_name='镜像ID')),
+                ('vcpu', models.IntegerField(verbose_name='CPU数')),
+                ('mem', models.IntegerField(help_text='单位GB', verbose_name='内存大小')),
+                ('remarks', models.CharField(blank=True, default='', max_length=255, verbose_name='备注')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('complete_time', models.DateTimeField(blank=True, default=None, null=True, verbose_name='完成时间')),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='创建者')),
+            ],
+            options={
+                'verbose_name': '批量创建虚拟机任务',
+                'verbose_name_plural': '批量创建虚拟机任务',
+                'db_table': 'vm_batch_job',
+                'ordering': ['-create_time'],
+            },
+        ),
+        migrations.CreateModel(
+            name='VmBatchJobItem',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('index', models.IntegerField(verbose_name='序号')),
+                ('vm_uuid', models.CharField(max_length=36, verbose_name='虚拟机UUID')),
+                ('status', models.CharField(choices=[('pending', '等待创建'), ('cloning', '正在创建系统盘'), ('defining', '正在定义虚拟机'), ('complete', '创建成功'), ('failed', '创建失败')], default='pending', max_length=16, verbose_name='状态')),
+                ('error', models.CharField(blank=True, default='', max_length=255, verbose_name='错误信息')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('host', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='compute.host')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='vms.vmbatchjob')),
+                ('mac_ip', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='network.macip')),
+            ],
+            options={
+                'verbose_name': '批量创建虚拟机任务项',
+                'verbose_name_plural': '批量创建虚拟机任务项',
+                'db_table': 'vm_batch_job_item',
+                'ordering': ['index'],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.9 on 2026-10-18 18:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0024_vmbatchjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('job_type', models.CharField(max_length=32, verbose_name='任务类型')),
+                ('params', models.JSONField(default=dict, verbose_name='任务参数')),
+                ('ref_id', models.CharField(blank=True, default='', help_text='如迁移任务id、批量创建任务id', max_length=64, verbose_name='关联对象ID')),
+                ('host_ipv4', models.GenericIPAddressField(blank=True, default=None, help_text='任务占用的宿主机，用于限制每个宿主机同时执行的任务数', null=True, verbose_name='宿主机IP')),
+                ('status', models.CharField(choices=[('pending', '等待执行'), ('running', '正在执行'), ('succeeded', '执行成功'), ('failed', '执行失败')], default='pending', max_length=16, verbose_name='状态')),
+                ('attempts', models.IntegerField(default=0, verbose_name='已执行次数')),
+                ('max_attempts', models.IntegerField(default=1, verbose_name='最多执行次数')),
+                ('timeout', models.IntegerField(default=3600, verbose_name='超时时间(秒)')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='可执行时间')),
+                ('lease_owner', models.CharField(blank=True, default='', max_length=128, verbose_name='执行者')),
+                ('lease_expires', models.DateTimeField(blank=True, default=None, null=True, verbose_name='租约到期时间')),
+                ('heartbeat_time', models.DateTimeField(blank=True, default=None, null=True, verbose_name='心跳时间')),
+                ('result', models.JSONField(blank=True, default=None, null=True, verbose_name='执行结果')),
+                ('error', models.TextField(blank=True, default='', verbose_name='错误信息')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('start_time', models.DateTimeField(blank=True, default=None, null=True, verbose_name='开始时间')),
+                ('finish_time', models.DateTimeField(blank=True, default=None, null=True, verbose_name='完成时间')),
+            ],
+            options={
+                'verbose_name': '后台任务',
+                'verbose_name_plural': '后台任务',
+                'db_table': 'vm_job',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['status', 'run_after'], name='vm_job_status_run_after_idx'), models.Index(fields=['job_type', 'ref_id'], name='vm_job_type_ref_idx')],
+            },
+        ),
+    ]
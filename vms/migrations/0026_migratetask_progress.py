@@ -0,0 +1,33 @@
+# Generated by Django 4.2.9 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0025_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='migratetask',
+            name='options',
+            field=models.JSONField(blank=True, default=dict, help_text='动态迁移参数，自动收敛、post-copy、压缩、并行连接数、带宽、最大停机时间等', verbose_name='迁移参数'),
+        ),
+        migrations.AddField(
+            model_name='migratetask',
+            name='progress',
+            field=models.JSONField(blank=True, default=dict, help_text='最近一次采样的迁移作业统计信息，剩余数据量、脏页速率、迭代次数、预计停机时间等', verbose_name='迁移进度'),
+        ),
+        migrations.AddField(
+            model_name='migratetask',
+            name='progress_time',
+            field=models.DateTimeField(blank=True, default=None, null=True, verbose_name='进度更新时间'),
+        ),
+        migrations.AddField(
+            model_name='migratetask',
+            name='abort_requested',
+            field=models.BooleanField(default=False, verbose_name='请求取消迁移'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.9 on 2026-10-18 20:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('compute', '0013_hosttelemetry'),
+        ('vms', '0026_migratetask_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostEvacuation',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False, verbose_name='任务ID')),
+                ('host_ipv4', models.GenericIPAddressField(verbose_name='宿主机IP')),
+                ('status', models.CharField(choices=[('running', '正在疏散'), ('complete', '全部迁移成功'), ('partial', '部分迁移失败'), ('failed', '全部迁移失败')], default='running', max_length=16, verbose_name='状态')),
+                ('total', models.IntegerField(verbose_name='虚拟机数量')),
+                ('src_parallel', models.IntegerField(help_text='从此宿主机同时迁出的虚拟机数', verbose_name='同时迁移数')),
+                ('dst_parallel', models.IntegerField(help_text='每个目标宿主机同时迁入的虚拟机数', verbose_name='目标宿主机同时迁入数')),
+                ('options', models.JSONField(blank=True, default=dict, verbose_name='动态迁移参数')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('complete_time', models.DateTimeField(blank=True, default=None, null=True, verbose_name='完成时间')),
+                ('host', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='compute.host', verbose_name='宿主机')),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='创建者')),
+            ],
+            options={
+                'verbose_name': '宿主机疏散任务',
+                'verbose_name_plural': '宿主机疏散任务',
+                'db_table': 'vm_host_evacuation',
+                'ordering': ['-create_time'],
+            },
+        ),
+        migrations.CreateModel(
+            name='HostEvacuationItem',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('vm_uuid', models.CharField(max_length=36, verbose_name='虚拟机UUID')),
+                ('tag', models.CharField(blank=True, choices=[('live', '动态迁移'), ('static', '静态迁移')], default='', help_text='运行中的虚拟机动态迁移，关机的静态迁移', max_length=16, verbose_name='迁移类型')),
+                ('status', models.CharField(choices=[('pending', '等待迁移'), ('migrating', '正在迁移'), ('complete', '迁移成功'), ('failed', '迁移失败')], default='pending', max_length=16, verbose_name='状态')),
+                ('error', models.CharField(blank=True, default='', max_length=255, verbose_name='错误信息')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('dst_host', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='compute.host')),
+                ('evacuation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='vms.hostevacuation')),
+                ('migrate_task', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='vms.migratetask')),
+            ],
+            options={
+                'verbose_name': '宿主机疏散任务项',
+                'verbose_name_plural': '宿主机疏散任务项',
+                'db_table': 'vm_host_evacuation_item',
+                'ordering': ['id'],
+            },
+        ),
+    ]
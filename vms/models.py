@@ -747,6 +747,12 @@ class MigrateTask(models.Model):
     content = models.TextField(null=True, blank=True, default='', verbose_name=_('文字记录'))
     tag = models.CharField(max_length=16, choices=Tag.choices, default=Tag.MIGRATE_STATIC,
                            verbose_name=_('迁移类型'))
+    options = models.JSONField(default=dict, blank=True, verbose_name=_('迁移参数'),
+                               help_text=_('动态迁移参数，自动收敛、post-copy、压缩、并行连接数、带宽、最大停机时间等'))
+    progress = models.JSONField(default=dict, blank=True, verbose_name=_('迁移进度'),
+                                help_text=_('最近一次采样的迁移作业统计信息，剩余数据量、脏页速率、迭代次数、预计停机时间等'))
+    progress_time = models.DateTimeField(null=True, blank=True, default=None, verbose_name=_('进度更新时间'))
+    abort_requested = models.BooleanField(default=False, verbose_name=_('请求取消迁移'))
 
     class Meta:
         ordering = ['-id']
@@ -897,3 +903,218 @@ class VmSharedUser(models.Model):
 
     def __str__(self):
         return f'{self.user.username}[{self.get_permission_display()}]'
+
+
+class VmDomainState(models.Model):
+    """
+    虚拟机运行状态缓存，由虚拟机生命周期事件采集服务(manage.py domain_state_collector)维护
+    """
+    vm_uuid = models.CharField(verbose_name=_('虚拟机UUID'), max_length=36, primary_key=True)
+    host_ipv4 = models.GenericIPAddressField(verbose_name=_('宿主机IP'), db_index=True)
+    state = models.SmallIntegerField(verbose_name=_('运行状态码'))
+    update_time = models.DateTimeField(verbose_name=_('更新时间'))
+
+    class Meta:
+        db_table = 'vm_domain_state'
+        verbose_name = _('虚拟机运行状态缓存')
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f'{self.vm_uuid}[{self.state}]'
+
+
+class VmMetricRing(models.Model):
+    """
+    虚拟机监控指标环形存储，每个虚拟机每种采样间隔一行，所有采样点按列打包在data中
+    """
+    id = models.BigAutoField(primary_key=True)
+    vm_uuid = models.CharField(verbose_name=_('虚拟机UUID'), max_length=36, db_index=True)
+    step = models.IntegerField(verbose_name=_('采样间隔(秒)'))
+    data = models.BinaryField(verbose_name=_('打包的采样数据'))
+    update_time = models.DateTimeField(verbose_name=_('更新时间'))
+
+    class Meta:
+        db_table = 'vm_metric_ring'
+        verbose_name = _('虚拟机监控指标')
+        verbose_name_plural = verbose_name
+        constraints = [
+            models.UniqueConstraint(fields=('vm_uuid', 'step'), name='unique_vm_metric_ring_step')
+        ]
+
+
+class VmBatchJob(models.Model):
+    """
+    批量创建虚拟机任务
+    """
+    class Status(models.TextChoices):
+        RUNNING = 'running', _('正在创建')
+        COMPLETE = 'complete', _('全部成功')
+        PARTIAL = 'partial', _('部分失败')
+        FAILED = 'failed', _('全部失败')
+
+    id = models.CharField(verbose_name=_('任务ID'), max_length=32, primary_key=True)
+    user = models.ForeignKey(to=User, verbose_name=_('创建者'), on_delete=models.SET_NULL, null=True,
+                             related_name='+', db_constraint=False)
+    status = models.CharField(verbose_name=_('状态'), max_length=16, choices=Status.choices, default=Status.RUNNING)
+    total = models.IntegerField(verbose_name=_('虚拟机数量'))
+    image_id = models.IntegerField(verbose_name=_('镜像ID'))
+    vcpu = models.IntegerField(verbose_name=_('CPU数'))
+    mem = models.IntegerField(verbose_name=_('内存大小'), help_text=_('单位GB'))
+    remarks = models.CharField(verbose_name=_('备注'), max_length=255, default='', blank=True)
+    create_time = models.DateTimeField(verbose_name=_('创建时间'), auto_now_add=True)
+    complete_time = models.DateTimeField(verbose_name=_('完成时间'), null=True, blank=True, default=None)
+
+    class Meta:
+        db_table = 'vm_batch_job'
+        ordering = ['-create_time']
+        verbose_name = _('批量创建虚拟机任务')
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f'{self.id}[{self.status}]'
+
+
+class VmBatchJobItem(models.Model):
+    """
+    批量创建虚拟机任务中的一个虚拟机
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending', _('等待创建')
+        CLONING = 'cloning', _('正在创建系统盘')
+        DEFINING = 'defining', _('正在定义虚拟机')
+        COMPLETE = 'complete', _('创建成功')
+        FAILED = 'failed', _('创建失败')
+
+    id = models.BigAutoField(primary_key=True)
+    job = models.ForeignKey(to=VmBatchJob, on_delete=models.CASCADE, related_name='items')
+    index = models.IntegerField(verbose_name=_('序号'))
+    vm_uuid = models.CharField(verbose_name=_('虚拟机UUID'), max_length=36)
+    host = models.ForeignKey(to=Host, on_delete=models.SET_NULL, null=True, db_constraint=False, related_name='+')
+    mac_ip = models.ForeignKey(to=MacIP, on_delete=models.SET_NULL, null=True, db_constraint=False, related_name='+')
+    status = models.CharField(verbose_name=_('状态'), max_length=16, choices=Status.choices, default=Status.PENDING)
+    error = models.CharField(verbose_name=_('错误信息'), max_length=255, default='', blank=True)
+    update_time = models.DateTimeField(verbose_name=_('更新时间'), auto_now=True)
+
+    class Meta:
+        db_table = 'vm_batch_job_item'
+        ordering = ['index']
+        verbose_name = _('批量创建虚拟机任务项')
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f'{self.vm_uuid}[{self.status}]'
+
+
+class Job(models.Model):
+    """
+    后台任务队列，由任务执行服务(manage.py run_workers)领取执行
+
+    执行中的任务有租约，执行服务定期续约(心跳)；租约过期(执行服务退出或任务超时)的任务由执行服务回收，重试或标记失败
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending', _('等待执行')
+        RUNNING = 'running', _('正在执行')
+        SUCCEEDED = 'succeeded', _('执行成功')
+        FAILED = 'failed', _('执行失败')
+
+    id = models.BigAutoField(primary_key=True)
+    job_type = models.CharField(verbose_name=_('任务类型'), max_length=32)
+    params = models.JSONField(verbose_name=_('任务参数'), default=dict)
+    ref_id = models.CharField(verbose_name=_('关联对象ID'), max_length=64, blank=True, default='',
+                              help_text=_('如迁移任务id、批量创建任务id'))
+    host_ipv4 = models.GenericIPAddressField(verbose_name=_('宿主机IP'), null=True, blank=True, default=None,
+                                             help_text=_('任务占用的宿主机，用于限制每个宿主机同时执行的任务数'))
+    status = models.CharField(verbose_name=_('状态'), max_length=16, choices=Status.choices, default=Status.PENDING)
+    attempts = models.IntegerField(verbose_name=_('已执行次数'), default=0)
+    max_attempts = models.IntegerField(verbose_name=_('最多执行次数'), default=1)
+    timeout = models.IntegerField(verbose_name=_('超时时间(秒)'), default=3600)
+    run_after = models.DateTimeField(verbose_name=_('可执行时间'), default=timezone.now)
+    lease_owner = models.CharField(verbose_name=_('执行者'), max_length=128, blank=True, default='')
+    lease_expires = models.DateTimeField(verbose_name=_('租约到期时间'), null=True, blank=True, default=None)
+    heartbeat_time = models.DateTimeField(verbose_name=_('心跳时间'), null=True, blank=True, default=None)
+    result = models.JSONField(verbose_name=_('执行结果'), null=True, blank=True, default=None)
+    error = models.TextField(verbose_name=_('错误信息'), blank=True, default='')
+    create_time = models.DateTimeField(verbose_name=_('创建时间'), auto_now_add=True)
+    start_time = models.DateTimeField(verbose_name=_('开始时间'), null=True, blank=True, default=None)
+    finish_time = models.DateTimeField(verbose_name=_('完成时间'), null=True, blank=True, default=None)
+
+    class Meta:
+        db_table = 'vm_job'
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='vm_job_status_run_after_idx'),
+            models.Index(fields=['job_type', 'ref_id'], name='vm_job_type_ref_idx'),
+        ]
+        verbose_name = _('后台任务')
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f'{self.job_type}({self.id})[{self.status}]'
+
+
+class HostEvacuation(models.Model):
+    """
+    宿主机疏散任务，把宿主机上的虚拟机全部迁移到同宿主机组的其他宿主机
+    """
+    class Status(models.TextChoices):
+        RUNNING = 'running', _('正在疏散')
+        COMPLETE = 'complete', _('全部迁移成功')
+        PARTIAL = 'partial', _('部分迁移失败')
+        FAILED = 'failed', _('全部迁移失败')
+
+    id = models.CharField(verbose_name=_('任务ID'), max_length=32, primary_key=True)
+    host = models.ForeignKey(to=Host, verbose_name=_('宿主机'), on_delete=models.SET_NULL, null=True,
+                             db_constraint=False, related_name='+')
+    host_ipv4 = models.GenericIPAddressField(verbose_name=_('宿主机IP'))
+    user = models.ForeignKey(to=User, verbose_name=_('创建者'), on_delete=models.SET_NULL, null=True,
+                             related_name='+', db_constraint=False)
+    status = models.CharField(verbose_name=_('状态'), max_length=16, choices=Status.choices, default=Status.RUNNING)
+    total = models.IntegerField(verbose_name=_('虚拟机数量'))
+    src_parallel = models.IntegerField(verbose_name=_('同时迁移数'), help_text=_('从此宿主机同时迁出的虚拟机数'))
+    dst_parallel = models.IntegerField(verbose_name=_('目标宿主机同时迁入数'),
+                                       help_text=_('每个目标宿主机同时迁入的虚拟机数'))
+    options = models.JSONField(verbose_name=_('动态迁移参数'), default=dict, blank=True)
+    create_time = models.DateTimeField(verbose_name=_('创建时间'), auto_now_add=True)
+    complete_time = models.DateTimeField(verbose_name=_('完成时间'), null=True, blank=True, default=None)
+
+    class Meta:
+        db_table = 'vm_host_evacuation'
+        ordering = ['-create_time']
+        verbose_name = _('宿主机疏散任务')
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f'{self.host_ipv4}({self.id})[{self.status}]'
+
+
+class HostEvacuationItem(models.Model):
+    """
+    宿主机疏散任务中的一个虚拟机
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending', _('等待迁移')
+        MIGRATING = 'migrating', _('正在迁移')
+        COMPLETE = 'complete', _('迁移成功')
+        FAILED = 'failed', _('迁移失败')
+
+    id = models.BigAutoField(primary_key=True)
+    evacuation = models.ForeignKey(to=HostEvacuation, on_delete=models.CASCADE, related_name='items')
+    vm_uuid = models.CharField(verbose_name=_('虚拟机UUID'), max_length=36)
+    tag = models.CharField(verbose_name=_('迁移类型'), max_length=16, choices=MigrateTask.Tag.choices,
+                           blank=True, default='', help_text=_('运行中的虚拟机动态迁移，关机的静态迁移'))
+    dst_host = models.ForeignKey(to=Host, on_delete=models.SET_NULL, null=True, db_constraint=False,
+                                 related_name='+')
+    migrate_task = models.ForeignKey(to=MigrateTask, on_delete=models.SET_NULL, null=True, db_constraint=False,
+                                     related_name='+')
+    status = models.CharField(verbose_name=_('状态'), max_length=16, choices=Status.choices, default=Status.PENDING)
+    error = models.CharField(verbose_name=_('错误信息'), max_length=255, default='', blank=True)
+    update_time = models.DateTimeField(verbose_name=_('更新时间'), auto_now=True)
+
+    class Meta:
+        db_table = 'vm_host_evacuation_item'
+        ordering = ['id']
+        verbose_name = _('宿主机疏散任务项')
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f'{self.vm_uuid}[{self.status}]'
@@ -0,0 +1,462 @@
+"""
+宿主机组负载均衡
+
+按宿主机组读取每个宿主机的内存分配率(mem_allocated / mem_total)和资源快照(HostTelemetry)中的实际内存使用率，
+宿主机负载 = (1 - util_weight) * 分配率 + util_weight * 实际使用率，没有有效快照时只用分配率；
+贪心求解有限次迁移的均衡问题：每次在所有(虚拟机, 目标宿主机)中选择使组内负载标准差下降最多的一次迁移，
+直到达到每次运行的迁移数上限、每个宿主机的迁入迁出数上限，或者下降量小于min_improvement；
+只有运行状态缓存(VmDomainState)中正在运行的虚拟机参与均衡；
+调度策略为用户反亲和(anti_affinity)的宿主机组，不迁移到已有同一用户虚拟机的宿主机；
+结果为迁移计划，可只输出(dry run)，或者通过动态迁移(VmMigrateManager.live_migrate_vm)提交后台任务执行
+"""
+import logging
+import math
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from compute.models import Group, Host
+from compute.placement import get_group_placement_strategy
+from compute.telemetry import HostTelemetryManager
+from utils import errors
+from utils.ev_libvirt.virt import VIR_DOMAIN_RUNNING
+from .models import Vm, MigrateTask
+from .manager import VmDomainStateManager
+from .migrate import VmMigrateManager
+
+
+REBALANCE_MAX_MOVES = getattr(settings, 'REBALANCE_MAX_MOVES', 10)
+REBALANCE_MAX_MOVES_PER_HOST = getattr(settings, 'REBALANCE_MAX_MOVES_PER_HOST', 2)
+REBALANCE_UTIL_WEIGHT = getattr(settings, 'REBALANCE_UTIL_WEIGHT', 0.5)
+REBALANCE_MIN_IMPROVEMENT = getattr(settings, 'REBALANCE_MIN_IMPROVEMENT', 0.001)
+
+
+@dataclass
+class RebalanceHost:
+    id: int
+    ipv4: str
+    vcpu_total: int
+    vcpu_allocated: int
+    mem_total: int                      # GiB
+    mem_allocated: int                  # GiB
+    vm_limit: int
+    vm_created: int
+    real_mem_total: int = 0             # KiB，资源快照，0表示没有有效快照
+    real_mem_used: int = 0              # KiB
+    user_vms: Counter = field(default_factory=Counter)  # {user_id: 虚拟机数}，所有虚拟机(包括不能迁移的)
+
+    def alloc_ratio(self):
+        return self.mem_allocated / self.mem_total if self.mem_total > 0 else 1.0
+
+    def real_ratio(self):
+        if self.real_mem_total <= 0:
+            return self.alloc_ratio()
+
+        return self.real_mem_used / self.real_mem_total
+
+    def load(self, util_weight: float):
+        return (1 - util_weight) * self.alloc_ratio() + util_weight * self.real_ratio()
+
+    def vm_real_mem(self, vm: 'RebalanceVm'):
+        """
+        估算虚拟机的实际内存使用(KiB)，按分配内存占比分摊宿主机的实际内存使用
+        """
+        if self.real_mem_total <= 0 or self.mem_allocated <= 0:
+            return vm.mem * 1024 * 1024
+
+        return self.real_mem_used * vm.mem / self.mem_allocated
+
+    def can_hold(self, vm: 'RebalanceVm'):
+        return (self.vcpu_total - self.vcpu_allocated >= vm.vcpu and self.mem_total - self.mem_allocated >= vm.mem
+                and self.vm_created < self.vm_limit)
+
+
+@dataclass
+class RebalanceVm:
+    uuid: str
+    host_id: int
+    vcpu: int
+    mem: int                            # GiB
+    user_id: int = None
+
+
+@dataclass
+class RebalancePlan:
+    group_id: int = None
+    moves: list = field(default_factory=list)   # [{'vm_uuid', 'src_host_id', 'src_host_ipv4', 'dst_host_id', ...}]
+    imbalance_before: dict = field(default_factory=dict)
+    imbalance_after: dict = field(default_factory=dict)
+
+    def to_dict(self):
+        return {
+            'group_id': self.group_id,
+            'imbalance_before': self.imbalance_before,
+            'imbalance_after': self.imbalance_after,
+            'moves': self.moves
+        }
+
+
+def imbalance(loads: list):
+    """
+    负载不均衡度
+
+    :param loads: 每个宿主机的负载，0-1
+    :return:
+        {'stddev': 0.1, 'spread': 0.3, 'max': 0.9, 'min': 0.6, 'mean': 0.75}
+    """
+    if not loads:
+        return {'stddev': 0.0, 'spread': 0.0, 'max': 0.0, 'min': 0.0, 'mean': 0.0}
+
+    mean = sum(loads) / len(loads)
+    return {
+        'stddev': math.sqrt(sum((x - mean) ** 2 for x in loads) / len(loads)),
+        'spread': max(loads) - min(loads),
+        'max': max(loads),
+        'min': min(loads),
+        'mean': mean
+    }
+
+
+def plan_moves(hosts: list, vms: list, max_moves: int = REBALANCE_MAX_MOVES,
+               max_moves_per_host: int = REBALANCE_MAX_MOVES_PER_HOST, util_weight: float = REBALANCE_UTIL_WEIGHT,
+               min_improvement: float = REBALANCE_MIN_IMPROVEMENT, anti_affinity: bool = False):
+    """
+    贪心求解有限次迁移的负载均衡，每个虚拟机最多迁移1次；不修改数据库，会修改传入的hosts和vms
+
+    :param hosts: [RebalanceHost()]
+    :param vms: [RebalanceVm()]，可迁移的虚拟机
+    :param max_moves: 迁移数上限
+    :param max_moves_per_host: 每个宿主机迁入和迁出的虚拟机总数上限
+    :param util_weight: 实际内存使用率的权重，0-1
+    :param min_improvement: 每次迁移负载标准差的最小下降量
+    :param anti_affinity: True时不迁移到已有同一用户虚拟机的宿主机(RebalanceHost.user_vms)
+    :return:
+        RebalancePlan()
+    """
+    host_map = {h.id: h for h in hosts}
+    vms = [vm for vm in vms if vm.host_id in host_map]
+    loads = {h.id: h.load(util_weight) for h in hosts}
+    plan = RebalancePlan(imbalance_before=imbalance(list(loads.values())))
+    host_moves = Counter()
+    moved = set()
+    n = len(hosts)
+    while len(plan.moves) < max_moves and n > 1:
+        total = sum(loads.values())
+        square_sum = sum(x ** 2 for x in loads.values())
+        stddev = math.sqrt(max(square_sum / n - (total / n) ** 2, 0))
+        best = None
+        for vm in vms:
+            src = host_map[vm.host_id]
+            if vm.uuid in moved or host_moves[src.id] >= max_moves_per_host:
+                continue
+
+            real_mem = src.vm_real_mem(vm)
+            src_load = _load_after(src, vm, real_mem=real_mem, util_weight=util_weight, sign=-1)
+            for dst in hosts:
+                if dst.id == src.id or host_moves[dst.id] >= max_moves_per_host or loads[dst.id] >= loads[src.id]:
+                    continue
+                if not dst.can_hold(vm):
+                    continue
+                if anti_affinity and vm.user_id is not None and dst.user_vms[vm.user_id] > 0:
+                    continue
+
+                dst_load = _load_after(dst, vm, real_mem=real_mem, util_weight=util_weight, sign=1)
+                new_total = total - loads[src.id] - loads[dst.id] + src_load + dst_load
+                new_square_sum = square_sum - loads[src.id] ** 2 - loads[dst.id] ** 2 + src_load ** 2 + dst_load ** 2
+                new_stddev = math.sqrt(max(new_square_sum / n - (new_total / n) ** 2, 0))
+                gain = stddev - new_stddev
+                if best is None or gain > best[0]:
+                    best = (gain, vm, dst, real_mem, src_load, dst_load)
+
+        if best is None or best[0] < min_improvement:
+            break
+
+        gain, vm, dst, real_mem, src_load, dst_load = best
+        src = host_map[vm.host_id]
+        plan.moves.append({
+            'vm_uuid': vm.uuid, 'vcpu': vm.vcpu, 'mem': vm.mem,
+            'src_host_id': src.id, 'src_host_ipv4': src.ipv4, 'src_load': round(loads[src.id], 4),
+            'dst_host_id': dst.id, 'dst_host_ipv4': dst.ipv4, 'dst_load': round(loads[dst.id], 4),
+        })
+        _move(src, dst, vm, real_mem=real_mem)
+        loads[src.id], loads[dst.id] = src_load, dst_load
+        host_moves[src.id] += 1
+        host_moves[dst.id] += 1
+        moved.add(vm.uuid)
+
+    plan.imbalance_after = imbalance(list(loads.values()))
+    return plan
+
+
+def _load_after(host: RebalanceHost, vm: RebalanceVm, real_mem: float, util_weight: float, sign: int):
+    """
+    虚拟机迁入(sign=1)或迁出(sign=-1)后宿主机的负载
+    """
+    mem_allocated = host.mem_allocated + sign * vm.mem
+    alloc = mem_allocated / host.mem_total if host.mem_total > 0 else 1.0
+    if host.real_mem_total > 0:
+        real = (host.real_mem_used + sign * real_mem) / host.real_mem_total
+    else:
+        real = alloc
+
+    return (1 - util_weight) * alloc + util_weight * real
+
+
+def _move(src: RebalanceHost, dst: RebalanceHost, vm: RebalanceVm, real_mem: float):
+    for host, sign in ((src, -1), (dst, 1)):
+        host.vcpu_allocated += sign * vm.vcpu
+        host.mem_allocated += sign * vm.mem
+        host.vm_created += sign
+        if host.real_mem_total > 0:
+            host.real_mem_used += sign * real_mem
+        if vm.user_id is not None:
+            host.user_vms[vm.user_id] += sign
+
+    vm.host_id = dst.id
+
+
+class HostRebalancer:
+    """
+    宿主机组负载均衡
+    """
+    def __init__(self, max_moves: int = REBALANCE_MAX_MOVES, max_moves_per_host: int = REBALANCE_MAX_MOVES_PER_HOST,
+                 util_weight: float = REBALANCE_UTIL_WEIGHT, min_improvement: float = REBALANCE_MIN_IMPROVEMENT,
+                 logger=None):
+        self.max_moves = max_moves
+        self.max_moves_per_host = max_moves_per_host
+        self.util_weight = util_weight
+        self.min_improvement = min_improvement
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+    @staticmethod
+    def load_group(group: Group):
+        """
+        读取宿主机组内启用的宿主机、资源快照、每个用户的虚拟机数和可动态迁移的虚拟机(正在运行)
+
+        :return:
+            (
+                [RebalanceHost()],
+                [RebalanceVm()]
+            )
+        """
+        hosts = list(Host.objects.filter(group_id=group.id, enable=True).order_by('id'))
+        snapshots = HostTelemetryManager.get_snapshots(ipv4s=[h.ipv4 for h in hosts])
+        r_hosts = []
+        for h in hosts:
+            r_host = RebalanceHost(
+                id=h.id, ipv4=h.ipv4, vcpu_total=h.vcpu_total, vcpu_allocated=h.vcpu_allocated,
+                mem_total=h.mem_total, mem_allocated=h.mem_allocated, vm_limit=h.vm_limit, vm_created=h.vm_created)
+            snapshot = snapshots.get(h.ipv4)
+            if snapshot is not None and snapshot.mem_total > 0:
+                r_host.real_mem_total = snapshot.mem_total
+                r_host.real_mem_used = max(
+                    snapshot.mem_total - snapshot.mem_free - snapshot.mem_cached - snapshot.mem_buffers, 0)
+
+            r_hosts.append(r_host)
+
+        host_map = {h.id: h for h in r_hosts}
+        for host_id, user_id in Vm.objects.filter(host__in=hosts).values_list('host_id', 'user_id'):
+            host_map[host_id].user_vms[user_id] += 1
+
+        # 本地硬盘的虚拟机不能迁移；有未结束迁移任务的虚拟机不参与；
+        # 关机的虚拟机不能动态迁移，运行状态缓存中没有或已过期(状态未知)的也不参与
+        migrating = MigrateTask.objects.filter(
+            status__in=[MigrateTask.Status.WAITING, MigrateTask.Status.IN_PROCESS]).values_list('vm_uuid', flat=True)
+        vms = list(Vm.objects.select_related('host').filter(host__in=hosts).exclude(
+            disk_type=Vm.DiskType.LOCAL).exclude(uuid__in=migrating).only(
+            'uuid', 'vcpu', 'mem', 'user_id', 'host__ipv4'))
+        states = VmDomainStateManager.get_vms_status(vms=vms)
+        r_vms = [
+            RebalanceVm(uuid=vm.uuid, host_id=vm.host_id, vcpu=vm.vcpu, mem=vm.mem, user_id=vm.user_id) for vm in vms
+            if states.get(vm.hex_uuid, (None,))[0] == VIR_DOMAIN_RUNNING
+        ]
+        return r_hosts, r_vms
+
+    @staticmethod
+    def is_migrating(group: Group):
+        """
+        宿主机组是否有未结束的迁移任务，上次均衡的迁移完成前不再均衡
+        """
+        return MigrateTask.objects.filter(
+            src_host__group_id=group.id, status__in=[MigrateTask.Status.WAITING, MigrateTask.Status.IN_PROCESS]
+        ).exists()
+
+    def plan(self, group: Group):
+        """
+        生成宿主机组的迁移计划，遵循宿主机组的用户反亲和调度策略
+
+        :return:
+            RebalancePlan()
+        """
+        hosts, vms = self.load_group(group)
+        anti_affinity = get_group_placement_strategy(group).name == Group.PlacementStrategy.ANTI_AFFINITY.value
+        plan = plan_moves(hosts=hosts, vms=vms, max_moves=self.max_moves, max_moves_per_host=self.max_moves_per_host,
+                          util_weight=self.util_weight, min_improvement=self.min_improvement,
+                          anti_affinity=anti_affinity)
+        plan.group_id = group.id
+        return plan
+
+    def execute(self, plan: RebalancePlan, options: dict = None):
+        """
+        按迁移计划逐个提交动态迁移后台任务，不等待迁移完成；提交失败的跳过，结果写入每个迁移项
+
+        :param plan: 迁移计划
+        :param options: 动态迁移参数
+        :return:
+            (
+                int,    # 提交成功数
+                int     # 提交失败数
+            )
+        """
+        ok = failed = 0
+        for move in plan.moves:
+            vm = Vm.objects.select_related('host', 'host__group', 'user').filter(uuid=move['vm_uuid']).first()
+            try:
+                if vm is None:
+                    raise errors.VmError(msg='虚拟机不存在')
+                if vm.host_id != move['src_host_id']:
+                    raise errors.VmError(msg='虚拟机已不在计划的源宿主机上')
+
+                m_task = VmMigrateManager().live_migrate_vm(vm=vm, dest_host_id=move['dst_host_id'], options=options)
+            except errors.Error as e:
+                failed += 1
+                move['error'] = str(e)
+                self.logger.warning(f'rebalance migrate vm({move["vm_uuid"]}) to host({move["dst_host_ipv4"]}) '
+                                    f'failed, {str(e)}')
+                continue
+
+            ok += 1
+            move['migrate_task_id'] = m_task.id
+            self.logger.info(f'rebalance migrate vm({move["vm_uuid"]}) from host({move["src_host_ipv4"]}) '
+                             f'to host({move["dst_host_ipv4"]}), task={m_task.id}')
+
+        return ok, failed
+
+    def run_once(self, group_ids: list = None, execute: bool = False, options: dict = None):
+        """
+        均衡指定的或全部宿主机组
+
+        :param group_ids: 宿主机组id列表，None表示全部
+        :param execute: True(执行迁移)，False(只生成计划)
+        :param options: 动态迁移参数
+        :return:
+            [RebalancePlan()]
+        """
+        groups = Group.objects.order_by('id')
+        if group_ids:
+            groups = groups.filter(id__in=group_ids)
+
+        plans = []
+        for group in groups:
+            if execute and self.is_migrating(group):
+                self.logger.info(f'group({group.id}) has unfinished migrate tasks, skip')
+                continue
+
+            plan = self.plan(group)
+            before, after = plan.imbalance_before['stddev'], plan.imbalance_after['stddev']
+            self.logger.info(f'group({group.id}) moves={len(plan.moves)}, stddev {before:.4f} -> {after:.4f}')
+            if execute and plan.moves:
+                self.execute(plan, options=options)
+
+            plans.append(plan)
+
+        return plans
+
+    def run_forever(self, interval: int, group_ids: list = None, execute: bool = False, options: dict = None):
+        while True:
+            close_old_connections()
+            try:
+                self.run_once(group_ids=group_ids, execute=execute, options=options)
+            except Exception as e:
+                self.logger.error(f'rebalance error, {str(e)}')
+
+            time.sleep(interval)
+
+
+class RebalanceSimulator:
+    """
+    合成集群上的负载均衡模拟，按创建/删除虚拟机事件序列随机调度(同HostMacIPScheduler)后均衡，不访问数据库
+    """
+    def __init__(self, hosts: int = 20, host_vcpu: int = 64, host_mem: int = 256, vm_limit: int = 64):
+        self.hosts = hosts
+        self.host_vcpu = host_vcpu
+        self.host_mem = host_mem
+        self.vm_limit = vm_limit
+
+    def build_cluster(self, trace: list, util_noise: float = 0.2, seed: int = 0):
+        """
+        回放事件序列，每个虚拟机随机放置到资源足够的宿主机；每个宿主机的实际内存使用率在分配率上下随机浮动util_noise
+
+        :param trace: 事件序列，格式同compute.placement_sim.generate_trace()
+        :param util_noise: 实际内存使用率相对分配率的浮动比例
+        :param seed: 随机数种子
+        :return:
+            (
+                [RebalanceHost()],
+                [RebalanceVm()]
+            )
+        """
+        rand = random.Random(seed)
+        hosts = [RebalanceHost(id=i + 1, ipv4=f'198.18.{i // 250}.{i % 250 + 1}', vcpu_total=self.host_vcpu,
+                               vcpu_allocated=0, mem_total=self.host_mem, mem_allocated=0, vm_limit=self.vm_limit,
+                               vm_created=0) for i in range(self.hosts)]
+        vms = {}
+        for event in trace:
+            if event['op'] == 'create':
+                vm = RebalanceVm(uuid=event['id'], host_id=0, vcpu=event['vcpu'], mem=event['mem'])
+                candidates = [h for h in hosts if h.can_hold(vm)]
+                if not candidates:
+                    continue
+
+                host = rand.choice(candidates)
+                vm.host_id = host.id
+                vms[vm.uuid] = vm
+                sign = 1
+            elif event['op'] == 'delete':
+                vm = vms.pop(event['id'], None)
+                if vm is None:
+                    continue
+
+                host = hosts[vm.host_id - 1]
+                sign = -1
+            else:
+                continue
+
+            host.vcpu_allocated += sign * vm.vcpu
+            host.mem_allocated += sign * vm.mem
+            host.vm_created += sign
+
+        for host in hosts:
+            host.real_mem_total = host.mem_total * 1024 * 1024
+            ratio = host.alloc_ratio() * (1 + rand.uniform(-util_noise, util_noise))
+            host.real_mem_used = int(host.real_mem_total * min(max(ratio, 0.0), 1.0))
+
+        return hosts, list(vms.values())
+
+    def run(self, trace: list, util_noise: float = 0.2, seed: int = 0, max_moves: int = REBALANCE_MAX_MOVES,
+            max_moves_per_host: int = REBALANCE_MAX_MOVES_PER_HOST, util_weight: float = REBALANCE_UTIL_WEIGHT,
+            min_improvement: float = REBALANCE_MIN_IMPROVEMENT):
+        """
+        :return:
+            {
+                'vms': 300, 'moves': 10,
+                'before': {'stddev': 0.1, 'spread': 0.3, ...}, 'after': {...},  # 负载
+                'alloc_before': {...}, 'alloc_after': {...}                     # 只按内存分配率计算
+            }
+        """
+        hosts, vms = self.build_cluster(trace=trace, util_noise=util_noise, seed=seed)
+        alloc_before = imbalance([h.alloc_ratio() for h in hosts])
+        plan = plan_moves(hosts=hosts, vms=vms, max_moves=max_moves, max_moves_per_host=max_moves_per_host,
+                          util_weight=util_weight, min_improvement=min_improvement)
+        return {
+            'vms': len(vms),
+            'moves': len(plan.moves),
+            'before': plan.imbalance_before,
+            'after': plan.imbalance_after,
+            'alloc_before': alloc_before,
+            'alloc_after': imbalance([h.alloc_ratio() for h in hosts]),
+        }
@@ -2,6 +2,8 @@ import random
 
 from network.managers import MacIPManager, VlanManager
 from compute.managers import GroupManager, HostManager, ComputeError
+from compute.models import Host
+from compute.placement import get_placement_strategy, PLACEMENT_CANDIDATES
 from utils import errors
 
 
@@ -10,7 +12,7 @@ class HostMacIPScheduler:
     创建虚拟机宿主机和MAC IP资源分配调度器
     """
     def schedule(self, vcpu: int, mem: int, groups: list = None, host=None, vlan=None,
-                 need_mac_ip=True, ip_public=None):
+                 need_mac_ip=True, ip_public=None, user=None):
         """
         申请满足要求的宿主机和mac_ip资源
 
@@ -24,6 +26,7 @@ class HostMacIPScheduler:
         :param vlan: 子网 Vlan(), 默认None不指定子网
         :param need_mac_ip: 是否需要申请MAC IP资源，True(申请)
         :param ip_public: 指定分配公网或私网ip；默认None（不指定），True(公网)，False(私网)
+        :param user: 虚拟机所有者，宿主机组使用反亲和调度策略时使用
         :return:
             (host, mac_ip)          # host不为None, mac_ip都可能为None
             raise ScheduleError     # 没有可用的宿主机
@@ -37,10 +40,10 @@ class HostMacIPScheduler:
             raise errors.ScheduleError.from_error(errors.NoHostGroupError(msg='无宿主机组资源可用'))
         elif len(groups) == 1:
             h, mac_ip = self.schedule_by_group_vlan(group=groups[0], vcpu=vcpu, mem=mem, vlan=vlan,
-                                                    need_mac_ip=need_mac_ip, ip_public=ip_public)
+                                                    need_mac_ip=need_mac_ip, ip_public=ip_public, user=user)
         else:
             h, mac_ip = self.schedule_by_group_list_vlan(groups=groups, vcpu=vcpu, mem=mem, vlan=vlan,
-                                                         need_mac_ip=need_mac_ip, ip_public=ip_public)
+                                                         need_mac_ip=need_mac_ip, ip_public=ip_public, user=user)
 
         self.host = h
         self.mac_ip = mac_ip
@@ -114,9 +117,10 @@ class HostMacIPScheduler:
 
         return mac_ip
 
-    def schedule_by_group_vlan(self, group, vcpu: int, mem: int, vlan=None, need_mac_ip=True, ip_public=None):
+    def schedule_by_group_vlan(self, group, vcpu: int, mem: int, vlan=None, need_mac_ip=True, ip_public=None,
+                               user=None):
         """
-        通过指定的宿主机组group和子网vlan进行宿主机和MAC IP的资源调度
+        通过指定的宿主机组group和子网vlan进行宿主机和MAC IP的资源调度，按宿主机组的调度策略选择宿主机
 
         :param group: 宿主机组 Group()
         :param vcpu: cpu核数
@@ -124,6 +128,7 @@ class HostMacIPScheduler:
         :param vlan: 子网 Vlan(), 默认None不指定子网
         :param need_mac_ip: 是否需要申请MAC IP资源，True(申请)
         :param ip_public: 指定分配公网或私网ip；默认None（不指定），True(公网)，False(私网)
+        :param user: 虚拟机所有者，反亲和调度策略使用
         :return:
             (host, mac_ip)  #
 
@@ -134,19 +139,18 @@ class HostMacIPScheduler:
                 msg=f'宿主机组和指定的子网vlan<{str(vlan)}>不在同一宿主机组内')
             raise errors.ScheduleError.from_error(exc)
 
-        host_list = self.get_host_list(group=group)
-        if not host_list:
-            raise errors.NoHostError(msg='没有足够资源的宿主机可用')
-
+        host_qs = self.get_host_queryset(group=group)
         if need_mac_ip:
             ok, vlan_list = self.has_free_mac_ip_in_group(group=group, ip_public=ip_public)
             if not ok:
                 raise errors.NoMacIPError(msg='没有mac ip可用')
 
-        return self.schedule_hosts_vlan(host_list=host_list, vcpu=vcpu, mem=mem, vlan=vlan,
-                                        need_mac_ip=need_mac_ip, ip_public=ip_public)
+        return self.schedule_hosts_vlan(host_list=host_qs, vcpu=vcpu, mem=mem, vlan=vlan,
+                                        need_mac_ip=need_mac_ip, ip_public=ip_public,
+                                        strategy=group.placement_strategy, user=user)
 
-    def schedule_by_group_list_vlan(self, groups, vcpu: int, mem: int, vlan=None, need_mac_ip=True, ip_public=None):
+    def schedule_by_group_list_vlan(self, groups, vcpu: int, mem: int, vlan=None, need_mac_ip=True, ip_public=None,
+                                    user=None):
         """
         通过指定的宿主机组group列表和子网vlan进行宿主机和MAC IP的资源调度
 
@@ -156,6 +160,7 @@ class HostMacIPScheduler:
         :param vlan: 子网 Vlan(), 默认None不指定子网
         :param need_mac_ip: 是否需要申请MAC IP资源，True(申请)
         :param ip_public: 指定分配公网或私网ip；默认None（不指定），True(公网)，False(私网)
+        :param user: 虚拟机所有者，反亲和调度策略使用
         :return:
             (host, mac_ip)  #
 
@@ -165,7 +170,7 @@ class HostMacIPScheduler:
         for group in groups:
             try:
                 return self.schedule_by_group_vlan(group=group, vcpu=vcpu, mem=mem, vlan=vlan, need_mac_ip=need_mac_ip,
-                                                   ip_public=ip_public)
+                                                   ip_public=ip_public, user=user)
             except errors.ScheduleError as e:
                 continue
 
@@ -179,72 +184,85 @@ class HostMacIPScheduler:
         raise errors.NoHostOrMacIPError(msg=msg)
 
     @staticmethod
-    def get_host_list(group):
+    def get_host_queryset(group):
         """
-        获取指定宿主机组的宿主机列表
+        获取指定宿主机组的可用宿主机查询集
 
         :param group: 宿主机组Group()，只获取此组的宿主机
         :return:
-            list                    # success
-            raise ScheduleError     # failed ,未找到宿主机或发生错误
+            QuerySet                # success
+            raise ScheduleError     # failed ,发生错误
 
         :raise ScheduleError
         """
         try:
-            host_list = list(GroupManager().get_enable_host_queryset_by_group(group_or_id=group))
+            return GroupManager().get_enable_host_queryset_by_group(group_or_id=group)
         except (ComputeError, Exception) as e:
-            raise errors.ScheduleError(msg=f'获取宿主机list错误，{str(e)}')
+            raise errors.ScheduleError(msg=f'获取宿主机查询集错误，{str(e)}')
 
-        return host_list
-
-    def schedule_hosts_vlan(self, host_list: list, vcpu: int, mem: int, vlan=None, need_mac_ip=True, ip_public=None):
+    def schedule_hosts_vlan(self, host_list, vcpu: int, mem: int, vlan=None, need_mac_ip=True, ip_public=None,
+                            strategy: str = None, user=None):
         """
         通过指定的宿主机list和子网vlan进行宿主机和MAC IP的资源调度
 
-        :param host_list: 宿主机实例列表
+        按调度策略在一个查询中筛选排序宿主机，依次向排名靠前的几个宿主机申请资源
+
+        :param host_list: 宿主机实例列表或查询集
         :param vcpu: cpu核数
         :param mem: 内存大小MB
         :param vlan: 子网 Vlan(), 默认None不指定子网
         :param need_mac_ip: 是否需要申请MAC IP资源，True(申请)
         :param ip_public: 指定分配公网或私网ip；默认None（不指定），True(公网)，False(私网)
+        :param strategy: 宿主机调度策略名称，默认None使用系统默认策略
+        :param user: 虚拟机所有者，反亲和调度策略使用
         :return:
             (host, mac_ip)  # mac_ip=None if need_mac_ip==False
 
         :raises: ScheduleError, NoHostError, NoMacIPError
         """
-        if not host_list:
-            raise errors.NoHostError(msg='没有足够资源的宿主机可用')
+        if isinstance(host_list, (list, tuple)):
+            if not host_list:
+                raise errors.NoHostError(msg='没有足够资源的宿主机可用')
 
-        host = None
-        mac_ip = None
-        random.shuffle(host_list)  # 打乱宿主机顺序
-        for h in host_list:
-            # 宿主机是否满足资源需求
-            if not h.meet_needs(vcpu=vcpu, mem=mem):
-                continue
+            host_list = Host.objects.filter(id__in=[h.id for h in host_list])
 
-            host = h
-            break
+        try:
+            candidates = get_placement_strategy(strategy).rank(
+                host_list, vcpu=vcpu, mem=mem, user=user, limit=PLACEMENT_CANDIDATES)
+        except ComputeError as e:
+            raise errors.ScheduleError.from_error(e)
 
-        if not host:
+        if not candidates:
             raise errors.NoHostError(msg='没有足够资源的宿主机可用')
 
+        mac_ip = None
         if need_mac_ip:
             if vlan:
                 vlan_list = [vlan]
             else:
-                vlan_list = self.get_vlan_list_by_group(group=host.group_id)
+                vlan_list = self.get_vlan_list_by_group(group=candidates[0].group_id)
 
             mac_ip = self.get_mac_ip(vlan_list=vlan_list, ip_public=ip_public)
 
-        try:
-            host = HostManager().claim_from_host(host_id=host.id, vcpu=vcpu, mem=mem)
-        except ComputeError as e:
-            if mac_ip:
-                MacIPManager().free_used_ip(ip_id=mac_ip.id)  # 释放已申请的mac ip资源
-            raise errors.ScheduleError.from_error(e)
+        host_manager = HostManager()
+        error = None
+        for h in candidates:
+            try:
+                host = host_manager.claim_from_host(host_id=h.id, vcpu=vcpu, mem=mem)
+            except ComputeError as e:   # 资源已被并发占用，尝试下一个宿主机
+                error = e
+                continue
+
+            if host:
+                return host, mac_ip
+
+        if mac_ip:
+            MacIPManager().free_used_ip(ip_id=mac_ip.id)  # 释放已申请的mac ip资源
+
+        if error is not None:
+            raise errors.ScheduleError.from_error(error)
 
-        return host, mac_ip
+        raise errors.NoHostError(msg='没有足够资源的宿主机可用')
 
     def has_free_mac_ip_in_group(self, group, ip_public=None):
         """
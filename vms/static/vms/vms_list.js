@@ -123,11 +123,36 @@
         });
     }
 
+    // 批量获取并设置虚拟机的运行状态
     function update_vms_status(vmids){
+        if (vmids.length === 0){
+            return;
+        }
         for(let i in vmids) {
-            let api = build_vm_status_api(vmids[i]);
-            get_vm_status(api, vmids[i]);
+            $("#vm_status_" + vmids[i]).html(`<i class="fa fa-spinner fa-pulse"></i>`);
         }
+        $.ajax({
+            url: build_vm_status_batch_api(),
+            type: 'post',
+            contentType: 'application/json',
+            data: JSON.stringify({'vm_uuids': vmids}),
+            success: function(data) {
+                for(let i in vmids) {
+                    let node_status = $("#vm_status_" + vmids[i]);
+                    let s = data.status[vmids[i]];
+                    if (s === undefined){
+                        node_status.html('<span class="badge  badge-danger">' + gettext("查询失败") + '</span>');
+                    }else{
+                        node_status.html('<span class="badge  badge-' + VM_STATUS_LABEL[s.status_code] + '">' + VM_STATUS_CN[s.status_code] + "</span>");
+                    }
+                }
+            },
+            error: function (xhr) {
+                for(let i in vmids) {
+                    $("#vm_status_" + vmids[i]).html('<span class="badge  badge-danger">' + gettext("查询失败") + '</span>');
+                }
+            }
+        });
     }
 
     // 刷新虚拟机状态点击事件
@@ -142,6 +167,12 @@
         return build_absolute_url(url);
     }
 
+    // 批量查询虚拟机运行状态api构建
+    function build_vm_status_batch_api(){
+        let url = 'api/v3/vms/status/batch/';
+        return build_absolute_url(url);
+    }
+
     // 虚拟机vnc api构建
     function build_vm_vnc_api(vm_uuid){
         let url = 'api/v3/vms/' + vm_uuid + '/vnc/';
@@ -22,6 +22,14 @@
             alert(gettext('请选择迁移的目标宿主机'));
             return;
         }
+        let options = {
+            'auto_converge': $('#id-auto-converge').prop('checked'),
+            'postcopy': $('#id-postcopy').prop('checked'),
+            'compression': obj_data['compression'] || '',
+        };
+        ['parallel', 'bandwidth', 'max_downtime', 'timeout'].forEach(function (name) {
+            options[name] = parseInt(obj_data[name]) || 0;
+        });
         let vm_uuid = $("#id-vm-uuid").text();
         let api = build_absolute_url('api/v3/vms/' + vm_uuid + '/live-migrate/' + host_id + '/');
         let msg = gettext("确定迁移虚拟机吗？");
@@ -38,6 +46,7 @@
             url: api,
             type: 'post',
             contentType: 'application/json',
+            data: JSON.stringify(options),
             success: function (data, status, xhr) {
                 if (xhr.status === 202){
                     $("#id-div-migrate-status").show();
@@ -45,6 +54,8 @@
                     display_icon();
                     $("#id-migrate-result").text(gettext('等待迁移'));
                     let task_id = data['migrate_task'];
+                    window.migrate_task_id = task_id;
+                    $("#btn-vm-migrate-abort").show();
                     window.migrate_status_timer_number = window.setInterval(function () {
                         get_vm_migrate_status(task_id, handle_vm_status_callback);
                     }, 2000);
@@ -84,6 +95,49 @@
 		});
     }
 
+    // 取消迁移按钮点击事件
+    $('#btn-vm-migrate-abort').click(function (e) {
+        e.preventDefault();
+        if(!window.migrate_task_id || !confirm(gettext("确定取消迁移吗？")))
+            return;
+
+        $.ajax({
+            url: build_absolute_url('api/v3/task/vm-migrate/' + window.migrate_task_id + '/abort/'),
+            type: 'post',
+            success: function (data) {
+                alert(data['code_text']);
+            },
+            error: function (xhr) {
+                let msg = gettext('取消迁移失败!');
+                try{
+                    msg = xhr.responseJSON.code_text;
+                }catch (e) {}
+                alert(msg);
+            }
+        });
+    });
+
+    function size_display(bytes){
+        return (bytes / 1024 / 1024).toFixed(1) + 'MiB';
+    }
+
+    // 迁移进度：剩余数据量、脏页速率、迭代次数、预计停机时间
+    function progress_display(progress){
+        if (!progress || !progress['active'])
+            return '';
+
+        let text = gettext('剩余') + ': ' + size_display(progress['data_remaining']) + '/' + size_display(progress['data_total']) +
+            ', ' + gettext('传输速率') + ': ' + size_display(progress['bandwidth']) + '/s' +
+            ', ' + gettext('脏页速率') + ': ' + size_display(progress['dirty_rate']) + '/s' +
+            ', ' + gettext('迭代次数') + ': ' + progress['iteration'] +
+            ', ' + gettext('预计停机时间') + ': ' + progress['downtime'] + 'ms';
+        if (progress['throttle'])
+            text += ', ' + gettext('CPU限制') + ': ' + progress['throttle'] + '%';
+        if (progress['postcopy'])
+            text += ', post-copy';
+        return text;
+    }
+
     function handle_vm_status_callback(data){
         let dom_result = $("#id-migrate-result");
         let status = data['status']
@@ -97,6 +151,9 @@
             text_class = 'text-info';
             status_display = gettext('正在迁移');
             display_icon();
+            $("#id-migrate-progress").text(progress_display(data['progress']));
+            if (data['progress'] && data['progress']['postcopy'])
+                $("#btn-vm-migrate-abort").hide();
         }else if (status === 'some-todo'){
             text_class = 'text-warning';
             status_display = gettext('迁移完成，有些需要手动善后的工作;') + data['content'];
@@ -125,6 +182,8 @@
     }
     function migrate_complete_do(){
         window.clearInterval(window.migrate_status_timer_number);
+        $("#btn-vm-migrate-abort").hide();
+        $("#id-migrate-progress").text('');
         let btn_submit = $("#btn-vm-live-migrate");
         btn_submit.removeClass('disabled');   //鼠标悬停时，使按钮表现为可点击状态
         btn_submit.attr('disabled', false); //激活对应按钮
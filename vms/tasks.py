@@ -1,13 +1,104 @@
-from concurrent.futures import ThreadPoolExecutor
+"""
+后台任务类型
 
+任务记录在数据库中，由任务执行服务(manage.py run_workers)领取执行，见jobs.py
+"""
+from django.conf import settings
 
-_pool_executor = ThreadPoolExecutor()
+from .jobs import JobManager, register_job, get_cancel_event
 
 
-def creat_migrate_vm_task(task, **kwargs):
-    try:
-        future = _pool_executor.submit(task, **kwargs)
-    except Exception as e:
-        return e
+LIVE_MIGRATE = 'live_migrate'
+VM_BATCH_CREATE = 'vm_batch_create'
+HOST_EVACUATE = 'host_evacuate'
 
-    return future
+JOB_LIVE_MIGRATE_TIMEOUT = getattr(settings, 'JOB_LIVE_MIGRATE_TIMEOUT', 6 * 3600)
+JOB_VM_BATCH_CREATE_TIMEOUT = getattr(settings, 'JOB_VM_BATCH_CREATE_TIMEOUT', 3600)
+JOB_HOST_EVACUATE_TIMEOUT = getattr(settings, 'JOB_HOST_EVACUATE_TIMEOUT', 24 * 3600)
+
+
+def submit_live_migrate(m_task):
+    """
+    提交动态迁移任务，每个源宿主机同时执行的迁移数受限
+
+    :param m_task: MigrateTask()
+    :return:
+        Job()
+
+    :raise: Error
+    """
+    return JobManager.submit(job_type=LIVE_MIGRATE, params={'m_task_id': m_task.id}, ref_id=m_task.id,
+                             host_ipv4=m_task.src_host_ipv4)
+
+
+def submit_vm_batch_create(job_id: str, image_size: int, sys_disk_size: int, owner_id: int):
+    """
+    提交批量创建虚拟机任务
+
+    :return:
+        Job()
+
+    :raise: Error
+    """
+    return JobManager.submit(job_type=VM_BATCH_CREATE, ref_id=job_id, params={
+        'job_id': job_id, 'image_size': image_size, 'sys_disk_size': sys_disk_size, 'owner_id': owner_id})
+
+
+def submit_host_evacuate(evacuation):
+    """
+    提交宿主机疏散任务，每个宿主机同时只执行一个
+
+    :param evacuation: HostEvacuation()
+    :return:
+        Job()
+
+    :raise: Error
+    """
+    return JobManager.submit(job_type=HOST_EVACUATE, params={'evacuation_id': evacuation.id}, ref_id=evacuation.id,
+                             host_ipv4=evacuation.host_ipv4)
+
+
+def _live_migrate(job):
+    from .migrate import VmMigrateManager
+
+    return VmMigrateManager.run_live_migrate_job(m_task_id=job.params['m_task_id'],
+                                                 cancel_event=get_cancel_event(job.id))
+
+
+def _live_migrate_recover(job):
+    from .migrate import VmMigrateManager
+
+    VmMigrateManager.recover_live_migrate_task(m_task_id=job.params['m_task_id'])
+
+
+def _vm_batch_create(job):
+    from .vm_batch import VmBatchBuilder
+
+    return VmBatchBuilder().run_job_by_id(**job.params, cancel_event=get_cancel_event(job.id))
+
+
+def _vm_batch_create_recover(job):
+    from .vm_batch import VmBatchBuilder
+
+    VmBatchBuilder().recover_job(job_id=job.params['job_id'])
+
+
+def _host_evacuate(job):
+    from .evacuate import HostEvacuator
+
+    return HostEvacuator().run(evacuation_id=job.params['evacuation_id'], cancel_event=get_cancel_event(job.id))
+
+
+def _host_evacuate_recover(job):
+    from .evacuate import HostEvacuator
+
+    HostEvacuator().recover(evacuation_id=job.params['evacuation_id'])
+
+
+# 迁移、批量创建有副作用，执行中断后不重复执行，由回收函数善后
+register_job(LIVE_MIGRATE, handler=_live_migrate, recover=_live_migrate_recover, max_attempts=1,
+             timeout=JOB_LIVE_MIGRATE_TIMEOUT)
+register_job(VM_BATCH_CREATE, handler=_vm_batch_create, recover=_vm_batch_create_recover, max_attempts=1,
+             timeout=JOB_VM_BATCH_CREATE_TIMEOUT)
+register_job(HOST_EVACUATE, handler=_host_evacuate, recover=_host_evacuate_recover, max_attempts=1,
+             timeout=JOB_HOST_EVACUATE_TIMEOUT, host_concurrency=1)
@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import Counter
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TransactionTestCase
+
+from compute.models import Center, Group, Host
+from utils import errors
+from vms.models import Vm, MigrateTask, HostEvacuation, HostEvacuationItem
+from vms.evacuate import HostEvacuator
+
+
+User = get_user_model()
+
+
+class FakeEvacuator(HostEvacuator):
+    """
+    不连接宿主机，迁移只修改虚拟机关联的宿主机，记录同时迁移数
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.running = Counter()
+        self.max_running = Counter()
+
+    @staticmethod
+    def get_migrate_tag(vm):
+        return MigrateTask.Tag.MIGRATE_LIVE if vm.vcpu == 1 else MigrateTask.Tag.MIGRATE_STATIC
+
+    def _submit_migrate(self, executor, evacuation, item, vm, tag, dst_host, cancel_event=None):
+        return executor.submit(self._fake_migrate, vm, dst_host)
+
+    def _fake_migrate(self, vm, dst_host):
+        with self.lock:
+            self.running['src'] += 1
+            self.running[dst_host.id] += 1
+            for key in ['src', dst_host.id]:
+                self.max_running[key] = max(self.max_running[key], self.running[key])
+
+        try:
+            time.sleep(0.05)
+            Vm.objects.filter(uuid=vm.uuid).update(host=dst_host)
+        finally:
+            with self.lock:
+                self.running['src'] -= 1
+                self.running[dst_host.id] -= 1
+            connection.close()
+
+
+class HostEvacuateTests(TransactionTestCase):
+    def setUp(self):
+        center = Center(name='test', location='test')
+        center.save()
+        group = Group(center=center, name='test')
+        group.save(force_insert=True)
+        self.src = Host(group=group, ipv4='10.0.0.1', vcpu_total=64, mem_total=128, vm_limit=100)
+        self.h2 = Host(group=group, ipv4='10.0.0.2', vcpu_total=64, mem_total=128, vm_limit=100)
+        self.h3 = Host(group=group, ipv4='10.0.0.3', vcpu_total=64, mem_total=128, vm_limit=100)
+        self.disabled = Host(group=group, ipv4='10.0.0.4', vcpu_total=64, mem_total=128, vm_limit=100, enable=False)
+        for h in [self.src, self.h2, self.h3, self.disabled]:
+            h.save(force_insert=True)
+
+        self.user = User.objects.create(username='test')
+
+    def add_vms(self, count: int, vcpu: int = 1, mem: int = 2):
+        for i in range(count):
+            Vm(uuid=f'test{vcpu}{i}', name=f'test{i}', vcpu=vcpu, mem=mem, disk=f'test{vcpu}{i}', user=self.user,
+               host=self.src, xml='').save()
+
+    def test_evacuate(self):
+        evacuation = HostEvacuator.evacuate(host_id=self.src.id, user=self.user)
+        self.assertEqual((evacuation.status, evacuation.total), (HostEvacuation.Status.COMPLETE, 0))
+        self.assertFalse(Host.objects.get(id=self.src.id).enable)
+
+        self.add_vms(count=8)
+        self.add_vms(count=2, vcpu=2)
+        self.add_vms(count=1, vcpu=100)     # 没有资源足够的宿主机
+        evacuation = HostEvacuation(id='test', host=self.src, host_ipv4=self.src.ipv4, total=11, src_parallel=4,
+                                    dst_parallel=1)
+        evacuation.save(force_insert=True)
+        HostEvacuationItem.objects.bulk_create([
+            HostEvacuationItem(evacuation=evacuation, vm_uuid=u) for u in Vm.objects.values_list('uuid', flat=True)
+        ])
+
+        evacuator = FakeEvacuator()
+        self.assertEqual(evacuator.run(evacuation_id=evacuation.id), {'status': HostEvacuation.Status.PARTIAL})
+        # 两个可用的目标宿主机，每个同时迁入1个
+        self.assertEqual(evacuator.max_running['src'], 2)
+        self.assertEqual(evacuator.max_running[self.h2.id], 1)
+        self.assertEqual(evacuator.max_running[self.disabled.id], 0)
+
+        progress, items = HostEvacuator.get_progress(evacuation)
+        self.assertEqual(progress, {'pending': 0, 'migrating': 0, 'complete': 10, 'failed': 1})
+        self.assertEqual(Counter(i.tag for i in items if i.status == HostEvacuationItem.Status.COMPLETE),
+                         {MigrateTask.Tag.MIGRATE_LIVE: 8, MigrateTask.Tag.MIGRATE_STATIC: 2})
+        self.assertEqual(Vm.objects.filter(host=self.src).count(), 1)
+        self.assertEqual(HostEvacuator.get_evacuation(host_id=self.src.id).id, evacuation.id)
+
+    def test_evacuate_submit_failed(self):
+        self.add_vms(count=1)
+        with mock.patch('vms.tasks.submit_host_evacuate', side_effect=errors.Error(msg='test')):
+            with self.assertRaises(errors.VmError):
+                HostEvacuator.evacuate(host_id=self.src.id, user=self.user)
+
+        # 提交失败时恢复宿主机停用前的状态
+        self.assertTrue(Host.objects.get(id=self.src.id).enable)
+        self.assertFalse(HostEvacuation.objects.exists())
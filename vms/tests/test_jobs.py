@@ -0,0 +1,130 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from vms.models import Job
+from vms.jobs import JobManager, JobWorker, register_job, get_cancel_event
+
+
+recovered = []
+timeout_events = []
+
+
+def ok_handler(job):
+    return {'x': job.params['x'] * 2}
+
+
+def error_handler(job):
+    raise Exception('test error')
+
+
+def timeout_handler(job):
+    if not get_cancel_event(job.id).wait(10):
+        return {}
+
+    time.sleep(1)   # 中止执行中的操作，超过租约时间
+    timeout_events.append(('handler exit', job.id))
+    raise Exception('aborted')
+
+
+register_job('test_ok', handler=ok_handler, host_concurrency=1)
+register_job('test_retry', handler=error_handler, max_attempts=3, retry_delay=10)
+register_job('test_recover', handler=ok_handler, recover=lambda job: recovered.append(job.id))
+register_job('test_timeout', handler=timeout_handler, timeout=0,
+             recover=lambda job: timeout_events.append(('recover', job.id)))
+
+
+class JobQueueTests(TransactionTestCase):
+    def test_claim(self):
+        jobs = [JobManager.submit('test_ok', params={'x': i}, host_ipv4='10.0.0.1') for i in range(3)]
+        JobManager.submit('test_ok', params={'x': 3}, host_ipv4='10.0.0.2')
+        JobManager.submit('test_ok', params={'x': 4}, delay=3600)
+
+        # 每个宿主机同时执行1个，延迟的任务未到执行时间
+        claimed = JobManager.claim(owner='w1', limit=10, job_types=['test_ok'])
+        self.assertEqual([j.params['x'] for j in claimed], [0, 3])
+        self.assertEqual(claimed[0].attempts, 1)
+        self.assertEqual(JobManager.claim(owner='w2', limit=10, job_types=['test_ok']), [])
+
+        self.assertEqual(JobManager.heartbeat(owner='w2', job_ids=[claimed[0].id]), set())
+        self.assertEqual(JobManager.heartbeat(owner='w1', job_ids=[j.id for j in claimed]), {j.id for j in claimed})
+        self.assertTrue(JobManager.complete(claimed[0], owner='w1', result={'x': 0}))
+        self.assertFalse(JobManager.complete(claimed[0], owner='w1'))
+
+        claimed = JobManager.claim(owner='w2', limit=10, job_types=['test_ok'])
+        self.assertEqual([j.id for j in claimed], [jobs[1].id])
+
+    def test_retry_and_recover(self):
+        job = JobManager.submit('test_retry')
+        self.assertEqual(job.max_attempts, 3)
+        job = JobManager.claim(owner='w1', limit=1, job_types=['test_retry'])[0]
+        self.assertEqual(JobManager.fail(job, owner='w1', error='e1'), Job.Status.PENDING)
+        job.refresh_from_db()
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=5))
+        self.assertEqual(JobManager.claim(owner='w1', limit=1, job_types=['test_retry']), [])
+
+        job.attempts = 3
+        Job.objects.filter(id=job.id).update(status=Job.Status.RUNNING, lease_owner='w1', attempts=3)
+        self.assertEqual(JobManager.fail(job, owner='w1', error='e3'), Job.Status.FAILED)
+
+        # 租约过期：可重试的重新等待，不可重试的失败并善后
+        r1 = JobManager.submit('test_retry')
+        r2 = JobManager.submit('test_recover')
+        claimed = JobManager.claim(owner='w1', limit=10, job_types=['test_retry', 'test_recover'])
+        self.assertEqual(len(claimed), 2)
+        Job.objects.filter(id__in=[r1.id, r2.id]).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(JobManager.recover_expired(), (1, 1))
+        self.assertEqual(Job.objects.get(id=r1.id).status, Job.Status.PENDING)
+        self.assertEqual(Job.objects.get(id=r2.id).status, Job.Status.FAILED)
+        self.assertEqual(recovered, [r2.id])
+        self.assertFalse(JobManager.complete(claimed[1], owner='w1'))
+        self.assertTrue(JobManager.has_active_job('test_retry', ref_id=''))
+
+    def test_worker(self):
+        jobs = [JobManager.submit('test_ok', params={'x': i}) for i in range(5)]
+        failed = JobManager.submit('test_retry')
+        worker = JobWorker(workers=2, lease_seconds=3, poll_interval=0.1, job_types=['test_ok', 'test_retry'])
+
+        def stop_when_done():
+            while Job.objects.filter(status__in=[Job.Status.PENDING], run_after__lte=timezone.now()).exists() \
+                    or Job.objects.filter(status=Job.Status.RUNNING).exists():
+                threading.Event().wait(0.1)
+            worker.stop()
+
+        t = threading.Thread(target=stop_when_done)
+        t.start()
+        worker.run_forever()
+        t.join()
+        for job in jobs:
+            job.refresh_from_db()
+            self.assertEqual(job.status, Job.Status.SUCCEEDED)
+            self.assertEqual(job.result, {'x': job.params['x'] * 2})
+
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.attempts, failed.error), (Job.Status.PENDING, 1, 'test error'))
+
+    def test_timeout_and_recover(self):
+        """
+        超时的任务设置取消事件，执行函数结束前一直续约，结束后才善后，善后只执行一次
+        """
+        job = JobManager.submit('test_timeout')
+        worker = JobWorker(workers=1, lease_seconds=0.6, poll_interval=0.05, recover_interval=0.1,
+                           job_types=['test_timeout'])
+
+        def stop_when_done():
+            while Job.objects.filter(status__in=[Job.Status.PENDING, Job.Status.RUNNING]).exists():
+                threading.Event().wait(0.05)
+            worker.stop()
+
+        t = threading.Thread(target=stop_when_done)
+        t.start()
+        worker.run_forever()
+        t.join()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.FAILED)
+        self.assertIn('任务超时已取消', job.error)
+        self.assertEqual(timeout_events, [('handler exit', job.id), ('recover', job.id)])
+        self.assertFalse(get_cancel_event(job.id).is_set())
@@ -0,0 +1,101 @@
+from django.test import TestCase
+from django.utils import timezone
+
+from utils.ev_libvirt.virt import VmStatsRecord
+from vms.models import VmMetricRing
+from vms.metrics import MetricRing, METRICS, compute_rates, VmMetricsManager, VmMetricsSampler, VM_METRICS_RINGS
+
+
+def new_record(timestamp, cpu_time_abs, disk_bytes=0, disk_reqs=0, net_bytes=0):
+    return VmStatsRecord(
+        timestamp=timestamp, cpu_time_abs=cpu_time_abs, host_cpus=8, guest_cpus=2,
+        total_mem_kb=4096, cur_mem_kb=1024, disk_rd_bytes=disk_bytes, disk_wr_bytes=disk_bytes,
+        net_rx_bytes=net_bytes, net_tx_bytes=net_bytes, vm_uuid='test', state=1,
+        disk_rd_reqs=disk_reqs, disk_wr_reqs=disk_reqs
+    )
+
+
+class MetricsTests(TestCase):
+    def test_compute_rates(self):
+        prev = new_record(timestamp=100, cpu_time_abs=0)
+        cur = new_record(timestamp=110, cpu_time_abs=10 * 10 ** 9, disk_bytes=10240, disk_reqs=100, net_bytes=2048)
+        values = compute_rates(prev=prev, cur=cur)
+        self.assertEqual(len(values), len(METRICS))
+        r = dict(zip(METRICS, values))
+        self.assertEqual(r['cpu_percent'], 50.0)
+        self.assertEqual(r['mem_percent'], 25.0)
+        self.assertEqual(r['disk_rd_iops'], 10.0)
+        self.assertEqual(r['disk_wr_bps'], 1024.0)
+        self.assertEqual(r['net_tx_bps'], 204.8)
+
+        # 计数器重置
+        self.assertIsNone(compute_rates(prev=cur, cur=new_record(timestamp=120, cpu_time_abs=0)))
+        self.assertIsNone(compute_rates(prev=cur, cur=cur))
+
+    def test_ring(self):
+        ring = MetricRing(step=10, size=6)
+        values = [0.0] * len(METRICS)
+        for t in range(0, 100, 5):
+            values[0] = t
+            ring.add(timestamp=t, values=values)
+
+        data = ring.to_bytes()
+        self.assertEqual(len(data), MetricRing.packed_size(6))
+        ring = MetricRing(step=10, size=6, data=data)
+        points = list(ring.points(start=0, end=100))
+        self.assertEqual([p[0] for p in points], [50, 60, 70, 80, 90])   # 只保留最近6个slot中有效的
+        self.assertEqual(points[0][1][0], 52.5)     # 同一slot取平均
+
+        # 大小不匹配的数据丢弃
+        ring = MetricRing(step=10, size=8, data=data)
+        self.assertEqual(list(ring.points(start=0, end=100)), [])
+
+    def test_history(self):
+        now = int(timezone.now().timestamp())
+        ring = MetricRing(step=10, size=360)
+        values = [1.0] * len(METRICS)
+        for t in range(now - 600, now, 10):
+            ring.add(timestamp=t, values=values)
+
+        VmMetricRing(vm_uuid='test', step=10, data=ring.to_bytes(), update_time=timezone.now()).save()
+        r = VmMetricsManager.get_vm_metrics_history(vm_uuid='test', start=now - 300, end=now, step=60)
+        self.assertEqual(r['step'], 60)
+        self.assertEqual(len(r['timestamps']), len(r['metrics']['cpu_percent']))
+        self.assertEqual(r['metrics']['cpu_percent'][1], 1.0)
+
+        r = VmMetricsManager.get_vm_metrics_history(vm_uuid='test', start=now - 300, end=now)
+        self.assertEqual(r['step'], 10)
+
+        # 超出10秒序列保留时间，使用5分钟序列
+        r = VmMetricsManager.get_vm_metrics_history(vm_uuid='test', start=now - 86400, end=now)
+        self.assertEqual(r['step'], 300)
+        self.assertEqual(set(r['metrics']['cpu_percent']), {None})
+
+    def test_sampler_flush(self):
+        now = timezone.now().timestamp()
+        sampler = VmMetricsSampler(flush_interval=0)
+        sampler.ingest([new_record(timestamp=now - 10, cpu_time_abs=0)])
+        self.assertEqual(sampler.flush(), 0)
+        sampler.ingest([new_record(timestamp=now, cpu_time_abs=10 ** 9)])
+        self.assertEqual(sampler.flush(), len(VM_METRICS_RINGS))
+        self.assertEqual(VmMetricRing.objects.filter(vm_uuid='test').count(), len(VM_METRICS_RINGS))
+
+        # 没有新采样点的不再写入
+        self.assertEqual(sampler.flush_all(), 0)
+
+        # 虚拟机没有采集到，写入后从内存移除
+        sampler.ingest([new_record(timestamp=now + 10, cpu_time_abs=2 * 10 ** 9)])
+        sampler.ingest([])
+        self.assertEqual(sampler._rings, {})
+        self.assertEqual(sampler._flushed, {})
+        self.assertEqual(sampler.flush_all(), 0)
+
+        # 已有的记录更新
+        sampler.ingest([new_record(timestamp=now + 20, cpu_time_abs=3 * 10 ** 9)])
+        sampler.ingest([new_record(timestamp=now + 30, cpu_time_abs=4 * 10 ** 9)])
+        self.assertEqual(sampler.flush_all(), len(VM_METRICS_RINGS))
+        self.assertEqual(VmMetricRing.objects.filter(vm_uuid='test').count(), len(VM_METRICS_RINGS))
+        step, size = VM_METRICS_RINGS[0]
+        row = VmMetricRing.objects.get(vm_uuid='test', step=step)
+        points = list(MetricRing(step=step, size=size, data=bytes(row.data)).points(start=int(now), end=int(now) + 60))
+        self.assertEqual(points[-1][1][0], 5.0)
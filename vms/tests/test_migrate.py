@@ -0,0 +1,130 @@
+from datetime import timedelta
+from unittest import mock
+
+import libvirt
+from django.test import TestCase
+from django.utils import timezone
+
+from utils.ev_libvirt.virt import VmDomain, build_migrate_params
+from vms.models import MigrateTask, HostEvacuation, HostEvacuationItem, Job
+from vms import tasks
+from vms.jobs import JobManager
+from vms.migrate import LiveMigrateMonitor, VmMigrateManager
+from utils import errors
+
+
+class FakeDomain:
+    def __init__(self, iterations: list):
+        self.iterations = iterations
+        self.calls = []
+
+    def get_job_stats(self):
+        iteration = self.iterations.pop(0)
+        if iteration is None:
+            return {'type': libvirt.VIR_DOMAIN_JOB_NONE}
+
+        return {
+            'type': libvirt.VIR_DOMAIN_JOB_UNBOUNDED, 'time_elapsed': 1000 * iteration, 'data_total': 4096,
+            'data_processed': 1024 * iteration, 'data_remaining': 4096 - 1024 * iteration, 'memory_dirty_rate': 10,
+            'memory_page_size': 4096, 'memory_iteration': iteration, 'memory_bps': 1024, 'downtime': 300
+        }
+
+    def migrate_set_max_downtime(self, downtime):
+        self.calls.append(('downtime', downtime))
+
+    def migrate_start_postcopy(self):
+        self.calls.append(('postcopy',))
+
+    def abort_job(self):
+        self.calls.append(('abort',))
+
+
+class LiveMigrateTests(TestCase):
+    def new_task(self, options: dict):
+        return MigrateTask.objects.create(
+            vm_uuid='test', src_host_ipv4='10.0.0.1', dst_host_ipv4='10.0.0.2', tag=MigrateTask.Tag.MIGRATE_LIVE,
+            status=MigrateTask.Status.IN_PROCESS, options=options)
+
+    def test_build_migrate_params(self):
+        params, flags = build_migrate_params(options={}, dest_xml='<domain/>')
+        self.assertEqual(params, {libvirt.VIR_MIGRATE_PARAM_DEST_XML: '<domain/>'})
+        self.assertTrue(flags & libvirt.VIR_MIGRATE_PEER2PEER)
+        self.assertFalse(flags & libvirt.VIR_MIGRATE_AUTO_CONVERGE)
+
+        params, flags = build_migrate_params(options={
+            'auto_converge': True, 'postcopy': True, 'compression': 'xbzrle', 'parallel': 4, 'bandwidth': 100})
+        self.assertTrue(flags & libvirt.VIR_MIGRATE_AUTO_CONVERGE)
+        self.assertTrue(flags & libvirt.VIR_MIGRATE_POSTCOPY)
+        self.assertTrue(flags & libvirt.VIR_MIGRATE_COMPRESSED)
+        self.assertTrue(flags & libvirt.VIR_MIGRATE_PARALLEL)
+        self.assertEqual(params[libvirt.VIR_MIGRATE_PARAM_PARALLEL_CONNECTIONS], 4)
+        self.assertEqual(params[libvirt.VIR_MIGRATE_PARAM_BANDWIDTH], 100)
+
+    def test_monitor_abort(self):
+        m_task = self.new_task(options={'max_downtime': 500})
+        domain = FakeDomain(iterations=[1, 2, None])
+        monitor = LiveMigrateMonitor(m_task_id=m_task.id, domain=domain, options=m_task.options)
+
+        progress = monitor.sample()
+        self.assertEqual(progress['dirty_rate'], 10 * 4096)
+        m_task.refresh_from_db()
+        self.assertEqual(m_task.progress['iteration'], 1)
+        self.assertEqual(m_task.progress['data_remaining'], 3072)
+        self.assertIsNotNone(m_task.progress_time)
+
+        VmMigrateManager.abort_live_migrate(m_task)
+        monitor.sample()
+        self.assertEqual(domain.calls, [('downtime', 500), ('abort',)])
+        self.assertTrue(monitor.aborted)
+        self.assertIsNone(monitor.sample())
+
+        m_task.status = MigrateTask.Status.FAILED
+        with self.assertRaises(errors.VmError):
+            VmMigrateManager.abort_live_migrate(m_task)
+
+    def test_monitor_postcopy(self):
+        m_task = self.new_task(options={'postcopy': True, 'postcopy_after': 2})
+        domain = FakeDomain(iterations=[1, 2, 3])
+        monitor = LiveMigrateMonitor(m_task_id=m_task.id, domain=domain, options=m_task.options)
+        monitor.sample()
+        self.assertEqual(domain.calls, [])
+        monitor.sample()
+        self.assertEqual(domain.calls, [('postcopy',)])
+
+        # 切换到post-copy后不能取消
+        m_task.refresh_from_db()
+        self.assertTrue(m_task.progress['postcopy'])
+        with self.assertRaises(errors.VmError):
+            VmMigrateManager.abort_live_migrate(m_task)
+
+        MigrateTask.objects.filter(id=m_task.id).update(abort_requested=True)
+        monitor.sample()
+        self.assertEqual(domain.calls, [('postcopy',)])
+        self.assertFalse(VmDomain.parse_migrate_job_stats({'type': libvirt.VIR_DOMAIN_JOB_NONE})['active'])
+
+    def test_recover_orphaned_skip_evacuating(self):
+        evacuating = self.new_task(options={})
+        orphaned = self.new_task(options={})
+        MigrateTask.objects.filter(id__in=[evacuating.id, orphaned.id]).update(
+            migrate_time=timezone.now() - timedelta(hours=1))
+        evacuation = HostEvacuation.objects.create(
+            id='test', host_ipv4='10.0.0.1', total=1, src_parallel=1, dst_parallel=1)
+        HostEvacuationItem.objects.create(evacuation=evacuation, vm_uuid='test', migrate_task=evacuating,
+                                          status=HostEvacuationItem.Status.MIGRATING)
+        job = JobManager.submit(job_type=tasks.HOST_EVACUATE, params={}, ref_id=evacuation.id)
+
+        with mock.patch.object(VmMigrateManager, 'recover_live_migrate_task', return_value=True) as recover:
+            self.assertEqual(VmMigrateManager.recover_orphaned_tasks(grace_seconds=600), 1)
+            recover.assert_called_once_with(m_task_id=orphaned.id)
+
+            # 疏散任务已结束，迁移任务没有执行者
+            Job.objects.filter(id=job.id).update(status=Job.Status.SUCCEEDED)
+            self.assertEqual(VmMigrateManager.recover_orphaned_tasks(grace_seconds=600), 2)
+
+    def test_after_live_migrated_once(self):
+        m_task = self.new_task(options={})
+        MigrateTask.objects.filter(id=m_task.id).update(status=MigrateTask.Status.COMPLETE)
+        # 已被其他线程处理的迁移任务不再更新宿主机资源
+        VmMigrateManager._after_live_migrated(m_task)
+        m_task.refresh_from_db()
+        self.assertEqual(m_task.status, MigrateTask.Status.COMPLETE)
@@ -0,0 +1,119 @@
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+
+from compute.models import Center, Group, Host, HostTelemetry
+from compute.placement_sim import generate_trace
+from utils.ev_libvirt.virt import VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTOFF
+from vms.models import Vm, MigrateTask, VmDomainState
+from vms.rebalance import HostRebalancer, RebalanceHost, RebalanceVm, RebalanceSimulator, plan_moves
+
+
+User = get_user_model()
+
+
+def new_host(host_id: int, mem_allocated: int, mem_total: int = 100):
+    return RebalanceHost(id=host_id, ipv4=f'10.0.0.{host_id}', vcpu_total=100, vcpu_allocated=0,
+                         mem_total=mem_total, mem_allocated=mem_allocated, vm_limit=100, vm_created=0)
+
+
+class RebalanceTests(TestCase):
+    def test_plan_moves(self):
+        hosts = [new_host(1, mem_allocated=90), new_host(2, mem_allocated=10), new_host(3, mem_allocated=50)]
+        vms = [RebalanceVm(uuid=f'vm{i}', host_id=1, vcpu=1, mem=10) for i in range(9)]
+        vms += [RebalanceVm(uuid='vm-h2', host_id=2, vcpu=1, mem=10)]
+        plan = plan_moves(hosts=hosts, vms=vms, max_moves=10, max_moves_per_host=10, util_weight=0)
+        self.assertEqual(len(plan.moves), 4)
+        self.assertTrue(all(m['src_host_id'] == 1 and m['dst_host_id'] == 2 for m in plan.moves))
+        self.assertAlmostEqual(plan.imbalance_before['spread'], 0.8)
+        self.assertAlmostEqual(plan.imbalance_after['spread'], 0.0)
+        self.assertEqual([h.mem_allocated for h in hosts], [50, 50, 50])
+
+        # 每次运行和每个宿主机的迁移数上限
+        hosts = [new_host(1, mem_allocated=90), new_host(2, mem_allocated=10), new_host(3, mem_allocated=10)]
+        vms = [RebalanceVm(uuid=f'vm{i}', host_id=1, vcpu=1, mem=10) for i in range(9)]
+        plan = plan_moves(hosts=hosts, vms=vms, max_moves=10, max_moves_per_host=3, util_weight=0)
+        self.assertEqual(len(plan.moves), 3)
+        plan = plan_moves(hosts=hosts, vms=vms, max_moves=1, max_moves_per_host=3, util_weight=0)
+        self.assertEqual(len(plan.moves), 1)
+
+        # 目标宿主机资源不足
+        hosts = [new_host(1, mem_allocated=90), new_host(2, mem_allocated=10, mem_total=15)]
+        vms = [RebalanceVm(uuid='vm1', host_id=1, vcpu=1, mem=10)]
+        self.assertEqual(plan_moves(hosts=hosts, vms=vms, util_weight=0).moves, [])
+
+        # 用户反亲和，不迁移到已有同一用户虚拟机的宿主机
+        hosts = [new_host(1, mem_allocated=90), new_host(2, mem_allocated=10), new_host(3, mem_allocated=50)]
+        hosts[0].user_vms.update({1: 4, 2: 5})
+        hosts[1].user_vms.update({1: 1})
+        hosts[2].user_vms.update({1: 1, 2: 1})
+        vms = [RebalanceVm(uuid=f'vm{i}', host_id=1, vcpu=1, mem=10, user_id=1 if i < 4 else 2) for i in range(9)]
+        plan = plan_moves(hosts=hosts, vms=vms, max_moves=10, max_moves_per_host=10, util_weight=0,
+                          anti_affinity=True)
+        moved = {m['vm_uuid']: m['dst_host_id'] for m in plan.moves}
+        self.assertEqual(len(moved), 1)
+        self.assertEqual(list(moved.values()), [2])
+        self.assertTrue(all(uuid not in moved for uuid in ['vm0', 'vm1', 'vm2', 'vm3']))
+        self.assertEqual(hosts[1].user_vms[2], 1)
+
+    def test_plan_group(self):
+        center = Center(name='test', location='test')
+        center.save()
+        group = Group(center=center, name='test')
+        group.save(force_insert=True)
+        hosts = []
+        for i, mem_allocated in enumerate([64, 8, 8]):
+            host = Host(group=group, ipv4=f'10.0.0.{i + 1}', vcpu_total=64, mem_total=128, vm_limit=100,
+                        mem_allocated=mem_allocated)
+            host.save(force_insert=True)
+            hosts.append(host)
+
+        user = User.objects.create(username='test')
+        for i in range(8):
+            Vm(uuid=f'test{i}', name=f'test{i}', vcpu=1, mem=8, disk=f'test{i}', user=user, host=hosts[0],
+               xml='', disk_type=Vm.DiskType.LOCAL if i == 0 else Vm.DiskType.CEPH_RBD).save()
+        Vm(uuid='test-h2', name='test-h2', vcpu=1, mem=8, disk='test-h2', user=user, host=hosts[1], xml='').save()
+        Vm(uuid='test-off', name='test-off', vcpu=1, mem=8, disk='test-off', user=user, host=hosts[0], xml='').save()
+        Vm(uuid='test-unknown', name='test-unknown', vcpu=1, mem=8, disk='test-unknown', user=user, host=hosts[0],
+           xml='').save()
+        # 只有正在运行的虚拟机参与均衡，关机和运行状态未知的不参与
+        for vm in Vm.objects.select_related('host').exclude(uuid='test-unknown'):
+            VmDomainState.objects.create(
+                vm_uuid=vm.hex_uuid, host_ipv4=vm.host.ipv4, update_time=timezone.now(),
+                state=VIR_DOMAIN_SHUTOFF if vm.uuid == 'test-off' else VIR_DOMAIN_RUNNING)
+        MigrateTask.objects.create(vm_uuid='test1', src_host=hosts[0], src_host_ipv4=hosts[0].ipv4,
+                                   dst_host_ipv4=hosts[1].ipv4, status=MigrateTask.Status.WAITING)
+
+        # 第二个宿主机实际内存使用很高，优先迁到第三个宿主机
+        HostTelemetry.objects.create(host_ipv4=hosts[1].ipv4, mem_total=128 * 1024 ** 2,
+                                     mem_free=8 * 1024 ** 2, update_time=timezone.now())
+        r_hosts, r_vms = HostRebalancer.load_group(group)
+        self.assertEqual({v.uuid for v in r_vms}, {f'test{i}' for i in range(2, 8)} | {'test-h2'})
+        self.assertEqual(r_hosts[1].real_mem_used, 120 * 1024 ** 2)
+        self.assertEqual(r_hosts[0].user_vms[user.id], 10)
+
+        rebalancer = HostRebalancer(max_moves=10, max_moves_per_host=10, util_weight=0.5)
+        plan = rebalancer.plan(group)
+        self.assertEqual(plan.group_id, group.id)
+        dst = Counter(m['dst_host_id'] for m in plan.moves)
+        self.assertGreater(dst[hosts[2].id], dst[hosts[1].id])
+        self.assertLess(plan.imbalance_after['stddev'], plan.imbalance_before['stddev'])
+        self.assertTrue(HostRebalancer.is_migrating(group))
+        # dry run不修改数据库
+        self.assertEqual(Vm.objects.filter(host=hosts[0]).count(), 10)
+        self.assertEqual(rebalancer.run_once(group_ids=[group.id], execute=True), [])
+
+        # 用户反亲和宿主机组，目标宿主机已有同一用户的虚拟机，不迁移
+        group.placement_strategy = Group.PlacementStrategy.ANTI_AFFINITY
+        group.save(update_fields=['placement_strategy'])
+        Vm(uuid='test-h3', name='test-h3', vcpu=1, mem=8, disk='test-h3', user=user, host=hosts[2], xml='').save()
+        self.assertEqual(rebalancer.plan(group).moves, [])
+
+    def test_simulator(self):
+        trace = generate_trace(num_events=1000, seed=1)
+        r = RebalanceSimulator(hosts=10, host_mem=128).run(trace=trace, seed=1, max_moves=20, max_moves_per_host=4)
+        self.assertGreater(r['vms'], 0)
+        self.assertLessEqual(r['moves'], 20)
+        self.assertLessEqual(r['after']['stddev'], r['before']['stddev'])
@@ -1,8 +1,12 @@
+from datetime import timedelta
+
 from django.urls import reverse
+from django.utils import timezone
 
-from api.tests import MyAPITestCase, get_or_create_user
+from api.tests import MyAPITestCase, get_or_create_user, get_or_create_host
 
-from vms.models import VmSharedUser
+from vms.models import Vm, VmSharedUser, VmDomainState, VmBatchJob, VmBatchJobItem
+from vms.manager import VmDomainStateManager
 from . import config_res_admin, create_vm_metadata
 
 
@@ -227,3 +231,86 @@ class VmPermTests(MyAPITestCase):
         sh_user.save(update_fields=['permission'])
         response = self.client.post(url)
         self.assertEqual(response.status_code, 500)
+
+    def test_vm_status_batch(self):
+        user1 = get_or_create_user(username='user1@qq.com')
+        vm1 = create_vm_metadata(uuid='test-vm-uuid2', owner=user1)
+
+        self.client.force_login(user1)
+        url = reverse('api:vms-vm-status-batch')
+        response = self.client.post(url, data={'vm_uuids': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(url, data={'vm_uuids': 'test'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        # 没有宿主机和不存在的虚拟机不在结果中
+        response = self.client.post(url, data={'vm_uuids': [vm1.uuid, 'test']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], {})
+
+    def test_vm_domain_state_cache(self):
+        user1 = get_or_create_user(username='user1@qq.com')
+        host = get_or_create_host()
+        vm1 = create_vm_metadata(uuid='testvmuuid2', owner=user1, host=host)
+        vm1 = Vm.objects.select_related('host').get(uuid=vm1.uuid)
+
+        self.assertIsNone(VmDomainStateManager.get_vm_status(vm=vm1))
+        VmDomainStateManager.sync_host_states(host_ipv4=host.ipv4, states={vm1.hex_uuid: 1, 'other': 5})
+        self.assertEqual(VmDomainStateManager.get_vm_status(vm=vm1), (1, 'running'))
+        self.assertEqual(VmDomainState.objects.filter(host_ipv4=host.ipv4).count(), 2)
+
+        # 过期
+        VmDomainState.objects.filter(vm_uuid=vm1.hex_uuid).update(
+            update_time=timezone.now() - timedelta(seconds=120))
+        self.assertIsNone(VmDomainStateManager.get_vm_status(vm=vm1, max_age=60))
+        VmDomainStateManager.touch_host_states(host_ipv4=host.ipv4)
+        self.assertEqual(VmDomainStateManager.get_vm_status(vm=vm1, max_age=60), (1, 'running'))
+
+        # 缓存的宿主机不是虚拟机当前宿主机
+        VmDomainStateManager.set_vm_state(vm_uuid=vm1.hex_uuid, host_ipv4='10.0.0.1', state=5)
+        self.assertIsNone(VmDomainStateManager.get_vm_status(vm=vm1))
+        VmDomainStateManager.delete_vm_state(vm_uuid=vm1.hex_uuid, host_ipv4=host.ipv4)
+        self.assertEqual(VmDomainState.objects.filter(vm_uuid=vm1.hex_uuid).count(), 1)
+
+        VmDomainStateManager.sync_host_states(host_ipv4=host.ipv4, states={vm1.hex_uuid: 5})
+        self.assertEqual(VmDomainStateManager.get_vm_status(vm=vm1), (5, 'shut off'))
+        self.assertEqual(VmDomainState.objects.filter(host_ipv4=host.ipv4).count(), 1)
+        VmDomainStateManager.clear_host_states(host_ipv4=host.ipv4)
+        self.assertIsNone(VmDomainStateManager.get_vm_status(vm=vm1))
+
+    def test_vm_batch_job(self):
+        user1 = get_or_create_user(username='user1@qq.com')
+        self.client.force_login(user1)
+        url = reverse('api:vms-vm-batch-create')
+        response = self.client.post(url, data={'image_id': 1, 'vcpu': 1, 'mem': 1, 'group_id': 1}, format='json')
+        self.assertEqual(response.status_code, 400)     # 没有count
+        response = self.client.post(url, data={'count': 2, 'image_id': 1, 'vcpu': 1, 'mem': 1}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, data={'count': 2, 'image_id': 1, 'vcpu': 1, 'mem': 1, 'group_id': 1,
+                                               'mem_unit': 'GB'}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+        job_id = 'c58ad1b0b3e311eaa4a1c800a0c5e5d1'
+        url = reverse('api:vms-vm-batch-job', kwargs={'job_id': job_id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+        job = VmBatchJob(id=job_id, user=self.res_user, total=2, image_id=1, vcpu=1, mem=1)
+        job.save(force_insert=True)
+        VmBatchJobItem.objects.bulk_create([
+            VmBatchJobItem(job=job, index=0, vm_uuid='test1', status=VmBatchJobItem.Status.COMPLETE),
+            VmBatchJobItem(job=job, index=1, vm_uuid='test2', status=VmBatchJobItem.Status.FAILED, error='test')
+        ])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        self.client.logout()
+        self.client.force_login(self.res_user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['job']['status'], VmBatchJob.Status.RUNNING)
+        self.assertEqual(response.data['progress']['complete'], 1)
+        self.assertEqual(response.data['progress']['failed'], 1)
+        self.assertEqual([i['vm_uuid'] for i in response.data['items']], ['test1', 'test2'])
+        self.assertIsNone(response.data['items'][0]['ipv4'])
@@ -1,6 +1,8 @@
+from unittest import mock
+
 from django.test import TestCase
 
-from utils.ev_libvirt.virt import VmDomain, VirtHost
+from utils.ev_libvirt.virt import VmDomain, VirtHost, VmStatsRecord, VirtConnectionPool
 from vms.xml import XMLEditor
 from vms.xml_builder import VmXMLBuilder
 
@@ -28,6 +30,94 @@ class TestVm(TestCase):
         print(f'defined_domain_num: {r}')
 
 
+class TestVmStatsRecord(TestCase):
+    def test_from_domain_stats(self):
+        stats = {
+            'state.state': 1, 'cpu.time': 123456789, 'vcpu.current': 2,
+            'balloon.current': 4096, 'balloon.unused': 1024,
+            'block.count': 2, 'block.0.rd.bytes': 2048, 'block.0.wr.bytes': 4096,
+            'block.1.rd.bytes': 1024, 'block.1.wr.bytes': 0,
+            'net.count': 1, 'net.0.rx.bytes': 10240, 'net.0.tx.bytes': 5120,
+        }
+        r = VmStatsRecord.from_domain_stats(vm_uuid='test', stats=stats, host_cpus=8, timestamp=1)
+        self.assertEqual(r.vm_uuid, 'test')
+        self.assertEqual(r.cpu_time_abs, 123456789)
+        self.assertEqual(r.guest_cpus, 2)
+        self.assertEqual(r.host_cpus, 8)
+        self.assertEqual(r.total_mem_kb, 4096)
+        self.assertEqual(r.cur_mem_kb, 3072)
+        self.assertEqual(r.disk_rd_kb, 3)
+        self.assertEqual(r.disk_wr_kb, 4)
+        self.assertEqual(r.net_rx_kb, 10)
+        self.assertEqual(r.net_tx_kb, 5)
+        self.assertEqual(r.curr_mem_percent, 75.0)
+
+        # offline
+        stats['state.state'] = 5
+        r = VmStatsRecord.from_domain_stats(vm_uuid='test', stats=stats, host_cpus=8, timestamp=1)
+        self.assertEqual(r.cpu_time_abs, 0)
+        self.assertEqual(r.guest_cpus, 0)
+        self.assertEqual(r.disk_rd_kb, 0)
+        self.assertEqual(r.net_rx_kb, 0)
+
+
+class FakeConn:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.callback_registered = False
+
+    def isAlive(self):
+        return 1 if self.alive else 0
+
+    def setKeepAlive(self, interval, count):
+        pass
+
+    def registerCloseCallback(self, cb, opaque):
+        self.callback_registered = True
+
+    def unregisterCloseCallback(self):
+        self.callback_registered = False
+
+    def close(self):
+        self.closed = True
+
+
+@mock.patch('utils.ev_libvirt.virt.ensure_event_loop', mock.Mock(return_value=True))
+class TestVirtConnectionPool(TestCase):
+    def test_close_removed_conns(self):
+        pool = VirtConnectionPool(max_size=1)
+        c1 = pool.get(host_ipv4='10.0.0.1', opener=FakeConn)
+        self.assertTrue(c1.callback_registered)
+        self.assertIs(pool.get(host_ipv4='10.0.0.1', opener=FakeConn), c1)
+
+        # 被使用的连接移出连接池时不关闭，最后一个引用释放时关闭
+        c2 = pool.get(host_ipv4='10.0.0.2', opener=FakeConn)
+        self.assertEqual(pool.evictions, 1)
+        self.assertFalse(c1.closed)
+        pool.release(c1)
+        self.assertFalse(c1.closed)
+        pool.release(c1)
+        self.assertTrue(c1.closed)
+        self.assertFalse(c1.callback_registered)
+
+        # 没有被使用的连接移出时立即关闭
+        pool.release(c2)
+        pool.invalidate(host_ipv4='10.0.0.2')
+        self.assertTrue(c2.closed)
+        self.assertFalse(c2.callback_registered)
+
+        # close回调中不关闭，之后的连接池操作中关闭
+        c3 = pool.get(host_ipv4='10.0.0.3', opener=FakeConn)
+        pool.release(c3)
+        pool._on_conn_closed(c3, 0, '10.0.0.3')
+        self.assertFalse(c3.closed)
+        c4 = pool.get(host_ipv4='10.0.0.3', opener=FakeConn)
+        self.assertIsNot(c4, c3)
+        self.assertTrue(c3.closed)
+        self.assertEqual(pool.stats()['retired'], 0)
+
+
 class TestXML(TestCase):
 
     def setUp(self):
@@ -0,0 +1,496 @@
+"""
+批量创建虚拟机
+
+请求中一次性申请所有虚拟机的宿主机资源（每个宿主机一条更新语句）和ip，创建任务后立即返回任务ID；
+后台任务执行服务(manage.py run_workers)中用线程池并行克隆系统盘，每个宿主机用一个连接依次定义虚拟机，只回滚失败的虚拟机
+"""
+import logging
+import math
+import random
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from ceph.managers import RadosError
+from compute.managers import GroupManager, HostManager, ComputeError
+from compute.models import Host, Group
+from compute.placement import get_group_placement_strategy
+from network.managers import MacIPManager
+from utils import errors
+from utils.ev_libvirt.virt import VirtHost
+from users.models import UserProfile as User
+from .models import Vm, VmBatchJob, VmBatchJobItem
+from .scheduler import HostMacIPScheduler
+from .vm_builder import VmBuilder
+from . import tasks
+
+
+VM_BATCH_CREATE_MAX = getattr(settings, 'VM_BATCH_CREATE_MAX', 200)
+VM_BATCH_CREATE_WORKERS = getattr(settings, 'VM_BATCH_CREATE_WORKERS', 8)
+
+
+def _close_db_connection(func):
+    """
+    线程池中执行的函数结束后关闭本线程的数据库连接
+    """
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+
+    return wrapper
+
+
+class VmBatchBuilder:
+    """
+    批量创建虚拟机
+    """
+    def __init__(self, logger=None):
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self._builder = VmBuilder()
+        self._host_manager = HostManager()
+        self._macip_manager = MacIPManager()
+
+    def create_vms(self, count: int, image_id: int, vcpu: int, mem: int, user, center_id=None, group_id=None,
+                   host_id=None, vlan_id=None, remarks: str = '', ip_public=None, sys_disk_size: int = None,
+                   owner=None):
+        """
+        批量创建虚拟机，申请资源成功后创建任务，后台创建虚拟机
+
+        :param count: 虚拟机数量
+        :param image_id: 镜像id
+        :param vcpu: cpu数
+        :param mem: 内存大小
+        :param user: 用户对象
+        :param center_id: 数据中心id
+        :param group_id: 宿主机组id
+        :param host_id: 宿主机id
+        :param vlan_id: 子网id
+        :param remarks: 备注
+        :param ip_public: 指定分配公网或私网ip；默认None（不指定），True(公网)，False(私网)
+        :param sys_disk_size: 系统盘大小GB
+        :param owner: 拥有者，默认为用户
+        :return:
+            VmBatchJob()
+
+        :raise VmError
+        """
+        if not (0 < count <= VM_BATCH_CREATE_MAX):
+            raise errors.VmError.from_error(
+                errors.BadRequestError(msg=f'虚拟机数量必须在1-{VM_BATCH_CREATE_MAX}之间'))
+        if vcpu <= 0:
+            raise errors.VmError.from_error(errors.BadRequestError(msg='无法创建虚拟机,vcpu参数无效'))
+        if mem <= 0:
+            raise errors.VmError.from_error(errors.BadRequestError(msg='无法创建虚拟机,men参数无效'))
+        if not ((center_id and center_id > 0) or (group_id and group_id > 0) or (host_id and host_id > 0)):
+            raise errors.VmError.from_error(errors.BadRequestError(
+                msg='无法创建虚拟机,必须指定一个有效center_id或group_id或host_id参数'))
+        if sys_disk_size and sys_disk_size > 5 * 1024:
+            raise errors.VmError(msg='系统盘容量不得大于5TB')
+
+        image = self._builder.get_image(image_id)
+        try:
+            image_size = image.get_size()
+        except Exception as e:
+            raise errors.VmError(msg=f'获取系统镜像大小错误，{str(e)}')
+
+        if sys_disk_size and sys_disk_size < image_size:
+            raise errors.VmSysDiskSizeSmallError(msg='系统盘大小不得小于系统镜像大小')
+
+        try:
+            rbd_manager = image.get_rbd_manager()
+        except Exception as e:
+            raise errors.VmError(msg=str(e))
+
+        vlan = None
+        if vlan_id and vlan_id > 0:
+            vlan = self._builder.get_vlan(vlan_id, user=user)
+            if not vlan.group.user_has_perms(user=user):
+                raise errors.GroupAccessDeniedError(msg='无权限使用指定的vlan资源')
+
+        groups, host_or_none = self._builder.get_groups_host_check_perms(
+            center_id=center_id, group_id=group_id, host_id=host_id, user=user, vlan=vlan)
+
+        vm_owner = owner if owner else user
+        placements = self.claim_hosts(groups=groups, host=host_or_none, vcpu=vcpu, mem=mem, count=count,
+                                      user=vm_owner)
+        try:
+            host_ips = self.claim_ips(placements=placements, vlan=vlan, ip_public=ip_public)
+        except errors.Error as e:
+            for host, n in placements:
+                self._host_manager.free_to_host(host_id=host.id, vcpu=vcpu, mem=mem, count=n)
+            raise errors.VmError.from_error(e)
+
+        job = VmBatchJob(id=uuid.uuid4().hex, user=user, total=count, image_id=image.id, vcpu=vcpu, mem=mem,
+                         remarks=remarks)
+        items = []
+        for host, ips in host_ips:
+            for macip in ips:
+                items.append(VmBatchJobItem(
+                    job=job, index=len(items), vm_uuid=uuid.uuid4().hex, host=host, mac_ip=macip))
+
+        job.save(force_insert=True)
+        VmBatchJobItem.objects.bulk_create(items)
+
+        try:
+            tasks.submit_vm_batch_create(job_id=job.id, image_size=image_size, sys_disk_size=sys_disk_size,
+                                         owner_id=vm_owner.id)
+        except errors.Error as e:
+            self.rollback_items(job=job, items=items, rbd_manager=rbd_manager, error=f'提交任务失败，{str(e)}')
+            self.finish_job(job)
+            raise errors.VmError(msg=f'提交批量创建虚拟机任务失败，{str(e)}')
+
+        return job
+
+    def claim_hosts(self, groups: list, host, vcpu: int, mem: int, count: int, user=None):
+        """
+        按宿主机组的调度策略为count个虚拟机申请宿主机资源，每个宿主机一条更新语句
+
+        best_fit策略尽量集中到排名靠前的宿主机，其他策略每轮每个宿主机最多分配平均数
+
+        :return:
+            [(Host(), n)]
+
+        :raise VmError
+        """
+        if host:
+            targets = [(host.group, Host.objects.filter(id=host.id))]
+        else:
+            group_manager = GroupManager()
+            targets = [(g, group_manager.get_enable_host_queryset_by_group(g)) for g in groups]
+
+        placements = []
+        remain = count
+        try:
+            for group, qs in targets:
+                strategy = get_group_placement_strategy(group)
+                while remain > 0:
+                    ranked = strategy.rank(qs, vcpu=vcpu, mem=mem, user=user)
+                    if not ranked:
+                        break
+
+                    if strategy.name == Group.PlacementStrategy.BEST_FIT:
+                        per_host = remain
+                    else:
+                        per_host = math.ceil(remain / len(ranked))
+
+                    progress = 0
+                    for h in ranked:
+                        n = min(remain, per_host, h.free_vcpu // vcpu, h.free_mem // mem, h.free_vm)
+                        if n <= 0:
+                            continue
+
+                        try:
+                            claimed = self._host_manager.claim_batch_from_host(
+                                host_id=h.id, vcpu=vcpu, mem=mem, count=n)
+                        except ComputeError:    # 资源被并发占用，下一轮重新排序
+                            continue
+
+                        if claimed:
+                            placements.append((claimed, n))
+                            remain -= n
+                            progress += n
+                            if remain <= 0:
+                                break
+
+                    if progress == 0:
+                        break
+
+                if remain <= 0:
+                    break
+        except Exception as e:
+            self._free_placements(placements, vcpu=vcpu, mem=mem)
+            raise errors.VmError(msg=f'申请宿主机资源错误，{str(e)}')
+
+        if remain > 0:
+            self._free_placements(placements, vcpu=vcpu, mem=mem)
+            raise errors.VmError.from_error(
+                errors.NoHostError(msg=f'没有足够资源的宿主机可用，还有{remain}个虚拟机无法分配宿主机'))
+
+        return self._merge_placements(placements)
+
+    def _free_placements(self, placements: list, vcpu: int, mem: int):
+        for host, n in placements:
+            self._host_manager.free_to_host(host_id=host.id, vcpu=vcpu, mem=mem, count=n)
+
+    @staticmethod
+    def _merge_placements(placements: list):
+        merged = {}
+        for host, n in placements:
+            if host.id in merged:
+                merged[host.id] = (host, merged[host.id][1] + n)
+            else:
+                merged[host.id] = (host, n)
+
+        return list(merged.values())
+
+    def claim_ips(self, placements: list, vlan=None, ip_public=None):
+        """
+        为已分配宿主机的虚拟机申请ip，同一宿主机组的一起申请
+
+        :param placements: [(Host(), n)]
+        :param vlan: 指定的子网
+        :param ip_public: 指定分配公网或私网ip；默认None（不指定），True(公网)，False(私网)
+        :return:
+            [(Host(), [MacIP()])]
+
+        :raise NoMacIPError
+        """
+        group_need = {}
+        for host, n in placements:
+            group_need[host.group_id] = group_need.get(host.group_id, 0) + n
+
+        group_ips = {}
+        try:
+            for group_id, need in group_need.items():
+                if vlan:
+                    vlan_list = [vlan]
+                else:
+                    vlan_list = HostMacIPScheduler.get_vlan_list_by_group(group=group_id)
+                    random.shuffle(vlan_list)
+
+                ips = []
+                for v in vlan_list:
+                    if ip_public and not v.is_public():
+                        continue
+                    elif ip_public is not None and not ip_public and v.is_public():
+                        continue
+
+                    ips += self._macip_manager.apply_for_free_ips(vlan_id=v.id, num=need - len(ips))
+                    if len(ips) >= need:
+                        break
+
+                group_ips[group_id] = ips
+                if len(ips) < need:
+                    raise errors.NoMacIPError(msg=f'没有足够的mac ip资源，还缺少{need - len(ips)}个')
+        except errors.Error as e:
+            for ips in group_ips.values():
+                for ip in ips:
+                    self._macip_manager.free_used_ip(ip_id=ip.id)
+
+            if isinstance(e, errors.NoMacIPError):
+                raise e
+
+            raise errors.NoMacIPError(msg=str(e))
+
+        host_ips = []
+        for host, n in placements:
+            ips = group_ips[host.group_id]
+            host_ips.append((host, ips[:n]))
+            group_ips[host.group_id] = ips[n:]
+
+        return host_ips
+
+    def run_job(self, job: VmBatchJob, items: list, image, rbd_manager, image_size: int, sys_disk_size: int,
+                owner, cancel_event=None):
+        """
+        后台执行批量创建任务：线程池并行克隆系统盘，每个宿主机一个连接依次定义虚拟机，失败的虚拟机单独回滚；
+        cancel_event设置后未开始的虚拟机不再创建，回滚
+        """
+        disk_cloned = {}    # {item.id: True}，已克隆系统盘的虚拟机
+        try:
+            self._run_job(job=job, items=items, image=image, rbd_manager=rbd_manager, image_size=image_size,
+                          sys_disk_size=sys_disk_size, owner=owner, disk_cloned=disk_cloned, cancel_event=cancel_event)
+        except Exception as e:
+            self.rollback_items(
+                job=job, items=[i for i in items if i.status != VmBatchJobItem.Status.COMPLETE],
+                rbd_manager=rbd_manager, error=str(e), disk_cloned=disk_cloned)
+        finally:
+            self.finish_job(job)
+            connection.close()
+
+    def run_job_by_id(self, job_id: str, image_size: int, sys_disk_size: int, owner_id: int, cancel_event=None):
+        """
+        后台任务执行服务中执行批量创建任务
+
+        :param cancel_event: 后台任务的取消事件
+        :return:
+            {'status': str}    # 批量创建任务状态
+        """
+        job = VmBatchJob.objects.select_related('user').get(id=job_id)
+        items = list(VmBatchJobItem.objects.select_related('host', 'mac_ip').filter(
+            job=job, status=VmBatchJobItem.Status.PENDING))
+        image = self._builder.get_image(job.image_id)
+        rbd_manager = image.get_rbd_manager()
+        owner = User.objects.get(id=owner_id)
+        self.run_job(job=job, items=items, image=image, rbd_manager=rbd_manager, image_size=image_size,
+                     sys_disk_size=sys_disk_size, owner=owner, cancel_event=cancel_event)
+        return {'status': job.status}
+
+    def recover_job(self, job_id: str):
+        """
+        执行中断的批量创建任务善后：已创建虚拟机的标记成功，其他未完成的回滚
+        """
+        job = VmBatchJob.objects.filter(id=job_id).first()
+        if job is None or job.status != VmBatchJob.Status.RUNNING:
+            return
+
+        items = list(VmBatchJobItem.objects.filter(job=job).exclude(
+            status__in=[VmBatchJobItem.Status.COMPLETE, VmBatchJobItem.Status.FAILED]))
+        created = set(Vm.objects.filter(uuid__in=[i.vm_uuid for i in items]).values_list('uuid', flat=True))
+        rollback = []
+        disk_cloned = {}
+        for item in items:
+            if item.vm_uuid in created:
+                self._set_item_status(item, VmBatchJobItem.Status.COMPLETE)
+            else:
+                disk_cloned[item.id] = item.status != VmBatchJobItem.Status.PENDING    # 可能已克隆系统盘
+                rollback.append(item)
+
+        rbd_manager = None
+        if any(disk_cloned.values()):
+            try:
+                rbd_manager = self._builder.get_image(job.image_id).get_rbd_manager()
+            except Exception:
+                pass
+
+        self.rollback_items(job=job, items=rollback, rbd_manager=rbd_manager, error='任务执行中断',
+                            disk_cloned=disk_cloned)
+        self.finish_job(job)
+
+    def _run_job(self, job, items, image, rbd_manager, image_size, sys_disk_size, owner, disk_cloned: dict,
+                 cancel_event=None):
+        if not sys_disk_size or sys_disk_size <= image_size:
+            sys_disk_size = image_size
+
+        ceph_pool = image.ceph_pool
+        data_pool = ceph_pool.data_pool if ceph_pool.has_data_pool else None
+        rbd_manager.get_cluster()   # 各线程共用一个已连接的集群对象
+
+        def cancelled():
+            return cancel_event is not None and cancel_event.is_set()
+
+        def rollback(r_items: list, error: str):
+            self.rollback_items(job=job, items=r_items, rbd_manager=rbd_manager, error=error,
+                                disk_cloned=disk_cloned)
+
+        def clone_disk(item):
+            if cancelled():
+                rollback([item], error='任务超时，已取消')
+                return
+
+            self._set_item_status(item, VmBatchJobItem.Status.CLONING)
+            try:
+                rbd_manager.clone_image(snap_image_name=image.base_image, snap_name=image.snap,
+                                        new_image_name=item.vm_uuid, data_pool=data_pool)
+                disk_cloned[item.id] = True
+                if sys_disk_size > image_size:
+                    if rbd_manager.resize_rbd_image(image_name=item.vm_uuid, size=sys_disk_size * 1024 ** 3) is not True:
+                        raise errors.VmError(msg='resize system disk size error')
+            except (RadosError, errors.Error) as e:
+                rollback([item], error=f'创建系统盘错误，{str(e)}')
+
+        with ThreadPoolExecutor(max_workers=VM_BATCH_CREATE_WORKERS) as executor:
+            list(executor.map(_close_db_connection(clone_disk), items))
+
+        host_items = {}
+        for item in items:
+            if item.status != VmBatchJobItem.Status.FAILED:
+                host_items.setdefault(item.host_id, []).append(item)
+
+        virt_hosts = {}
+        for host_id, h_items in host_items.items():
+            try:
+                virt_hosts[host_id] = VirtHost(host_ipv4=h_items[0].host.ipv4)
+            except Exception as e:
+                rollback(h_items, error=f'连接宿主机错误，{str(e)}')
+
+        def define_host_vms(host_id):
+            virt_host = virt_hosts[host_id]
+            created = 0
+            for item in host_items[host_id]:
+                if cancelled():
+                    rollback([item], error='任务超时，已取消')
+                    continue
+
+                self._set_item_status(item, VmBatchJobItem.Status.DEFINING)
+                try:
+                    vm = self._builder._create_vm2(
+                        vm_uuid=item.vm_uuid, diskname=item.vm_uuid, vcpu=job.vcpu, mem=job.mem, image=image,
+                        host=item.host, macip=item.mac_ip, user=owner, remarks=job.remarks,
+                        sys_disk_size=sys_disk_size, virt_host=virt_host)
+                except Exception as e:
+                    rollback([item], error=str(e))
+                    continue
+
+                self._set_item_status(item, VmBatchJobItem.Status.COMPLETE)
+                created += 1
+                try:
+                    vm.update_sys_disk_size()  # 系统盘有变化，更新系统盘大小
+                except Exception as e:
+                    self.logger.warning(f'batch job({job.id}) update vm({item.vm_uuid}) sys disk size error, {str(e)}')
+
+            if created:
+                Host.objects.filter(id=host_id).update(vm_created=F('vm_created') + created)
+
+        with ThreadPoolExecutor(max_workers=min(max(len(virt_hosts), 1), VM_BATCH_CREATE_WORKERS)) as executor:
+            list(executor.map(_close_db_connection(define_host_vms), list(virt_hosts)))
+
+    @staticmethod
+    def _set_item_status(item, status: str, error: str = ''):
+        item.status = status
+        item.error = error[:255]
+        VmBatchJobItem.objects.filter(id=item.id).update(status=status, error=item.error, update_time=timezone.now())
+
+    def rollback_items(self, job, items: list, rbd_manager, error: str, disk_cloned: dict = None):
+        """
+        回滚创建失败的虚拟机：释放ip和宿主机资源，删除已克隆的系统盘
+
+        :param disk_cloned: {item.id: bool}，已克隆系统盘的虚拟机，None时都没有克隆
+        """
+        disk_cloned = disk_cloned or {}
+        for item in items:
+            if item.status == VmBatchJobItem.Status.FAILED:
+                continue
+
+            if item.mac_ip_id:
+                self._macip_manager.free_used_ip(ip_id=item.mac_ip_id)
+            if item.host_id:
+                self._host_manager.free_to_host(host_id=item.host_id, vcpu=job.vcpu, mem=job.mem)
+            if rbd_manager is not None and disk_cloned.get(item.id, False):
+                try:
+                    rbd_manager.remove_image(image_name=item.vm_uuid)
+                except RadosError:
+                    pass
+
+            self._set_item_status(item, VmBatchJobItem.Status.FAILED, error=error)
+
+    @staticmethod
+    def finish_job(job: VmBatchJob):
+        """
+        根据各虚拟机的创建结果更新任务状态
+        """
+        completed = VmBatchJobItem.objects.filter(job=job, status=VmBatchJobItem.Status.COMPLETE).count()
+        if completed == job.total:
+            job.status = VmBatchJob.Status.COMPLETE
+        elif completed == 0:
+            job.status = VmBatchJob.Status.FAILED
+        else:
+            job.status = VmBatchJob.Status.PARTIAL
+
+        job.complete_time = timezone.now()
+        job.save(update_fields=['status', 'complete_time'])
+
+    @staticmethod
+    def get_job(job_id: str, user):
+        """
+        查询批量创建任务，只有任务创建者和超级用户可查询
+
+        :return:
+            VmBatchJob()
+
+        :raise NotFoundError, AccessDeniedError
+        """
+        job = VmBatchJob.objects.filter(id=job_id).first()
+        if job is None:
+            raise errors.NotFoundError(msg='批量创建虚拟机任务不存在')
+
+        if not user.is_superuser and job.user_id != user.id:
+            raise errors.AccessDeniedError(msg='你没有权限查询此任务')
+
+        return job
@@ -288,17 +288,20 @@ class VmBuilder:
             groups, host_or_none = self.get_groups_host_check_perms(
                 center_id=center_id, group_id=group_id, host_id=host_id, user=user)
 
+        # owner有效，指定了资源拥有者, 否则拥有者为用户个人
+        vm_owner = owner if owner else user
+
         host = None  # 指示是否分配了宿主机和资源，指示创建失败时释放资源
         try:
-            # 向宿主机申请资源
+            # 向宿主机申请资源，反亲和调度按虚拟机拥有者分散
             scheduler = HostMacIPScheduler()
             try:
                 if macip:
                     host, _ = scheduler.schedule(vcpu=vcpu, mem=mem, groups=groups, host=host_or_none, vlan=vlan,
-                                                 need_mac_ip=False, ip_public=ip_public)
+                                                 need_mac_ip=False, ip_public=ip_public, user=vm_owner)
                 else:
                     host, macip = scheduler.schedule(vcpu=vcpu, mem=mem, groups=groups, host=host_or_none,
-                                                     vlan=vlan, ip_public=ip_public)
+                                                     vlan=vlan, ip_public=ip_public, user=vm_owner)
             except errors.ScheduleError as e:
                 e.msg = f'申请资源错误,{str(e)}'
                 raise errors.VmError.from_error(e)
@@ -319,9 +322,6 @@ class VmBuilder:
             else:
                 sys_disk_size = image_size
 
-            # owner有效，指定了资源拥有者, 否则拥有者为用户个人
-            vm_owner = owner if owner else user
-
             # 创建虚拟机
             vm = self._create_vm2(vm_uuid=vm_uuid, diskname=diskname, vcpu=vcpu, mem=mem, image=image,
                                   host=host, macip=macip, user=vm_owner, remarks=remarks, sys_disk_size=sys_disk_size)
@@ -429,7 +429,7 @@ class VmBuilder:
 
     @staticmethod
     def _create_vm2(vm_uuid: str, diskname: str, vcpu: int, mem: int, image, host, macip, sys_disk_size: int,
-                    user, remarks: str = ''):
+                    user, remarks: str = '', virt_host=None):
         """
         仅创建虚拟机，不会清理传入的各种资源
 
@@ -442,6 +442,7 @@ class VmBuilder:
         :param sys_disk_size: 系统盘大小GB
         :param user: 用户对象
         :param remarks: 虚拟机备注信息
+        :param virt_host: 宿主机连接VirtHost()，批量创建时同一宿主机的虚拟机共用，默认None新建
         :return:
             Vm()
             raise VmError
@@ -467,7 +468,10 @@ class VmBuilder:
 
         # 创建虚拟机
         try:
-            VirtHost(host_ipv4=host.ipv4).define(xml_desc=xml_desc)
+            if virt_host is None:
+                virt_host = VirtHost(host_ipv4=host.ipv4)
+
+            virt_host.define(xml_desc=xml_desc)
         except VirtError as e:
             vm.delete()     # 删除虚拟机元数据
             raise errors.VmError(msg=str(e))
@@ -758,10 +762,10 @@ class VmBuilder:
                 if macip:
                     ip_public = macip.vlan.is_public()
                     host, _ = scheduler.schedule(vcpu=vm.vcpu, mem=vm.mem, groups=groups, host=host_or_none, vlan=vlan,
-                                                 need_mac_ip=False, ip_public=ip_public)
+                                                 need_mac_ip=False, ip_public=ip_public, user=vm.user)
                 else:
                     host, macip = scheduler.schedule(vcpu=vm.vcpu, mem=vm.mem, groups=groups, host=host_or_none,
-                                                     vlan=vlan, ip_public=ip_public)
+                                                     vlan=vlan, ip_public=ip_public, user=vm.user)
             except errors.ScheduleError as e:
                 e.msg = f'申请资源错误,{str(e)}'
                 raise errors.VmError.from_error(e)
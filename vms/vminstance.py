@@ -1080,17 +1080,18 @@ class VmInstance:
 
         return vm
 
-    def live_migrate(self, dest_host_id: int):
+    def live_migrate(self, dest_host_id: int, options: dict = None):
         """
         动态迁移虚拟机
 
         :param dest_host_id: 目标宿主机id
+        :param options: 迁移参数
         :return:
             MigrateTask()   # success
 
         :raises: VmError
         """
-        return VmMigrateManager().live_migrate_vm(vm=self.vm, dest_host_id=dest_host_id)
+        return VmMigrateManager().live_migrate_vm(vm=self.vm, dest_host_id=dest_host_id, options=options)
 
     def get_stats(self):
         """
@@ -0,0 +1,39 @@
+"""
+OpenVPN用户认证服务的客户端，每次登录都会启动一个进程执行，只导入必需的模块
+"""
+import json
+import socket
+
+
+AUTH_SOCKET_PATH = '/var/run/evcloud_openvpn_auth.sock'
+MAX_REQUEST_SIZE = 4096
+
+
+def request(data: dict, socket_path: str = AUTH_SOCKET_PATH, timeout: float = 10):
+    """
+    向认证服务发送请求
+
+    :raise: OSError     # 认证服务不可用
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(data).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline(MAX_REQUEST_SIZE)
+
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise OSError(f'invalid response: {line!r}')
+
+
+def request_auth(username: str, password: str, socket_path: str = AUTH_SOCKET_PATH, timeout: float = 10):
+    """
+    :return:
+        True -> auth passed
+        False -> not passed
+    :raise: OSError     # 认证服务不可用
+    """
+    r = request({'username': username, 'password': password}, socket_path=socket_path, timeout=timeout)
+    return r.get('ok') is True
@@ -0,0 +1,206 @@
+"""
+OpenVPN用户认证服务
+
+常驻进程在Unix socket上提供认证，openvpn的auth-user-pass-verify脚本(00_script/openvpn_auth.py)只需连接socket
+发送用户名密码，不再每次登录都导入配置、连接数据库。
+
+* 数据库查询在固定的几个工作线程中执行，每个线程的数据库连接保持复用；
+* 用户认证信息缓存在内存中，后台线程定期查询vpn_auth表的版本(记录数和最后修改时间)，表有变化时清空缓存。
+
+本模块不依赖django，数据库查询函数由服务启动时传入；客户端见auth_client.py。
+
+请求和响应都是一行json：
+    {"username": "xxx", "password": "xxx"}  ->  {"ok": true}
+    {"cmd": "stats"}                        ->  {"hits": 0, "misses": 0, ...}
+"""
+import hmac
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .auth_client import MAX_REQUEST_SIZE
+
+
+class CredentialCache:
+    """
+    用户认证信息缓存，用户不存在也缓存；表版本变化时清空
+    """
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._data = {}     # {username: (info, expire)}
+        self._lock = threading.Lock()
+        self.version = None
+        self.hits = self.misses = self.clears = 0
+
+    def get(self, username: str):
+        """
+        :return:
+            (True, info)    # 缓存中有，info为None表示用户不存在
+            (False, None)   # 缓存中没有
+        """
+        with self._lock:
+            item = self._data.get(username)
+            if item is not None and item[1] > time.monotonic():
+                self.hits += 1
+                return True, item[0]
+
+            self.misses += 1
+            return False, None
+
+    def set(self, username: str, info, version):
+        with self._lock:
+            if version != self.version:     # 查询期间表有变化
+                return
+
+            self._data[username] = (info, time.monotonic() + self.ttl)
+
+    def set_version(self, version):
+        """
+        :return:
+            True    # 版本变化，已清空缓存
+            False
+        """
+        with self._lock:
+            if version == self.version:
+                return False
+
+            self.version = version
+            self._data.clear()
+            self.clears += 1
+            return True
+
+    def __len__(self):
+        return len(self._data)
+
+
+class VPNAuthService:
+    """
+    认证逻辑，数据库查询在固定的工作线程中执行
+    """
+    def __init__(self, lookup, version, workers: int = 4, check_interval: float = 2, cache_ttl: float = 300,
+                 timeout: float = 10, logger=None):
+        """
+        :param lookup: 查询用户认证信息的函数，参数username，返回{'password': str, 'active': bool}或None
+        :param version: 查询vpn_auth表版本的函数，表有修改时返回值应变化
+        :param workers: 查询数据库的线程数
+        :param check_interval: 检查表版本的间隔(秒)
+        :param cache_ttl: 缓存最长有效时间(秒)
+        :param timeout: 一次认证查询数据库的超时时间(秒)
+        """
+        self._lookup = lookup
+        self._version = version
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.cache = CredentialCache(ttl=cache_ttl)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='vpn-auth-db')
+        self._stopped = threading.Event()
+        self._watcher = None
+        self.passed = self.failed = self.errors = 0
+
+    def check_version(self):
+        try:
+            version = self._executor.submit(self._version).result(timeout=self.timeout)
+        except Exception as e:
+            self.logger.error(f'check vpn_auth version error, {str(e)}')
+            return
+
+        if self.cache.set_version(version):
+            self.logger.info(f'vpn_auth changed, cache cleared, version={version}')
+
+    def _watch(self):
+        while not self._stopped.wait(self.check_interval):
+            self.check_version()
+
+    def start(self):
+        self.check_version()
+        self._watcher = threading.Thread(target=self._watch, name='vpn-auth-watcher', daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._executor.shutdown(wait=False)
+
+    def get_info(self, username: str):
+        """
+        :raise: 数据库查询错误
+        """
+        cached, info = self.cache.get(username)
+        if cached:
+            return info
+
+        version = self.cache.version
+        info = self._executor.submit(self._lookup, username).result(timeout=self.timeout)
+        self.cache.set(username, info, version=version)
+        return info
+
+    def authenticate(self, username: str, password: str):
+        """
+        :return:
+            True -> auth passed
+            False -> not passed
+        """
+        if not username or not password:
+            self.failed += 1
+            return False
+
+        try:
+            info = self.get_info(username)
+        except Exception as e:
+            self.errors += 1
+            self.logger.error(f'get vpn({username}) error, {str(e)}')
+            return False
+
+        if info and info['active'] and hmac.compare_digest(info['password'].encode(), password.encode()):
+            self.passed += 1
+            return True
+
+        self.failed += 1
+        return False
+
+    def stats(self):
+        return {
+            'passed': self.passed, 'failed': self.failed, 'errors': self.errors, 'cached': len(self.cache),
+            'hits': self.cache.hits, 'misses': self.cache.misses, 'clears': self.cache.clears
+        }
+
+
+class AuthRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        service = self.server.service
+        line = self.rfile.readline(MAX_REQUEST_SIZE)
+        try:
+            req = json.loads(line)
+            if req.get('cmd') == 'stats':
+                resp = service.stats()
+            else:
+                resp = {'ok': service.authenticate(username=str(req.get('username', '')),
+                                                   password=str(req.get('password', '')))}
+        except (ValueError, AttributeError):
+            resp = {'ok': False, 'error': 'invalid request'}
+
+        self.wfile.write(json.dumps(resp).encode() + b'\n')
+
+
+class AuthServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 256    # 登录风暴时的连接积压
+
+    def __init__(self, socket_path: str, service: VPNAuthService):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self.service = service
+        super().__init__(socket_path, AuthRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
@@ -0,0 +1,177 @@
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from vpn.auth_client import request, request_auth
+from vpn.auth_server import AuthServer, VPNAuthService
+
+
+# 每次登录启动一个python进程，连接数据库查询(原openvpn_auth.py的方式)
+LEGACY_SCRIPT = """
+import logging, sqlite3, sys, time, traceback
+db_path, latency, username, password = sys.argv[1:5]
+time.sleep(float(latency))
+conn = sqlite3.connect(db_path)
+row = conn.execute('SELECT password, active FROM vpn_auth WHERE username = ?', (username,)).fetchone()
+conn.close()
+sys.exit(0 if row and row[1] and row[0] == password else 1)
+"""
+
+# 每次登录启动一个python进程，请求认证服务(现在openvpn_auth.py的方式)
+CLIENT_SCRIPT = """
+import logging, sys, traceback
+sys.path.insert(0, sys.argv[1])
+from vpn.auth_client import request_auth
+sys.exit(0 if request_auth(sys.argv[3], sys.argv[4], socket_path=sys.argv[2]) else 1)
+"""
+
+
+class SqliteVPNAuth:
+    """
+    sqlite模拟的vpn_auth表，每个线程一个连接，建立连接有模拟的耗时
+    """
+    def __init__(self, db_path: str, connect_latency: float, connects):
+        self.db_path = db_path
+        self.connect_latency = connect_latency
+        self.connects = connects        # multiprocessing.Value
+        self._local = threading.local()
+
+    def connect(self):
+        time.sleep(self.connect_latency)
+        with self.connects.get_lock():
+            self.connects.value += 1
+        return sqlite3.connect(self.db_path)
+
+    def thread_conn(self):
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = self.connect()
+        return self._local.conn
+
+    @staticmethod
+    def query(conn, username):
+        row = conn.execute('SELECT password, active FROM vpn_auth WHERE username = ?', (username,)).fetchone()
+        return {'password': row[0], 'active': bool(row[1])} if row else None
+
+    def lookup(self, username):
+        return self.query(self.thread_conn(), username)
+
+    def version(self):
+        return self.thread_conn().execute('SELECT COUNT(id), MAX(modified_time) FROM vpn_auth').fetchone()
+
+    def legacy_auth(self, username, password):
+        conn = self.connect()
+        try:
+            info = self.query(conn, username)
+        finally:
+            conn.close()
+        return bool(info and info['active'] and info['password'] == password)
+
+
+def serve(db: SqliteVPNAuth, socket_path: str, workers: int, ready):
+    service = VPNAuthService(lookup=db.lookup, version=db.version, workers=workers, check_interval=1)
+    service.start()
+    server = AuthServer(socket_path=socket_path, service=service)
+    ready.set()
+    server.serve_forever()
+
+
+class Command(BaseCommand):
+    '''
+    OpenVPN用户认证性能测试
+    '''
+
+    help = """
+            使用本地sqlite数据库模拟vpn_auth表，对比每次认证新建数据库连接和常驻认证服务(Unix socket，独立进程)两种方式，
+            并发登录时每秒认证数和认证延迟；--process-auths时再对比每次登录启动一个python进程(openvpn调用认证脚本)的情况
+            python manage.py bench_openvpn_auth [--users 500] [--auths 5000] [--concurrency 50] [--connect-latency 5] [--process-auths 200]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', default=500, dest='users', type=int, help='vpn用户数')
+        parser.add_argument('--auths', default=5000, dest='auths', type=int, help='认证次数')
+        parser.add_argument('--concurrency', default=50, dest='concurrency', type=int, help='同时认证数')
+        parser.add_argument('--connect-latency', default=5, dest='connect_latency', type=float,
+                            help='模拟每次建立数据库连接的耗时(毫秒)')
+        parser.add_argument('--workers', default=4, dest='workers', type=int, help='认证服务查询数据库的线程数')
+        parser.add_argument('--process-auths', default=0, dest='process_auths', type=int,
+                            help='每次登录启动一个python进程方式的认证次数，0不测试')
+
+    def handle(self, *args, **options):
+        connect_latency = options['connect_latency'] / 1000
+        users = [(f'user{i}', f'pass{i}') for i in range(options['users'])]
+        logins = [users[i % len(users)] for i in range(options['auths'])]
+        ctx = multiprocessing.get_context('fork')
+        connects = ctx.Value('i', 0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, 'vpn.db')
+            with sqlite3.connect(db_path) as conn:
+                conn.execute('CREATE TABLE vpn_auth (id INTEGER PRIMARY KEY, username VARCHAR(150) UNIQUE, '
+                             'password VARCHAR(64), active BOOL, modified_time INTEGER)')
+                conn.executemany('INSERT INTO vpn_auth (username, password, active, modified_time) VALUES (?, ?, 1, 0)',
+                                 users)
+
+            db = SqliteVPNAuth(db_path=db_path, connect_latency=connect_latency, connects=connects)
+            socket_path = os.path.join(tmpdir, 'auth.sock')
+            ready = ctx.Event()
+            server = ctx.Process(target=serve, args=(db, socket_path, options['workers'], ready), daemon=True)
+            server.start()
+            ready.wait(10)
+            try:
+                modes = [
+                    ('connect-per-auth', db.legacy_auth, logins),
+                    ('auth-server', lambda u, p: request_auth(username=u, password=p, socket_path=socket_path), logins)
+                ]
+                if options['process_auths'] > 0:
+                    process_logins = logins[:options['process_auths']]
+                    modes += [
+                        ('process+connect-per-auth', lambda u, p: subprocess.run(
+                            [sys.executable, '-c', LEGACY_SCRIPT, db_path, str(connect_latency), u, p]
+                        ).returncode == 0, process_logins),
+                        ('process+auth-server', lambda u, p: subprocess.run(
+                            [sys.executable, '-c', CLIENT_SCRIPT, str(settings.BASE_DIR), socket_path, u, p]
+                        ).returncode == 0, process_logins),
+                    ]
+
+                for name, auth, items in modes:
+                    connects.value = 0
+                    r = self.run_auths(auth=auth, logins=items, concurrency=options['concurrency'])
+                    db_connects = '-' if name.startswith('process+connect') else connects.value
+                    self.stdout.write(
+                        f"{name}: auths={len(items)}, elapsed={r['seconds']:.2f}s, "
+                        f"auths/s={len(items) / r['seconds']:.0f}, p50={r['p50'] * 1000:.2f}ms, "
+                        f"p99={r['p99'] * 1000:.2f}ms, db_connects={db_connects}, failed={r['failed']}"
+                    )
+
+                self.stdout.write(f"auth-server stats: {request({'cmd': 'stats'}, socket_path=socket_path)}")
+            finally:
+                server.terminate()
+                server.join()
+
+        self.stdout.write(self.style.SUCCESS('Successfully benchmark openvpn auth.'))
+
+    @staticmethod
+    def run_auths(auth, logins, concurrency: int):
+        def one(login):
+            start = time.monotonic()
+            ok = auth(*login)
+            return time.monotonic() - start, ok
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(one, logins))
+
+        seconds = time.monotonic() - start
+        latencies = sorted(r[0] for r in results)
+        return {
+            'seconds': seconds, 'failed': sum(1 for r in results if not r[1]),
+            'p50': latencies[len(latencies) // 2], 'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        }
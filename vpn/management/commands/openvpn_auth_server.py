@@ -0,0 +1,61 @@
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, Error as DatabaseError
+
+from utils.loggers import config_script_logger
+from vpn.auth_client import AUTH_SOCKET_PATH
+from vpn.auth_server import AuthServer, VPNAuthService
+from vpn.manager import VPNManager
+
+
+def db_call(func, *args):
+    """
+    在工作线程的数据库连接上执行查询，连接失效时重建连接重试一次
+    """
+    try:
+        return func(*args)
+    except DatabaseError:
+        connection.close()
+
+    return func(*args)
+
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+class Command(BaseCommand):
+    '''
+    OpenVPN用户认证服务
+    '''
+
+    help = """
+            常驻的OpenVPN用户认证服务，在Unix socket上提供认证，由00_script/openvpn_auth.py调用
+            python manage.py openvpn_auth_server [--socket /var/run/evcloud_openvpn_auth.sock] [--workers 4] [--check-interval 2]
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=AUTH_SOCKET_PATH, dest='socket', help='Unix socket路径')
+        parser.add_argument('--workers', default=4, dest='workers', type=int, help='查询数据库的线程数(数据库连接数)')
+        parser.add_argument('--check-interval', default=2, dest='check_interval', type=float,
+                            help='检查vpn_auth表是否有修改的间隔（秒），有修改时清空认证信息缓存')
+
+    def handle(self, *args, **options):
+        logger = config_script_logger(name='openvpn-auth-server', filename='openvpn_auth_server.log', stdout=True)
+        service = VPNAuthService(
+            lookup=lambda username: db_call(VPNManager.get_vpn_auth_info, username),
+            version=lambda: db_call(VPNManager.get_vpn_auth_version),
+            workers=options['workers'], check_interval=options['check_interval'], logger=logger
+        )
+        service.start()
+        server = AuthServer(socket_path=options['socket'], service=service)
+        signal.signal(signal.SIGTERM, raise_interrupt)
+        self.stdout.write(self.style.SUCCESS(f'Start openvpn auth server on {options["socket"]}.'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Exit.'))
+        finally:
+            server.server_close()
+            service.stop()
@@ -1,7 +1,7 @@
 from datetime import timedelta
 from django.utils import timezone
 
-from django.db.models import Count
+from django.db.models import Count, Max
 
 from ceph.models import GlobalConfig
 from utils.errors import VPNError
@@ -85,6 +85,28 @@ class VPNManager:
         """
         return GlobalConfig.objects.filter(name='vpnUserConfigCA').first()
 
+    @staticmethod
+    def get_vpn_auth_info(username: str):
+        """
+        vpn用户认证信息
+
+        :return:
+            {'password': str, 'active': bool}   # exists
+            None                                # not exists
+        """
+        return VPNAuth.objects.filter(username=username).values('password', 'active').first()
+
+    @staticmethod
+    def get_vpn_auth_version():
+        """
+        vpn_auth表的版本，增删改记录后会变化
+
+        :return:
+            (count: int, max_id: int, last_modified: datetime)
+        """
+        r = VPNAuth.objects.aggregate(count=Count('id'), max_id=Max('id'), modified=Max('modified_time'))
+        return r['count'], r['max_id'], r['modified']
+
     def vpn_login_num(self):
         """vpn 登录数"""
         one_month_ago = timezone.now() - timedelta(days=30)
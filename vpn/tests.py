@@ -1,3 +1,52 @@
+import os
+import tempfile
+import threading
+
 from django.test import TestCase
 
-# Create your tests here.
+from .auth_client import request, request_auth
+from .auth_server import AuthServer, VPNAuthService
+
+
+class VPNAuthServiceTests(TestCase):
+    def test_auth_server(self):
+        table = {'u1': {'password': 'p1', 'active': True}, 'u2': {'password': 'p2', 'active': False}}
+        state = {'version': 1, 'lookups': 0}
+
+        def lookup(username):
+            state['lookups'] += 1
+            info = table.get(username)
+            return dict(info) if info else None
+
+        service = VPNAuthService(lookup=lookup, version=lambda: state['version'], workers=2, check_interval=60)
+        service.start()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, 'auth.sock')
+            server = AuthServer(socket_path=socket_path, service=service)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                self.assertTrue(request_auth('u1', 'p1', socket_path=socket_path))
+                self.assertFalse(request_auth('u1', 'p2', socket_path=socket_path))
+                self.assertFalse(request_auth('u2', 'p2', socket_path=socket_path))     # 未激活
+                self.assertFalse(request_auth('u3', 'p3', socket_path=socket_path))
+                self.assertFalse(request_auth('u3', 'p3', socket_path=socket_path))
+                self.assertEqual(state['lookups'], 3)   # 缓存，不存在的用户也缓存
+
+                # 表有修改时清空缓存
+                table['u1']['password'] = 'new'
+                table['u3'] = {'password': 'p3', 'active': True}
+                self.assertTrue(request_auth('u1', 'p1', socket_path=socket_path))
+                state['version'] = 2
+                service.check_version()
+                self.assertTrue(request_auth('u1', 'new', socket_path=socket_path))
+                self.assertTrue(request_auth('u3', 'p3', socket_path=socket_path))
+
+                stats = request({'cmd': 'stats'}, socket_path=socket_path)
+                self.assertEqual((stats['passed'], stats['clears']), (4, 2))
+            finally:
+                server.shutdown()
+                server.server_close()
+                service.stop()
+
+        with self.assertRaises(OSError):
+            request_auth('u1', 'p1', socket_path=socket_path)